@@ -0,0 +1,209 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于排队等待
+import asyncio
+# 导入 heapq 模块，用于按优先级排列等待者
+import heapq
+# 导入 itertools 模块，用于生成先来先服务的序号
+import itertools
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 math 模块，用于计算 Retry-After
+import math
+# 导入 time 模块，用于计时
+import time
+# 从 contextlib 导入 asynccontextmanager，用于提供 async with 用法
+from contextlib import asynccontextmanager
+# 从 typing 模块导入类型提示
+from typing import Dict, Optional, List
+
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 优先级类别，数值越小越优先
+PRIORITY_CLASSES = {
+    "interactive": 0,  # 交互式聊天
+    "batch": 1,        # 批量任务
+}
+
+# 默认优先级类别
+DEFAULT_PRIORITY = "interactive"
+
+
+# 准入被拒绝时抛出的异常
+class AdmissionRejected(Exception):
+    """请求未被准入（队列已满、排队超时或超出配额）"""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code  # 建议返回的HTTP状态码（503或429）
+        self.reason = reason  # 拒绝原因
+        self.retry_after = retry_after  # 建议客户端等待的秒数
+
+
+# 定义 AdmissionController 类，在 MCP.handle_request 前进行准入控制
+class AdmissionController:
+    """有界的优先级请求队列
+
+    同时执行的请求数不超过 max_in_flight，排队请求数不超过 max_queued。
+    队列满或排队超时时快速拒绝，并给出 Retry-After 建议。
+    """
+
+    def __init__(self, max_in_flight: int = 32, max_queued: int = 128,
+                 queue_timeouts: Optional[Dict[str, float]] = None,
+                 max_queued_per_consumer: Optional[int] = None):
+        if max_in_flight <= 0:
+            raise ValueError("max_in_flight 必须大于0")
+        if max_queued < 0:
+            raise ValueError("max_queued 不能为负数")
+        self.max_in_flight = max_in_flight  # 最大并发执行数
+        self.max_queued = max_queued  # 最大排队数
+        # 各优先级类别的最长排队时间（秒）
+        self.queue_timeouts = {"interactive": 10.0, "batch": 300.0}
+        if queue_timeouts:
+            self.queue_timeouts.update(queue_timeouts)
+        # 单个调用方最多可占用的排队数，None 表示不限制
+        self.max_queued_per_consumer = max_queued_per_consumer
+        self.in_flight = 0  # 当前执行中的请求数
+        self._waiters: List[list] = []  # 等待堆，元素为 [优先级, 序号, future, 调用方]
+        self._queued = 0  # 有效的排队数（不含已取消的堆元素）
+        self._queued_by_consumer: Dict[str, int] = {}  # 各调用方的排队数
+        self._counter = itertools.count()
+        self._avg_service_time = 1.0  # 请求平均执行时间（指数滑动平均）
+
+    @property
+    def queued(self) -> int:
+        """当前排队中的请求数"""
+        return self._queued
+
+    def _retry_after(self) -> int:
+        """根据队列长度和平均执行时间估算 Retry-After 秒数"""
+        estimate = self._avg_service_time * (self._queued + 1) / self.max_in_flight
+        return max(1, int(math.ceil(estimate)))
+
+    def _reject(self, status_code: int, reason: str, priority: str):
+        retry_after = self._retry_after()
+        metrics.incr("admission_rejected", priority=priority, status=status_code)
+        logger.warning(f"请求未被准入: {reason}，Retry-After={retry_after}")
+        raise AdmissionRejected(status_code, reason, retry_after)
+
+    def _dequeue(self, entry: list):
+        """从排队计数中移除一个等待者"""
+        self._queued -= 1
+        consumer = entry[3]
+        if consumer is not None:
+            left = self._queued_by_consumer.get(consumer, 1) - 1
+            if left > 0:
+                self._queued_by_consumer[consumer] = left
+            else:
+                self._queued_by_consumer.pop(consumer, None)
+
+    async def acquire(self, priority: str = DEFAULT_PRIORITY, consumer: Optional[str] = None,
+                      queue_timeout: Optional[float] = None):
+        """获取执行槽位，必要时排队等待"""
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"未知的优先级类别: {priority}")
+
+        # 有空闲槽位且无人排队时直接执行
+        if self.in_flight < self.max_in_flight and self._queued == 0:
+            self.in_flight += 1
+            metrics.incr("admission_admitted", priority=priority)
+            return
+
+        # 队列已满，快速拒绝
+        if self._queued >= self.max_queued:
+            self._reject(503, "服务繁忙，请求队列已满", priority)
+
+        # 单个调用方的排队配额
+        if consumer is not None and self.max_queued_per_consumer is not None:
+            if self._queued_by_consumer.get(consumer, 0) >= self.max_queued_per_consumer:
+                self._reject(429, f"调用方 {consumer} 的排队请求过多", priority)
+
+        # 进入等待队列
+        future = asyncio.get_running_loop().create_future()
+        entry = [PRIORITY_CLASSES[priority], next(self._counter), future, consumer]
+        heapq.heappush(self._waiters, entry)
+        self._queued += 1
+        if consumer is not None:
+            self._queued_by_consumer[consumer] = self._queued_by_consumer.get(consumer, 0) + 1
+
+        timeout = queue_timeout if queue_timeout is not None else self.queue_timeouts.get(priority)
+        enqueued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            if future.done():
+                # 超时的同时被分配了槽位，视为准入成功
+                pass
+            else:
+                future.cancel()
+                self._dequeue(entry)
+                self._reject(503, "请求排队超时", priority)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 槽位已移交给当前请求，需归还
+                self.release()
+            else:
+                future.cancel()
+                self._dequeue(entry)
+            raise
+
+        metrics.incr("admission_admitted", priority=priority)
+        metrics.incr("admission_queue_seconds", time.monotonic() - enqueued_at, priority=priority)
+
+    def release(self, service_time: Optional[float] = None):
+        """归还执行槽位，并移交给优先级最高的等待者"""
+        if service_time is not None:
+            self._avg_service_time = 0.8 * self._avg_service_time + 0.2 * service_time
+        while self._waiters:
+            entry = heapq.heappop(self._waiters)
+            future = entry[2]
+            if future.done():
+                # 已超时或已取消的等待者
+                continue
+            self._dequeue(entry)
+            # 槽位直接移交，in_flight 保持不变
+            future.set_result(None)
+            return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: str = DEFAULT_PRIORITY, consumer: Optional[str] = None,
+                   queue_timeout: Optional[float] = None):
+        """以 async with 方式占用一个执行槽位"""
+        await self.acquire(priority, consumer, queue_timeout)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def status(self) -> dict:
+        """当前准入状态"""
+        return {
+            "in_flight": self.in_flight,
+            "queued": self._queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+            "queue_timeouts": self.queue_timeouts,
+            "avg_service_time": round(self._avg_service_time, 3)
+        }
@@ -34,18 +34,408 @@ import asyncio
 # 导入 mimetypes 库，用于文件类型猜测
 import mimetypes
 
+# 导入上传文件内联编码的格式化函数
+from media_cache import openai_content_parts, gemini_part, anthropic_image_block, attach_to_last_user
+# 导入 Anthropic 提示缓存断点策略
+from prompt_cache import PromptCachePolicy, with_cache_control
+# 导入服务端上下文缓存管理（Gemini、Moonshot）
+from context_cache import ContextCacheManager, ContextCacheMiss, is_cache_miss
+# 导入上游 HTTP 传输层
+from transport import AiohttpTransport, Transport
+# 导入上游请求的分项超时和截止时间
+from timeouts import timed_session
+
 # 获取一个 logger 实例，用于记录日志
 logger = logging.getLogger(__name__)
 
+# 批量任务的统一状态：进行中、已完成、失败、已过期、已取消
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
 # 定义一个抽象基类 BaseAdapter，继承自 ABC
 class BaseAdapter(ABC):
+    # 是否支持提供商原生的异步批量接口（价格更低、吞吐更高）
+    supports_native_batch = False
+    # 是否需要把本地上传文件内联编码后发送（file_urls 中为 EncodedMedia 或外部URL）
+    inline_media = False
+    # 是否支持服务端上下文缓存，以及可缓存的最短前缀（估算 token）
+    supports_context_cache = False
+    context_cache_min_tokens = 1024
+    # 服务端上下文缓存管理，启用时为 ContextCacheManager 实例
+    context_cache: Optional[ContextCacheManager] = None
+    # 上游 HTTP 传输，未设置时在第一次请求时创建复用连接池的 aiohttp 传输
+    transport: Optional[Transport] = None
+    # 模型列表接口相对 base_url 的路径，None 表示不支持查询模型列表
+    models_path: Optional[str] = None
+
     # 定义一个抽象方法 chat_completion，所有继承此类的子类都必须实现此方法
     @abstractmethod
     async def chat_completion(self, messages: list, model: str) -> str:
         pass
 
+    # 流式聊天补全，逐段产出文本；不支持流式的提供商默认一次性返回完整结果
+    async def stream_chat_completion(self, messages: list, model: str, **kwargs):
+        yield await self.chat_completion(messages, model, **kwargs)
+
+    # 上游请求使用的会话（async with），接口与 aiohttp.ClientSession 相同；
+    # 在 MCP 的调用范围内时，请求的超时由提供商和模型的超时策略及请求的剩余时间预算决定
+    def http_session(self):
+        if self.transport is None:
+            self.transport = AiohttpTransport()
+        return timed_session(self.transport.session())
+
+    # 预热：建立到上游的连接并放入连接池，需要鉴权令牌的提供商覆盖此方法同时获取令牌
+    async def warm_up(self):
+        base_url = getattr(self, "base_url", None)
+        if not base_url:
+            return
+        async with self.http_session() as session:
+            # 任何状态码都说明 DNS 解析、TCP 和 TLS 握手已完成（基础路径通常返回 404 或 401）
+            async with session.head(base_url, timeout=aiohttp.ClientTimeout(10)) as response:
+                await response.read()
+
+    # 模型列表接口的完整地址，不支持时返回 None
+    def models_url(self) -> Optional[str]:
+        return f"{self.base_url}{self.models_path}" if self.models_path else None
+
+    # 查询上游可用的模型ID列表（不产生费用，也用作健康探测）
+    async def list_models(self) -> List[str]:
+        url = self.models_url()
+        if url is None:
+            raise NotImplementedError(f"{type(self).__name__} 不支持查询模型列表")
+        async with self.http_session() as session:
+            async with session.get(url, headers=getattr(self, "headers", None),
+                                   timeout=aiohttp.ClientTimeout(30)) as response:
+                if response.status != 200:
+                    raise Exception(f"查询模型列表失败: {response.status} - {await response.text()}")
+                data = await response.json()
+        # OpenAI/Anthropic 格式为 {"data": [{"id"}]}，Gemini/Cohere/Ollama 格式为 {"models": [{"name"}]}
+        items = data.get("data") or data.get("models") or []
+        models = [item.get("id") or item.get("name") for item in items if isinstance(item, dict)]
+        return [model.split("/", 1)[1] if model.startswith("models/") else model for model in models if model]
+
+    # 释放适配器持有的资源（连接池、服务端缓存等），路由快照退役且使用它的请求全部结束后调用
+    async def aclose(self):
+        if self.context_cache is not None:
+            await self.context_cache.close()
+        if self.transport is not None:
+            await self.transport.aclose()
+
+    # 以下为可选的服务端上下文缓存接口，支持的提供商需覆盖实现
+    async def create_context_cache(self, model: str, prefix: List[dict], ttl: float) -> str:
+        """在服务端缓存开头的系统消息，返回缓存名称或ID"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持上下文缓存")
+
+    async def refresh_context_cache(self, name: str, ttl: float):
+        """把缓存的有效期重置为 ttl 秒"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持上下文缓存")
+
+    async def delete_context_cache(self, name: str):
+        """删除服务端缓存"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持上下文缓存")
+
+    def enable_context_cache(self, **options):
+        """启用服务端上下文缓存，options 传给 ContextCacheManager"""
+        if not self.supports_context_cache:
+            raise ValueError(f"{type(self).__name__} 不支持上下文缓存")
+        options.setdefault("min_tokens", self.context_cache_min_tokens)
+        self.context_cache = ContextCacheManager(self, **options)
+
+    # 以下为可选的原生批量接口，支持的提供商需覆盖实现
+    async def submit_batch(self, requests: List[dict], model: str) -> str:
+        """提交批量任务，requests 中每项包含 custom_id、messages 和可选的聊天参数，返回提供商的批量任务ID"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持原生批量接口")
+
+    async def get_batch_status(self, batch_id: str) -> dict:
+        """查询批量任务状态，返回 {"id", "status", "raw"}，status 取值见 BATCH_TERMINAL_STATUSES 和 in_progress"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持原生批量接口")
+
+    async def fetch_batch_results(self, batch_id: str) -> List[dict]:
+        """获取批量任务结果，返回 [{"custom_id", "status", "content" 或 "error"}]"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持原生批量接口")
+
+    async def cancel_batch(self, batch_id: str):
+        """取消提供商侧的批量任务，尚未执行的请求不再执行（也不再计费）"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持原生批量接口")
+
+# 聊天补全结果：本身就是回复文本，只需要字符串的调用方无需修改，需要时读取附带的用量等信息
+class ChatResult(str):
+    def __new__(cls, text: str = "", usage: Optional[dict] = None, finish_reason: Optional[str] = None,
+                request_id: Optional[str] = None, latency: Optional[float] = None, cache: Optional[dict] = None):
+        obj = super().__new__(cls, text or "")
+        obj.usage = usage or {}  # {"prompt_tokens", "completion_tokens", "total_tokens"}，上游未返回时为空
+        obj.finish_reason = finish_reason  # 结束原因（stop、length 等，按上游原样返回）
+        obj.request_id = request_id  # 上游请求ID，排查问题时提供给服务商
+        obj.latency = latency  # 上游耗时（秒），由 MCP 填写
+        obj.cache = cache  # 语义缓存命中时为 {"id", "similarity"}
+        return obj
+
+    @property
+    def text(self) -> str:
+        return str(self)
+
+    def to_dict(self) -> dict:
+        return {"text": self.text, "usage": self.usage, "finish_reason": self.finish_reason,
+                "request_id": self.request_id, "latency": self.latency, "cache": self.cache}
+
+# 各家响应中 token 用量的位置和字段名：(所在字段, 输入字段名, 输出字段名)，None 表示在顶层
+USAGE_FIELDS = [
+    ("usage", "prompt_tokens", "completion_tokens"),  # OpenAI 兼容接口、百度、智谱等
+    ("usage", "input_tokens", "output_tokens"),  # Anthropic、阿里云
+    ("usageMetadata", "promptTokenCount", "candidatesTokenCount"),  # Google Gemini
+    ("billed_units", "input_tokens", "output_tokens"),  # Cohere（在 meta 中）
+    ("metrics", "input_token_count", "output_token_count"),  # Replicate
+    (None, "prompt_eval_count", "eval_count"),  # Ollama
+]
+
+# 响应头中的上游请求ID
+REQUEST_ID_HEADERS = ("x-request-id", "request-id", "x-acs-request-id", "x-log-id")
+
+def extract_usage(body) -> dict:
+    """从上游响应中提取 token 用量，统一为 prompt_tokens / completion_tokens / total_tokens
+
+    命中或写入提示缓存时另有 cache_read_tokens / cache_write_tokens（已包含在 prompt_tokens 中）。
+    """
+    if not isinstance(body, dict):
+        return {}
+    containers = {
+        None: body,
+        "usage": body.get("usage") or ((body.get("payload") or {}).get("usage") or {}).get("text"),
+        "usageMetadata": body.get("usageMetadata"),
+        "billed_units": (body.get("meta") or {}).get("billed_units"),
+        "metrics": body.get("metrics"),
+    }
+    for container, prompt_field, completion_field in USAGE_FIELDS:
+        data = containers.get(container)
+        if isinstance(data, dict) and (prompt_field in data or completion_field in data):
+            prompt = int(data.get(prompt_field) or 0)
+            completion = int(data.get(completion_field) or 0)
+            usage = {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+            usage.update(_cache_usage(data))
+            return usage
+    return {}
+
+def _cache_usage(data: dict) -> dict:
+    """提示缓存的 token 数：Anthropic 的 input_tokens 不含缓存部分，需要加回 prompt_tokens"""
+    cache = {}
+    read = (data.get("cache_read_input_tokens")  # Anthropic
+            or (data.get("prompt_tokens_details") or {}).get("cached_tokens")  # OpenAI
+            or data.get("prompt_cache_hit_tokens")  # DeepSeek
+            or data.get("cachedContentTokenCount")  # Google Gemini
+            or data.get("cached_tokens"))  # Moonshot
+    write = data.get("cache_creation_input_tokens")  # Anthropic
+    if read:
+        cache["cache_read_tokens"] = int(read)
+    if write:
+        cache["cache_write_tokens"] = int(write)
+    if "cache_read_input_tokens" in data or "cache_creation_input_tokens" in data:
+        extra = cache.get("cache_read_tokens", 0) + cache.get("cache_write_tokens", 0)
+        cache["prompt_tokens"] = int(data.get("input_tokens") or 0) + extra
+        cache["total_tokens"] = cache["prompt_tokens"] + int(data.get("output_tokens") or 0)
+    return cache
+
+def extract_finish_reason(body) -> Optional[str]:
+    """从上游响应中提取结束原因"""
+    if not isinstance(body, dict):
+        return None
+    for key in ("choices", "candidates"):
+        items = body.get(key)
+        if isinstance(items, list) and items and isinstance(items[0], dict):
+            reason = items[0].get("finish_reason") or items[0].get("finishReason")
+            if reason:
+                return reason
+    output = body.get("output")
+    if isinstance(output, dict):
+        return extract_finish_reason(output) or output.get("finish_reason")
+    return body.get("stop_reason") or body.get("finish_reason") or body.get("done_reason")
+
+def chat_result(text, body=None, headers=None) -> ChatResult:
+    """把适配器解析出的文本和上游响应组装为 ChatResult"""
+    request_id = None
+    if headers is not None:
+        request_id = next((headers.get(name) for name in REQUEST_ID_HEADERS if headers.get(name)), None)
+    if not request_id and isinstance(body, dict):
+        request_id = (body.get("id") or body.get("request_id") or body.get("responseId")
+                      or body.get("response_id") or (body.get("header") or {}).get("sid"))
+    return ChatResult(text, usage=extract_usage(body), finish_reason=extract_finish_reason(body),
+                      request_id=str(request_id) if request_id else None)
+
+# 以 SSE 方式调用 OpenAI 兼容的 /chat/completions 接口，逐段产出增量文本
+async def stream_openai_compatible(api_url: str, payload: dict, headers: dict, provider_label: str,
+                                   adapter: Optional["BaseAdapter"] = None):
+    payload = dict(payload, stream=True)
+    async with (adapter.http_session() if adapter is not None else aiohttp.ClientSession()) as session:
+        async with session.post(
+            api_url,
+            json=payload,
+            headers=headers,
+            timeout=aiohttp.ClientTimeout(60)  # 添加超时设置
+        ) as response:
+            if response.status != 200:
+                response_text = await response.text()
+                logger.error(f"{provider_label}流式请求失败，状态码: {response.status}，详情: {response_text}")
+                raise Exception(f"{provider_label} API请求失败: {response.status} - {response_text}")
+            # 逐行读取SSE事件，取消时未读完的连接直接关闭，不放回连接池
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8').strip()
+                if not line.startswith('data:'):
+                    continue
+                data = line[5:].strip()
+                if data == '[DONE]':
+                    break
+                try:
+                    chunk = json.loads(data)
+                except json.JSONDecodeError:
+                    logger.warning(f"{provider_label}流式响应包含无法解析的数据: {data}")
+                    continue
+                choices = chunk.get('choices') or []
+                if choices:
+                    content = (choices[0].get('delta') or {}).get('content')
+                    if content:
+                        yield content
+
+# 把附件以 OpenAI 兼容的 image_url 内容块附加到最后一条用户消息
+def apply_openai_media(messages: list, file_urls: Optional[list]) -> list:
+    if not file_urls:
+        return messages
+    return attach_to_last_user(messages, lambda content: openai_content_parts(content, file_urls))
+
+# 批量请求中允许透传给上游的聊天参数
+BATCH_CHAT_PARAMS = ("temperature", "top_p", "max_tokens")
+
+# 定义 OpenAI 兼容批量接口的混入类（/files + /batches），供 OpenAI、硅基流动、智谱复用
+class OpenAICompatibleBatchMixin:
+    supports_native_batch = True
+    # 批量任务中每行请求调用的端点
+    batch_endpoint = "/v1/chat/completions"
+
+    # 返回批量接口的基础URL（包含版本前缀），由子类实现
+    def _batch_api_base(self) -> str:
+        raise NotImplementedError
+
+    # 返回批量接口的认证请求头（不含 Content-Type，以便上传文件）
+    def _batch_headers(self) -> dict:
+        return {k: v for k, v in self.headers.items() if k.lower() != "content-type"}
+
+    # 将批量请求转换为 JSONL 输入文件
+    def _build_batch_file(self, requests: List[dict], model: str) -> bytes:
+        lines = []
+        for item in requests:
+            body = {"model": model, "messages": item["messages"]}
+            for key in BATCH_CHAT_PARAMS:
+                if item.get(key) is not None:
+                    body[key] = item[key]
+            lines.append(json.dumps({
+                "custom_id": item["custom_id"],
+                "method": "POST",
+                "url": self.batch_endpoint,
+                "body": body
+            }, ensure_ascii=False))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    async def submit_batch(self, requests: List[dict], model: str) -> str:
+        if not requests:
+            raise ValueError("批量请求为空")
+        api_base = self._batch_api_base()
+        headers = self._batch_headers()
+        async with self.http_session() as session:
+            # 第一步：上传输入文件
+            form = aiohttp.FormData()
+            form.add_field("purpose", "batch")
+            form.add_field("file", self._build_batch_file(requests, model),
+                           filename="batch_input.jsonl", content_type="application/jsonl")
+            async with session.post(f"{api_base}/files", data=form, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(300)) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    logger.error(f"批量输入文件上传失败，状态码: {response.status}，详情: {response_text}")
+                    raise Exception(f"批量输入文件上传失败: {response.status} - {response_text}")
+                file_id = json.loads(response_text).get("id")
+                if not file_id:
+                    raise ValueError(f"批量输入文件上传响应缺少id: {response_text}")
+
+            # 第二步：创建批量任务
+            payload = {
+                "input_file_id": file_id,
+                "endpoint": self.batch_endpoint,
+                "completion_window": "24h"
+            }
+            async with session.post(f"{api_base}/batches", json=payload, headers=headers,
+                                    timeout=aiohttp.ClientTimeout(60)) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    logger.error(f"创建批量任务失败，状态码: {response.status}，详情: {response_text}")
+                    raise Exception(f"创建批量任务失败: {response.status} - {response_text}")
+                batch_id = json.loads(response_text).get("id")
+                if not batch_id:
+                    raise ValueError(f"创建批量任务响应缺少id: {response_text}")
+                logger.debug(f"已提交批量任务: {batch_id}, 请求数: {len(requests)}")
+                return batch_id
+
+    async def _get_batch(self, batch_id: str) -> dict:
+        async with self.http_session() as session:
+            async with session.get(f"{self._batch_api_base()}/batches/{batch_id}",
+                                   headers=self._batch_headers(),
+                                   timeout=aiohttp.ClientTimeout(60)) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    raise Exception(f"查询批量任务失败: {response.status} - {response_text}")
+                return json.loads(response_text)
+
+    async def get_batch_status(self, batch_id: str) -> dict:
+        batch = await self._get_batch(batch_id)
+        raw_status = batch.get("status", "")
+        # validating/in_progress/finalizing/cancelling 均视为进行中
+        status = raw_status if raw_status in BATCH_TERMINAL_STATUSES else "in_progress"
+        return {"id": batch_id, "status": status, "raw": batch}
+
+    async def cancel_batch(self, batch_id: str):
+        async with self.http_session() as session:
+            async with session.post(f"{self._batch_api_base()}/batches/{batch_id}/cancel",
+                                    headers=self._batch_headers(),
+                                    timeout=aiohttp.ClientTimeout(60)) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    raise Exception(f"取消批量任务失败: {response.status} - {response_text}")
+                logger.debug(f"已取消批量任务: {batch_id}")
+
+    async def fetch_batch_results(self, batch_id: str) -> List[dict]:
+        batch = await self._get_batch(batch_id)
+        results = []
+        async with self.http_session() as session:
+            for file_key in ("output_file_id", "error_file_id"):
+                file_id = batch.get(file_key)
+                if not file_id:
+                    continue
+                async with session.get(f"{self._batch_api_base()}/files/{file_id}/content",
+                                       headers=self._batch_headers(),
+                                       timeout=aiohttp.ClientTimeout(300)) as response:
+                    response_text = await response.text()
+                    if response.status != 200:
+                        raise Exception(f"下载批量结果失败: {response.status} - {response_text}")
+                for line in response_text.splitlines():
+                    if line.strip():
+                        results.append(self._parse_batch_line(json.loads(line)))
+        return results
+
+    @staticmethod
+    def _parse_batch_line(record: dict) -> dict:
+        custom_id = record.get("custom_id")
+        response = record.get("response") or {}
+        body = response.get("body") or {}
+        if record.get("error") or response.get("status_code") != 200:
+            error = record.get("error") or body.get("error") or body
+            return {"custom_id": custom_id, "status": "failed", "error": str(error)}
+        try:
+            content = body["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            return {"custom_id": custom_id, "status": "failed", "error": f"批量结果格式无效: {body}"}
+        return {"custom_id": custom_id, "status": "succeeded", "content": content, "usage": extract_usage(body)}
+
 # 定义 OllamaAdapter 类，继承自 BaseAdapter
 class OllamaAdapter(BaseAdapter):
+    # 本地已下载的模型
+    models_path = "/api/tags"
+
     # 构造函数，初始化 Ollama 服务的基准 URL
     def __init__(self, base_url="http://localhost:11434"):
         self.base_url = base_url
@@ -61,8 +451,8 @@ class OllamaAdapter(BaseAdapter):
             logger.error("Ollama请求错误: 模型名称无效")
             raise ValueError("模型名称无效")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,  # 模型名称
@@ -95,7 +485,7 @@ class OllamaAdapter(BaseAdapter):
                     
                     # 检查响应格式并提取内容
                     if 'message' in result and 'content' in result['message']:
-                        return result['message']['content']
+                        return chat_result(result['message']['content'], result, response.headers)
                     
                     logger.error(f"无法从Ollama响应中提取文本内容: {result}")
                     return ""
@@ -110,8 +500,13 @@ class OllamaAdapter(BaseAdapter):
                 # 重新抛出异常
                 raise
 
-# 定义 OpenAIAdapter 类，继承自 BaseAdapter
-class OpenAIAdapter(BaseAdapter):
+# 定义 OpenAIAdapter 类，继承自 BaseAdapter，支持原生批量接口
+class OpenAIAdapter(OpenAICompatibleBatchMixin, BaseAdapter):
+    # 本地上传文件以 data URL 内联发送
+    inline_media = True
+    # base_url 已包含 /v1
+    models_path = "/models"
+
     # 构造函数，初始化 OpenAI API 密钥和基准 URL
     def __init__(self, api_key: str, base_url="https://api.openai.com/v1", organization_id=None):
         if not api_key or not isinstance(api_key, str):
@@ -130,6 +525,34 @@ class OpenAIAdapter(BaseAdapter):
             
         logger.debug(f"已初始化OpenAI适配器，API基础URL: {base_url}")
 
+    # OpenAI 的 base_url 已包含 /v1
+    def _batch_api_base(self) -> str:
+        return self.base_url.rstrip('/')
+
+    # 流式聊天补全
+    async def stream_chat_completion(self, messages: list, model: str, temperature=0.7, max_tokens=None, top_p=1.0, frequency_penalty=0, presence_penalty=0, stop=None, file_urls=None):
+        if not messages or not isinstance(messages, list):
+            raise ValueError("消息列表为空或格式不正确")
+        if not model or not isinstance(model, str):
+            raise ValueError("模型名称无效")
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "top_p": top_p,
+            "frequency_penalty": frequency_penalty,
+            "presence_penalty": presence_penalty
+        }
+        if max_tokens is not None and max_tokens > 0:
+            payload["max_tokens"] = max_tokens
+        if stop and (isinstance(stop, str) or isinstance(stop, list)):
+            payload["stop"] = stop
+        if file_urls:
+            payload["messages"] = apply_openai_media(messages, file_urls)
+        async for content in stream_openai_compatible(f"{self.base_url}/chat/completions", payload, self.headers,
+                                                      "OpenAI", adapter=self):
+            yield content
+
     # 实现 chat_completion 抽象方法，用于与 OpenAI 服务进行聊天补全
     async def chat_completion(self, messages: list, model: str, temperature=0.7, max_tokens=None, top_p=1.0, frequency_penalty=0, presence_penalty=0, stop=None, file_urls=None) -> str:
         logger.info(f"[OpenAI] chat_completion called, model={model}, file_urls={file_urls}")
@@ -143,8 +566,8 @@ class OpenAIAdapter(BaseAdapter):
             logger.error("OpenAI请求错误: 模型名称无效")
             raise ValueError("模型名称无效")
             
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,        # 模型名称
@@ -163,10 +586,10 @@ class OpenAIAdapter(BaseAdapter):
                 payload["stop"] = stop
             
             if file_urls:
-                # 假设OpenAI多模态API支持 images 字段
-                payload["images"] = file_urls
+                # 附件以 image_url 内容块附加到最后一条用户消息
+                payload["messages"] = apply_openai_media(messages, file_urls)
             
-            logger.debug(f"[OpenAI] chat_completion payload: {payload}")
+            logger.debug(f"[OpenAI] chat_completion 参数: { {k: v for k, v in payload.items() if k != 'messages'} }")
             
             try:
                 logger.debug(f"向OpenAI发送请求: {model}, 消息数: {len(messages)}")
@@ -210,7 +633,7 @@ class OpenAIAdapter(BaseAdapter):
                         logger.debug(f"OpenAI API使用情况: 输入tokens: {result['usage'].get('prompt_tokens', '未知')}, "
                                    f"输出tokens: {result['usage'].get('completion_tokens', '未知')}")
                         
-                    return choice['message']['content']
+                    return chat_result(choice['message']['content'], result, response.headers)
                     
             except aiohttp.ClientError as e:
                 logger.error(f"OpenAI请求客户端错误: {str(e)}")
@@ -221,8 +644,13 @@ class OpenAIAdapter(BaseAdapter):
 
 # 定义 AnthropicAdapter 类，继承自 BaseAdapter
 class AnthropicAdapter(BaseAdapter):
-    # 构造函数，初始化 Anthropic API 密钥和基准 URL
-    def __init__(self, api_key: str, base_url="https://api.anthropic.com", api_version="2023-06-01"):
+    # 本地上传图片以 base64 图片块内联发送
+    inline_media = True
+    models_path = "/v1/models"
+
+    # 构造函数，初始化 Anthropic API 密钥和基准 URL，prompt_cache 控制是否设置提示缓存断点
+    def __init__(self, api_key: str, base_url="https://api.anthropic.com", api_version="2023-06-01",
+                 prompt_cache: bool = True):
         if not api_key or not isinstance(api_key, str):
             raise ValueError("Anthropic API密钥不能为空且必须是字符串")
             
@@ -235,13 +663,15 @@ class AnthropicAdapter(BaseAdapter):
             "anthropic-version": api_version,  # 添加API版本头
             "Content-Type": "application/json"
         }
+        # 提示缓存断点策略：长会话的稳定前缀按缓存价格计费，并减少首字延迟
+        self.prompt_cache = PromptCachePolicy() if prompt_cache else None
         
         logger.debug(f"已初始化Anthropic适配器，API基础URL: {base_url}, API版本: {api_version}")
 
     # 将OpenAI格式的消息转换为Anthropic格式
     def _convert_messages(self, messages):
         if not messages:
-            return []
+            return [], None
             
         # 提取系统消息（如果存在）
         system_content = None
@@ -264,6 +694,100 @@ class AnthropicAdapter(BaseAdapter):
         
         return chat_messages, system_content
 
+    # Anthropic 支持原生的 Message Batches 接口
+    supports_native_batch = True
+
+    # 提交批量任务到 /v1/messages/batches
+    async def submit_batch(self, requests: List[dict], model: str) -> str:
+        if not requests:
+            raise ValueError("批量请求为空")
+        batch_requests = []
+        for item in requests:
+            chat_messages, system_content = self._convert_messages(item["messages"])
+            params = {
+                "model": model,
+                "messages": chat_messages,
+                "max_tokens": item.get("max_tokens") or 1000
+            }
+            if system_content:
+                params["system"] = system_content
+            for key in ("temperature", "top_p"):
+                if item.get(key) is not None:
+                    params[key] = item[key]
+            batch_requests.append({"custom_id": item["custom_id"], "params": params})
+        async with self.http_session() as session:
+            async with session.post(
+                f"{self.base_url}/v1/messages/batches",
+                json={"requests": batch_requests},
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(300)
+            ) as response:
+                response_text = await response.text()
+                if response.status not in (200, 201):
+                    logger.error(f"Anthropic创建批量任务失败，状态码: {response.status}，详情: {response_text}")
+                    raise Exception(f"Anthropic创建批量任务失败: {response.status} - {response_text}")
+                batch_id = json.loads(response_text).get("id")
+                if not batch_id:
+                    raise ValueError(f"Anthropic批量任务响应缺少id: {response_text}")
+                logger.debug(f"已提交Anthropic批量任务: {batch_id}, 请求数: {len(requests)}")
+                return batch_id
+
+    async def _get_batch(self, batch_id: str) -> dict:
+        async with self.http_session() as session:
+            async with session.get(
+                f"{self.base_url}/v1/messages/batches/{batch_id}",
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(60)
+            ) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    raise Exception(f"Anthropic查询批量任务失败: {response.status} - {response_text}")
+                return json.loads(response_text)
+
+    async def get_batch_status(self, batch_id: str) -> dict:
+        batch = await self._get_batch(batch_id)
+        # processing_status 为 in_progress / canceling / ended
+        status = "completed" if batch.get("processing_status") == "ended" else "in_progress"
+        return {"id": batch_id, "status": status, "raw": batch}
+
+    async def cancel_batch(self, batch_id: str):
+        async with self.http_session() as session:
+            async with session.post(
+                f"{self.base_url}/v1/messages/batches/{batch_id}/cancel",
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(60)
+            ) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    raise Exception(f"Anthropic取消批量任务失败: {response.status} - {response_text}")
+                logger.debug(f"已取消Anthropic批量任务: {batch_id}")
+
+    async def fetch_batch_results(self, batch_id: str) -> List[dict]:
+        batch = await self._get_batch(batch_id)
+        results_url = batch.get("results_url") or f"{self.base_url}/v1/messages/batches/{batch_id}/results"
+        async with self.http_session() as session:
+            async with session.get(results_url, headers=self.headers,
+                                   timeout=aiohttp.ClientTimeout(300)) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    raise Exception(f"Anthropic下载批量结果失败: {response.status} - {response_text}")
+        results = []
+        for line in response_text.splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            result = record.get("result") or {}
+            if result.get("type") == "succeeded":
+                blocks = (result.get("message") or {}).get("content") or []
+                text = "".join(block.get("text", "") for block in blocks if block.get("type") == "text")
+                results.append({"custom_id": record.get("custom_id"), "status": "succeeded", "content": text,
+                                "usage": extract_usage(result.get("message"))})
+            else:
+                # errored / canceled / expired
+                error = result.get("error") or result.get("type", "未知错误")
+                results.append({"custom_id": record.get("custom_id"), "status": "failed", "error": str(error)})
+        return results
+
     # 实现 chat_completion 抽象方法，用于与 Anthropic 服务进行聊天补全
     async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
         # 验证输入
@@ -275,15 +799,33 @@ class AnthropicAdapter(BaseAdapter):
             logger.error("Anthropic请求错误: 模型名称无效")
             raise ValueError("模型名称无效")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 转换消息格式
             chat_messages, system_content = self._convert_messages(messages)
             
             if not chat_messages:
                 logger.error("Anthropic请求错误: 转换后的消息列表为空")
                 raise ValueError("转换后的消息列表为空")
-                
+
+            # 附件以图片块附加到最后一条用户消息，放在文本之前
+            if kwargs.get("file_urls"):
+                blocks = [b for b in (anthropic_image_block(item) for item in kwargs["file_urls"]) if b]
+                chat_messages = attach_to_last_user(
+                    chat_messages,
+                    lambda content: blocks + ([{"type": "text", "text": content}] if isinstance(content, str) else list(content))
+                )
+
+            # 在系统提示和会话的稳定前缀上设置缓存断点
+            if self.prompt_cache is not None:
+                cache_system, breakpoints = self.prompt_cache.plan(model, system_content, chat_messages)
+                if cache_system:
+                    system_content = with_cache_control(system_content)
+                for index in breakpoints:
+                    chat_messages[index] = dict(chat_messages[index],
+                                                content=with_cache_control(chat_messages[index]["content"]))
+                logger.debug(f"Anthropic提示缓存: 系统提示={cache_system}, 断点={breakpoints}")
+
             # 构建请求体 payload
             payload = {
                 "model": model,         # 模型名称
@@ -334,11 +876,11 @@ class AnthropicAdapter(BaseAdapter):
                     # 提取文本内容
                     for content_item in result['content']:
                         if content_item.get('type') == 'text':
-                            return content_item.get('text', '')
+                            return chat_result(content_item.get('text', ''), result, response.headers)
                     
                     # 如果没有找到文本内容，使用旧版格式尝试
                     if result['content'][0].get('text'):
-                        return result['content'][0]['text']
+                        return chat_result(result['content'][0]['text'], result, response.headers)
                         
                     logger.warning(f"无法从Anthropic响应中提取文本内容: {result}")
                     return ""
@@ -379,8 +921,8 @@ class MetaAdapter(BaseAdapter):
             logger.error("Meta请求错误: 模型名称无效")
             raise ValueError("模型名称无效")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 验证消息格式
             valid_messages = []
             for msg in messages:
@@ -459,7 +1001,7 @@ class MetaAdapter(BaseAdapter):
                         logger.debug(f"Meta API使用情况: 输入tokens: {result['usage'].get('prompt_tokens', '未知')}, "
                                    f"输出tokens: {result['usage'].get('completion_tokens', '未知')}")
                     
-                    return choice['message']['content']
+                    return chat_result(choice['message']['content'], result, response.headers)
                     
             except aiohttp.ClientError as e:
                 # 捕获 aiohttp 客户端错误
@@ -472,6 +1014,13 @@ class MetaAdapter(BaseAdapter):
 
 # 定义 GoogleAdapter 类，继承自 BaseAdapter
 class GoogleAdapter(BaseAdapter):
+    # 本地上传文件以 inline_data 内联发送
+    inline_media = True
+    models_path = "/v1beta/models"
+    # 支持 cachedContents 上下文缓存（Gemini 1.5 要求至少 32768 tokens，更新的模型要求更低，过短时创建失败后退避）
+    supports_context_cache = True
+    context_cache_min_tokens = 4096
+
     # 构造函数，初始化 Google API 密钥和基准 URL
     def __init__(self, api_key: str, base_url="https://generativelanguage.googleapis.com"):
         self.base_url = base_url
@@ -489,8 +1038,52 @@ class GoogleAdapter(BaseAdapter):
         
         logger.debug(f"已初始化Google适配器，API基础URL: {base_url}")
 
+    # 在 cachedContents 中缓存系统消息
+    async def create_context_cache(self, model: str, prefix: List[dict], ttl: float) -> str:
+        payload = {
+            "model": f"models/{model}",
+            "systemInstruction": {"parts": [{"text": msg["content"]} for msg in prefix if msg.get("content")]},
+            "ttl": f"{int(ttl)}s"
+        }
+        async with self.http_session() as session:
+            async with session.post(f"{self.base_url}/v1beta/cachedContents", json=payload,
+                                    headers=self.headers, timeout=aiohttp.ClientTimeout(60)) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    raise Exception(f"Google Gemini创建上下文缓存失败: {response.status} - {response_text}")
+                name = json.loads(response_text).get("name")
+                if not name:
+                    raise ValueError(f"Google Gemini上下文缓存响应缺少name: {response_text}")
+                return name
+
+    async def refresh_context_cache(self, name: str, ttl: float):
+        async with self.http_session() as session:
+            async with session.patch(f"{self.base_url}/v1beta/{name}", params={"updateMask": "ttl"},
+                                     json={"ttl": f"{int(ttl)}s"}, headers=self.headers,
+                                     timeout=aiohttp.ClientTimeout(30)) as response:
+                if response.status != 200:
+                    raise Exception(f"Google Gemini上下文缓存续期失败: {response.status} - {await response.text()}")
+
+    async def delete_context_cache(self, name: str):
+        async with self.http_session() as session:
+            async with session.delete(f"{self.base_url}/v1beta/{name}", headers=self.headers,
+                                      timeout=aiohttp.ClientTimeout(30)) as response:
+                if response.status not in (200, 204, 404):
+                    raise Exception(f"Google Gemini删除上下文缓存失败: {response.status} - {await response.text()}")
+
     # 实现 chat_completion 抽象方法，用于与 Google 服务进行聊天补全
-    async def chat_completion(self, messages: list, model: str, temperature: float = 0.7, top_p: float = 1.0, top_k: int = 0, max_output_tokens: int = 1024, stop_sequences: Optional[list] = None, file_urls=None) -> str:
+    async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
+        # 统一的 max_tokens 参数（配置、MCP.complete）对应 Gemini 的 maxOutputTokens
+        max_tokens = kwargs.pop('max_tokens', None)
+        if max_tokens:
+            kwargs.setdefault('max_output_tokens', max_tokens)
+        # 启用上下文缓存时，开头的系统消息由服务端缓存提供
+        if self.context_cache is not None:
+            return await self.context_cache.run(
+                model, messages, lambda msgs, entry: self._generate_content(msgs, model, cache_entry=entry, **kwargs))
+        return await self._generate_content(messages, model, **kwargs)
+
+    async def _generate_content(self, messages: list, model: str, temperature: float = 0.7, top_p: float = 1.0, top_k: int = 0, max_output_tokens: int = 1024, stop_sequences: Optional[list] = None, file_urls=None, cache_entry=None) -> str:
         # Gemini多模态严格适配
         contents = []
         for msg in messages:
@@ -499,19 +1092,13 @@ class GoogleAdapter(BaseAdapter):
             # 文本内容
             if msg.get("content"):
                 parts.append({"text": msg["content"]})
-            # 如果是用户消息且有 file_urls，则插入图片parts
-            if role == "user" and file_urls:
-                for url in file_urls:
-                    mime_type, _ = mimetypes.guess_type(url)
-                    if not mime_type:
-                        mime_type = "image/png"  # 默认
-                    parts.append({
-                        "file_data": {
-                            "mime_type": mime_type,
-                            "file_uri": url
-                        }
-                    })
             contents.append({"role": role, "parts": parts})
+        # 附件属于本轮提问，插入到最后一条用户消息：本地上传文件为 inline_data，外部URL为 file_data
+        if file_urls:
+            for content in reversed(contents):
+                if content["role"] == "user":
+                    content["parts"].extend(gemini_part(item) for item in file_urls)
+                    break
         payload = {
             "model": model,
             "contents": contents,
@@ -524,8 +1111,10 @@ class GoogleAdapter(BaseAdapter):
         }
         if stop_sequences and isinstance(stop_sequences, list):
             payload["generationConfig"]["stopSequences"] = stop_sequences
+        if cache_entry is not None:
+            payload["cachedContent"] = cache_entry.name
         # ... existing code for aiohttp request ...
-        async with aiohttp.ClientSession() as session:
+        async with self.http_session() as session:
             try:
                 async with session.post(
                     f"{self.base_url}/v1beta/models/{model}:generateContent",
@@ -535,6 +1124,10 @@ class GoogleAdapter(BaseAdapter):
                 ) as response:
                     response_text = await response.text()
                     if response.status != 200:
+                        # 缓存不存在或已过期时返回 403 "CachedContent not found (or permission denied)" 或 404
+                        if cache_entry is not None and is_cache_miss(response.status, response_text, (400, 403, 404),
+                                                                     ("cachedcontent", "cached content")):
+                            raise ContextCacheMiss(f"{response.status} - {response_text}")
                         logger.error(f"Google Gemini请求失败，状态码: {response.status}，详情: {response_text}")
                         raise Exception(f"Google Gemini API请求失败: {response.status} - {response_text}")
                     try:
@@ -548,26 +1141,30 @@ class GoogleAdapter(BaseAdapter):
                         if 'content' in candidate and 'parts' in candidate['content']:
                             parts = candidate['content']['parts']
                             if parts and 'text' in parts[0]:
-                                return parts[0]['text']
+                                return chat_result(parts[0]['text'], result, response.headers)
                         elif 'content' in candidate:
                             content = candidate['content']
                             if isinstance(content, str):
-                                return content
+                                return chat_result(content, result, response.headers)
                         elif 'parts' in candidate and candidate['parts']:
                             text_content = "".join([part['text'] for part in candidate['parts'] if 'text' in part])
                             if text_content:
-                                return text_content
+                                return chat_result(text_content, result, response.headers)
                     logger.warning(f"无法从Google Gemini API响应提取文本内容: {result}")
                     return "无法获取有效响应"
             except aiohttp.ClientError as e:
                 logger.error(f"Google Gemini请求客户端错误: {str(e)}")
                 raise
+            except ContextCacheMiss:
+                raise
             except Exception as e:
                 logger.error(f"Google Gemini请求发生未知错误: {str(e)}")
                 raise
 
 # 定义 CohereAdapter 类，继承自 BaseAdapter
 class CohereAdapter(BaseAdapter):
+    models_path = "/v1/models"
+
     # 构造函数，初始化 Cohere API 密钥和基准 URL
     def __init__(self, api_key: str, base_url="https://api.cohere.ai"):
         if not api_key or not isinstance(api_key, str):
@@ -643,8 +1240,8 @@ class CohereAdapter(BaseAdapter):
             logger.error("Cohere请求错误: 当前消息为空")
             raise ValueError("当前消息为空")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload - 使用正确的Cohere API格式
             payload = {
                 "model": model,  # 模型名称
@@ -689,7 +1286,7 @@ class CohereAdapter(BaseAdapter):
                     
                     # 检查响应格式并提取内容
                     if 'text' in result:
-                        return result['text']
+                        return chat_result(result['text'], result, response.headers)
                     
                     # 记录使用信息（如果存在）
                     if 'meta' in result and 'billed_units' in result['meta']:
@@ -724,8 +1321,60 @@ class ReplicateAdapter(BaseAdapter):
             "Content-Type": "application/json"
         }
         
+        self._cancelling = set()  # 后台发送中的取消预测请求
         logger.debug(f"已初始化Replicate适配器，API基础URL: {base_url}")
 
+    # 创建预测，返回预测ID
+    async def _create_prediction(self, payload: dict) -> str:
+        async with self.http_session() as session:
+            async with session.post(
+                f"{self.base_url}/v1/predictions",
+                json=payload,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(60)  # 添加超时设置
+            ) as response:
+                response_text = await response.text()
+                
+                # 检查响应状态码
+                if response.status != 201:  # Replicate创建预测返回201
+                    logger.error(f"Replicate创建预测失败，状态码: {response.status}，详情: {response_text}")
+                    raise Exception(f"Replicate API创建预测失败: {response.status} - {response_text}")
+                
+                # 解析 JSON 响应
+                try:
+                    result = await response.json()
+                except Exception as e:
+                    logger.error(f"Replicate响应JSON解析失败: {str(e)}, 原始响应: {response_text}")
+                    raise ValueError(f"无法解析Replicate API响应: {str(e)}")
+                
+                # 获取预测ID
+                if 'id' not in result:
+                    logger.error(f"Replicate响应缺少预测ID: {result}")
+                    raise ValueError("Replicate响应缺少预测ID")
+                
+                logger.debug(f"Replicate预测ID: {result['id']}")
+                return result['id']
+
+    # 取消预测，避免客户端离开后上游继续生成；created 为创建预测的任务，请求在创建过程中被取消时等它拿到预测ID
+    async def _cancel_prediction(self, created: asyncio.Future):
+        try:
+            prediction_id = await created
+            async with self.http_session() as session:
+                async with session.post(
+                    f"{self.base_url}/v1/predictions/{prediction_id}/cancel",
+                    headers=self.headers,
+                    timeout=aiohttp.ClientTimeout(10)
+                ) as response:
+                    logger.debug(f"Replicate取消预测 {prediction_id}，状态码: {response.status}")
+        except Exception as e:
+            logger.warning(f"Replicate取消预测失败: {str(e)}")
+
+    # 等待后台的取消请求发送完成，再释放连接池
+    async def aclose(self):
+        if self._cancelling:
+            await asyncio.gather(*self._cancelling, return_exceptions=True)
+        await super().aclose()
+
     # 实现 chat_completion 抽象方法，用于与 Replicate 服务进行聊天补全
     async def chat_completion(self, messages: list, model: str, temperature=0.7, max_tokens=1024) -> str:
         # 验证输入
@@ -754,8 +1403,8 @@ class ReplicateAdapter(BaseAdapter):
             logger.error("Replicate请求错误: 转换后的消息列表为空")
             raise ValueError("转换后的消息列表为空")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload - 创建预测请求
             payload = {
                 "version": model,  # 模型版本
@@ -766,37 +1415,11 @@ class ReplicateAdapter(BaseAdapter):
                 }
             }
             
+            # 第一步：创建预测（在独立任务中执行，请求在创建过程中被取消时仍能拿到预测ID并取消预测）
+            logger.debug(f"向Replicate发送预测请求: {model}, 消息数: {len(valid_messages)}")
+            created = asyncio.ensure_future(self._create_prediction(payload))
             try:
-                logger.debug(f"向Replicate发送预测请求: {model}, 消息数: {len(valid_messages)}")
-                
-                # 第一步：创建预测
-                async with session.post(
-                    f"{self.base_url}/v1/predictions",
-                    json=payload,
-                    headers=self.headers,
-                    timeout=aiohttp.ClientTimeout(60)  # 添加超时设置
-                ) as response:
-                    response_text = await response.text()
-                    
-                    # 检查响应状态码
-                    if response.status != 201:  # Replicate创建预测返回201
-                        logger.error(f"Replicate创建预测失败，状态码: {response.status}，详情: {response_text}")
-                        raise Exception(f"Replicate API创建预测失败: {response.status} - {response_text}")
-                    
-                    # 解析 JSON 响应
-                    try:
-                        result = await response.json()
-                    except Exception as e:
-                        logger.error(f"Replicate响应JSON解析失败: {str(e)}, 原始响应: {response_text}")
-                        raise ValueError(f"无法解析Replicate API响应: {str(e)}")
-                    
-                    # 获取预测ID
-                    if 'id' not in result:
-                        logger.error(f"Replicate响应缺少预测ID: {result}")
-                        raise ValueError("Replicate响应缺少预测ID")
-                    
-                    prediction_id = result['id']
-                    logger.debug(f"Replicate预测ID: {prediction_id}")
+                prediction_id = await asyncio.shield(created)
                 
                 # 第二步：轮询预测结果
                 max_attempts = 30  # 最大轮询次数
@@ -829,12 +1452,12 @@ class ReplicateAdapter(BaseAdapter):
                             output = prediction_result.get('output')
                             if output:
                                 if isinstance(output, list) and len(output) > 0:
-                                    return output[0]  # 返回第一个输出
+                                    return chat_result(output[0], prediction_result, response.headers)  # 返回第一个输出
                                 elif isinstance(output, str):
-                                    return output
+                                    return chat_result(output, prediction_result, response.headers)
                                 else:
                                     logger.error(f"Replicate输出格式异常: {output}")
-                                    return str(output)
+                                    return chat_result(str(output), prediction_result, response.headers)
                             else:
                                 logger.error(f"Replicate预测成功但输出为空: {prediction_result}")
                                 return ""
@@ -858,6 +1481,12 @@ class ReplicateAdapter(BaseAdapter):
                 logger.error(f"Replicate预测超时，预测ID: {prediction_id}")
                 raise Exception("Replicate预测超时")
                     
+            except asyncio.CancelledError:
+                # 请求在创建或轮询过程中被取消（例如客户端断开），通知上游取消预测
+                cancelling = asyncio.ensure_future(self._cancel_prediction(created))
+                self._cancelling.add(cancelling)
+                cancelling.add_done_callback(self._cancelling.discard)
+                raise
             except aiohttp.ClientError as e:
                 # 捕获 aiohttp 客户端错误
                 logger.error(f"Replicate请求客户端错误: {str(e)}")
@@ -922,8 +1551,8 @@ class AliyunAdapter(BaseAdapter):
             logger.error("阿里云请求错误: 转换后的消息列表为空")
             raise ValueError("转换后的消息列表为空")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload - 使用正确的阿里云通义千问API格式
             payload = {
                 "model": model,  # 模型名称
@@ -972,7 +1601,7 @@ class AliyunAdapter(BaseAdapter):
                     if 'choices' in result and result['choices']:
                         choice = result['choices'][0]
                         if 'message' in choice and 'content' in choice['message']:
-                            return choice['message']['content']
+                            return chat_result(choice['message']['content'], result, response.headers)
                     
                     # 记录使用信息（如果存在）
                     if 'usage' in result:
@@ -1018,9 +1647,9 @@ class BaiduAdapter(BaseAdapter):
             return self.access_token
 
         # 构建请求 URL
-        url = f"https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id={self.api_key}&client_secret={self.secret_key}"
+        url = f"{self.base_url}/oauth/2.0/token?grant_type=client_credentials&client_id={self.api_key}&client_secret={self.secret_key}"
         
-        async with aiohttp.ClientSession() as session:
+        async with self.http_session() as session:
             try:
                 # 发送 POST 请求获取访问令牌
                 async with session.post(url) as response:
@@ -1049,6 +1678,10 @@ class BaiduAdapter(BaseAdapter):
                 logger.error(f"获取百度访问令牌时发生错误: {str(e)}")
                 raise
 
+    # 预热时获取访问令牌，令牌请求同时建立了到上游的连接
+    async def warm_up(self):
+        await self._get_access_token()
+
     # 实现 chat_completion 抽象方法，用于与百度服务进行聊天补全
     async def chat_completion(self, messages: list, model: str, temperature=0.7, top_p=0.8, penalty_score=1.0, file_urls=None) -> str:
         # 验证输入
@@ -1116,7 +1749,7 @@ class BaiduAdapter(BaseAdapter):
             
         logger.debug(f"向百度文心发送请求: {model}, 消息数: {len(valid_messages)}")
         
-        async with aiohttp.ClientSession() as session:
+        async with self.http_session() as session:
             try:
                 # 发送 POST 请求到百度聊天补全接口
                 async with session.post(
@@ -1160,10 +1793,10 @@ class BaiduAdapter(BaseAdapter):
                     if 'result' in result:
                         # 基本响应格式
                         if isinstance(result['result'], str):
-                            return result['result']
+                            return chat_result(result['result'], result, response.headers)
                         # 包含content字段的格式
                         elif isinstance(result['result'], dict) and 'content' in result['result']:
-                            return result['result']['content']
+                            return chat_result(result['result']['content'], result, response.headers)
                     
                     # 记录使用信息（如果存在）
                     if 'usage' in result:
@@ -1185,6 +1818,8 @@ class BaiduAdapter(BaseAdapter):
 
 # 定义 DeepSeekAdapter 类，继承自 BaseAdapter
 class DeepSeekAdapter(BaseAdapter):
+    models_path = "/models"
+
     # 构造函数，初始化 DeepSeek API 密钥和基准 URL
     def __init__(self, api_key: str, base_url="https://api.deepseek.com"):
         if not api_key or not isinstance(api_key, str):
@@ -1227,8 +1862,8 @@ class DeepSeekAdapter(BaseAdapter):
             logger.error("DeepSeek请求错误: 转换后的消息列表为空")
             raise ValueError("转换后的消息列表为空")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,  # 模型名称
@@ -1275,7 +1910,7 @@ class DeepSeekAdapter(BaseAdapter):
                     if 'choices' in result and result['choices']:
                         choice = result['choices'][0]
                         if 'message' in choice and 'content' in choice['message']:
-                            return choice['message']['content']
+                            return chat_result(choice['message']['content'], result, response.headers)
                     
                     # 记录使用信息（如果存在）
                     if 'usage' in result:
@@ -1297,6 +1932,10 @@ class DeepSeekAdapter(BaseAdapter):
 
 # 定义 MoonshotAdapter 类，继承自 BaseAdapter
 class MoonshotAdapter(BaseAdapter):
+    models_path = "/v1/models"
+    # 支持上下文缓存，引用时通过 reset_ttl 续期
+    supports_context_cache = True
+    context_cache_refresh_on_use = True
     # 构造函数，初始化 Moonshot API 密钥和基准 URL
     def __init__(self, api_key: str, base_url="https://api.moonshot.cn"):
         if not api_key or not isinstance(api_key, str):
@@ -1313,9 +1952,53 @@ class MoonshotAdapter(BaseAdapter):
         
         logger.debug(f"已初始化Moonshot适配器，API基础URL: {base_url}")
 
+    # 上下文缓存按模型系列创建（moonshot-v1-8k/32k/128k 共用 moonshot-v1）
+    @staticmethod
+    def _cache_model(model: str) -> str:
+        return "moonshot-v1" if model.startswith("moonshot-v1") else model
+
+    # 在 /v1/caching 中缓存系统消息
+    async def create_context_cache(self, model: str, prefix: List[dict], ttl: float) -> str:
+        payload = {
+            "model": self._cache_model(model),
+            "messages": [{"role": "system", "content": msg["content"]} for msg in prefix],
+            "ttl": int(ttl)
+        }
+        async with self.http_session() as session:
+            async with session.post(f"{self.base_url}/v1/caching", json=payload,
+                                    headers=self.headers, timeout=aiohttp.ClientTimeout(60)) as response:
+                response_text = await response.text()
+                if response.status != 200:
+                    raise Exception(f"Moonshot创建上下文缓存失败: {response.status} - {response_text}")
+                cache_id = json.loads(response_text).get("id")
+                if not cache_id:
+                    raise ValueError(f"Moonshot上下文缓存响应缺少id: {response_text}")
+                return cache_id
+
+    async def refresh_context_cache(self, name: str, ttl: float):
+        async with self.http_session() as session:
+            async with session.put(f"{self.base_url}/v1/caching/{name}", json={"ttl": int(ttl)},
+                                   headers=self.headers, timeout=aiohttp.ClientTimeout(30)) as response:
+                if response.status != 200:
+                    raise Exception(f"Moonshot上下文缓存续期失败: {response.status} - {await response.text()}")
+
+    async def delete_context_cache(self, name: str):
+        async with self.http_session() as session:
+            async with session.delete(f"{self.base_url}/v1/caching/{name}", headers=self.headers,
+                                      timeout=aiohttp.ClientTimeout(30)) as response:
+                if response.status not in (200, 204, 404):
+                    raise Exception(f"Moonshot删除上下文缓存失败: {response.status} - {await response.text()}")
+
     # 实现 chat_completion 抽象方法，用于与 Moonshot 服务进行聊天补全
-    async def chat_completion(self, messages: list, model: str, temperature=0.7, top_p=0.9, max_tokens=None, 
-                              frequency_penalty=0.0, presence_penalty=0.0, stop=None, file_urls=None) -> str:
+    async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
+        # 启用上下文缓存时，开头的系统消息由服务端缓存提供
+        if self.context_cache is not None:
+            return await self.context_cache.run(
+                model, messages, lambda msgs, entry: self._chat(msgs, model, cache_entry=entry, **kwargs))
+        return await self._chat(messages, model, **kwargs)
+
+    async def _chat(self, messages: list, model: str, temperature=0.7, top_p=0.9, max_tokens=None,
+                    frequency_penalty=0.0, presence_penalty=0.0, stop=None, file_urls=None, cache_entry=None) -> str:
         # 验证输入
         if not messages or not isinstance(messages, list):
             logger.error("Moonshot请求错误: 消息列表为空或格式不正确")
@@ -1346,9 +2029,14 @@ class MoonshotAdapter(BaseAdapter):
         if not valid_messages:
             logger.error("Moonshot请求错误: 转换后的消息列表为空")
             raise ValueError("转换后的消息列表为空")
+
+        # 引用上下文缓存，并在每次使用时重置有效期
+        if cache_entry is not None:
+            valid_messages.insert(0, {"role": "cache",
+                                      "content": f"cache_id={cache_entry.name};reset_ttl={int(self.context_cache.ttl)}"})
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,  # 模型名称
@@ -1388,6 +2076,10 @@ class MoonshotAdapter(BaseAdapter):
                     
                     # 检查响应状态码
                     if response.status != 200:
+                        # 缓存不存在或已过期时返回 404 resource_not_found_error 或 400 "cache ... expired"
+                        if cache_entry is not None and is_cache_miss(response.status, response_text, (400, 404),
+                                                                     ("cache",)):
+                            raise ContextCacheMiss(f"{response.status} - {response_text}")
                         logger.error(f"Moonshot请求失败，状态码: {response.status}，详情: {response_text}")
                         raise Exception(f"Moonshot API请求失败: {response.status} - {response_text}")
                     
@@ -1414,20 +2106,25 @@ class MoonshotAdapter(BaseAdapter):
                         logger.debug(f"Moonshot API使用情况: 输入tokens: {result['usage'].get('prompt_tokens', '未知')}, "
                                    f"输出tokens: {result['usage'].get('completion_tokens', '未知')}")
                     
-                    return choice['message']['content']
+                    return chat_result(choice['message']['content'], result, response.headers)
                     
             except aiohttp.ClientError as e:
                 # 捕获 aiohttp 客户端错误
                 logger.error(f"Moonshot请求客户端错误: {str(e)}")
                 raise
+            except ContextCacheMiss:
+                raise
             except Exception as e:
                 # 捕获其他未知异常并记录错误日志
                 logger.error(f"Moonshot请求失败: {str(e)}")
                 # 重新抛出异常
                 raise
 
-# 定义 ZhipuAdapter 类，继承自 BaseAdapter
-class ZhipuAdapter(BaseAdapter):
+# 定义 ZhipuAdapter 类，继承自 BaseAdapter，支持原生批量接口
+class ZhipuAdapter(OpenAICompatibleBatchMixin, BaseAdapter):
+    # 智谱批量任务中每行请求调用的端点
+    batch_endpoint = "/v4/chat/completions"
+
     # 构造函数，初始化智谱 API 密钥和基准 URL
     def __init__(self, api_key: str, base_url="https://open.bigmodel.cn"):
         if not api_key or not isinstance(api_key, str):
@@ -1488,6 +2185,24 @@ class ZhipuAdapter(BaseAdapter):
         
         return token
 
+    # 预热时生成一次JWT令牌（导入 PyJWT），再建立到上游的连接
+    async def warm_up(self):
+        self._generate_token()
+        await super().warm_up()
+
+    # 智谱的批量接口位于 /api/paas/v4 下
+    def _batch_api_base(self) -> str:
+        return f"{self.base_url}/api/paas/v4"
+
+    # 智谱使用JWT令牌认证
+    def _batch_headers(self) -> dict:
+        try:
+            token = self._generate_token()
+        except Exception as e:
+            logger.warning(f"生成JWT令牌失败，将使用原始API密钥: {str(e)}")
+            token = self.api_key
+        return {"Authorization": f"Bearer {token}"}
+
     # 实现 chat_completion 抽象方法，用于与智谱服务进行聊天补全
     async def chat_completion(self, messages: list, model: str, temperature=0.7, top_p=0.7, max_tokens=1024, file_urls=None) -> str:
         # 验证输入
@@ -1542,8 +2257,8 @@ class ZhipuAdapter(BaseAdapter):
                 "Content-Type": "application/json"
             }
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,  # 模型名称
@@ -1598,13 +2313,13 @@ class ZhipuAdapter(BaseAdapter):
                     if 'data' in result and 'choices' in result['data'] and result['data']['choices']:
                         choice = result['data']['choices'][0]
                         if 'message' in choice and 'content' in choice['message']:
-                            return choice['message']['content']
+                            return chat_result(choice['message']['content'], result, response.headers)
                     
                     # 兼容v3版本API的返回格式
                     if 'choices' in result and result['choices']:
                         choice = result['choices'][0]
                         if 'message' in choice and 'content' in choice['message']:
-                            return choice['message']['content']
+                            return chat_result(choice['message']['content'], result, response.headers)
                         
                     # 记录使用信息（如果存在）
                     if 'usage' in result:
@@ -1738,8 +2453,8 @@ class SparkAdapter(BaseAdapter):
         # 获取请求头，包含认证信息
         headers = self._get_headers()
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 确定API版本和端点
             api_version = "v3.5"  # 默认版本
             if "v2" in model:
@@ -1830,17 +2545,17 @@ class SparkAdapter(BaseAdapter):
                     # 讯飞星火API可能返回多个消息，找到assistant角色的消息
                     for msg in text:
                         if msg.get('role') == 'assistant':
-                            return msg.get('content', '')
+                            return chat_result(msg.get('content', ''), result, response.headers)
                     
                     # 如果没有找到assistant消息，返回最后一个消息
                     if text and 'content' in text[-1]:
-                        return text[-1]['content']
+                        return chat_result(text[-1]['content'], result, response.headers)
                     
                     # 使用兼容格式
                     if 'choices' in result and result['choices']:
                         choice = result['choices'][0]
                         if 'message' in choice and 'content' in choice['message']:
-                            return choice['message']['content']
+                            return chat_result(choice['message']['content'], result, response.headers)
                     
                     # 记录使用信息（如果存在）
                     usage = result.get('usage', {})
@@ -1905,8 +2620,8 @@ class MinimaxAdapter(BaseAdapter):
             logger.error("Minimax请求错误: 转换后的消息列表为空")
             raise ValueError("转换后的消息列表为空")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,  # 模型名称
@@ -1953,7 +2668,7 @@ class MinimaxAdapter(BaseAdapter):
                     if 'choices' in result and result['choices']:
                         choice = result['choices'][0]
                         if 'message' in choice and 'content' in choice['message']:
-                            return choice['message']['content']
+                            return chat_result(choice['message']['content'], result, response.headers)
                     
                     # 记录使用信息（如果存在）
                     if 'usage' in result:
@@ -2017,8 +2732,8 @@ class SenseChatAdapter(BaseAdapter):
             logger.error("SenseChat请求错误: 转换后的消息列表为空")
             raise ValueError("转换后的消息列表为空")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,  # 模型名称
@@ -2065,7 +2780,7 @@ class SenseChatAdapter(BaseAdapter):
                     if 'choices' in result and result['choices']:
                         choice = result['choices'][0]
                         if 'message' in choice and 'content' in choice['message']:
-                            return choice['message']['content']
+                            return chat_result(choice['message']['content'], result, response.headers)
                     
                     # 记录使用信息（如果存在）
                     if 'usage' in result:
@@ -2129,8 +2844,8 @@ class XunfeiAdapter(BaseAdapter):
             logger.error("讯飞请求错误: 转换后的消息列表为空")
             raise ValueError("转换后的消息列表为空")
         
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,  # 模型名称
@@ -2177,7 +2892,7 @@ class XunfeiAdapter(BaseAdapter):
                     if 'choices' in result and result['choices']:
                         choice = result['choices'][0]
                         if 'message' in choice and 'content' in choice['message']:
-                            return choice['message']['content']
+                            return chat_result(choice['message']['content'], result, response.headers)
                     
                     # 记录使用信息（如果存在）
                     if 'usage' in result:
@@ -2199,6 +2914,9 @@ class XunfeiAdapter(BaseAdapter):
 
 # 定义 CustomAdapter 类，继承自 BaseAdapter
 class CustomAdapter(BaseAdapter):
+    # OpenAI 兼容接口，本地上传文件以 data URL 内联发送
+    inline_media = True
+
     # 构造函数，初始化自定义 API 密钥和基准 URL
     def __init__(self, api_key: str, base_url: str):
         self.base_url = base_url.rstrip('/')  # 移除末尾的斜杠
@@ -2209,14 +2927,36 @@ class CustomAdapter(BaseAdapter):
         }
         print(f"CustomAdapter初始化: base_url={self.base_url}")
 
+    # OpenAI 兼容的模型列表接口，避免重复添加/v1
+    def models_url(self) -> Optional[str]:
+        if self.base_url.endswith('/v1'):
+            return f"{self.base_url}/models"
+        return f"{self.base_url}/v1/models"
+
+    # 流式聊天补全
+    async def stream_chat_completion(self, messages: list, model: str, **kwargs):
+        payload = {
+            "model": model,  # 模型名称
+            "messages": apply_openai_media(messages, kwargs.get('file_urls'))  # 消息列表（附件附加到最后一条用户消息）
+        }
+        for key in ('temperature', 'max_tokens', 'top_p', 'top_k'):
+            if key in kwargs:
+                payload[key] = kwargs[key]
+        if self.base_url.endswith('/v1'):
+            api_url = f"{self.base_url}/chat/completions"
+        else:
+            api_url = f"{self.base_url}/v1/chat/completions"
+        async for content in stream_openai_compatible(api_url, payload, self.headers, "Custom", adapter=self):
+            yield content
+
     # 实现 chat_completion 抽象方法，用于与自定义服务进行聊天补全
     async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload
             payload = {
                 "model": model,  # 模型名称
-                "messages": messages,  # 消息列表
+                "messages": apply_openai_media(messages, kwargs.get('file_urls')),  # 消息列表（附件附加到最后一条用户消息）
                 "stream": False  # 不使用流式传输
             }
             
@@ -2239,7 +2979,8 @@ class CustomAdapter(BaseAdapter):
                 api_url = f"{self.base_url}/v1/chat/completions"
             
             print(f"CustomAdapter请求URL: {api_url}")
-            print(f"CustomAdapter请求payload: {payload}")
+            # 不打印消息内容，避免输出内联的图片数据
+            print(f"CustomAdapter请求参数: { {k: v for k, v in payload.items() if k != 'messages'} }, 消息数: {len(payload['messages'])}")
             
             try:
                 # 发送 POST 请求到自定义服务的聊天补全接口
@@ -2293,7 +3034,7 @@ class CustomAdapter(BaseAdapter):
                         logger.debug(f"Custom API使用情况: 输入tokens: {result['usage'].get('prompt_tokens', '未知')}, "
                                    f"输出tokens: {result['usage'].get('completion_tokens', '未知')}")
                     
-                    return choice['message']['content']
+                    return chat_result(choice['message']['content'], result, response.headers)
                     
             except aiohttp.ClientError as e:
                 # 捕获 aiohttp 客户端错误
@@ -2305,8 +3046,11 @@ class CustomAdapter(BaseAdapter):
                 # 重新抛出异常
                 raise
 
-# 定义 SiliconFlowAdapter 类，继承自 BaseAdapter
-class SiliconFlowAdapter(BaseAdapter):
+# 定义 SiliconFlowAdapter 类，继承自 BaseAdapter，支持原生批量接口
+class SiliconFlowAdapter(OpenAICompatibleBatchMixin, BaseAdapter):
+    # OpenAI 兼容接口，本地上传文件以 data URL 内联发送
+    inline_media = True
+
     # 构造函数，初始化硅基流动 API 密钥和基准 URL
     def __init__(self, api_key: str, base_url: str = "https://api.siliconflow.cn"):
         self.base_url = base_url.rstrip('/')  # 移除末尾的斜杠
@@ -2317,14 +3061,40 @@ class SiliconFlowAdapter(BaseAdapter):
         }
         print(f"SiliconFlowAdapter初始化: base_url={self.base_url}")
 
+    # 硅基流动的批量接口位于 /v1 下，避免重复添加/v1
+    def _batch_api_base(self) -> str:
+        if self.base_url.endswith('/v1'):
+            return self.base_url
+        return f"{self.base_url}/v1"
+
+    # 模型列表接口同样位于 /v1 下
+    def models_url(self) -> Optional[str]:
+        return f"{self._batch_api_base()}/models"
+
+    # 流式聊天补全
+    async def stream_chat_completion(self, messages: list, model: str, **kwargs):
+        payload = {
+            "model": model,  # 模型名称
+            "messages": apply_openai_media(messages, kwargs.get('file_urls'))  # 消息列表（附件附加到最后一条用户消息）
+        }
+        for key in ('temperature', 'max_tokens', 'top_p', 'top_k'):
+            if key in kwargs:
+                payload[key] = kwargs[key]
+        if self.base_url.endswith('/v1'):
+            api_url = f"{self.base_url}/chat/completions"
+        else:
+            api_url = f"{self.base_url}/v1/chat/completions"
+        async for content in stream_openai_compatible(api_url, payload, self.headers, "硅基流动", adapter=self):
+            yield content
+
     # 实现 chat_completion 抽象方法，用于与硅基流动服务进行聊天补全
     async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
-        # 使用 aiohttp.ClientSession 创建一个异步 HTTP 客户端会话
-        async with aiohttp.ClientSession() as session:
+        # 使用适配器的传输层会话（复用连接池）
+        async with self.http_session() as session:
             # 构建请求体 payload - 硅基流动使用标准的OpenAI格式
             payload = {
                 "model": model,  # 模型名称
-                "messages": messages,  # 消息列表
+                "messages": apply_openai_media(messages, kwargs.get('file_urls')),  # 消息列表（附件附加到最后一条用户消息）
                 "stream": False  # 不使用流式传输
             }
             
@@ -2346,7 +3116,8 @@ class SiliconFlowAdapter(BaseAdapter):
                 api_url = f"{self.base_url}/v1/chat/completions"
             
             print(f"SiliconFlowAdapter请求URL: {api_url}")
-            print(f"SiliconFlowAdapter请求payload: {payload}")
+            # 不打印消息内容，避免输出内联的图片数据
+            print(f"SiliconFlowAdapter请求参数: { {k: v for k, v in payload.items() if k != 'messages'} }, 消息数: {len(payload['messages'])}")
             
             try:
                 # 发送 POST 请求到硅基流动的聊天补全接口
@@ -2400,7 +3171,7 @@ class SiliconFlowAdapter(BaseAdapter):
                         logger.debug(f"硅基流动API使用情况: 输入tokens: {result['usage'].get('prompt_tokens', '未知')}, "
                                    f"输出tokens: {result['usage'].get('completion_tokens', '未知')}")
                     
-                    return choice['message']['content']
+                    return chat_result(choice['message']['content'], result, response.headers)
                     
             except aiohttp.ClientError as e:
                 # 捕获 aiohttp 客户端错误
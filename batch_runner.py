@@ -0,0 +1,340 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于并发执行批量请求
+import asyncio
+# 导入 datetime 模块，用于记录任务时间
+import datetime
+# 导入 json 模块，用于解析 JSONL 和写出 NDJSON
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 os 模块，用于输出文件处理
+import os
+# 导入 uuid 模块，用于生成任务ID
+import uuid
+# 从 typing 模块导入类型提示
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+# 导入准入控制异常
+from admission import AdmissionRejected
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 批量请求在准入队列中的优先级类别
+BATCH_PRIORITY = "batch"
+# 准入被拒绝时的最大重试次数
+MAX_ADMISSION_RETRIES = 5
+# 批量执行方式：auto 自动选择，native 使用提供商原生批量接口，fanout 使用并发扇出
+BATCH_MODES = ("auto", "native", "fanout")
+
+
+# 定义 BatchRunner 类，用有界并发执行批量聊天请求
+class BatchRunner:
+    """批量聊天补全执行器
+
+    复用 MCP 的路由和准入控制（以 batch 优先级排队），
+    并按提供商限制并发，避免批量任务挤占交互流量。
+    """
+
+    def __init__(self, mcp, output_dir: str = "batch_outputs", default_concurrency: int = 4,
+                 max_concurrency: int = 16, native_min_items: int = 100,
+                 native_poll_interval: float = 30.0, max_finished_jobs: int = 100):
+        self.mcp = mcp  # MCP 实例，用于路由请求
+        self.output_dir = output_dir  # 输出文件目录
+        self.default_concurrency = default_concurrency  # 单个批次的默认并发数
+        self.max_concurrency = max_concurrency  # 单个提供商上所有批次的总并发上限
+        self.native_min_items = native_min_items  # 自动模式下使用原生批量接口的最小请求数
+        self.native_poll_interval = native_poll_interval  # 原生批量任务的轮询间隔（秒）
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}  # 每个提供商的并发信号量，跨批次共享
+        self.max_finished_jobs = max_finished_jobs  # 保留状态的已结束任务数，超出时删除最早的
+        self.jobs: Dict[str, dict] = {}  # 后台批量任务的状态
+        self._tasks: Dict[str, asyncio.Task] = {}  # 后台批量任务对象
+        self._outputs: Dict[str, str] = {}  # 运行中任务的输出文件 -> 任务ID，同一文件同时只允许一个任务写入
+
+    @staticmethod
+    def parse_jsonl(text: str) -> List[dict]:
+        """解析 JSONL 格式的批量请求，每行一个请求"""
+        items = []
+        for line_no, line in enumerate(text.splitlines(), start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"第 {line_no} 行不是有效的JSON: {str(e)}")
+            if not isinstance(item, dict) or not isinstance(item.get("messages"), list):
+                raise ValueError(f"第 {line_no} 行缺少 messages 列表")
+            # 没有 custom_id 时使用行号，保证可以断点续跑
+            item.setdefault("custom_id", f"line-{line_no}")
+            items.append(item)
+        return items
+
+    def resolve_output_path(self, output_file: str) -> str:
+        """将输出文件名限定在输出目录内"""
+        filename = os.path.basename(output_file)
+        if not filename:
+            raise ValueError("输出文件名无效")
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, filename)
+
+    @staticmethod
+    def load_completed_ids(path: str) -> Set[str]:
+        """读取输出文件中已成功完成的请求ID，用于断点续跑"""
+        completed = set()
+        if not os.path.exists(path):
+            return completed
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 最后一行可能因中断而不完整
+                    continue
+                if record.get("status") == "succeeded":
+                    completed.add(record.get("custom_id"))
+        return completed
+
+    def _semaphore(self, provider: str) -> asyncio.Semaphore:
+        """获取提供商的并发信号量"""
+        if provider not in self._semaphores:
+            self._semaphores[provider] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[provider]
+
+    async def _run_one(self, item: dict) -> dict:
+        """执行单个批量请求"""
+        custom_id = item["custom_id"]
+        provider = self.mcp.current_provider or ""
+        async with self._semaphore(provider):
+            attempt = 0
+            while True:
+                try:
+                    content = await self.mcp.handle_request(
+                        item["messages"], item.get("model", "default"),
+                        file_urls=item.get("file_urls"),
+                        priority=BATCH_PRIORITY,
+                        consumer=item.get("consumer")
+                    )
+                    metrics.incr("batch_requests", status="succeeded", provider=provider)
+                    return {
+                        "custom_id": custom_id,
+                        "status": "succeeded",
+                        "response": {
+                            "object": "chat.completion",
+                            "choices": [{"message": {"role": "assistant", "content": content}}]
+                        }
+                    }
+                except AdmissionRejected as e:
+                    # 系统繁忙时按 Retry-After 退避，为交互请求让路
+                    attempt += 1
+                    if attempt > MAX_ADMISSION_RETRIES:
+                        metrics.incr("batch_requests", status="failed", provider=provider)
+                        return {"custom_id": custom_id, "status": "failed", "error": e.reason}
+                    await asyncio.sleep(e.retry_after)
+                except Exception as e:
+                    logger.error(f"批量请求 {custom_id} 失败: {str(e)}")
+                    metrics.incr("batch_requests", status="failed", provider=provider)
+                    return {"custom_id": custom_id, "status": "failed", "error": str(e)}
+
+    async def run(self, items: List[dict], concurrency: Optional[int] = None,
+                  skip_ids: Optional[Set[str]] = None) -> AsyncIterator[dict]:
+        """执行批量请求，按完成顺序逐个产出结果"""
+        concurrency = max(1, min(concurrency or self.default_concurrency, self.max_concurrency))
+        skip_ids = skip_ids or set()
+        pending = [item for item in items if item["custom_id"] not in skip_ids]
+        results: asyncio.Queue = asyncio.Queue()
+        source = iter(pending)
+
+        async def worker():
+            for item in source:
+                await results.put(await self._run_one(item))
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(min(concurrency, len(pending)))]
+        try:
+            for _ in range(len(pending)):
+                yield await results.get()
+        finally:
+            # 调用方中途停止迭代（例如客户端断开）时取消剩余请求
+            for w in workers:
+                w.cancel()
+
+    def choose_mode(self, items: List[dict], mode: str = "auto", latency_tolerant: bool = False) -> str:
+        """选择批量执行方式：大批量且可容忍延迟时优先使用提供商原生批量接口"""
+        if mode not in BATCH_MODES:
+            raise ValueError(f"未知的批量执行方式: {mode}")
+        adapter = self.mcp.providers.get(self.mcp.current_provider)
+        model = self.mcp.configurations.get(self.mcp.current_provider, {}).get("model")
+        native_ok = (
+            adapter is not None
+            and getattr(adapter, "supports_native_batch", False)
+            # 模型能力数据中标记为支持批量接口
+            and self.mcp.capabilities.lookup(self.mcp.current_provider, model).batch
+            # 原生批量接口不支持附件
+            and not any(item.get("file_urls") for item in items)
+        )
+        if mode == "native":
+            if not native_ok:
+                raise ValueError(f"当前提供商 {self.mcp.current_provider} 不支持原生批量接口")
+            return "native"
+        if mode == "auto" and native_ok and latency_tolerant and len(items) >= self.native_min_items:
+            return "native"
+        return "fanout"
+
+    async def run_native(self, items: List[dict], job: Optional[dict] = None) -> List[dict]:
+        """通过提供商原生批量接口执行，提交后轮询直至完成"""
+        # 固定提交时的路由快照，任务完成前配置变更不会关闭该适配器
+        with self.mcp.pin_routes() as routes:
+            provider_name, adapter, actual_model, chat_params = self.mcp.resolve_route("default", routes)
+            requests = []
+            for item in items:
+                request = dict(chat_params)
+                request.update({k: v for k, v in item.items() if k != "model"})
+                requests.append(request)
+            provider_batch_id = await adapter.submit_batch(requests, actual_model)
+            if job is not None:
+                job["provider_batch_id"] = provider_batch_id
+            logger.info(f"已提交原生批量任务: 提供商={provider_name}, ID={provider_batch_id}, 请求数={len(items)}")
+            try:
+                while True:
+                    status = await adapter.get_batch_status(provider_batch_id)
+                    if status["status"] != "in_progress":
+                        break
+                    await asyncio.sleep(self.native_poll_interval)
+            except asyncio.CancelledError:
+                # 本地任务被取消时同时取消提供商侧的任务，否则上游会继续执行并计费
+                await self._cancel_native(adapter, provider_batch_id, job)
+                raise
+            if status["status"] != "completed":
+                raise Exception(f"原生批量任务 {provider_batch_id} 未完成: {status['status']}")
+            results = await adapter.fetch_batch_results(provider_batch_id)
+        consumers = {item["custom_id"]: item.get("consumer") for item in items}
+        records = []
+        for result in results:
+            metrics.incr("batch_requests", status=result["status"], provider=provider_name, mode="native")
+            if result["status"] == "succeeded":
+                if self.mcp.usage is not None:
+                    self.mcp.usage.record(provider_name, actual_model, result.get("usage"),
+                                          consumer=consumers.get(result["custom_id"]),
+                                          estimated=not result.get("usage"))
+                records.append({
+                    "custom_id": result["custom_id"],
+                    "status": "succeeded",
+                    "response": {
+                        "object": "chat.completion",
+                        "choices": [{"message": {"role": "assistant", "content": result["content"]}}]
+                    }
+                })
+            else:
+                records.append({"custom_id": result["custom_id"], "status": "failed", "error": result.get("error")})
+        return records
+
+    @staticmethod
+    async def _cancel_native(adapter, provider_batch_id: str, job: Optional[dict]):
+        """取消提供商侧的批量任务，失败时只记录日志"""
+        try:
+            await adapter.cancel_batch(provider_batch_id)
+            logger.info(f"已取消原生批量任务: ID={provider_batch_id}")
+            if job is not None:
+                job["provider_cancelled"] = True
+        except Exception as e:
+            logger.error(f"取消原生批量任务 {provider_batch_id} 失败: {str(e)}")
+            if job is not None:
+                job["provider_cancelled"] = False
+
+    def start_job(self, items: List[dict], output_path: str, resume: bool = False,
+                  concurrency: Optional[int] = None, mode: str = "auto",
+                  latency_tolerant: bool = False) -> dict:
+        """在后台执行批量任务，结果逐行追加写入输出文件"""
+        output_key = os.path.abspath(output_path)
+        if output_key in self._outputs:
+            raise FileExistsError(f"输出文件 {os.path.basename(output_path)} 正在被批量任务 "
+                                  f"{self._outputs[output_key]} 写入，请等待其结束或取消后再续跑")
+        if not resume and os.path.exists(output_path):
+            raise FileExistsError(f"输出文件已存在: {os.path.basename(output_path)}，如需续跑请设置 resume=true")
+        skip_ids = self.load_completed_ids(output_path) if resume else set()
+        pending = [item for item in items if item["custom_id"] not in skip_ids]
+        mode = self.choose_mode(pending, mode, latency_tolerant)
+        batch_id = str(uuid.uuid4())
+        job = {
+            "batch_id": batch_id,
+            "status": "running",
+            "mode": mode,
+            "output_file": os.path.basename(output_path),
+            "total": len(items),
+            "skipped": len(items) - len(pending),
+            "succeeded": 0,
+            "failed": 0,
+            "created_at": datetime.datetime.now().isoformat()
+        }
+        self.jobs[batch_id] = job
+
+        async def run_job():
+            try:
+                with open(output_path, "a", encoding="utf-8") as f:
+                    if mode == "native":
+                        for record in await self.run_native(pending, job):
+                            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                            job[record["status"]] += 1
+                        f.flush()
+                    else:
+                        async for record in self.run(pending, concurrency):
+                            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                            f.flush()
+                            job[record["status"]] += 1
+                job["status"] = "completed"
+            except asyncio.CancelledError:
+                job["status"] = "cancelled"
+                raise
+            except Exception as e:
+                logger.error(f"批量任务 {batch_id} 失败: {str(e)}")
+                job["status"] = "failed"
+                job["error"] = str(e)
+            finally:
+                job["finished_at"] = datetime.datetime.now().isoformat()
+
+        job_task = asyncio.ensure_future(run_job())
+        # 任务对象不放进状态字典，保证状态可直接序列化
+        self._tasks[batch_id] = job_task
+        self._outputs[output_key] = batch_id
+        job_task.add_done_callback(lambda _: self._finish_job(batch_id, output_key))
+        return job
+
+    def _finish_job(self, batch_id: str, output_key: str):
+        """任务结束：释放输出文件，只保留最近 max_finished_jobs 个已结束任务的状态"""
+        self._tasks.pop(batch_id, None)
+        self._outputs.pop(output_key, None)
+        job = self.jobs.get(batch_id)
+        if job is not None and job["status"] == "running":
+            # 任务在开始执行前被取消
+            job["status"] = "cancelled"
+            job["finished_at"] = datetime.datetime.now().isoformat()
+        finished = [job_id for job_id in self.jobs if job_id not in self._tasks]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            del self.jobs[job_id]
+
+    def cancel_job(self, batch_id: str) -> bool:
+        """取消正在运行的后台批量任务"""
+        task = self._tasks.get(batch_id)
+        if not task:
+            return False
+        task.cancel()
+        return True
@@ -0,0 +1,212 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 json 模块，用于读取能力数据文件
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 os 模块，用于检查数据文件的修改时间
+import os
+# 导入 time 模块，用于限制文件检查频率
+import time
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional, Tuple
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 能力字段及其类型
+CAPABILITY_FIELDS = {
+    "context_window": int,  # 上下文窗口（token）
+    "max_output": int,  # 最大输出（token）
+    "vision": bool,  # 支持图片输入
+    "video": bool,  # 支持视频输入
+    "streaming": bool,  # 支持流式输出
+    "batch": bool,  # 支持原生批量接口
+    "input_price": float,  # 输入价格（每百万 token），0 表示未知
+    "output_price": float,  # 输出价格（每百万 token），0 表示未知
+    "cache_read_ratio": float,  # 命中提示缓存的输入 token 相对输入价格的倍数
+    "cache_write_ratio": float,  # 写入提示缓存的输入 token 相对输入价格的倍数
+    "currency": str,  # 价格的币种
+}
+
+
+# 单个模型的能力
+class ModelCapabilities:
+    def __init__(self, provider: str, model: str, matched: Optional[str], **fields):
+        self.provider = provider  # 提供商类型
+        self.model = model  # 查询的模型名
+        self.matched = matched  # 命中的数据文件条目，None 表示使用提供商默认值（上下文窗口和输出上限未知，不限制）
+        for name, cast in CAPABILITY_FIELDS.items():
+            setattr(self, name, cast(fields[name]))
+
+    def to_dict(self) -> dict:
+        result = {"provider": self.provider, "model": self.model, "matched": self.matched}
+        result.update({name: getattr(self, name) for name in CAPABILITY_FIELDS})
+        return result
+
+
+# 定义 CapabilityRegistry 类，从数据文件加载模型能力
+class CapabilityRegistry:
+    """模型能力索引
+
+    数据文件结构见 model_capabilities.json：全局默认值、提供商默认值、按模型覆盖。
+    模型名先精确匹配，再按最长前缀匹配（例如 gpt-4o-2024-08-06 命中 gpt-4o），
+    查询结果按 (提供商, 模型) 缓存，之后每次查询都是一次字典访问。
+    数据文件修改后自动重新加载（最多每 check_interval 秒检查一次），也可调用 reload。
+    """
+
+    def __init__(self, path: str = "model_capabilities.json", check_interval: float = 5.0):
+        self.path = path  # 数据文件路径
+        self.check_interval = check_interval  # 检查文件修改的最小间隔（秒）
+        self._defaults: dict = {}  # 全局默认值
+        self._aliases: Dict[str, str] = {}  # 提供商名称别名 -> 提供商类型
+        self._providers: Dict[str, dict] = {}  # 提供商类型 -> {"defaults", "models"}
+        self._cache: Dict[Tuple[str, str], ModelCapabilities] = {}  # 查询结果缓存
+        self._mtime: Optional[float] = None  # 已加载文件的修改时间
+        self._checked_at = 0.0  # 上次检查文件的时间
+        self.reload()
+
+    def reload(self):
+        """重新加载数据文件，失败时保留当前数据"""
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            defaults = {name: data.get("defaults", {}).get(name, cast())
+                        for name, cast in CAPABILITY_FIELDS.items()}
+            providers = {}
+            for provider, entry in data.get("providers", {}).items():
+                providers[provider.lower()] = {
+                    "defaults": entry.get("defaults", {}),
+                    "models": {model.lower(): caps for model, caps in entry.get("models", {}).items()},
+                }
+        except Exception as e:
+            logger.error(f"加载模型能力数据失败: {str(e)}")
+            return
+        # 整体替换，查询无需加锁
+        self._defaults = defaults
+        self._aliases = {k.lower(): v.lower() for k, v in data.get("aliases", {}).items()}
+        self._providers = providers
+        self._cache = {}
+        self._mtime = mtime
+        logger.info(f"已加载模型能力数据: {len(providers)} 个提供商")
+
+    def _maybe_reload(self):
+        """数据文件修改后重新加载"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            if os.path.getmtime(self.path) != self._mtime:
+                self.reload()
+        except OSError:
+            pass
+
+    def provider_key(self, provider_name: Optional[str]) -> str:
+        """配置中的提供商名称转换为提供商类型"""
+        key = str(provider_name or "").lower()
+        return self._aliases.get(key, key)
+
+    def lookup(self, provider_name: Optional[str], model: Optional[str]) -> ModelCapabilities:
+        """查询 (提供商, 模型) 的能力"""
+        self._maybe_reload()
+        provider = self.provider_key(provider_name)
+        model_key = str(model or "").lower()
+        cache_key = (provider, model_key)
+        caps = self._cache.get(cache_key)
+        if caps is not None:
+            return caps
+
+        entry = self._providers.get(provider, {"defaults": {}, "models": {}})
+        matched = None
+        if model_key in entry["models"]:
+            matched = model_key
+        else:
+            for candidate in entry["models"]:
+                if model_key.startswith(candidate) and (matched is None or len(candidate) > len(matched)):
+                    matched = candidate
+        fields = dict(self._defaults)
+        fields.update(entry["defaults"])
+        if matched is not None:
+            fields.update(entry["models"][matched])
+        caps = ModelCapabilities(provider, model_key, matched, **fields)
+        self._cache[cache_key] = caps
+        return caps
+
+    def all(self) -> Dict[str, dict]:
+        """导出数据文件内容"""
+        self._maybe_reload()
+        return {"defaults": self._defaults, "aliases": self._aliases, "providers": self._providers}
+
+
+def estimate_cost(caps: ModelCapabilities, prompt_tokens: int, completion_tokens: int,
+                  cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> float:
+    """按模型价格计算费用（币种见 caps.currency），prompt_tokens 包含命中和写入提示缓存的 token"""
+    uncached = max(prompt_tokens - cache_read_tokens - cache_write_tokens, 0)
+    prompt_cost = caps.input_price * (uncached + cache_read_tokens * caps.cache_read_ratio
+                                      + cache_write_tokens * caps.cache_write_ratio)
+    return (prompt_cost + completion_tokens * caps.output_price) / 1_000_000
+
+
+def estimate_tokens(messages: List[dict]) -> int:
+    """粗略估算消息的 token 数：按 UTF-8 字节数 / 3（中文约 1 字 1 token，英文偏保守）"""
+    total = 0
+    for msg in messages:
+        if not isinstance(msg, dict):
+            continue
+        content = msg.get("content", "")
+        if isinstance(content, str):
+            total += len(content.encode("utf-8")) // 3 + 4
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, dict) and isinstance(part.get("text"), str):
+                    total += len(part["text"].encode("utf-8")) // 3
+            total += 4
+    return total
+
+
+def fit_to_context(messages: List[dict], caps: ModelCapabilities, max_tokens: Optional[int] = None) -> List[dict]:
+    """按上下文窗口裁剪消息：保留系统消息和最后一条消息，从最早的对话开始丢弃
+
+    数据文件中没有的模型（自定义模型等）上下文窗口未知，不裁剪。
+    """
+    if caps.matched is None:
+        return messages
+    reserve = min(max_tokens or caps.max_output, caps.max_output)
+    budget = caps.context_window - reserve
+    if estimate_tokens(messages) <= budget:
+        return messages
+    system = [m for m in messages[:-1] if isinstance(m, dict) and m.get("role") == "system"]
+    history = [m for m in messages[:-1] if not (isinstance(m, dict) and m.get("role") == "system")]
+    last = messages[-1:]
+    used = estimate_tokens(system) + estimate_tokens(last)
+    if used > budget:
+        raise ValueError(f"消息过长：约 {used} tokens，超出模型 {caps.model} 的上下文窗口 {caps.context_window}")
+    # 从最新的对话往前保留
+    kept = []
+    for msg in reversed(history):
+        cost = estimate_tokens([msg])
+        if used + cost > budget:
+            break
+        kept.append(msg)
+        used += cost
+    kept.reverse()
+    logger.info(f"上下文超出模型窗口，丢弃了最早的 {len(history) - len(kept)} 条消息")
+    return system + kept + last
@@ -1,33 +1,68 @@
 import os
-import json
+import threading
 import uuid
 import datetime
 from typing import List, Dict, Optional
 
+from state_backend import StateBackend, SQLiteBackend, migrate_json_file
+
+# 聊天历史在共享状态存储中的命名空间，每个会话一条记录
+HISTORY_NAMESPACE = 'histories'
+
+
 class ChatHistory:
-    def __init__(self, history_file: str = 'chat_histories.json'):
+    def __init__(self, history_file: str = 'chat_histories.json', backend: Optional[StateBackend] = None):
         self.history_file = history_file
-        self.histories: Dict[str, dict] = {}
-        self._load_histories()
-
-    def _load_histories(self):
-        if os.path.exists(self.history_file):
-            try:
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    self.histories = json.load(f)
-            except Exception:
-                self.histories = {}
-        else:
-            self.histories = {}
+        # 未指定存储时使用与历史文件同名的 SQLite 数据库
+        self.backend = backend or SQLiteBackend(os.path.splitext(history_file)[0] + '.db')
+        self.histories: Dict[str, dict] = {}  # 本地缓存，存储版本号变化时读取修改过的会话
+        self._version = -1
+        # 异步接口通过 asyncio.to_thread 调用，缓存可能在多个线程中更新
+        self._lock = threading.Lock()
+        # 首次启动时导入旧的 JSON 历史文件
+        migrate_json_file(self.backend, HISTORY_NAMESPACE, history_file,
+                          lambda data: data if isinstance(data, dict) else {})
+        self._refresh()
+
+    def _refresh(self):
+        # 其他 worker 修改过历史时只读取修改过的会话，删除的会话从缓存中移除
+        with self._lock:
+            if self.backend.version(HISTORY_NAMESPACE) == self._version:
+                return
+            changed, keys, version = self.backend.changes(HISTORY_NAMESPACE, self._version)
+            self.histories = {key: changed[key] if key in changed else self.histories[key] for key in keys}
+            self._version = version
 
-    def _save_histories(self):
-        with open(self.history_file, 'w', encoding='utf-8') as f:
-            json.dump(self.histories, f, ensure_ascii=False, indent=2)
+    def _applied(self, history_id: str, history: Optional[dict], version: int):
+        # 存储中只有本次写入时直接更新缓存，否则下次读取时增量刷新
+        with self._lock:
+            if version != self._version + 1:
+                return
+            if history is None:
+                self.histories.pop(history_id, None)
+            else:
+                self.histories[history_id] = history
+            self._version = version
+
+    def _modify(self, history_id: str, change) -> bool:
+        # 在存储的事务中修改一个会话，并发修改同一会话的 worker 不会互相覆盖
+        def apply(history):
+            if history is None:
+                return None
+            change(history)
+            history['updated_at'] = datetime.datetime.now().isoformat()
+            return history
+
+        history, version = self.backend.update(HISTORY_NAMESPACE, history_id, apply)
+        if history is None:
+            return False
+        self._applied(history_id, history, version)
+        return True
 
     def create_history(self, title: Optional[str] = None) -> str:
         history_id = str(uuid.uuid4())
         now = datetime.datetime.now().isoformat()
-        self.histories[history_id] = {
+        history = {
             'id': history_id,
             'title': title or f'对话 {now[:10]}',
             'created_at': now,
@@ -35,50 +70,52 @@ class ChatHistory:
             'messages': [],
             'is_favorite': False
         }
-        self._save_histories()
+        version = self.backend.put(HISTORY_NAMESPACE, history_id, history)
+        self._applied(history_id, history, version)
         return history_id
 
     def get_histories(self) -> List[dict]:
+        self._refresh()
         # 按更新时间倒序
         return sorted(self.histories.values(), key=lambda h: h['updated_at'], reverse=True)
 
     def get_favorites(self) -> List[dict]:
+        self._refresh()
         return [h for h in self.histories.values() if h.get('is_favorite')]
 
     def get_history(self, history_id: str) -> Optional[dict]:
+        self._refresh()
         return self.histories.get(history_id)
 
     def update_history_title(self, history_id: str, title: str) -> bool:
-        if history_id in self.histories:
-            self.histories[history_id]['title'] = title
-            self.histories[history_id]['updated_at'] = datetime.datetime.now().isoformat()
-            self._save_histories()
-            return True
-        return False
+        return self._modify(history_id, lambda h: h.update(title=title))
 
     def toggle_favorite(self, history_id: str) -> bool:
-        if history_id in self.histories:
-            self.histories[history_id]['is_favorite'] = not self.histories[history_id].get('is_favorite', False)
-            self.histories[history_id]['updated_at'] = datetime.datetime.now().isoformat()
-            self._save_histories()
-            return True
-        return False
+        return self._modify(history_id, lambda h: h.update(is_favorite=not h.get('is_favorite', False)))
 
     def delete_history(self, history_id: str) -> bool:
-        if history_id in self.histories:
-            del self.histories[history_id]
-            self._save_histories()
-            return True
-        return False
+        deleted, version = self.backend.delete(HISTORY_NAMESPACE, history_id)
+        if deleted:
+            self._applied(history_id, None, version)
+        return deleted
 
     def clear_all_histories(self):
-        self.histories = {}
-        self._save_histories()
+        version = self.backend.clear(HISTORY_NAMESPACE)
+        with self._lock:
+            self.histories = {}
+            self._version = version
 
     def add_message(self, history_id: str, message: dict) -> bool:
-        if history_id in self.histories:
-            self.histories[history_id]['messages'].append(message)
-            self.histories[history_id]['updated_at'] = datetime.datetime.now().isoformat()
-            self._save_histories()
-            return True
-        return False
+        return self._modify(history_id, lambda h: h['messages'].append(message))
+
+    def set_summary(self, history_id: str, summary: dict) -> bool:
+        # 保存较早对话的摘要，summary['watermark'] 为摘要覆盖的消息条数；
+        # 多个 worker 同时压缩同一会话时只保留覆盖范围更大的摘要
+        applied = []
+
+        def change(history):
+            current = history.get('summary') or {}
+            if current.get('watermark', 0) < summary['watermark'] <= len(history['messages']):
+                history['summary'] = summary
+                applied.append(True)
+        return self._modify(history_id, change) and bool(applied)
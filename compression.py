@@ -0,0 +1,286 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 json 模块，用于错误响应
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 zlib 模块，用于 gzip 和 deflate
+import zlib
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional, Tuple
+
+# brotli 为可选依赖，未安装时不提供 br 编码
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    brotli = None
+    BROTLI_AVAILABLE = False
+# brotli 1.2 起解压时可以限制输出大小（output_buffer_limit），旧版本无法防止解压炸弹，不接受 br 编码的请求体
+BROTLI_BOUNDED = BROTLI_AVAILABLE and hasattr(brotli.Decompressor, "can_accept_more_data")
+
+# zstandard 为可选依赖，未安装时不提供 zstd 编码
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    zstandard = None
+    ZSTD_AVAILABLE = False
+
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 可压缩的响应类型（前缀匹配）
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/", "application/javascript",
+                      "image/svg+xml")
+# 不压缩的响应类型：服务器推送事件需要逐条立即送达
+EXCLUDED_TYPES = ("text/event-stream",)
+
+
+def available_encodings() -> List[str]:
+    """按优先顺序返回可用的压缩编码"""
+    return (["br"] if BROTLI_AVAILABLE else []) + (["zstd"] if ZSTD_AVAILABLE else []) + ["gzip"]
+
+
+def choose_encoding(accept_encoding: str, encodings: Optional[List[str]] = None) -> Optional[str]:
+    """按 Accept-Encoding 的 q 值选择编码，q 值相同时按 encodings 的顺序，没有可接受的编码时返回 None"""
+    encodings = encodings or available_encodings()
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name:
+            weights[name.strip()] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+# 流式压缩器，flush 后已写入的数据可以立即被客户端解压
+class _Encoder:
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=min(level, 11))
+        elif encoding == "zstd":
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, flush: bool = False) -> bytes:
+        if self.encoding == "br":
+            out = self._compressor.process(data)
+            return out + self._compressor.flush() if flush else out
+        out = self._compressor.compress(data)
+        if flush:
+            mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK if self.encoding == "zstd" else zlib.Z_SYNC_FLUSH
+            out += self._compressor.flush(mode)
+        return out
+
+    def finish(self) -> bytes:
+        return self._compressor.finish() if self.encoding == "br" else self._compressor.flush()
+
+
+def decompress(data: bytes, encoding: str, max_size: int) -> bytes:
+    """解压请求体，超过 max_size 字节时抛出 OverflowError，不支持的编码抛出 LookupError"""
+    encoding = encoding.strip().lower()
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        # deflate 兼容带 zlib 头和不带头的两种格式
+        wbits = 16 + zlib.MAX_WBITS if encoding != "deflate" else (zlib.MAX_WBITS if data[:1] == b"\x78" else -zlib.MAX_WBITS)
+        decompressor = zlib.decompressobj(wbits)
+        out = decompressor.decompress(data, max_size + 1)
+        if len(out) > max_size or decompressor.unconsumed_tail:
+            raise OverflowError
+        return out
+    if encoding == "br" and BROTLI_BOUNDED:
+        # 输出达到上限后停止解压，不会先把整个请求体解压到内存
+        out = brotli.Decompressor().process(data, output_buffer_limit=max_size + 1)
+    elif encoding == "zstd" and ZSTD_AVAILABLE:
+        out = zstandard.ZstdDecompressor().stream_reader(data).read(max_size + 1)
+    elif encoding == "identity":
+        out = data
+    else:
+        raise LookupError(encoding)
+    if len(out) > max_size:
+        raise OverflowError
+    return out
+
+
+# 定义 CompressionMiddleware 类，协商压缩响应并解压压缩的请求体
+class CompressionMiddleware:
+    """ASGI 中间件
+
+    响应：按 Accept-Encoding 选择 br / zstd / gzip（br 和 zstd 需要安装对应的包），
+    不小于 minimum_size 字节的可压缩类型才压缩；流式响应逐块压缩并立即刷新，不缓冲整个响应。
+    请求：Content-Encoding 为 gzip / deflate / br / zstd 的请求体解压后交给应用，
+    解压后超过 max_request_size 字节返回 413，不支持的编码返回 415。
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, level: int = 6, max_request_size: int = 32 * 1024 * 1024,
+                 encodings: Optional[List[str]] = None):
+        self.app = app
+        self.minimum_size = minimum_size  # 小于该字节数的响应不压缩
+        self.level = level  # 压缩级别（gzip 1-9，br 0-11，zstd 1-22）
+        self.max_request_size = max_request_size  # 解压后请求体的上限
+        self.encodings = [e for e in (encodings or available_encodings()) if e in available_encodings()]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        content_encoding = headers.get("content-encoding", "").strip().lower()
+        if content_encoding and content_encoding != "identity":
+            scope, receive = await self._decompressed_request(scope, receive, send, content_encoding)
+            if scope is None:
+                return
+        encoding = choose_encoding(headers.get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding, self))
+
+    async def _decompressed_request(self, scope, receive, send, content_encoding: str):
+        """读取并解压整个请求体，返回新的 (scope, receive)；出错时已发送错误响应并返回 (None, None)"""
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None, None
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if size > self.max_request_size:
+                await _send_error(send, 413, "请求体过大")
+                return None, None
+            if not message.get("more_body"):
+                break
+        compressed = b"".join(chunks)
+        try:
+            body = decompress(compressed, content_encoding, self.max_request_size)
+        except LookupError:
+            await _send_error(send, 415, f"不支持的请求体编码: {content_encoding}")
+            return None, None
+        except OverflowError:
+            await _send_error(send, 413, "解压后的请求体过大")
+            return None, None
+        except Exception as e:
+            await _send_error(send, 400, f"请求体解压失败: {str(e)}")
+            return None, None
+        metrics.incr("request_bytes_compressed", len(compressed), encoding=content_encoding)
+        metrics.incr("request_bytes_decompressed", len(body), encoding=content_encoding)
+        headers = [(key, value) for key, value in scope["headers"]
+                   if key.lower() not in (b"content-encoding", b"content-length")]
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+        scope = dict(scope, headers=headers)
+        sent = False
+
+        async def replay():
+            nonlocal sent
+            if sent:
+                return await receive()
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        return scope, replay
+
+
+async def _send_error(send, status: int, detail: str):
+    body = json.dumps({"detail": detail}, ensure_ascii=False).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+# 包装 send：根据响应头和第一块响应体决定是否压缩
+class _CompressingSend:
+    def __init__(self, send, encoding: str, middleware: CompressionMiddleware):
+        self.send = send
+        self.encoding = encoding
+        self.middleware = middleware
+        self.start: Optional[dict] = None  # 暂存的响应头
+        self.encoder: Optional[_Encoder] = None  # 压缩器，None 表示原样发送
+        self.passthrough = False
+
+    def _compressible(self, headers: List[Tuple[bytes, bytes]]) -> bool:
+        values = {key.decode("latin-1").lower(): value.decode("latin-1").lower() for key, value in headers}
+        if "content-encoding" in values:
+            return False
+        content_type = values.get("content-type", "")
+        if any(content_type.startswith(t) for t in EXCLUDED_TYPES):
+            return False
+        return any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+    async def __call__(self, message: dict):
+        if message["type"] == "http.response.start":
+            self.start = message
+            self.passthrough = not self._compressible(message.get("headers", []))
+            if self.passthrough:
+                await self.send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            if not more_body and len(body) < self.middleware.minimum_size:
+                # 完整且较小的响应不压缩
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            self.encoder = _Encoder(self.encoding, self.middleware.level)
+            headers = [(key, value) for key, value in start.get("headers", [])
+                       if key.lower() not in (b"content-length", b"vary")]
+            vary = [value for key, value in start.get("headers", []) if key.lower() == b"vary"]
+            headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+            headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+            if not more_body:
+                compressed = self.encoder.compress(body) + self.encoder.finish()
+                headers.append((b"content-length", str(len(compressed)).encode("latin-1")))
+                metrics.incr("response_bytes_uncompressed", len(body), encoding=self.encoding)
+                metrics.incr("response_bytes_compressed", len(compressed), encoding=self.encoding)
+                await self.send(dict(start, headers=headers))
+                await self.send({"type": "http.response.body", "body": compressed})
+                return
+            await self.send(dict(start, headers=headers))
+
+        # 流式响应：每块压缩后立即刷新
+        if more_body:
+            data = self.encoder.compress(body, flush=True)
+        else:
+            data = self.encoder.compress(body) + self.encoder.finish()
+        metrics.incr("response_bytes_uncompressed", len(body), encoding=self.encoding)
+        metrics.incr("response_bytes_compressed", len(data), encoding=self.encoding)
+        await self.send({"type": "http.response.body", "body": data, "more_body": more_body})
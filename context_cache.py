@@ -0,0 +1,280 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于后台维护任务和合并并发的创建请求
+import asyncio
+# 导入 hashlib 模块，用于计算前缀的摘要
+import hashlib
+# 导入 json 模块，用于序列化前缀消息
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 time 模块，用于过期时间计算
+import time
+# 从 collections 导入 OrderedDict，限制记录的前缀数量
+from collections import OrderedDict
+# 从 typing 模块导入类型提示
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+# 导入 token 估算
+from capabilities import estimate_tokens
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 引用的缓存不存在或已过期时，上游错误信息中的关键词（小写）
+CACHE_GONE_MARKERS = ("not found", "not_found", "not exist", "expired", "permission denied")
+
+
+# 上游报告引用的缓存不可用
+class ContextCacheMiss(Exception):
+    pass
+
+
+def is_cache_miss(status: int, body: str, statuses: Tuple[int, ...], subjects: Tuple[str, ...]) -> bool:
+    """上游错误是否表示引用的缓存不可用：状态码属于 statuses，且错误信息提到缓存（subjects 中的关键词）并说明其不存在或已过期；
+    参数校验等其他错误照常抛出，不丢弃缓存，也不重发请求"""
+    if status not in statuses:
+        return False
+    text = body.lower()
+    return any(subject in text for subject in subjects) and any(marker in text for marker in CACHE_GONE_MARKERS)
+
+
+def split_system_prefix(messages: List[dict]) -> Tuple[List[dict], List[dict]]:
+    """拆分开头连续的纯文本系统消息（长系统提示、参考文档）和其余消息"""
+    index = 0
+    while (index < len(messages) and isinstance(messages[index], dict) and messages[index].get("role") == "system"
+           and isinstance(messages[index].get("content"), str)):
+        index += 1
+    return messages[:index], messages[index:]
+
+
+# 一个服务端缓存
+class CacheEntry:
+    def __init__(self, key: str, model: str, name: str, ttl: float, tokens: int):
+        now = time.monotonic()
+        self.key = key  # 前缀摘要
+        self.model = model  # 创建缓存时的模型
+        self.name = name  # 服务端的缓存名称或ID
+        self.tokens = tokens  # 估算的前缀 token 数
+        self.expires_at = now + ttl  # 服务端过期时间（本地时钟）
+        self.last_used = now  # 最近一次使用时间
+        self.refs = 0  # 正在使用该缓存的请求数
+        self.hits = 0  # 使用次数
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "model": self.model, "tokens": self.tokens, "refs": self.refs,
+                "hits": self.hits, "expires_in": round(self.expires_at - time.monotonic(), 1)}
+
+
+# 定义 ContextCacheManager 类，管理提供商服务端的上下文缓存
+class ContextCacheManager:
+    """服务端上下文缓存（Gemini cachedContents、Moonshot 上下文缓存）
+
+    请求开头的系统消息在近期重复出现 min_repeats 次且足够长时，在服务端创建缓存，
+    之后的请求只引用缓存名称。本地记录每个缓存的过期时间和引用计数：
+    后台任务为近期仍在使用的缓存续期，删除长时间未使用的缓存，正在被请求引用的缓存不会删除。
+    上游报告缓存不可用时丢弃本地记录并在后台删除服务端缓存，不使用缓存重发一次。
+
+    adapter 需实现 create_context_cache(model, prefix, ttl) -> 名称、
+    refresh_context_cache(name, ttl) 和 delete_context_cache(name)。
+    """
+
+    def __init__(self, adapter, ttl: float = 3600.0, min_tokens: int = 1024, min_repeats: int = 2,
+                 refresh_margin: float = 60.0, maintain_interval: float = 30.0, max_entries: int = 32,
+                 failure_backoff: float = 600.0):
+        self.adapter = adapter  # 提供商适配器
+        self.ttl = ttl  # 缓存有效期（秒）
+        self.min_tokens = min_tokens  # 可缓存的最短前缀（估算 token）
+        self.min_repeats = min_repeats  # 前缀出现多少次后创建缓存
+        self.refresh_margin = refresh_margin  # 剩余有效期不足该值时不再引用，改为续期
+        self.maintain_interval = maintain_interval  # 后台维护间隔（秒）
+        self.max_entries = max_entries  # 最多同时保留的缓存数（服务端缓存按存储时长计费）
+        self.failure_backoff = failure_backoff  # 创建失败后多久内不再尝试（秒）
+        self._entries: Dict[str, CacheEntry] = {}  # 前缀摘要 -> 缓存
+        self._seen: "OrderedDict[str, int]" = OrderedDict()  # 前缀摘要 -> 出现次数
+        self._failed: Dict[str, float] = {}  # 前缀摘要 -> 可以重试创建的时间
+        self._creating: Dict[str, asyncio.Future] = {}  # 正在创建的缓存，并发请求共用同一次创建
+        self._task: Optional[asyncio.Task] = None  # 后台维护任务
+        self._deleting: Set[asyncio.Task] = set()  # 后台进行中的删除
+
+    @staticmethod
+    def _key(model: str, prefix: List[dict]) -> str:
+        data = json.dumps([model, prefix], ensure_ascii=False, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()
+
+    def _ensure_maintenance(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._maintain())
+
+    async def acquire(self, model: str, prefix: List[dict]) -> Optional[CacheEntry]:
+        """返回可以引用的缓存并增加引用计数，没有可用缓存时返回 None"""
+        if not prefix:
+            return None
+        key = self._key(model, prefix)
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires_at - now > self.refresh_margin:
+            entry.refs += 1
+            entry.hits += 1
+            entry.last_used = now
+            metrics.incr("context_cache_hits")
+            return entry
+        if entry is not None:
+            # 即将过期，由后台任务续期或删除，本次发送完整消息
+            return None
+
+        pending = self._creating.get(key)
+        if pending is None:
+            tokens = estimate_tokens(prefix)
+            if tokens < self.min_tokens or self._failed.get(key, 0) > now:
+                return None
+            self._seen[key] = self._seen.get(key, 0) + 1
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.max_entries * 32:
+                self._seen.popitem(last=False)
+            if self._seen[key] < self.min_repeats:
+                return None
+            pending = asyncio.ensure_future(self._create(key, model, prefix, tokens))
+            self._creating[key] = pending
+            pending.add_done_callback(lambda _: self._creating.pop(key, None))
+        entry = await asyncio.shield(pending)
+        if entry is not None:
+            entry.refs += 1
+            entry.hits += 1
+            entry.last_used = time.monotonic()
+        return entry
+
+    async def _create(self, key: str, model: str, prefix: List[dict], tokens: int) -> Optional[CacheEntry]:
+        """在服务端创建缓存，失败时在 failure_backoff 秒内不再尝试"""
+        self._ensure_maintenance()
+        await self._evict()
+        try:
+            name = await self.adapter.create_context_cache(model, prefix, self.ttl)
+        except Exception as e:
+            self._failed[key] = time.monotonic() + self.failure_backoff
+            metrics.incr("context_cache_errors", operation="create")
+            logger.warning(f"创建上下文缓存失败，{int(self.failure_backoff)} 秒内不再尝试: {str(e)}")
+            return None
+        entry = CacheEntry(key, model, name, self.ttl, tokens)
+        self._entries[key] = entry
+        metrics.incr("context_cache_created")
+        logger.info(f"已创建上下文缓存: {name}, 约 {tokens} tokens")
+        return entry
+
+    async def _evict(self):
+        """缓存数达到上限时删除最久未使用且没有被引用的缓存"""
+        while len(self._entries) >= self.max_entries:
+            idle = [e for e in self._entries.values() if e.refs == 0]
+            if not idle:
+                return
+            victim = min(idle, key=lambda e: e.last_used)
+            del self._entries[victim.key]
+            await self._delete(victim)
+
+    def release(self, entry: CacheEntry):
+        """请求结束，减少引用计数"""
+        entry.refs -= 1
+        entry.last_used = time.monotonic()
+
+    def invalidate(self, entry: CacheEntry):
+        """上游报告缓存不可用：丢弃本地记录，并在后台删除服务端缓存（已不存在时删除接口返回 404，不影响）"""
+        metrics.incr("context_cache_invalidated")
+        if self._entries.get(entry.key) is not entry:
+            # 并发的请求已经处理过
+            return
+        del self._entries[entry.key]
+        task = asyncio.ensure_future(self._delete(entry))
+        self._deleting.add(task)
+        task.add_done_callback(self._deleting.discard)
+
+    async def _delete(self, entry: CacheEntry):
+        try:
+            await self.adapter.delete_context_cache(entry.name)
+            metrics.incr("context_cache_deleted")
+        except Exception as e:
+            metrics.incr("context_cache_errors", operation="delete")
+            logger.warning(f"删除上下文缓存 {entry.name} 失败: {str(e)}")
+        entry.expires_at = 0
+
+    async def run(self, model: str, messages: List[dict],
+                  call: Callable[[List[dict], Optional[CacheEntry]], Awaitable]):
+        """拆出可缓存的前缀后调用 call(其余消息, 缓存)；没有可用缓存时 call(全部消息, None)"""
+        prefix, rest = split_system_prefix(messages)
+        entry = await self.acquire(model, prefix)
+        if entry is None:
+            return await call(messages, None)
+        try:
+            result = await call(rest, entry)
+        except ContextCacheMiss as e:
+            logger.warning(f"上下文缓存 {entry.name} 不可用，改为发送完整消息: {str(e)}")
+            self.invalidate(entry)
+            return await call(messages, None)
+        finally:
+            self.release(entry)
+        if getattr(self.adapter, "context_cache_refresh_on_use", False):
+            # 使用时即续期的提供商（如 Moonshot 的 reset_ttl）
+            entry.expires_at = time.monotonic() + self.ttl
+        return result
+
+    async def _maintain(self):
+        """后台任务：为仍在使用的缓存续期，删除长时间未使用的缓存"""
+        while self._entries or self._creating:
+            await asyncio.sleep(self.maintain_interval)
+            now = time.monotonic()
+            for entry in list(self._entries.values()):
+                remaining = entry.expires_at - now
+                idle = now - entry.last_used
+                if remaining <= 0 and entry.refs <= 0:
+                    # 服务端已过期
+                    del self._entries[entry.key]
+                elif remaining <= self.refresh_margin + self.maintain_interval:
+                    if entry.refs <= 0 and idle >= self.ttl / 2:
+                        # 即将过期且近期很少使用，不再续期
+                        del self._entries[entry.key]
+                        await self._delete(entry)
+                        continue
+                    try:
+                        await self.adapter.refresh_context_cache(entry.name, self.ttl)
+                        entry.expires_at = time.monotonic() + self.ttl
+                        metrics.incr("context_cache_refreshed")
+                    except Exception as e:
+                        metrics.incr("context_cache_errors", operation="refresh")
+                        logger.warning(f"上下文缓存 {entry.name} 续期失败: {str(e)}")
+                        if self._entries.get(entry.key) is entry:
+                            del self._entries[entry.key]
+                            # 不再引用的缓存在服务端过期前仍然计费
+                            await self._delete(entry)
+            self._failed = {key: until for key, until in self._failed.items() if until > now}
+
+    def status(self) -> dict:
+        return {"entries": [entry.to_dict() for entry in self._entries.values()], "tracked_prefixes": len(self._seen)}
+
+    async def close(self):
+        """停止维护任务并删除所有服务端缓存"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._deleting:
+            await asyncio.gather(*self._deleting, return_exceptions=True)
+        entries, self._entries = list(self._entries.values()), {}
+        for entry in entries:
+            if entry.expires_at > time.monotonic():
+                await self._delete(entry)
@@ -0,0 +1,196 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于在后台执行摘要任务
+import asyncio
+# 导入 datetime 模块，用于记录摘要时间
+import datetime
+# 导入 logging 模块，用于日志记录
+import logging
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional
+
+# 导入 token 估算
+from capabilities import estimate_tokens
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 生成摘要的指令
+SUMMARY_INSTRUCTION = ("你负责压缩对话记录。请把已有摘要和新的对话合并为一份简洁的摘要，"
+                       "保留用户的目标、偏好、已确认的事实、结论、代码或数据中的关键细节以及未解决的问题，"
+                       "省略寒暄和重复内容。直接输出摘要正文，不要添加说明。")
+# 拼装请求时摘要前的提示
+SUMMARY_PREFIX = "以下是此前对话的摘要：\n"
+# 各角色在摘要输入中的名称
+ROLE_NAMES = {"user": "用户", "assistant": "助手", "system": "系统"}
+
+
+def render_message(message: dict) -> str:
+    """把一条消息转换为摘要输入中的一行，图片等非文本内容用占位符表示"""
+    content = message.get("content", "")
+    if isinstance(content, list):
+        content = " ".join(part.get("text", "") if isinstance(part, dict) and part.get("type") == "text" else "[附件]"
+                           for part in content)
+    return f"{ROLE_NAMES.get(message.get('role'), message.get('role'))}：{content}"
+
+
+def _same_message(a, b) -> bool:
+    return isinstance(a, dict) and isinstance(b, dict) and a.get("role") == b.get("role") \
+        and a.get("content") == b.get("content")
+
+
+# 定义 ConversationCompactor 类，对长对话的较早部分滚动生成摘要
+class ConversationCompactor:
+    """长对话滚动摘要
+
+    会话中摘要之后的消息超过 threshold_tokens 时，在后台用配置的（较便宜的）模型把较早的对话
+    与已有摘要合并为新摘要，和覆盖的消息条数（watermark）一起保存在聊天历史中；最近约
+    keep_recent_tokens 的对话保留原文。之后的请求由 assemble 把已被摘要覆盖的消息替换为摘要。
+    每次只摘要上次 watermark 之后的新消息，单次输入不超过 chunk_tokens。
+    """
+
+    def __init__(self, chat_history, mcp, provider: Optional[str] = None, model: Optional[str] = None,
+                 threshold_tokens: int = 6000, keep_recent_tokens: int = 2000, chunk_tokens: int = 8000,
+                 max_summary_tokens: int = 800):
+        self.chat_history = chat_history  # 聊天历史记录管理实例
+        self.mcp = mcp  # MCP 实例，用于请求摘要模型
+        self.provider = provider  # 摘要使用的提供商，None 表示当前提供商
+        self.model = model  # 摘要使用的模型，None 表示该提供商配置的模型
+        self.threshold_tokens = threshold_tokens  # 未摘要的消息超过该值时开始压缩
+        self.keep_recent_tokens = keep_recent_tokens  # 保留原文的最近对话长度
+        self.chunk_tokens = chunk_tokens  # 单次摘要输入的新消息上限
+        self.max_summary_tokens = max_summary_tokens  # 摘要的最大输出长度
+        self._tasks: Dict[str, asyncio.Task] = {}  # 进行中的摘要任务，键为 history_id
+        self._again: set = set()  # 任务进行中又有新消息的会话
+
+    def assemble(self, history_id: Optional[str], messages: List[dict]) -> List[dict]:
+        """请求的对话以已摘要的消息开头时，把这些消息替换为摘要，否则原样返回"""
+        history = self.chat_history.get_history(history_id) if history_id else None
+        summary = (history or {}).get("summary")
+        if not summary:
+            return messages
+        covered = history["messages"][:summary["watermark"]]
+        start = 0
+        while start < len(messages) and isinstance(messages[start], dict) and messages[start].get("role") == "system":
+            start += 1
+        dialog = messages[start:]
+        # 客户端修改过早期消息或只发送了部分对话时不替换
+        if len(dialog) <= len(covered) or not all(_same_message(a, b) for a, b in zip(dialog, covered)):
+            return messages
+        metrics.incr("conversation_summary_applied")
+        metrics.incr("conversation_summary_tokens_saved",
+                      max(estimate_tokens(covered) - estimate_tokens([{"content": summary["text"]}]), 0))
+        return messages[:start] + [{"role": "system", "content": SUMMARY_PREFIX + summary["text"]}] \
+            + dialog[len(covered):]
+
+    def schedule(self, history_id: Optional[str]):
+        """会话有新消息后调用，需要压缩时在后台启动摘要任务，不等待结果"""
+        if not history_id:
+            return
+        if history_id in self._tasks:
+            self._again.add(history_id)
+            return
+        task = asyncio.ensure_future(self._run(history_id))
+        self._tasks[history_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(history_id, None))
+
+    async def _run(self, history_id: str):
+        while True:
+            try:
+                await self.compact(history_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                metrics.incr("conversation_summary_errors")
+                logger.warning(f"会话 {history_id} 生成摘要失败: {str(e)}")
+                return
+            if history_id not in self._again:
+                return
+            self._again.discard(history_id)
+
+    def _plan(self, messages: List[dict], watermark: int) -> int:
+        """返回本轮摘要的结束位置，不需要压缩时返回 watermark"""
+        if estimate_tokens(messages[watermark:]) < self.threshold_tokens:
+            return watermark
+        # 从最新的消息往前保留 keep_recent_tokens 的原文
+        cut, kept = len(messages), 0
+        while cut > watermark:
+            cost = estimate_tokens(messages[cut - 1:cut])
+            if kept + cost > self.keep_recent_tokens:
+                break
+            kept += cost
+            cut -= 1
+        # 保留的部分从一条用户消息开始，不拆开一问一答
+        while cut > watermark and (cut >= len(messages) or messages[cut].get("role") != "user"):
+            cut -= 1
+        if cut <= watermark:
+            return watermark
+        # 单次输入不超过 chunk_tokens，剩余部分在下一轮继续
+        end, used = watermark, 0
+        while end < cut:
+            cost = estimate_tokens(messages[end:end + 1])
+            if end > watermark and used + cost > self.chunk_tokens:
+                break
+            used += cost
+            end += 1
+        return end
+
+    async def compact(self, history_id: str) -> bool:
+        """把 watermark 之后可压缩的消息并入摘要，返回是否生成了新摘要"""
+        changed = False
+        while True:
+            history = self.chat_history.get_history(history_id)
+            if not history:
+                return changed
+            messages = history["messages"]
+            summary = history.get("summary") or {}
+            watermark = summary.get("watermark", 0)
+            end = self._plan(messages, watermark)
+            if end <= watermark:
+                return changed
+            prompt = [
+                {"role": "system", "content": SUMMARY_INSTRUCTION},
+                {"role": "user", "content": "已有摘要：\n" + (summary.get("text") or "（无）") + "\n\n新的对话：\n"
+                    + "\n".join(render_message(m) for m in messages[watermark:end] if isinstance(m, dict))},
+            ]
+            result = await self.mcp.complete(prompt, self.provider, self.model, max_tokens=self.max_summary_tokens,
+                                             consumer="summarizer", conversation=history_id)
+            text = str(result).strip()
+            if not text:
+                raise ValueError("摘要模型返回了空内容")
+            new_summary = {"text": text, "watermark": end, "updated_at": datetime.datetime.now().isoformat()}
+            if not await asyncio.to_thread(self.chat_history.set_summary, history_id, new_summary):
+                # 其他 worker 已写入覆盖范围更大的摘要，基于最新记录重新判断
+                continue
+            changed = True
+            metrics.incr("conversation_summaries")
+            logger.info(f"会话 {history_id} 已摘要前 {end} 条消息（新增 {end - watermark} 条）")
+
+    def status(self) -> dict:
+        return {"running": len(self._tasks), "provider": self.provider, "model": self.model,
+                "threshold_tokens": self.threshold_tokens, "keep_recent_tokens": self.keep_recent_tokens}
+
+    async def close(self):
+        """取消进行中的摘要任务"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
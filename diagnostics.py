@@ -0,0 +1,194 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于事件循环延迟采样
+import asyncio
+# 导入 collections 模块，用于保存最近的慢回调和汇总调用栈
+import collections
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 os 模块，用于缩短调用栈中的文件路径
+import os
+# 导入 sys 模块，用于读取各线程当前的调用栈
+import sys
+# 导入 threading 模块，看门狗和采样器运行在独立线程中，事件循环阻塞时仍能工作
+import threading
+# 导入 time 模块，用于计时
+import time
+# 导入 traceback 模块，用于格式化调用栈
+import traceback
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional
+
+# 导入运行指标记录模块
+from metrics import Histogram, metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 事件循环延迟直方图的分桶上界（秒）
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+# 定义 LoopMonitor 类，监控事件循环是否被同步代码阻塞
+class LoopMonitor:
+    """事件循环延迟监控
+
+    后台协程每 interval 秒 sleep 一次，实际唤醒时间比预期晚多少即为事件循环延迟，记入直方图；
+    看门狗线程不断向事件循环投递一个空回调，超过 slow_callback 秒仍未执行说明有回调阻塞了事件循环，
+    此时记录事件循环线程的调用栈（即正在阻塞的代码），阻塞结束后记录持续时间。
+    """
+
+    def __init__(self, interval: float = 0.5, slow_callback: float = 0.1, keep: int = 20):
+        self.interval = interval  # 延迟采样间隔（秒），0 表示不监控
+        self.slow_callback = slow_callback  # 超过该秒数视为慢回调
+        self.lag = Histogram(LAG_BUCKETS)  # 事件循环延迟分布
+        self.slow_callbacks = collections.deque(maxlen=keep)  # 最近的慢回调
+        self.stalls = 0  # 慢回调总次数
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None  # 事件循环所在线程的 id
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """在事件循环中调用，开始采样延迟并启动看门狗线程"""
+        if self.interval <= 0 or self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._task = asyncio.ensure_future(self.run())
+        if self.slow_callback > 0:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag.observe(max(0.0, loop.time() - started - self.interval))
+
+    def _watch(self):
+        """看门狗线程：检查事件循环能否及时执行回调"""
+        while not self._stop.is_set():
+            executed = threading.Event()
+            sent = time.monotonic()
+            try:
+                self._loop.call_soon_threadsafe(executed.set)
+            except RuntimeError:
+                # 事件循环已关闭
+                return
+            if not executed.wait(self.slow_callback):
+                self._capture(sent, executed)
+            self._stop.wait(self.slow_callback)
+
+    def _capture(self, sent: float, executed: threading.Event):
+        """事件循环阻塞中：记录事件循环线程的调用栈，等待阻塞结束后记录持续时间"""
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = traceback.format_stack(frame) if frame is not None else []
+        del frame
+        while not executed.wait(self.slow_callback):
+            if self._stop.is_set():
+                return
+        duration = time.monotonic() - sent
+        self.stalls += 1
+        self.slow_callbacks.append({"at": time.time(), "duration": round(duration, 3),
+                                    "stack": [line.rstrip() for line in stack]})
+        metrics.incr("event_loop_stalls")
+        location = stack[-1].strip().splitlines()[0] if stack else "未知位置"
+        logger.warning(f"事件循环被阻塞 {duration:.3f} 秒: {location}")
+
+    def status(self, stacks: bool = False) -> dict:
+        """stacks=False 时不返回调用栈（/metrics 使用，调用栈只在需要鉴权的调试接口中返回）"""
+        recent = [entry if stacks else {key: value for key, value in entry.items() if key != "stack"}
+                  for entry in list(self.slow_callbacks)]
+        return {"interval": self.interval, "slow_callback": self.slow_callback,
+                "lag": self.lag.snapshot(), "stalls": self.stalls, "slow_callbacks": recent}
+
+    async def close(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._watchdog is not None:
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+
+# 定义 SamplingProfiler 类，对运行中的进程做统计采样
+class SamplingProfiler:
+    """统计采样分析器
+
+    在独立线程中每 interval 秒读取一次所有线程的调用栈（sys._current_frames），不需要插桩，
+    对被分析的进程影响很小。结果为折叠调用栈格式（每行 "线程;外层函数;...;内层函数 采样数"），
+    可直接交给 flamegraph.pl、speedscope 或 inferno 生成火焰图。同一时间只允许一次分析。
+    """
+
+    def __init__(self, max_seconds: float = 60.0):
+        self.max_seconds = max_seconds  # 单次分析的最长时间（秒）
+        self._lock = threading.Lock()
+
+    @property
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    async def profile(self, seconds: float, interval: float = 0.005, loop_only: bool = False) -> str:
+        """采样 seconds 秒，返回折叠调用栈文本；loop_only=True 时只采样事件循环所在的线程"""
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError(f"分析时长必须在 0 到 {self.max_seconds:g} 秒之间")
+        if not 0.001 <= interval <= 1:
+            raise ValueError("采样间隔必须在 0.001 到 1 秒之间")
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("已有正在进行的分析")
+        try:
+            target = threading.get_ident() if loop_only else None
+            counts = await asyncio.to_thread(self._sample, seconds, interval, target)
+        finally:
+            self._lock.release()
+        metrics.incr("profiles")
+        return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+    @staticmethod
+    def _sample(seconds: float, interval: float, target: Optional[int]) -> collections.Counter:
+        own = threading.get_ident()
+        names: Dict[int, str] = {}
+        counts: collections.Counter = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if len(names) != threading.active_count():
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (target is not None and ident != target):
+                    continue
+                counts[";".join([names.get(ident, str(ident))] + _frames(frame))] += 1
+            time.sleep(interval)
+        return counts
+
+
+def _frames(frame) -> List[str]:
+    """从外到内的函数列表，每一项为 "函数 (文件:行号)"，与 py-spy 的格式相同"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试公共夹具
+"""
+
+import asyncio
+import os
+import sys
+from unittest import mock
+
+import pytest
+from aiohttp import web
+
+# 项目根目录和模拟上游服务所在目录加入导入路径
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.abspath(os.path.join(TESTS_DIR, "..", "..", ".."))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "load_tests"))
+
+from mock_provider import LatencyModel, MockProvider  # noqa: E402
+from api_adapter import (AnthropicAdapter, BaiduAdapter, GoogleAdapter, OllamaAdapter,  # noqa: E402
+                         OpenAIAdapter, ReplicateAdapter)
+from mcp_module import MCP  # noqa: E402
+
+# 提供商名称 -> 创建指向模拟上游的适配器
+MOCK_ADAPTERS = {
+    "openai": lambda url, **kwargs: OpenAIAdapter(api_key="bench", base_url=f"{url}/v1", **kwargs),
+    "anthropic": lambda url, **kwargs: AnthropicAdapter(api_key="bench", base_url=url, **kwargs),
+    "google": lambda url, **kwargs: GoogleAdapter(api_key="bench", base_url=url, **kwargs),
+    "ollama": lambda url, **kwargs: OllamaAdapter(base_url=url, **kwargs),
+    "baidu": lambda url, **kwargs: BaiduAdapter(api_key="bench", secret_key="bench", base_url=url, **kwargs),
+    "replicate": lambda url, **kwargs: ReplicateAdapter(api_key="bench", base_url=url, **kwargs),
+}
+
+# 导入 server 模块时使用的环境变量：状态只保存在内存中，不启动后台任务
+SERVER_ENV = {
+    "BAIYU_STATE_BACKEND": "memory",
+    "BAIYU_CONFIG_WATCH_INTERVAL": "0",
+    "BAIYU_WARMUP": "0",
+    "BAIYU_LOOP_MONITOR_INTERVAL": "0",
+}
+
+
+def build_conversation(turns: int, with_system: bool = True) -> list:
+    """构造一段多轮对话（OpenAI 格式）"""
+    messages = []
+    if with_system:
+        messages.append({"role": "system", "content": "你是一个乐于助人的助手，请用简洁的中文回答。"})
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"第 {i} 个问题：请解释一下什么是事件循环，以及它和线程池的区别。"})
+        messages.append({"role": "assistant", "content": f"第 {i} 个回答：事件循环在单线程中调度协程，" * 4})
+    messages.append({"role": "user", "content": "最后一个问题：请总结一下。"})
+    return messages
+
+
+@pytest.fixture(params=[5, 50], ids=["turns=5", "turns=50"])
+def conversation(request):
+    """不同长度的对话"""
+    return build_conversation(request.param)
+
+
+@pytest.fixture(scope="session")
+def event_loop_runner():
+    """基准测试共用的事件循环，返回同步执行协程的函数"""
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def build_mcp(tmp_path, event_loop_runner):
+    """返回创建 MCP 的函数：providers 中的提供商都指向模拟上游 url，第一个为当前提供商；测试结束时关闭连接池"""
+    created = []
+
+    def build(url: str, providers=("openai",), model: str = "mock-model", **kwargs) -> MCP:
+        mcp = MCP(config_file=str(tmp_path / "mcp_config.json"), **kwargs)
+        mcp.providers = {name: MOCK_ADAPTERS[name](url) for name in providers}
+        mcp.configurations = {name: {"model": model} for name in providers}
+        mcp.current_provider = providers[0]
+        mcp.publish_routes()
+        created.append(mcp)
+        return mcp
+
+    yield build
+    for mcp in created:
+        event_loop_runner(mcp.aclose())
+
+
+@pytest.fixture(scope="session")
+def server(event_loop_runner):
+    """导入 server 模块（不运行应用生命周期），测试通过 server.app 调用接口、修改 server.mcp 的提供商"""
+    with mock.patch.dict(os.environ, SERVER_ENV):
+        import server
+    yield server
+    event_loop_runner(server.mcp.aclose())
+    server.state.close()
+
+
+@pytest.fixture
+def serve(server, event_loop_runner):
+    """返回设置 server.mcp 提供商的函数：providers 中的提供商都指向模拟上游 url，第一个为当前提供商；测试结束时关闭连接池"""
+
+    def configure(url: str, providers=("openai",), model: str = "mock-model"):
+        server.mcp.providers = {name: MOCK_ADAPTERS[name](url) for name in providers}
+        server.mcp.configurations = {name: {"model": model} for name in providers}
+        server.mcp.current_provider = providers[0]
+        server.mcp.publish_routes()
+        return server
+
+    yield configure
+    event_loop_runner(server.mcp.aclose())
+
+
+@pytest.fixture(scope="session")
+def mock_upstream(event_loop_runner):
+    """在共用事件循环中启动零延迟的模拟上游，返回其地址"""
+    provider = MockProvider(LatencyModel("fixed:0"))
+    runner = web.AppRunner(provider.build_app())
+    event_loop_runner(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    event_loop_runner(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    yield f"http://127.0.0.1:{port}"
+    event_loop_runner(runner.cleanup())
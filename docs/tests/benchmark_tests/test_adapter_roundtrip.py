@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+适配器完整调用基准测试：消息校验、角色转换、请求序列化、响应解析
+上游为同一事件循环中零延迟的模拟服务，耗时主要来自网关自身的CPU工作和本机回环。
+"""
+
+import pytest
+
+from api_adapter import (
+    AliyunAdapter, AnthropicAdapter, BaiduAdapter, CohereAdapter,
+    GoogleAdapter, OllamaAdapter, OpenAIAdapter, SparkAdapter,
+)
+
+# 适配器名称 -> (以模拟上游地址构造适配器的函数, 模型名)
+ADAPTERS = {
+    "openai": (lambda url: OpenAIAdapter(api_key="bench", base_url=f"{url}/v1"), "mock-model"),
+    "anthropic": (lambda url: AnthropicAdapter(api_key="bench", base_url=url), "mock-model"),
+    "google": (lambda url: GoogleAdapter(api_key="bench", base_url=url), "mock-model"),
+    "cohere": (lambda url: CohereAdapter(api_key="bench", base_url=url), "mock-model"),
+    "ollama": (lambda url: OllamaAdapter(base_url=url), "mock-model"),
+    "baidu": (lambda url: BaiduAdapter(api_key="bench", secret_key="bench", base_url=url), "mock-model"),
+    "aliyun": (lambda url: AliyunAdapter(api_key="bench", base_url=url), "mock-model"),
+    "spark": (lambda url: SparkAdapter(api_key="bench", base_url=url), "spark-v3"),
+}
+
+
+@pytest.mark.parametrize("name", sorted(ADAPTERS))
+def test_chat_completion_roundtrip(benchmark, event_loop_runner, mock_upstream, conversation, name):
+    factory, model = ADAPTERS[name]
+    adapter = factory(mock_upstream)
+
+    def call():
+        return event_loop_runner(adapter.chat_completion(conversation, model))
+
+    assert benchmark(call)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+准入控制基准测试
+测量无竞争时获取和归还执行槽位的开销，并校验排队请求按优先级（同级先来先服务）获得槽位，
+队列已满、排队超时和超出调用方配额时快速拒绝并给出 Retry-After，取消排队请求后计数正确。
+"""
+
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+def test_acquire_release(benchmark, event_loop_runner):
+    controller = AdmissionController(max_in_flight=4)
+
+    async def cycle():
+        async with controller.slot():
+            pass
+
+    benchmark(lambda: event_loop_runner(cycle()))
+    assert controller.status()["in_flight"] == 0
+
+
+def test_priority_order(event_loop_runner):
+    controller = AdmissionController(max_in_flight=1)
+    order = []
+
+    async def request(name: str, priority: str):
+        async with controller.slot(priority):
+            order.append(name)
+
+    async def run():
+        await controller.acquire()
+        # 批量请求先排队，交互请求后到但优先获得槽位；同一类别按到达顺序
+        waiters = [asyncio.ensure_future(request(name, priority)) for name, priority in
+                   (("batch-1", "batch"), ("batch-2", "batch"), ("chat-1", "interactive"), ("chat-2", "interactive"))]
+        await asyncio.sleep(0)
+        assert controller.queued == 4
+        controller.release()
+        await asyncio.gather(*waiters)
+
+    event_loop_runner(run())
+    assert order == ["chat-1", "chat-2", "batch-1", "batch-2"]
+    assert controller.status()["in_flight"] == 0 and controller.queued == 0
+
+
+def test_rejections(event_loop_runner):
+    controller = AdmissionController(max_in_flight=1, max_queued=2, max_queued_per_consumer=1)
+
+    async def run():
+        await controller.acquire()
+        first = asyncio.ensure_future(controller.acquire(consumer="alice", queue_timeout=5))
+        await asyncio.sleep(0)
+        # 同一调用方超出排队配额
+        with pytest.raises(AdmissionRejected) as quota:
+            await controller.acquire(consumer="alice")
+        second = asyncio.ensure_future(controller.acquire(consumer="bob", queue_timeout=5))
+        await asyncio.sleep(0)
+        # 队列已满
+        with pytest.raises(AdmissionRejected) as full:
+            await controller.acquire(consumer="carol")
+        # 排队超时
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        with pytest.raises(AdmissionRejected) as timeout:
+            await controller.acquire(queue_timeout=0.05)
+        assert controller.queued == 1
+        controller.release(service_time=4.0)
+        await second
+        controller.release()
+        return quota.value, full.value, timeout.value
+
+    quota, full, timeout = event_loop_runner(run())
+    assert quota.status_code == 429 and "alice" in quota.reason
+    assert full.status_code == 503 and "队列已满" in full.reason
+    assert timeout.status_code == 503 and "超时" in timeout.reason
+    assert all(error.retry_after >= 1 for error in (quota, full, timeout))
+    # 取消和超时的等待者不占用排队数和配额
+    assert controller.status()["in_flight"] == 0 and controller.queued == 0
+    assert controller._queued_by_consumer == {}
+    with pytest.raises(ValueError):
+        event_loop_runner(controller.acquire("unknown"))
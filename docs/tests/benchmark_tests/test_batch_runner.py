@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+批量请求执行器测试
+校验 /v1/batch 并发扇出的并发上限、NDJSON 流式返回、后台任务写入输出文件和断点续跑，
+对照模拟上游校验原生批量接口（OpenAI 兼容 /files + /batches、Anthropic Message Batches）的提交、轮询和
+成功 / 失败 / 过期结果的映射、取消任务时同时取消提供商侧的批量任务，以及自动选择执行方式的条件。
+"""
+
+import asyncio
+import json
+
+import httpx
+import pytest
+from aiohttp import web
+
+from api_adapter import BaseAdapter
+from batch_runner import BatchRunner
+from mock_provider import LatencyModel, MockProvider
+from usage_accounting import UsageAccountant
+
+# custom_id 前缀决定模拟上游返回的结果，见 MockProvider.batch_outcome
+ITEMS = [
+    {"custom_id": "ok-1", "messages": [{"role": "user", "content": "第一个问题"}]},
+    {"custom_id": "ok-2", "messages": [{"role": "system", "content": "简洁回答"},
+                                       {"role": "user", "content": "第二个问题"}], "temperature": 0.2},
+    {"custom_id": "fail-1", "messages": [{"role": "user", "content": "会失败的问题"}]},
+    {"custom_id": "expire-1", "messages": [{"role": "user", "content": "来不及执行的问题"}]},
+]
+
+
+class _FlakyAdapter(BaseAdapter):
+    """记录同时执行的请求数；内容含“失败”的请求第一次调用时失败，之后成功"""
+
+    def __init__(self, delay: float = 0.02):
+        self.delay = delay
+        self.running = 0
+        self.peak = 0
+        self.calls = []
+        self.failed_once = set()
+
+    async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
+        question = messages[-1]["content"]
+        self.calls.append(question)
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.running -= 1
+        if "失败" in question and question not in self.failed_once:
+            self.failed_once.add(question)
+            raise Exception("模拟的上游错误")
+        return f"回答: {question}"
+
+
+def jsonl(questions) -> bytes:
+    """每行一个请求，不带 custom_id（使用行号）"""
+    return "\n".join(json.dumps({"messages": [{"role": "user", "content": q}]}, ensure_ascii=False)
+                     for q in questions).encode("utf-8")
+
+
+@pytest.fixture
+def batch_server(serve, mock_upstream, tmp_path, monkeypatch):
+    """server 的当前提供商换成 _FlakyAdapter，批量输出写到临时目录"""
+    server = serve(mock_upstream)
+    adapter = _FlakyAdapter()
+    server.mcp.providers["openai"] = adapter
+    server.mcp.publish_routes()
+    monkeypatch.setattr(server.batch_runner, "output_dir", str(tmp_path))
+    return server, adapter
+
+
+def test_batch_fanout_stream(event_loop_runner, batch_server):
+    server, adapter = batch_server
+    questions = [f"问题 {i}" for i in range(8)] + ["会失败的问题"]
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app),
+                                     base_url="http://testserver") as client:
+            bad = await client.post("/v1/batch", content=b'{"messages": [}')
+            response = await client.post("/v1/batch", params={"concurrency": 3}, content=jsonl(questions))
+        return bad, response
+
+    bad, response = event_loop_runner(run())
+    assert bad.status_code == 400
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    records = {record["custom_id"]: record for record in map(json.loads, response.text.splitlines())}
+    assert set(records) == {f"line-{i}" for i in range(1, len(questions) + 1)}
+    assert records["line-1"]["response"]["choices"][0]["message"]["content"] == "回答: 问题 0"
+    assert records["line-9"]["status"] == "failed" and "模拟的上游错误" in records["line-9"]["error"]
+    # 并发扇出不超过请求的并发数
+    assert adapter.peak == 3
+
+
+def test_batch_job_resume(event_loop_runner, batch_server, tmp_path):
+    server, adapter = batch_server
+    questions = ["问题 0", "会失败的问题", "问题 2"]
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app),
+                                     base_url="http://testserver") as client:
+            async def start(**params):
+                response = await client.post("/v1/batch", params={"output_file": "../job.jsonl", **params},
+                                             content=jsonl(questions))
+                if response.status_code == 200:
+                    job = response.json()["batch"]
+                    await server.batch_runner._tasks[job["batch_id"]]
+                return response
+
+            first = await start()
+            status = await client.get(f"/v1/batch/{first.json()['batch']['batch_id']}")
+            exists = await start()
+            resumed = await start(resume="true")
+            missing = await client.get("/v1/batch/unknown")
+        return first, status, exists, resumed, missing
+
+    first, status, exists, resumed, missing = event_loop_runner(run())
+    job = status.json()["batch"]
+    assert (job["status"], job["succeeded"], job["failed"], job["mode"]) == ("completed", 2, 1, "fanout")
+    # 输出文件名限定在输出目录内；不续跑时不覆盖已有文件
+    assert job["output_file"] == "job.jsonl"
+    assert exists.status_code == 409
+    resumed_job = server.batch_runner.jobs[resumed.json()["batch"]["batch_id"]]
+    assert (resumed_job["skipped"], resumed_job["succeeded"], resumed_job["failed"]) == (2, 1, 0)
+    # 续跑只重新执行失败的请求
+    assert adapter.calls.count("问题 0") == 1 and adapter.calls.count("会失败的问题") == 2
+    assert missing.status_code == 404
+    with open(tmp_path / "job.jsonl", encoding="utf-8") as f:
+        statuses = [(record["custom_id"], record["status"]) for record in map(json.loads, f)]
+    assert sorted(statuses) == [("line-1", "succeeded"), ("line-2", "failed"), ("line-2", "succeeded"),
+                                ("line-3", "succeeded")]
+    assert BatchRunner.load_completed_ids(str(tmp_path / "job.jsonl")) == {"line-1", "line-2", "line-3"}
+
+
+@pytest.fixture(scope="module")
+def batch_upstream(event_loop_runner):
+    """返回 (模拟上游, 地址)，测试可以检查批量任务被轮询的次数"""
+    provider = MockProvider(LatencyModel("fixed:0"))
+    runner = web.AppRunner(provider.build_app())
+    event_loop_runner(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    event_loop_runner(site.start())
+    yield provider, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    event_loop_runner(runner.cleanup())
+
+
+@pytest.mark.parametrize("provider_name", ["openai", "anthropic"])
+def test_native_result_mapping(event_loop_runner, build_mcp, batch_upstream, tmp_path, provider_name):
+    upstream, url = batch_upstream
+    mcp = build_mcp(url, (provider_name,))
+    mcp.usage = UsageAccountant(mcp.capabilities)
+    runner = BatchRunner(mcp, str(tmp_path), native_poll_interval=0.01)
+    job = {}
+    records = {record["custom_id"]: record for record in event_loop_runner(runner.run_native(ITEMS, job))}
+
+    # 第一次查询时任务仍在进行，执行器继续轮询直到完成
+    assert upstream.batches[job["provider_batch_id"]]["_polls"] >= 2
+    assert set(records) == {item["custom_id"] for item in ITEMS}
+    for custom_id, question in (("ok-1", "第一个问题"), ("ok-2", "第二个问题")):
+        assert records[custom_id]["status"] == "succeeded"
+        assert question in records[custom_id]["response"]["choices"][0]["message"]["content"]
+    assert records["fail-1"]["status"] == "failed" and "模拟的请求错误" in records["fail-1"]["error"]
+    assert records["expire-1"]["status"] == "failed" and "expired" in records["expire-1"]["error"]
+    # 只有成功的请求计入用量，且用量来自上游而不是估算
+    assert len(mcp.usage._pending) == 2
+    assert all(record[5] > 0 and not record[-1] for record in mcp.usage._pending)
+
+
+def test_native_job_writes_ndjson(event_loop_runner, build_mcp, batch_upstream, tmp_path):
+    mcp = build_mcp(batch_upstream[1])
+    runner = BatchRunner(mcp, str(tmp_path), native_poll_interval=0.01)
+    output_path = runner.resolve_output_path("native.jsonl")
+
+    async def run():
+        job = runner.start_job(ITEMS, output_path, mode="native")
+        await runner._tasks[job["batch_id"]]
+        return job
+
+    job = event_loop_runner(run())
+    assert job["status"] == "completed" and job["mode"] == "native"
+    assert (job["succeeded"], job["failed"]) == (2, 2)
+    with open(output_path, encoding="utf-8") as f:
+        lines = [json.loads(line) for line in f]
+    assert sorted(line["custom_id"] for line in lines) == sorted(item["custom_id"] for item in ITEMS)
+    # 续跑时只重新提交失败的请求
+    assert runner.load_completed_ids(output_path) == {"ok-1", "ok-2"}
+
+
+@pytest.mark.parametrize("provider_name", ["openai", "anthropic"])
+def test_native_job_cancel(event_loop_runner, build_mcp, batch_upstream, tmp_path, provider_name):
+    upstream, url = batch_upstream
+    runner = BatchRunner(build_mcp(url, (provider_name,)), str(tmp_path), native_poll_interval=30)
+    output_path = runner.resolve_output_path(f"cancel-{provider_name}.jsonl")
+
+    async def run():
+        job = runner.start_job(ITEMS, output_path, mode="native")
+        task = runner._tasks[job["batch_id"]]
+        while "provider_batch_id" not in job:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        assert runner.cancel_job(job["batch_id"])
+        await asyncio.gather(task, return_exceptions=True)
+        return job
+
+    job = event_loop_runner(run())
+    assert job["status"] == "cancelled" and job["provider_cancelled"] is True
+    # 提供商侧的批量任务也被取消，不会继续执行
+    batch = upstream.batches[job["provider_batch_id"]]
+    assert batch.get("status", batch.get("processing_status")) in ("cancelling", "canceling")
+
+
+def test_choose_mode(build_mcp, mock_upstream, tmp_path):
+    mcp = build_mcp(mock_upstream, ("openai", "anthropic", "ollama"))
+    runner = BatchRunner(mcp, str(tmp_path), native_min_items=3)
+    assert runner.choose_mode(ITEMS, "auto", latency_tolerant=True) == "native"
+    # 请求数不够或不能容忍延迟时使用并发扇出
+    assert runner.choose_mode(ITEMS[:2], "auto", latency_tolerant=True) == "fanout"
+    assert runner.choose_mode(ITEMS, "auto") == "fanout"
+    assert runner.choose_mode(ITEMS, "fanout", latency_tolerant=True) == "fanout"
+    # 原生批量接口不支持附件
+    with_files = ITEMS + [{"custom_id": "file-1", "messages": [{"role": "user", "content": "看图"}],
+                           "file_urls": ["http://example.com/a.png"]}]
+    assert runner.choose_mode(with_files, "auto", latency_tolerant=True) == "fanout"
+    with pytest.raises(ValueError):
+        runner.choose_mode(with_files, "native")
+    with pytest.raises(ValueError):
+        runner.choose_mode(ITEMS, "unknown")
+
+    # 适配器支持但模型能力数据标记为不支持批量接口
+    mcp.current_provider = "anthropic"
+    assert runner.choose_mode(ITEMS, "native") == "native"
+    mcp.configurations["anthropic"]["model"] = "claude-2.1"
+    with pytest.raises(ValueError):
+        runner.choose_mode(ITEMS, "native")
+    # 适配器没有原生批量接口
+    mcp.current_provider = "ollama"
+    assert runner.choose_mode(ITEMS, "auto", latency_tolerant=True) == "fanout"
+    with pytest.raises(ValueError):
+        runner.choose_mode(ITEMS, "native")
+
+
+def test_native_batch_expired(event_loop_runner, build_mcp, batch_upstream, tmp_path):
+    upstream, url = batch_upstream
+    runner = BatchRunner(build_mcp(url), str(tmp_path), native_poll_interval=0.01)
+    # 整个批量任务在完成窗口内没有完成
+    upstream.batch_final_status = "expired"
+    try:
+        with pytest.raises(Exception, match="expired"):
+            event_loop_runner(runner.run_native(ITEMS[:1]))
+    finally:
+        upstream.batch_final_status = "completed"
+
+
+def test_one_job_per_output(event_loop_runner, build_mcp, mock_upstream, tmp_path):
+    runner = BatchRunner(build_mcp(mock_upstream), str(tmp_path))
+    output_path = runner.resolve_output_path("shared.jsonl")
+
+    async def run():
+        first = runner.start_job(ITEMS, output_path)
+        # 第一个任务还在写入时，续跑同一个输出文件会交错写入同一文件，直接拒绝
+        with pytest.raises(FileExistsError, match=first["batch_id"]):
+            runner.start_job(ITEMS, runner.resolve_output_path("./shared.jsonl"), resume=True)
+        await runner._tasks[first["batch_id"]]
+        second = runner.start_job(ITEMS, output_path, resume=True)
+        await runner._tasks[second["batch_id"]]
+        return first, second
+
+    first, second = event_loop_runner(run())
+    assert first["succeeded"] == 4 and second["skipped"] == 4 and second["status"] == "completed"
+    with open(output_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 4
+
+
+def test_finished_jobs_pruned(event_loop_runner, build_mcp, mock_upstream, tmp_path):
+    runner = BatchRunner(build_mcp(mock_upstream), str(tmp_path), max_finished_jobs=2)
+
+    async def run():
+        jobs = []
+        for i in range(4):
+            job = runner.start_job(ITEMS[:1], runner.resolve_output_path(f"job-{i}.jsonl"))
+            await runner._tasks[job["batch_id"]]
+            jobs.append(job)
+        # 开始执行前就被取消的任务也会结束并释放输出文件
+        cancelled = runner.start_job(ITEMS[:1], runner.resolve_output_path("job-cancelled.jsonl"))
+        running = runner.start_job(ITEMS[:1], runner.resolve_output_path("job-running.jsonl"))
+        cancelled_task = runner._tasks[cancelled["batch_id"]]
+        assert runner.cancel_job(cancelled["batch_id"])
+        await asyncio.gather(cancelled_task, return_exceptions=True)
+        assert runner.jobs == {job["batch_id"]: job for job in (jobs[3], cancelled, running)}
+        await runner._tasks[running["batch_id"]]
+        return jobs, cancelled, running
+
+    jobs, cancelled, running = event_loop_runner(run())
+    assert cancelled["status"] == "cancelled" and "finished_at" in cancelled
+    assert list(runner.jobs) == [cancelled["batch_id"], running["batch_id"]]
+    assert runner._outputs == {} and runner._tasks == {}
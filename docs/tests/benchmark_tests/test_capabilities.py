@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+模型能力索引基准测试
+测量缓存命中时查询一个 (提供商, 模型) 能力的开销，并校验精确匹配、最长前缀匹配、提供商别名和默认值、
+数据文件修改后自动重新加载（加载失败时保留旧数据）、按上下文窗口裁剪历史，
+MCP 按配置的实际模型（而不是客户端传入的模型名）校验附件和限制输出长度，以及数据文件中没有的模型不受默认上限限制。
+"""
+
+import json
+import os
+
+import pytest
+
+from api_adapter import BaseAdapter
+from capabilities import CapabilityRegistry, estimate_tokens, fit_to_context
+
+DATA = {
+    "defaults": {"context_window": 4096, "max_output": 1024},
+    "aliases": {"智谱": "zhipu"},
+    "providers": {
+        "openai": {
+            "defaults": {"streaming": True, "batch": True},
+            "models": {
+                "gpt-4": {"context_window": 8192, "max_output": 4096},
+                "gpt-4o": {"context_window": 128000, "max_output": 16384, "vision": True},
+            },
+        },
+        "zhipu": {"models": {"glm-4v": {"vision": True}}},
+    },
+}
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "model_capabilities.json"
+    path.write_text(json.dumps(DATA), encoding="utf-8")
+    return path
+
+
+def test_lookup(benchmark, data_file):
+    registry = CapabilityRegistry(str(data_file), check_interval=3600)
+    first = registry.lookup("openai", "gpt-4o-2024-08-06")
+    caps = benchmark(registry.lookup, "openai", "gpt-4o-2024-08-06")
+    # 之后的查询直接返回缓存的结果
+    assert caps is first
+    assert (caps.matched, caps.context_window, caps.vision) == ("gpt-4o", 128000, True)
+
+
+def test_resolution(data_file):
+    registry = CapabilityRegistry(str(data_file))
+    # 最长前缀匹配：gpt-4o-mini 命中 gpt-4o 而不是 gpt-4
+    assert registry.lookup("OpenAI", "GPT-4o-mini").matched == "gpt-4o"
+    assert registry.lookup("openai", "gpt-4-turbo").to_dict()["context_window"] == 8192
+    # 提供商默认值覆盖全局默认值，未知模型使用提供商默认值
+    unknown = registry.lookup("openai", "o1")
+    assert (unknown.matched, unknown.context_window, unknown.streaming, unknown.batch) == (None, 4096, True, True)
+    # 配置中的中文提供商名称通过别名转换
+    assert registry.lookup("智谱", "glm-4v-plus").vision is True
+    # 未知提供商使用全局默认值
+    other = registry.lookup("其他", None)
+    assert (other.provider, other.max_output, other.vision, other.currency) == ("其他", 1024, False, "")
+
+
+def test_reload(data_file):
+    registry = CapabilityRegistry(str(data_file), check_interval=0)
+    assert registry.lookup("openai", "gpt-4").max_output == 4096
+
+    # 数据文件修改后下次查询时重新加载，不需要重启
+    data = json.loads(data_file.read_text(encoding="utf-8"))
+    data["providers"]["openai"]["models"]["gpt-4"]["max_output"] = 2048
+    data_file.write_text(json.dumps(data), encoding="utf-8")
+    os.utime(data_file, (0, 1))
+    assert registry.lookup("openai", "gpt-4").max_output == 2048
+
+    # 无法解析的数据文件不会清空已加载的数据
+    data_file.write_text("{", encoding="utf-8")
+    os.utime(data_file, (0, 2))
+    assert registry.lookup("openai", "gpt-4").max_output == 2048
+    registry.reload()
+    assert registry.lookup("openai", "gpt-4o").vision is True
+    assert set(registry.all()["providers"]) == {"openai", "zhipu"}
+
+
+def test_fit_to_context(data_file):
+    caps = CapabilityRegistry(str(data_file)).lookup("openai", "gpt-4")
+    system = {"role": "system", "content": "你是助手"}
+    old = [{"role": "user" if i % 2 == 0 else "assistant", "content": "字" * 3000} for i in range(6)]
+    last = {"role": "user", "content": "最新的问题"}
+    messages = [system] + old + [last]
+    # 预留 max_tokens 后放不下全部历史：保留系统消息和最后一条，丢弃最早的对话
+    fitted = fit_to_context(messages, caps, max_tokens=2048)
+    assert fitted[0] is system and fitted[-1] is last
+    assert fitted[1:-1] == old[-len(fitted) + 2:] and len(fitted) < len(messages)
+    assert estimate_tokens(fitted) <= caps.context_window - 2048
+    # 放得下时原样返回
+    assert fit_to_context([system, last], caps) == [system, last]
+    with pytest.raises(ValueError, match="上下文窗口"):
+        fit_to_context([system, {"role": "user", "content": "字" * 9000}], caps)
+
+
+class _CaptureAdapter(BaseAdapter):
+    """记录收到的模型和参数"""
+
+    async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
+        self.model, self.messages, self.kwargs = model, messages, kwargs
+        return "好的"
+
+
+def test_mcp_uses_configured_model(event_loop_runner, build_mcp, mock_upstream):
+    mcp = build_mcp(mock_upstream, model="gpt-4")
+    adapter = _CaptureAdapter()
+    mcp.providers["openai"] = adapter
+    mcp.configurations["openai"]["max_tokens"] = 100000
+    mcp.publish_routes()
+    messages = [{"role": "user", "content": "看图"}]
+    image = ["https://example.com/a.png"]
+
+    # 客户端传入支持图片的模型名，但实际调用配置的 gpt-4，不支持图片
+    with pytest.raises(ValueError, match="不支持图片/视频输入"):
+        event_loop_runner(mcp.handle_request(messages, "gpt-4o", file_urls=image))
+    event_loop_runner(mcp.handle_request(messages, "gpt-4o"))
+    # 输出长度限制在实际模型的上限内
+    assert adapter.model == "gpt-4" and adapter.kwargs["max_tokens"] == 4096
+
+    mcp.configurations["openai"]["model"] = "gpt-4o"
+    mcp.publish_routes()
+    event_loop_runner(mcp.handle_request(messages, "default", file_urls=image))
+    assert adapter.model == "gpt-4o" and adapter.kwargs["file_urls"] == image
+    assert adapter.kwargs["max_tokens"] == 16384
+
+
+def test_unlisted_model_not_limited(event_loop_runner, build_mcp, mock_upstream):
+    # 数据文件中没有的自定义模型：上下文窗口和输出上限未知，不裁剪历史、不限制 max_tokens
+    registry = CapabilityRegistry(os.path.join(os.path.dirname(__file__), "..", "..", "..", "model_capabilities.json"))
+    caps = registry.lookup("其他", "llama-3.1-405b-128k")
+    assert caps.matched is None
+    messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": "字" * 3000} for i in range(13)]
+    assert fit_to_context(messages, caps) is messages
+
+    mcp = build_mcp(mock_upstream, model="my-finetune")
+    adapter = _CaptureAdapter()
+    mcp.providers["openai"] = adapter
+    mcp.configurations["openai"]["max_tokens"] = 100000
+    mcp.publish_routes()
+    event_loop_runner(mcp.handle_request(messages, "default"))
+    assert adapter.kwargs["max_tokens"] == 100000 and len(adapter.messages) == 13
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+聊天历史存储基准测试
+"""
+
+import datetime
+import uuid
+
+import pytest
+
+from chat_history import ChatHistory, HISTORY_NAMESPACE
+from state_backend import MemoryBackend, SQLiteBackend
+
+
+def make_histories(count: int, messages_per_history: int = 4) -> dict:
+    """构造指定数量的会话记录"""
+    base = datetime.datetime(2025, 1, 1)
+    histories = {}
+    for i in range(count):
+        history_id = str(uuid.UUID(int=i))
+        timestamp = (base + datetime.timedelta(seconds=(i * 7919) % count)).isoformat()
+        histories[history_id] = {
+            "id": history_id,
+            "title": f"对话 {i}",
+            "created_at": timestamp,
+            "updated_at": timestamp,
+            "messages": [{"role": "user" if j % 2 == 0 else "assistant", "content": f"消息 {j}"}
+                         for j in range(messages_per_history)],
+            "is_favorite": i % 10 == 0,
+        }
+    return histories
+
+
+def make_store(tmp_path, count: int, backend=None) -> ChatHistory:
+    backend = backend or MemoryBackend()
+    backend.import_if_empty(HISTORY_NAMESPACE, make_histories(count))
+    return ChatHistory(history_file=str(tmp_path / "chat_histories.json"), backend=backend)
+
+
+@pytest.mark.parametrize("count", [10_000, 100_000], ids=["10k", "100k"])
+def test_get_histories(benchmark, tmp_path, count):
+    store = make_store(tmp_path, count)
+    result = benchmark(store.get_histories)
+    assert len(result) == count
+
+
+@pytest.mark.parametrize("count", [100, 1_000], ids=["100", "1k"])
+def test_add_message(benchmark, tmp_path, count):
+    # 每次追加消息只在 SQLite 事务中改写该会话，耗时不随会话总数增长
+    store = make_store(tmp_path, count, SQLiteBackend(str(tmp_path / "state.db")))
+    history_id = next(iter(store.histories))
+    message = {"role": "user", "content": "新的问题"}
+    assert benchmark(store.add_message, history_id, message)
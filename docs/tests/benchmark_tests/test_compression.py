@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+响应压缩和请求体解压基准测试
+测量压缩中间件处理会话列表这类大 JSON 响应的开销和压缩率，并校验编码协商、小响应不压缩和解压上限。
+"""
+
+import gzip
+import json
+import tracemalloc
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from compression import BROTLI_BOUNDED, CompressionMiddleware, available_encodings, choose_encoding, decompress
+from test_chat_history import make_histories
+
+# 约 100 个会话的列表
+HISTORIES = list(make_histories(100, messages_per_history=20).values())
+
+
+def build_client(**options) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/chat/histories")
+    async def histories():
+        return {"status": "success", "histories": HISTORIES}
+
+    @app.get("/small")
+    async def small():
+        return {"status": "success"}
+
+    @app.post("/echo")
+    async def echo(request: Request):
+        return {"length": len(await request.body()), "data": await request.json()}
+
+    app.add_middleware(CompressionMiddleware, **options)
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("encoding", ["identity"] + available_encodings())
+def test_histories_response(benchmark, encoding):
+    client = build_client()
+    response = benchmark(lambda: client.get("/chat/histories", headers={"Accept-Encoding": encoding}))
+    assert response.status_code == 200 and len(response.json()["histories"]) == 100
+    raw = len(json.dumps({"status": "success", "histories": HISTORIES}, ensure_ascii=False).encode("utf-8"))
+    if encoding == "identity":
+        assert "content-encoding" not in response.headers
+    else:
+        assert response.headers["content-encoding"] == encoding
+        assert int(response.headers["content-length"]) < raw / 5
+        assert "Accept-Encoding" in response.headers["vary"]
+
+
+def test_negotiation():
+    assert choose_encoding("gzip, deflate", ["br", "gzip"]) == "gzip"
+    assert choose_encoding("br;q=0.5, gzip", ["br", "gzip"]) == "gzip"
+    assert choose_encoding("*", ["br", "gzip"]) == "br"
+    assert choose_encoding("gzip;q=0, identity", ["gzip"]) is None
+    assert choose_encoding("", ["gzip"]) is None
+
+
+def test_small_response_not_compressed():
+    client = build_client(minimum_size=1024)
+    response = client.get("/small", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+
+
+def test_compressed_request_body():
+    client = build_client(max_request_size=64 * 1024)
+    payload = {"messages": [{"role": "user", "content": "你好" * 1000}]}
+    body = json.dumps(payload).encode("utf-8")
+    response = client.post("/echo", content=gzip.compress(body),
+                           headers={"Content-Encoding": "gzip", "Content-Type": "application/json"})
+    assert response.status_code == 200 and response.json() == {"length": len(body), "data": payload}
+
+    # 解压后超过上限、未知编码和损坏的数据
+    bomb = gzip.compress(b" " * (1024 * 1024))
+    assert client.post("/echo", content=bomb, headers={"Content-Encoding": "gzip"}).status_code == 413
+    assert client.post("/echo", content=body, headers={"Content-Encoding": "lz4"}).status_code == 415
+    assert client.post("/echo", content=b"not gzip", headers={"Content-Encoding": "gzip"}).status_code == 400
+
+
+@pytest.mark.skipif(not BROTLI_BOUNDED, reason="需要 brotli>=1.2")
+def test_brotli_bomb_bounded():
+    import brotli
+    # 几百字节的请求体解压后为 64MB
+    bomb = brotli.compress(b"\0" * (64 * 1024 * 1024), quality=1)
+    tracemalloc.start()
+    try:
+        with pytest.raises(OverflowError):
+            decompress(bomb, "br", 1024)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 1024 * 1024
+
+    client = build_client(max_request_size=1024)
+    assert client.post("/echo", content=bomb, headers={"Content-Encoding": "br"}).status_code == 413
+    body = json.dumps({"messages": []}).encode("utf-8")
+    response = client.post("/echo", content=brotli.compress(body),
+                           headers={"Content-Encoding": "br", "Content-Type": "application/json"})
+    assert response.status_code == 200 and response.json()["length"] == len(body)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+MCP 配置持久化测试
+校验配置文件原子写入（写入中途失败时原文件不受影响、不留临时文件），事件循环中合并窗口内的多次保存
+只在线程池中写一次文件，写入失败时保留修改并在下次写入时重试，切换配置文件前先写入尚未保存的修改，
+以及没有事件循环时立即写入。
+"""
+
+import asyncio
+import json
+import os
+import threading
+
+import pytest
+
+from mcp_module import MCP
+from metrics import metrics
+
+
+def read_config(path) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_write_atomic(tmp_path, monkeypatch):
+    path = tmp_path / "mcp_config.json"
+    MCP._write_atomic(str(path), '{"current_provider": "openai"}')
+    assert read_config(path) == {"current_provider": "openai"}
+
+    # 重命名前失败：原文件保持完整，临时文件被删除
+    def fail(src, dst):
+        raise OSError("磁盘已满")
+
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        MCP._write_atomic(str(path), '{"current_provider": "anthropic"}')
+    assert read_config(path) == {"current_provider": "openai"}
+    assert os.listdir(tmp_path) == ["mcp_config.json"]
+
+
+def test_debounced_save(event_loop_runner, build_mcp, mock_upstream, monkeypatch):
+    mcp = build_mcp(mock_upstream, save_delay=0.05)
+    write_atomic = MCP._write_atomic
+    threads = []
+
+    def record_thread(path, text):
+        threads.append(threading.get_ident())
+        return write_atomic(path, text)
+
+    monkeypatch.setattr(MCP, "_write_atomic", staticmethod(record_thread))
+    writes = metrics.get("config_writes")
+
+    async def run():
+        # 一次 /mcp/save_config 调用会多次保存，合并为一次写入
+        mcp.save_configuration("openai", {"model": "gpt-4o", "base_url": mock_upstream})
+        mcp.switch_current_provider("openai")
+        mcp.save_configuration("openai", {"model": "gpt-4o-mini", "base_url": mock_upstream})
+        assert not os.path.exists(mcp.config_file) and mcp._dirty
+        await asyncio.sleep(0.2)
+
+    event_loop_runner(run())
+    assert metrics.get("config_writes") == writes + 1
+    # 文件写入不阻塞事件循环
+    assert len(threads) == 1 and threads[0] != threading.get_ident()
+    saved = read_config(mcp.config_file)
+    assert saved["current_provider"] == "openai" and saved["configurations"]["openai"]["model"] == "gpt-4o-mini"
+    assert not mcp._dirty
+
+
+def test_failed_write_retried(event_loop_runner, build_mcp, mock_upstream, monkeypatch):
+    mcp = build_mcp(mock_upstream, save_delay=3600)
+    persist = mcp._persist
+    failures = []
+
+    def fail_once(path, text):
+        if not failures:
+            failures.append(path)
+            raise OSError("磁盘已满")
+        return persist(path, text)
+
+    monkeypatch.setattr(mcp, "_persist", fail_once)
+
+    async def run():
+        mcp.save_configuration("openai", {"model": "gpt-4o", "base_url": mock_upstream})
+        await mcp.flush_configurations()
+        # 写入失败时保留修改标记
+        assert mcp._dirty and not os.path.exists(mcp.config_file)
+        await mcp.flush_configurations()
+
+    event_loop_runner(run())
+    assert not mcp._dirty and read_config(mcp.config_file)["configurations"]["openai"]["model"] == "gpt-4o"
+
+
+def test_set_config_file_flushes(event_loop_runner, build_mcp, mock_upstream, tmp_path):
+    mcp = build_mcp(mock_upstream, save_delay=3600)
+    old_file = mcp.config_file
+
+    async def run():
+        mcp.save_configuration("openai", {"model": "gpt-4o", "base_url": mock_upstream})
+        # 切换配置文件前把尚未写入的修改保存到原文件
+        mcp.set_config_file(str(tmp_path / "other" / "mcp_config.json"))
+
+    event_loop_runner(run())
+    assert read_config(old_file)["configurations"]["openai"]["model"] == "gpt-4o"
+    assert mcp._save_handle is None and not mcp._dirty
+
+    # 没有运行中的事件循环时立即写入
+    mcp.save_configuration("openai", {"model": "gpt-4", "base_url": mock_upstream})
+    assert read_config(tmp_path / "other" / "mcp_config.json")["configurations"]["openai"]["model"] == "gpt-4"
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+服务端上下文缓存基准测试：Gemini cachedContents 与 Moonshot 上下文缓存
+对比启用缓存前后单次调用的网关开销，并在模拟上游上校验缓存的创建、引用、失效回退和删除。
+"""
+
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from api_adapter import GoogleAdapter, MoonshotAdapter
+from mock_provider import LatencyModel, MockProvider
+
+# 适配器名称 -> (以模拟上游地址构造适配器的函数, 模型名)
+ADAPTERS = {
+    "google": (lambda url: GoogleAdapter(api_key="bench", base_url=url), "gemini-1.5-flash"),
+    "moonshot": (lambda url: MoonshotAdapter(api_key="bench", base_url=url), "moonshot-v1-32k"),
+}
+
+# 约 5000 tokens 的参考文档，作为共享的系统提示
+REFERENCE = "以下是产品手册的内容，请据此回答用户的问题。" + "退货政策：收到商品七天内可无理由退货。" * 800
+
+
+def build_messages(question: str) -> list:
+    return [{"role": "system", "content": REFERENCE}, {"role": "user", "content": question}]
+
+
+@pytest.fixture
+def upstream(event_loop_runner):
+    """每个测试独立的模拟上游，返回 (地址, 模拟服务实例)"""
+    provider = MockProvider(LatencyModel("fixed:0"))
+    runner = web.AppRunner(provider.build_app())
+    event_loop_runner(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    event_loop_runner(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    yield f"http://127.0.0.1:{port}", provider
+    event_loop_runner(runner.cleanup())
+
+
+@pytest.mark.parametrize("cached", [False, True], ids=["plain", "context_cache"])
+@pytest.mark.parametrize("name", sorted(ADAPTERS))
+def test_shared_prefix_roundtrip(benchmark, event_loop_runner, upstream, name, cached):
+    url, _ = upstream
+    factory, model = ADAPTERS[name]
+    adapter = factory(url)
+    if cached:
+        adapter.enable_context_cache(min_repeats=1)
+
+    def call():
+        return event_loop_runner(adapter.chat_completion(build_messages("可以退货吗？"), model))
+
+    assert benchmark(call)
+    event_loop_runner(adapter.aclose())
+
+
+@pytest.mark.parametrize("name", sorted(ADAPTERS))
+def test_cache_lifecycle(event_loop_runner, upstream, name):
+    url, provider = upstream
+    factory, model = ADAPTERS[name]
+    adapter = factory(url)
+    adapter.enable_context_cache()
+
+    # 第一次出现不创建缓存，重复出现后创建并引用
+    first = event_loop_runner(adapter.chat_completion(build_messages("第一个问题"), model))
+    assert not provider.context_caches and "cache_read_tokens" not in first.usage
+    second = event_loop_runner(adapter.chat_completion(build_messages("第二个问题"), model))
+    assert len(provider.context_caches) == 1 and second.usage["cache_read_tokens"] > 0
+    third = event_loop_runner(adapter.chat_completion(build_messages("第三个问题"), model))
+    assert len(provider.context_caches) == 1 and third.usage["cache_read_tokens"] > 0
+    entry = adapter.context_cache.status()["entries"][0]
+    assert entry["hits"] == 2 and entry["refs"] == 0
+
+    # 服务端缓存提前失效：丢弃本地记录并发送完整消息
+    provider.context_caches.clear()
+    fallback = event_loop_runner(adapter.chat_completion(build_messages("第四个问题"), model))
+    assert fallback and "cache_read_tokens" not in fallback.usage
+    assert not adapter.context_cache.status()["entries"]
+
+    # 重新创建后，关闭适配器时删除服务端缓存
+    event_loop_runner(adapter.chat_completion(build_messages("第五个问题"), model))
+    assert len(provider.context_caches) == 1
+    event_loop_runner(adapter.aclose())
+    assert not provider.context_caches
+
+
+@pytest.mark.parametrize("name", sorted(ADAPTERS))
+def test_only_cache_errors_invalidate(event_loop_runner, upstream, name):
+    url, provider = upstream
+    factory, model = ADAPTERS[name]
+    adapter = factory(url)
+    adapter.enable_context_cache(min_repeats=1)
+    assert event_loop_runner(adapter.chat_completion(build_messages("第一个问题"), model))
+    assert len(provider.context_caches) == 1
+
+    # 参数校验失败不是缓存失效：照常报错，不重发请求，保留缓存
+    requests = provider.requests
+    with pytest.raises(Exception, match="400"):
+        event_loop_runner(adapter.chat_completion(build_messages("第二个问题"), model, temperature=5))
+    assert provider.requests == requests + 1
+    assert len(adapter.context_cache.status()["entries"]) == 1 and len(provider.context_caches) == 1
+
+    # 上游报告缓存不可用：发送完整消息，并删除仍在计费的服务端缓存
+    provider.unavailable_caches.update(provider.context_caches)
+    fallback = event_loop_runner(adapter.chat_completion(build_messages("第三个问题"), model))
+    assert fallback and "cache_read_tokens" not in fallback.usage
+    event_loop_runner(asyncio.sleep(0.05))
+    assert not adapter.context_cache.status()["entries"] and not provider.context_caches
+    event_loop_runner(adapter.aclose())
+
+
+def test_short_prefix_not_cached(event_loop_runner, upstream):
+    url, provider = upstream
+    adapter = MoonshotAdapter(api_key="bench", base_url=url)
+    adapter.enable_context_cache(min_repeats=1)
+    messages = [{"role": "system", "content": "简短的系统提示"}, {"role": "user", "content": "你好"}]
+    for _ in range(3):
+        assert event_loop_runner(adapter.chat_completion(messages, "moonshot-v1-8k"))
+    assert not provider.context_caches
+    event_loop_runner(adapter.aclose())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+长对话滚动摘要基准测试
+测量用摘要替换已压缩消息拼装请求的开销，并校验超过阈值后只摘要较早的对话（保留的最近对话从用户消息开始）、
+之后只把 watermark 之后的新消息并入已有摘要、单次输入按 chunk_tokens 分批、摘要只能前进，
+以及后台任务在进行中收到新消息时再压缩一轮。
+"""
+
+import asyncio
+
+import pytest
+
+from api_adapter import BaseAdapter
+from chat_history import ChatHistory
+from conversation_summary import SUMMARY_PREFIX, ConversationCompactor
+from state_backend import MemoryBackend
+
+
+def message(i: int) -> dict:
+    # 约 304 tokens
+    return {"role": "user" if i % 2 == 0 else "assistant", "content": f"消息{i}：" + "字" * 296}
+
+
+class _SummaryAdapter(BaseAdapter):
+    """记录摘要请求，依次返回 摘要1、摘要2……；gate 未打开时请求挂起"""
+
+    def __init__(self):
+        self.prompts = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
+        await self.gate.wait()
+        self.prompts.append(messages[-1]["content"])
+        return f"摘要{len(self.prompts)}"
+
+
+@pytest.fixture
+def compactor(build_mcp, mock_upstream, tmp_path):
+    """返回 (摘要器, 聊天历史, 会话ID, 摘要适配器)：未摘要的消息超过 1000 tokens 时压缩，保留约 700 tokens 原文"""
+    mcp = build_mcp(mock_upstream)
+    adapter = _SummaryAdapter()
+    mcp.providers["openai"] = adapter
+    mcp.publish_routes()
+    history = ChatHistory(str(tmp_path / "chat_histories.json"), backend=MemoryBackend())
+    history_id = history.create_history()
+    return (ConversationCompactor(history, mcp, threshold_tokens=1000, keep_recent_tokens=700),
+            history, history_id, adapter)
+
+
+def add_messages(history: ChatHistory, history_id: str, start: int, stop: int):
+    for i in range(start, stop):
+        history.add_message(history_id, message(i))
+
+
+def test_assemble(benchmark, compactor):
+    summarizer, history, history_id, _ = compactor
+    add_messages(history, history_id, 0, 10)
+    assert history.set_summary(history_id, {"text": "用户在咨询退货", "watermark": 6})
+    messages = [{"role": "system", "content": "你是客服"}] + [message(i) for i in range(10)] + [message(10)]
+    assembled = benchmark(summarizer.assemble, history_id, messages)
+    assert assembled[:2] == [{"role": "system", "content": "你是客服"},
+                             {"role": "system", "content": SUMMARY_PREFIX + "用户在咨询退货"}]
+    assert assembled[2:] == [message(i) for i in range(6, 11)]
+
+    # 客户端修改过早期消息、只发送了部分对话或会话没有摘要时原样发送
+    edited = [dict(message(0), content="修改过的问题")] + [message(i) for i in range(1, 11)]
+    assert summarizer.assemble(history_id, edited) is edited
+    partial = [message(i) for i in range(4)]
+    assert summarizer.assemble(history_id, partial) is partial
+    assert summarizer.assemble(None, messages) is messages
+
+
+def test_incremental_compaction(event_loop_runner, compactor):
+    summarizer, history, history_id, adapter = compactor
+    add_messages(history, history_id, 0, 3)
+    # 未超过阈值时不压缩
+    assert not event_loop_runner(summarizer.compact(history_id)) and adapter.prompts == []
+
+    add_messages(history, history_id, 3, 8)
+    assert event_loop_runner(summarizer.compact(history_id))
+    summary = history.get_history(history_id)["summary"]
+    # 保留最近两条（一问一答）原文，其余并入摘要
+    assert (summary["text"], summary["watermark"]) == ("摘要1", 6)
+    assert "（无）" in adapter.prompts[0] and "消息5" in adapter.prompts[0] and "消息6" not in adapter.prompts[0]
+    assert "用户：消息0" in adapter.prompts[0] and "助手：消息1" in adapter.prompts[0]
+
+    # 下一轮只发送已有摘要和 watermark 之后的新消息
+    add_messages(history, history_id, 8, 12)
+    assert event_loop_runner(summarizer.compact(history_id))
+    prompt = adapter.prompts[1]
+    assert "摘要1" in prompt and "消息6" in prompt and "消息9" in prompt
+    assert "消息5" not in prompt and "消息10" not in prompt
+    assert history.get_history(history_id)["summary"]["watermark"] == 10
+
+    # 摘要只能前进，其他 worker 写入的较小 watermark 被忽略
+    assert not history.set_summary(history_id, {"text": "旧摘要", "watermark": 6})
+    assert not history.set_summary(history_id, {"text": "越界", "watermark": 13})
+    assert history.get_history(history_id)["summary"]["text"] == "摘要2"
+
+
+def test_chunked_compaction(event_loop_runner, compactor):
+    summarizer, history, history_id, adapter = compactor
+    summarizer.chunk_tokens = 700
+    add_messages(history, history_id, 0, 8)
+    assert event_loop_runner(summarizer.compact(history_id))
+    # 单次输入最多约 700 tokens（两条消息），分三轮压缩到同一位置
+    assert len(adapter.prompts) == 3 and "摘要1" in adapter.prompts[1] and "摘要2" in adapter.prompts[2]
+    assert "消息2" in adapter.prompts[1] and "消息1" not in adapter.prompts[1]
+    summary = history.get_history(history_id)["summary"]
+    assert (summary["text"], summary["watermark"]) == ("摘要3", 6)
+
+
+def test_background_schedule(event_loop_runner, compactor):
+    summarizer, history, history_id, adapter = compactor
+    add_messages(history, history_id, 0, 8)
+
+    async def run():
+        adapter.gate.clear()
+        summarizer.schedule(history_id)
+        await asyncio.sleep(0.01)
+        # 摘要在后台进行，不阻塞请求；进行中收到新消息时结束后再压缩一轮
+        assert summarizer.status()["running"] == 1
+        add_messages(history, history_id, 8, 12)
+        summarizer.schedule(history_id)
+        assert summarizer.status()["running"] == 1
+        adapter.gate.set()
+        while summarizer.status()["running"]:
+            await asyncio.sleep(0.01)
+
+    event_loop_runner(run())
+    assert len(adapter.prompts) == 2 and history.get_history(history_id)["summary"]["watermark"] == 10
+
+    async def cancel():
+        add_messages(history, history_id, 12, 16)
+        adapter.gate.clear()
+        summarizer.schedule(history_id)
+        await asyncio.sleep(0.01)
+        await summarizer.close()
+
+    event_loop_runner(cancel())
+    assert summarizer.status()["running"] == 0
+    assert history.get_history(history_id)["summary"]["watermark"] == 10
+    summarizer.schedule(None)
+    assert summarizer.status()["running"] == 0
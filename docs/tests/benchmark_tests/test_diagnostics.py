@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+事件循环监控和采样分析基准测试
+测量记录一次事件循环延迟的开销，并校验看门狗能捕获阻塞事件循环的代码的调用栈、
+采样分析器输出的折叠调用栈包含正在运行的函数。
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from diagnostics import LoopMonitor, SamplingProfiler
+from metrics import Histogram
+
+
+def test_histogram_observe(benchmark):
+    histogram = Histogram((0.001, 0.01, 0.1, 1.0))
+    benchmark(histogram.observe, 0.005)
+    histogram.reset()
+    for value in (0.0005, 0.05, 0.05, 3):
+        histogram.observe(value)
+    snapshot = histogram.snapshot()
+    assert [bucket["count"] for bucket in snapshot["buckets"]] == [1, 1, 3, 3, 4]
+    assert snapshot["buckets"][-1]["le"] == "+Inf" and snapshot["max"] == 3
+
+
+def block_event_loop():
+    # 模拟在事件循环中同步执行的耗时操作
+    time.sleep(0.3)
+
+
+def test_slow_callback_stack(event_loop_runner):
+    monitor = LoopMonitor(interval=0.05, slow_callback=0.05)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.1)
+        block_event_loop()
+        await asyncio.sleep(0.2)
+        await monitor.close()
+
+    event_loop_runner(run())
+    status = monitor.status(stacks=True)
+    assert status["stalls"] == 1
+    stall = status["slow_callbacks"][0]
+    assert stall["duration"] >= 0.25
+    assert any("block_event_loop" in line for line in stall["stack"])
+    # 阻塞期间的延迟记入直方图
+    assert status["lag"]["max"] >= 0.2
+    assert "stack" not in monitor.status()["slow_callbacks"][0]
+
+
+def busy_loop(seconds: float):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        sum(range(1000))
+
+
+def test_profile_folded_output(event_loop_runner):
+    profiler = SamplingProfiler(max_seconds=5)
+
+    async def run():
+        profiling = asyncio.ensure_future(profiler.profile(0.3, 0.002, loop_only=True))
+        await asyncio.sleep(0)
+        busy_loop(0.2)
+        with pytest.raises(RuntimeError):
+            await profiler.profile(0.1)
+        return await profiling
+
+    folded = event_loop_runner(run())
+    lines = folded.splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("busy_loop (test_diagnostics.py:" in line for line in lines)
+    assert not profiler.busy
+    with pytest.raises(ValueError):
+        event_loop_runner(profiler.profile(10))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+客户端断开连接测试
+校验 /v1/chat/completions 的客户端在上游调用完成前断开时返回 499，并取消上游的 Replicate 预测，
+无论断开发生在创建预测还是轮询预测状态的过程中。
+"""
+
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+
+from metrics import metrics
+from mock_provider import LatencyModel, MockProvider
+
+
+async def call_until_disconnect(app, path: str, body: dict, disconnect_after: float) -> list:
+    """直接调用 ASGI 应用，请求体发送完 disconnect_after 秒后客户端断开，返回应用发送的消息"""
+    loop = asyncio.get_running_loop()
+    disconnect_at = loop.time() + disconnect_after
+    pending = [{"type": "http.request", "body": json.dumps(body).encode("utf-8"), "more_body": False}]
+    sent = []
+
+    async def receive():
+        if pending:
+            return pending.pop(0)
+        # Request.is_disconnected 会立即取消未就绪的 receive，到点后才不经等待直接返回断开
+        if loop.time() < disconnect_at:
+            await asyncio.sleep(disconnect_at - loop.time())
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"content-type", b"application/json")], "client": ("127.0.0.1", 1),
+             "server": ("testserver", 80)}
+    await app(scope, receive, send)
+    return sent
+
+
+@pytest.fixture(params=[0.5, 0], ids=["during-create", "during-poll"])
+def replicate_upstream(request, event_loop_runner):
+    """返回 (模拟上游, 地址)；创建预测耗时 0.5 秒时客户端在创建过程中断开，否则在轮询间隔中断开"""
+    provider = MockProvider(LatencyModel(f"fixed:{request.param}"))
+    runner = web.AppRunner(provider.build_app())
+    event_loop_runner(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    event_loop_runner(site.start())
+    yield provider, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    event_loop_runner(runner.cleanup())
+
+
+def test_disconnect_cancels_prediction(event_loop_runner, serve, replicate_upstream):
+    upstream, url = replicate_upstream
+    server = serve(url, ("replicate",))
+    before = metrics.get("chat_requests_cancelled", reason="client_disconnect", provider="replicate")
+
+    async def run():
+        sent = await call_until_disconnect(server.app, "/v1/chat/completions",
+                                           {"messages": [{"role": "user", "content": "你好"}]}, 0.2)
+        # 取消请求在后台发送：创建中断开时要等预测创建完成
+        for _ in range(100):
+            if upstream.predictions and all(p["status"] == "canceled" for p in upstream.predictions.values()):
+                break
+            await asyncio.sleep(0.02)
+        return sent
+
+    sent = event_loop_runner(run())
+    assert sent[0]["type"] == "http.response.start" and sent[0]["status"] == 499
+    assert len(upstream.predictions) == 1
+    assert [p["status"] for p in upstream.predictions.values()] == ["canceled"]
+    assert metrics.get("chat_requests_cancelled", reason="client_disconnect", provider="replicate") == before + 1
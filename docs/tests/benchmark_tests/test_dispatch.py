@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+MCP 路由开销基准测试：准入控制、路由解析和参数整理，不含上游耗时
+"""
+
+from api_adapter import BaseAdapter
+from mcp_module import MCP
+
+
+class _EchoAdapter(BaseAdapter):
+    """立即返回的适配器，用于单独测量 MCP 的分发开销"""
+
+    async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
+        return messages[-1]["content"]
+
+
+def test_handle_request_dispatch(benchmark, event_loop_runner, tmp_path, conversation):
+    mcp = MCP(config_file=str(tmp_path / "mcp_config.json"))
+    mcp.providers["bench"] = _EchoAdapter()
+    mcp.configurations["bench"] = {"model": "bench-model", "temperature": 0.7, "max_tokens": 1024}
+    mcp.current_provider = "bench"
+    mcp.publish_routes()
+
+    def call():
+        return event_loop_runner(mcp.handle_request(conversation, "default"))
+
+    assert benchmark(call)
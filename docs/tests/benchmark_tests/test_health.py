@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+提供商健康探测和模型列表缓存基准测试
+测量一轮并发探测的耗时和路由时查询健康状态的开销，并校验不健康的提供商快速失败、
+一次成功即恢复，聊天请求探测不经过准入控制（网关过载不计为提供商故障），以及模型列表缓存在后台刷新、不阻塞调用方。
+"""
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+from api_adapter import OpenAIAdapter
+from health import ProviderHealth
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+# 百度不支持模型列表，只检查连接
+PROVIDERS = ("openai", "ollama", "baidu")
+
+
+def test_probe_all(benchmark, event_loop_runner, mock_upstream, build_mcp):
+    mcp = build_mcp(mock_upstream, PROVIDERS)
+    health = ProviderHealth(mcp)
+    benchmark(lambda: event_loop_runner(health.probe_all()))
+    status = health.status()
+    assert {name: entry["method"] for name, entry in status["providers"].items()} == {
+        "openai": "models", "ollama": "models", "baidu": "connect"}
+    assert all(health.is_healthy(name) and health.latency(name) is not None for name in mcp.providers)
+    assert health.cached_models("ollama") == ["mock-model", "mock-vision-model"]
+
+
+def test_health_lookup(benchmark, mock_upstream, build_mcp):
+    mcp = build_mcp(mock_upstream, PROVIDERS)
+    mcp.health = ProviderHealth(mcp, fail_fast=True)
+    mcp.health._record("openai", True, 0.05, "models", None)
+    # resolve_route 中的健康检查为一次字典查询
+    assert benchmark(lambda: mcp.resolve_route("default"))[0] == "openai"
+
+
+def test_fail_fast_and_recovery(event_loop_runner, mock_upstream, build_mcp):
+    mcp = build_mcp(mock_upstream, PROVIDERS)
+    healthy = mcp.providers["openai"]
+    # 没有服务监听的端口
+    broken = OpenAIAdapter(api_key="bench", base_url="http://127.0.0.1:9/v1")
+    mcp.providers = dict(mcp.providers, openai=broken)
+    mcp.publish_routes()
+    mcp.health = ProviderHealth(mcp, failure_threshold=2, fail_fast=True)
+
+    event_loop_runner(mcp.health.probe_all())
+    assert mcp.health.is_healthy("openai")  # 一次失败不足以标记为不健康
+    event_loop_runner(mcp.health.probe_all())
+    assert not mcp.health.is_healthy("openai")
+    with pytest.raises(AdmissionRejected) as rejected:
+        event_loop_runner(mcp.handle_request(MESSAGES, "default"))
+    assert rejected.value.status_code == 503 and rejected.value.retry_after >= 1
+
+    # 上游恢复后一次探测成功即恢复
+    mcp.providers = dict(mcp.providers, openai=healthy)
+    mcp.publish_routes()
+    event_loop_runner(mcp.health.probe_all())
+    assert mcp.health.is_healthy("openai")
+    assert event_loop_runner(mcp.handle_request(MESSAGES, "default"))
+    event_loop_runner(broken.aclose())
+
+
+def test_completion_probe_bypasses_admission(event_loop_runner, mock_upstream, build_mcp):
+    mcp = build_mcp(mock_upstream, ("baidu",))
+    # 网关已满载且不允许排队，普通请求会被立即拒绝
+    mcp.admission = AdmissionController(max_in_flight=1, max_queued=0)
+    mcp.health = ProviderHealth(mcp, failure_threshold=1, probe_completions=True, fail_fast=True)
+
+    async def run():
+        async with mcp.admission.slot("interactive"):
+            with pytest.raises(AdmissionRejected):
+                await mcp.complete(MESSAGES)
+            await mcp.health.probe_all()
+
+    event_loop_runner(run())
+    # 探测直接发给提供商，过载不会把健康的提供商标记为不可用
+    assert mcp.health.is_healthy("baidu") and mcp.health.status()["providers"]["baidu"]["method"] == "completion"
+
+
+def test_model_catalogue(event_loop_runner, mock_upstream, build_mcp):
+    mcp = build_mcp(mock_upstream, PROVIDERS)
+    health = ProviderHealth(mcp, catalogue_ttl=3600)
+
+    async def first_lookup():
+        # 没有缓存时立即返回，并在后台刷新
+        result = health.models("openai")
+        await health.refresh_models("openai")
+        return result
+
+    assert event_loop_runner(first_lookup()) == {"models": None, "stale": True, "refreshing": True}
+    assert health.models("openai") == {"models": ["mock-model", "mock-vision-model"], "stale": False,
+                                       "refreshing": False}
+    assert health.validate_model("openai", "mock-model") is None
+    assert health.validate_model("openai", "gpt-5") is not None
+    # 没有缓存的提供商不检查
+    assert health.validate_model("baidu", "ernie") is None
+    assert health.refresh_models("baidu") is None
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+配置热更新基准测试
+测量请求固定和释放路由快照的开销，并校验更换密钥时进行中的请求在旧适配器上完成、新请求使用新适配器、
+旧适配器在最后一个请求结束后才关闭，导入配置只发布一个快照，配置文件被外部修改后自动重新加载，
+以及请求中的错误信息使用固定的快照而不是正在修改的当前提供商。
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from api_adapter import BaseAdapter
+
+
+class _GatedAdapter(BaseAdapter):
+    """按密钥区分的适配器：gate 未打开时请求挂起，记录是否已关闭"""
+
+    def __init__(self, api_key: str = ""):
+        self.api_key = api_key
+        self.gate = asyncio.Event()
+        self.closed = False
+
+    async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
+        await self.gate.wait()
+        return f"{self.api_key}:{model}"
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def gated_mcp(build_mcp, mock_upstream):
+    """适配器由 _GatedAdapter 替代的 MCP，当前提供商 openai 使用密钥 key-1"""
+    mcp = build_mcp(mock_upstream)
+    mcp._create_adapter = lambda name, config: _GatedAdapter(config.get("api_key", ""))
+    mcp.providers, mcp.configurations = {}, {}
+    mcp.save_configuration("openai", {"model": "mock-model", "api_key": "key-1"})
+    return mcp
+
+
+def test_pin_routes(benchmark, build_mcp, mock_upstream):
+    mcp = build_mcp(mock_upstream)
+
+    def pin():
+        with mcp.pin_routes() as routes:
+            return routes
+
+    routes = benchmark(pin)
+    assert routes is mcp._routes and routes.active == 0
+
+
+def test_key_rotation(event_loop_runner, gated_mcp):
+    mcp = gated_mcp
+    messages = [{"role": "user", "content": "你好"}]
+
+    async def run():
+        old = mcp.providers["openai"]
+        old_request = asyncio.ensure_future(mcp.handle_request(messages, "default"))
+        await asyncio.sleep(0.01)
+        version = mcp.routing_status()["version"]
+        # 更换密钥：发布新快照，进行中的请求继续使用旧快照
+        mcp.save_configuration("openai", {"model": "mock-model", "api_key": "key-2"})
+        new = mcp.providers["openai"]
+        assert new is not old and mcp.routing_status()["version"] == version + 1
+        assert mcp.routing_status()["draining"] == [{"version": version, "active": 1}]
+        new.gate.set()
+        assert str(await mcp.handle_request(messages, "default")) == "key-2:mock-model"
+        # 旧适配器在最后一个请求结束前不关闭
+        assert not old.closed
+        old.gate.set()
+        answer = await old_request
+        await asyncio.sleep(0)
+        return old, new, answer
+
+    old, new, answer = event_loop_runner(run())
+    assert str(answer) == "key-1:mock-model"
+    assert old.closed and not new.closed
+    assert mcp.routing_status()["draining"] == []
+
+
+def test_import_publishes_once(event_loop_runner, gated_mcp):
+    mcp = gated_mcp
+    version = mcp.routing_status()["version"]
+    mcp.import_configuration({"openai": {"model": "gpt-4o", "api_key": "key-2"},
+                              "anthropic": {"model": "claude-3-5-sonnet", "api_key": "key-3"}})
+    # 所有修改完成后只发布一个快照
+    assert mcp.routing_status()["version"] == version + 1
+    routes = mcp._routes
+    assert routes.providers["openai"].api_key == "key-2" and routes.providers["anthropic"].api_key == "key-3"
+    assert routes.configurations["openai"]["model"] == "gpt-4o"
+    with pytest.raises(ValueError):
+        mcp.import_configuration(["openai"])
+
+
+def test_watch_config(event_loop_runner, gated_mcp):
+    mcp = gated_mcp
+    mcp.save_configuration("anthropic", {"model": "claude-3-5-sonnet", "api_key": "key-3"})
+    anthropic = mcp.providers["anthropic"]
+
+    async def run():
+        watcher = asyncio.ensure_future(mcp.watch_config(interval=0.01))
+        try:
+            await asyncio.sleep(0.05)
+            # 运维直接修改配置文件：更换密钥并切换当前提供商
+            with open(mcp.config_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            data["configurations"]["openai"]["api_key"] = "key-2"
+            data["current_provider"] = "anthropic"
+            mcp._write_atomic(mcp.config_file, json.dumps(data))
+            for _ in range(100):
+                if mcp._routes.current_provider == "anthropic":
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+
+    event_loop_runner(run())
+    routes = mcp._routes
+    assert routes.current_provider == "anthropic" and routes.providers["openai"].api_key == "key-2"
+    # 只修改了 openai 的密钥，anthropic 的适配器继续使用
+    assert routes.providers["anthropic"] is anthropic and not anthropic.closed
+
+
+def test_multimodal_error_uses_pinned_route(event_loop_runner, build_mcp, mock_upstream):
+    mcp = build_mcp(mock_upstream, providers=("openai", "anthropic"))
+    # 当前提供商已被修改但新快照尚未发布，请求仍按已发布的快照路由到 openai
+    mcp.current_provider = "anthropic"
+    with pytest.raises(ValueError) as error:
+        event_loop_runner(mcp.handle_request([{"role": "user", "content": "看图"}], "default",
+                                             file_urls=["https://example.com/a.png"]))
+    assert "(openai/mock-model)" in str(error.value)
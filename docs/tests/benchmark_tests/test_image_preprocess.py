@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+图片预处理基准测试
+测量把一张大图缩放到模型有效分辨率并重新编码的耗时，并校验长边和总像素上限、EXIF 方向和元数据、
+透明通道、小图和动图原样保留、按模型和提供商选择配置，以及不同配置的编码结果分别缓存。
+"""
+
+import base64
+import io
+import json
+
+import pytest
+
+pytest.importorskip("PIL")
+from PIL import Image  # noqa: E402
+
+import image_preprocess  # noqa: E402
+from image_preprocess import ImageProfile, load_profiles, preprocess_image, profile_for  # noqa: E402
+from media_cache import MediaCache  # noqa: E402
+
+
+def save_image(path, size, mode: str = "RGB", fmt: str = "PNG", **kwargs) -> str:
+    Image.new(mode, size, (200, 100, 50, 128) if mode == "RGBA" else (200, 100, 50)).save(path, format=fmt, **kwargs)
+    return str(path)
+
+
+def decode(data: str) -> Image.Image:
+    return Image.open(io.BytesIO(base64.b64decode(data)))
+
+
+def test_downscale(benchmark, tmp_path):
+    path = save_image(tmp_path / "large.png", (4000, 3000))
+    openai = image_preprocess.IMAGE_PROFILES["openai"]
+    mime_type, data = benchmark(preprocess_image, path, **openai.params())
+    assert mime_type == "image/jpeg"
+    with decode(data) as img:
+        assert max(img.size) <= openai.max_side and img.size[0] * img.size[1] <= openai.max_pixels
+        # 保持宽高比
+        assert abs(img.size[0] / img.size[1] - 4 / 3) < 0.01
+    assert len(base64.b64decode(data)) < (tmp_path / "large.png").stat().st_size
+
+
+def test_orientation_alpha_and_passthrough(tmp_path):
+    params = {"max_side": 1000, "max_pixels": 1_000_000, "fmt": "JPEG", "quality": 80}
+    # EXIF 方向为 6（顺时针旋转 90 度）时先旋转，输出不带 EXIF
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    rotated = save_image(tmp_path / "rotated.jpg", (1200, 600), fmt="JPEG", exif=exif.tobytes())
+    _, data = preprocess_image(rotated, **params)
+    with decode(data) as img:
+        assert img.size == (500, 1000) and not img.getexif()
+
+    # 透明图片转 JPEG 时铺白底；小图不放大
+    _, data = preprocess_image(save_image(tmp_path / "alpha.png", (100, 50), mode="RGBA"), **params)
+    with decode(data) as img:
+        assert img.mode == "RGB" and img.size == (100, 50)
+
+    # 动图和无法识别的文件按原样返回
+    frames = [Image.new("RGB", (20, 20), color) for color in ("red", "blue")]
+    frames[0].save(tmp_path / "anim.gif", save_all=True, append_images=frames[1:])
+    mime_type, data = preprocess_image(str(tmp_path / "anim.gif"), **params)
+    assert mime_type == "image/gif" and base64.b64decode(data) == (tmp_path / "anim.gif").read_bytes()
+    (tmp_path / "broken.png").write_bytes(b"not an image")
+    assert preprocess_image(str(tmp_path / "broken.png"), **params) == ("", base64.b64encode(b"not an image").decode())
+
+
+def test_profile_selection(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_preprocess, "IMAGE_PROFILES", dict(image_preprocess.IMAGE_PROFILES))
+    monkeypatch.setattr(image_preprocess, "MODEL_PROFILES", [])
+    assert profile_for("Anthropic", "claude-3-5-sonnet").name == "anthropic"
+    assert profile_for("siliconflow", "qwen-vl").name == "default"
+
+    config = tmp_path / "image_profiles.json"
+    config.write_text(json.dumps({"profiles": {"small": {"max_side": 512, "max_pixels": 262144, "fmt": "WEBP"}},
+                                  "models": {"qwen-vl": "small"}}), encoding="utf-8")
+    load_profiles(str(config))
+    # 按模型名匹配的配置优先于按提供商匹配
+    assert profile_for("siliconflow", "Qwen-VL-Max").name == "small"
+    assert profile_for("siliconflow", "Qwen-VL-Max").key == "small:512:262144:WEBP:85"
+    # 引用未定义的配置时只记录错误
+    config.write_text(json.dumps({"models": {"glm-4v": "missing"}}), encoding="utf-8")
+    load_profiles(str(config))
+    assert profile_for("zhipu", "glm-4v").name == "default"
+
+
+def test_cache_per_profile(event_loop_runner, tmp_path):
+    cache = MediaCache(str(tmp_path), workers=1)
+    path = save_image(tmp_path / "photo.png", (3000, 3000))
+    small = ImageProfile("small", max_side=256, max_pixels=65536)
+    webp = ImageProfile("webp", max_side=512, max_pixels=262144, fmt="WEBP")
+    try:
+        first = event_loop_runner(cache.encode_file("/static/uploads/photo.png", path, small))
+        again = event_loop_runner(cache.encode_file("/static/uploads/photo.png", path, small))
+        other = event_loop_runner(cache.encode_file("/static/uploads/photo.png", path, webp))
+    finally:
+        cache.close()
+    assert again is first and other is not first
+    assert (first.mime_type, other.mime_type) == ("image/jpeg", "image/webp")
+    with decode(first.data) as img:
+        assert img.size == (256, 256)
+    with decode(other.data) as img:
+        assert img.size == (512, 512)
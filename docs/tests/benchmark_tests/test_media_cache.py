@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+上传文件内联编码基准测试
+测量缓存命中时准备一个上传文件的开销，并校验上传文件URL的解析（防止路径穿越）、按内容哈希缓存、
+文件修改后重新编码、按编码后大小淘汰，以及各提供商的内联格式和 MCP 只为需要内联的适配器准备附件。
+"""
+
+import base64
+
+from api_adapter import BaseAdapter
+from media_cache import (EncodedMedia, MediaCache, anthropic_image_block, attach_to_last_user, gemini_part,
+                         openai_content_parts)
+from metrics import metrics
+
+PNG_URL = "http://localhost:8000/static/uploads/photo.png"
+
+
+def write_upload(tmp_path, name: str, content: bytes) -> str:
+    path = tmp_path / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_prepare_cached(benchmark, event_loop_runner, tmp_path):
+    cache = MediaCache(str(tmp_path))
+    write_upload(tmp_path, "photo.png", b"\x89PNG" + b"0" * 4096)
+    event_loop_runner(cache.prepare([PNG_URL]))
+    hits = metrics.get("media_cache_hits")
+    prepared = benchmark(lambda: event_loop_runner(cache.prepare([PNG_URL])))
+    assert prepared[0].data == base64.b64encode(b"\x89PNG" + b"0" * 4096).decode("ascii")
+    assert metrics.get("media_cache_hits") > hits
+
+
+def test_resolve(tmp_path):
+    cache = MediaCache(str(tmp_path))
+    path = write_upload(tmp_path, "photo.png", b"png")
+    assert cache.resolve(PNG_URL) == path
+    assert cache.resolve("/static/uploads/photo.png") == path
+    assert cache.resolve("/static/uploads/..%2F..%2Fphoto.png") == path
+    # 不在上传目录下、文件不存在或不是字符串
+    assert cache.resolve("https://example.com/static/other/photo.png") is None
+    assert cache.resolve("/static/uploads/missing.png") is None
+    assert cache.resolve(None) is None
+
+
+def test_encode_cache(event_loop_runner, tmp_path):
+    cache = MediaCache(str(tmp_path), max_bytes=90)
+    path = write_upload(tmp_path, "photo.png", b"a" * 30)
+    other = write_upload(tmp_path, "clip.mp4", b"b" * 30)
+
+    first = event_loop_runner(cache.encode_file(PNG_URL, path))
+    assert (first.mime_type, first.is_image) == ("image/png", True)
+    assert first.data_url() == "data:image/png;base64," + base64.b64encode(b"a" * 30).decode("ascii")
+    # 同一内容直接命中缓存
+    assert event_loop_runner(cache.encode_file(PNG_URL, path)) is first
+
+    # 文件修改后按新内容重新编码
+    write_upload(tmp_path, "photo.png", b"c" * 31)
+    changed = event_loop_runner(cache.encode_file(PNG_URL, path))
+    assert changed is not first and base64.b64decode(changed.data) == b"c" * 31
+
+    # 编码后总大小超过上限时淘汰最久未使用的条目
+    event_loop_runner(cache.encode_file("/static/uploads/clip.mp4", other))
+    assert cache.status()["entries"] == 2 and cache.status()["bytes"] == 84
+    assert changed.digest in {entry.digest for entry in cache._entries.values()}
+
+    prepared = event_loop_runner(cache.prepare(["https://example.com/a.png", "/static/uploads/clip.mp4"]))
+    assert prepared[0] == "https://example.com/a.png"
+    assert isinstance(prepared[1], EncodedMedia) and prepared[1].mime_type == "video/mp4"
+
+
+def test_provider_formats():
+    image = EncodedMedia(PNG_URL, "image/png", "digest", "aW1n")
+    video = EncodedMedia("/static/uploads/clip.mp4", "video/mp4", "digest2", "dmlk")
+    external = "https://example.com/a.jpg"
+
+    parts = openai_content_parts("看看这些", [image, video, external])
+    assert parts == [{"type": "text", "text": "看看这些"},
+                     {"type": "image_url", "image_url": {"url": "data:image/png;base64,aW1n"}},
+                     {"type": "image_url", "image_url": {"url": external}}]
+    assert gemini_part(video) == {"inline_data": {"mime_type": "video/mp4", "data": "dmlk"}}
+    assert gemini_part(external) == {"file_data": {"mime_type": "image/jpeg", "file_uri": external}}
+    assert anthropic_image_block(image)["source"] == {"type": "base64", "media_type": "image/png", "data": "aW1n"}
+    assert anthropic_image_block(video) is None
+    assert anthropic_image_block(external)["source"] == {"type": "url", "url": external}
+
+    messages = [{"role": "user", "content": "旧问题"}, {"role": "assistant", "content": "回答"},
+                {"role": "user", "content": "新问题"}]
+    attached = attach_to_last_user(messages, lambda content: [content, "附件"])
+    assert attached[2]["content"] == ["新问题", "附件"] and attached[0]["content"] == "旧问题"
+    # 不修改原消息列表
+    assert messages[2]["content"] == "新问题"
+
+
+class _CaptureAdapter(BaseAdapter):
+    """记录收到的附件"""
+
+    def __init__(self, inline_media: bool):
+        self.inline_media = inline_media
+        self.file_urls = None
+
+    async def chat_completion(self, messages: list, model: str, file_urls=None, **kwargs) -> str:
+        self.file_urls = file_urls
+        return "好的"
+
+
+def test_mcp_prepares_inline_media(event_loop_runner, build_mcp, mock_upstream, tmp_path):
+    upload_dir = tmp_path / "uploads"
+    upload_dir.mkdir()
+    write_upload(upload_dir, "photo.png", b"png")
+    mcp = build_mcp(mock_upstream, model="gpt-4o", media_cache=MediaCache(str(upload_dir)))
+    for inline_media in (True, False):
+        adapter = _CaptureAdapter(inline_media)
+        mcp.providers["openai"] = adapter
+        mcp.publish_routes()
+        event_loop_runner(mcp.handle_request([{"role": "user", "content": "看图"}], "default",
+                                             file_urls=[PNG_URL, "https://example.com/a.png"]))
+        if inline_media:
+            # 云端提供商访问不到本地上传文件，需要内联
+            assert isinstance(adapter.file_urls[0], EncodedMedia) and adapter.file_urls[1] == "https://example.com/a.png"
+        else:
+            assert adapter.file_urls == [PNG_URL, "https://example.com/a.png"]
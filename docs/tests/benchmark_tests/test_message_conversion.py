@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""
+消息转换与序列化基准测试：各适配器在发出请求前的纯CPU工作
+"""
+
+import json
+
+from api_adapter import AnthropicAdapter, CohereAdapter
+
+
+def test_anthropic_convert_messages(benchmark, conversation):
+    adapter = AnthropicAdapter(api_key="bench")
+    chat_messages, system_content = benchmark(adapter._convert_messages, conversation)
+    assert system_content and chat_messages
+
+
+def test_cohere_convert_messages(benchmark, conversation):
+    adapter = CohereAdapter(api_key="bench")
+    chat_history, current_message = benchmark(adapter._convert_messages, conversation)
+    assert current_message
+
+
+def test_openai_payload_serialisation(benchmark, conversation):
+    # aiohttp 的 json= 参数使用 json.dumps 序列化请求体
+    payload = {"model": "bench-model", "messages": conversation, "temperature": 0.7, "max_tokens": 2048}
+    body = benchmark(json.dumps, payload)
+    assert body
+
+
+def test_openai_response_parsing(benchmark):
+    text = json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "事件循环在单线程中调度协程。" * 200},
+                     "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 500, "completion_tokens": 800, "total_tokens": 1300}
+    }, ensure_ascii=False)
+
+    def parse():
+        return json.loads(text)["choices"][0]["message"]["content"]
+
+    assert benchmark(parse)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Anthropic 提示缓存基准测试
+测量为一段长对话选择缓存断点的开销，并校验系统提示重复出现后才缓存、一次性请求不写入缓存、
+延续的会话在上次写入的位置读取并在末尾写入新断点、过短的前缀和过期的缓存不使用断点，
+以及适配器按策略发送 cache_control 并返回缓存读写的 token 数。
+"""
+
+import time
+
+import pytest
+from aiohttp import web
+
+from api_adapter import AnthropicAdapter
+from prompt_cache import EPHEMERAL, PromptCachePolicy, with_cache_control
+
+SYSTEM = "你是客服助手，请根据知识库回答。" * 200
+
+
+def conversation(turns: int) -> list:
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"第 {i} 个问题：" + "详细描述" * 200})
+        messages.append({"role": "assistant", "content": f"第 {i} 个回答"})
+    return messages + [{"role": "user", "content": "新的问题"}]
+
+
+def test_plan(benchmark):
+    policy = PromptCachePolicy()
+    messages = conversation(50)
+    policy.plan("claude-3-5-sonnet", SYSTEM, messages[:-2])
+    cache_system, breakpoints = benchmark(policy.plan, "claude-3-5-sonnet", SYSTEM, messages)
+    assert cache_system and breakpoints[-1] == len(messages) - 1
+
+
+def test_breakpoints():
+    policy = PromptCachePolicy()
+    first = conversation(1)
+    # 第一次出现的系统提示和一次性请求不缓存
+    assert policy.plan("claude-3-5-sonnet", SYSTEM, first) == (False, [])
+
+    # 延续会话：缓存系统提示，在末尾写入断点
+    second = first + [{"role": "assistant", "content": "回答"}, {"role": "user", "content": "追问" * 300}]
+    assert policy.plan("claude-3-5-sonnet", SYSTEM, second) == (True, [len(second) - 1])
+
+    # 下一轮从上次写入的位置读取，并在新的末尾写入
+    third = second + [{"role": "assistant", "content": "回答"}, {"role": "user", "content": "再追问"}]
+    assert policy.plan("claude-3-5-sonnet", SYSTEM, third) == (True, [len(second) - 1, len(third) - 1])
+
+    # 另一个会话共用系统提示，但没有可读取的前缀
+    assert policy.plan("claude-3-5-sonnet", SYSTEM, conversation(2)) == (True, [])
+
+    # 短于最小可缓存长度（Haiku 为 2048 tokens）的前缀不设置断点
+    short = PromptCachePolicy()
+    messages = [{"role": "user", "content": "你好"}]
+    short.plan("claude-3-haiku", "简短的系统提示", messages)
+    messages = messages + [{"role": "assistant", "content": "你好"}, {"role": "user", "content": "在吗"}]
+    assert short.plan("claude-3-haiku", "简短的系统提示", messages) == (False, [])
+
+
+def test_expired_cache():
+    policy = PromptCachePolicy(ttl=0.01, session_ttl=0.01)
+    first = conversation(2)
+    policy.plan("claude-3-5-sonnet", None, first)
+    second = first + [{"role": "assistant", "content": "回答"}, {"role": "user", "content": "追问"}]
+    assert policy.plan("claude-3-5-sonnet", None, second) == (False, [len(second) - 1])
+    time.sleep(0.02)
+    # 上游缓存和会话都已过期，当作新的一次性请求
+    third = second + [{"role": "assistant", "content": "回答"}, {"role": "user", "content": "再追问"}]
+    assert policy.plan("claude-3-5-sonnet", None, third) == (False, [])
+
+
+def test_with_cache_control():
+    assert with_cache_control("文本") == [{"type": "text", "text": "文本", "cache_control": EPHEMERAL}]
+    blocks = [{"type": "image", "source": {}}, {"type": "text", "text": "看图"}]
+    marked = with_cache_control(blocks)
+    assert marked[-1]["cache_control"] == EPHEMERAL and "cache_control" not in marked[0]
+    # 不修改原内容
+    assert "cache_control" not in blocks[-1]
+    assert with_cache_control([]) == []
+
+
+@pytest.fixture(scope="module")
+def anthropic_upstream(event_loop_runner):
+    """记录请求体的 Anthropic 模拟上游：请求中有缓存断点时按命中缓存返回用量"""
+    bodies = []
+
+    async def messages(request: web.Request):
+        body = await request.json()
+        bodies.append(body)
+        cached = "cache_control" in str(body.get("messages")) or isinstance(body.get("system"), list)
+        usage = {"input_tokens": 10, "output_tokens": 5}
+        if cached:
+            usage.update(cache_read_input_tokens=2000, cache_creation_input_tokens=300)
+        return web.json_response({"id": "msg_1", "content": [{"type": "text", "text": "好的"}],
+                                  "stop_reason": "end_turn", "usage": usage})
+
+    app = web.Application()
+    app.router.add_post("/v1/messages", messages)
+    runner = web.AppRunner(app)
+    event_loop_runner(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    event_loop_runner(site.start())
+    yield f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}", bodies
+    event_loop_runner(runner.cleanup())
+
+
+@pytest.mark.parametrize("prompt_cache", [True, False])
+def test_adapter_sends_breakpoints(event_loop_runner, anthropic_upstream, prompt_cache):
+    url, bodies = anthropic_upstream
+    adapter = AnthropicAdapter("key", base_url=url, prompt_cache=prompt_cache)
+    first = [{"role": "system", "content": SYSTEM}] + conversation(1)
+    second = first + [{"role": "assistant", "content": "回答"}, {"role": "user", "content": "追问"}]
+    try:
+        event_loop_runner(adapter.chat_completion(first, "claude-3-5-sonnet"))
+        result = event_loop_runner(adapter.chat_completion(second, "claude-3-5-sonnet"))
+    finally:
+        event_loop_runner(adapter.aclose())
+    body = bodies[-1]
+    if not prompt_cache:
+        assert body["system"] == SYSTEM and "cache_control" not in str(body["messages"])
+        assert "cache_read_tokens" not in result.usage
+        return
+    assert body["system"] == [{"type": "text", "text": SYSTEM, "cache_control": EPHEMERAL}]
+    assert body["messages"][-1]["content"][-1] == {"type": "text", "text": "追问", "cache_control": EPHEMERAL}
+    assert all(isinstance(msg["content"], str) for msg in body["messages"][:-1])
+    # 缓存读写的 token 计入 prompt_tokens
+    assert result.usage == {"prompt_tokens": 2310, "completion_tokens": 5, "total_tokens": 2315,
+                            "cache_read_tokens": 2000, "cache_write_tokens": 300}
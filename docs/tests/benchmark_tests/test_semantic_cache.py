@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+语义缓存基准测试：本地哈希 n-gram 向量化 + 向量索引查找
+测量满载索引上单次查找的开销，并校验命中、范围隔离、容量淘汰和误命中反馈。
+"""
+
+import pytest
+
+from semantic_cache import NUMPY_AVAILABLE, HashingEmbedder, SemanticCache, VectorIndex
+
+pytestmark = pytest.mark.skipif(not NUMPY_AVAILABLE, reason="语义缓存需要 numpy")
+
+
+def ask(question: str, system: str = None) -> list:
+    messages = [{"role": "system", "content": system}] if system else []
+    return messages + [{"role": "user", "content": question}]
+
+
+@pytest.mark.parametrize("entries", [1000, 10000])
+def test_lookup_full_index(benchmark, event_loop_runner, entries):
+    cache = SemanticCache(max_entries=entries)
+    for i in range(entries):
+        lookup = event_loop_runner(cache.lookup("openai", "gpt-4o", ask(f"第 {i} 个问题：订单 {i * 7919} 的物流状态")))
+        cache.store(lookup, f"回复 {i}")
+
+    def call():
+        return event_loop_runner(cache.lookup("openai", "gpt-4o", ask("第 42 个问题：订单 332598 的物流状态")))
+
+    result = benchmark(call)
+    assert result.entry is not None and result.entry.answer == "回复 42"
+
+
+def test_hit_and_scope(event_loop_runner):
+    cache = SemanticCache(threshold=0.8)
+    lookup = event_loop_runner(cache.lookup("openai", "gpt-4o", ask("如何重置我的账户密码？")))
+    assert lookup.entry is None
+    cache.store(lookup, "在设置页面点击忘记密码。")
+
+    # 标点和大小写不同仍然命中
+    hit = event_loop_runner(cache.lookup("openai", "gpt-4o", ask("如何重置我的账户密码")))
+    assert hit.entry is not None and hit.similarity >= 0.8
+    # 不相关的问题、其他模型和其他系统提示不命中
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", ask("今天天气怎么样"))).entry is None
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o-mini", ask("如何重置我的账户密码？"))).entry is None
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", ask("如何重置我的账户密码？", "用英文回答"))).entry is None
+    # 多轮对话不缓存
+    history = [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好！"}] + ask("如何重置密码？")
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", history)) is None
+
+    assert cache.report_false_hit(hit.entry.id)
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", ask("如何重置我的账户密码？"))).entry is None
+    status = cache.status()
+    assert status["hits"] == 1 and status["reported_false_hits"] == 1 and status["entries"] == 0
+
+
+def test_eviction_keeps_recent_hits(event_loop_runner):
+    cache = SemanticCache(max_entries=3)
+    questions = ["问题一：退货流程", "问题二：发票开具", "问题三：会员积分", "问题四：配送时间"]
+    for question in questions[:3]:
+        cache.store(event_loop_runner(cache.lookup("openai", "gpt-4o", ask(question))), question)
+    # 命中第一个条目后，写入第四个时淘汰最久未命中的第二个
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", ask(questions[0]))).entry is not None
+    cache.store(event_loop_runner(cache.lookup("openai", "gpt-4o", ask(questions[3]))), questions[3])
+    assert cache.status()["entries"] == 3 and cache.status()["evictions"] == 1
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", ask(questions[1]))).entry is None
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", ask(questions[0]))).entry is not None
+
+
+def test_lsh_search_matches_exact(event_loop_runner):
+    embedder = HashingEmbedder()
+    texts = [f"商品 {i} 的尺码和颜色有哪些" for i in range(3000)]
+    vectors = event_loop_runner(embedder.embed(texts))
+    index = VectorIndex(embedder.dim, capacity=len(texts), exact_below=0)
+    for vector in vectors:
+        index.add(vector)
+    slot, similarity = index.search(vectors[1234])
+    assert slot == 1234 and similarity == pytest.approx(1.0, abs=1e-5)
+
+
+def test_limit_across_scopes(event_loop_runner):
+    cache = SemanticCache(max_entries=3)
+    # 每个系统提示是一个范围，上限按所有范围合计
+    for i in range(5):
+        cache.store(event_loop_runner(cache.lookup("openai", "gpt-4o", ask("退货流程", f"系统提示 {i}"))), f"回复 {i}")
+    status = cache.status()
+    assert (status["entries"], status["scopes"], status["evictions"]) == (3, 3, 2)
+    # 最早写入的两个范围被整体淘汰
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", ask("退货流程", "系统提示 0"))).entry is None
+    assert event_loop_runner(cache.lookup("openai", "gpt-4o", ask("退货流程", "系统提示 4"))).entry is not None
+
+
+def test_index_grows(event_loop_runner):
+    embedder = HashingEmbedder()
+    vectors = event_loop_runner(embedder.embed([f"问题 {i}" for i in range(10)]))
+    index = VectorIndex(embedder.dim, capacity=10, initial=4)
+    slots = [index.add(vector) for vector in vectors]
+    # 按需扩容到 capacity，扩容前写入的位置不变
+    assert slots == list(range(10)) and len(index) == 10
+    assert index.search(vectors[2])[0] == 2 and index.search(vectors[9])[0] == 9
+    with pytest.raises(IndexError):
+        index.add(vectors[0])
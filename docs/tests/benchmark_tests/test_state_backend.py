@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+共享状态存储基准测试
+测量 SQLite 存储写入一个值的开销，并对内存和 SQLite 存储校验同一套接口约定（读写、版本号、原子更新、累加、
+条件删除、只导入一次、增量读取），多个进程并发修改同一个键时不丢失更新，旧版数据库升级，
+以及聊天历史（只重新读取修改过的会话）和 MCP 配置通过共享存储在 worker 之间同步。
+"""
+
+import asyncio
+import json
+import multiprocessing
+import sqlite3
+
+import pytest
+
+from chat_history import ChatHistory
+from state_backend import MemoryBackend, SQLiteBackend, create_backend, migrate_json_file
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    store = create_backend(request.param, str(tmp_path / "state.db"))
+    yield store
+    store.close()
+
+
+def test_put(benchmark, tmp_path):
+    store = SQLiteBackend(str(tmp_path / "state.db"))
+    try:
+        version = benchmark(store.put, "config", "mcp", {"current_provider": "openai"})
+        assert store.version("config") == version and store.get("config", "mcp") == {"current_provider": "openai"}
+    finally:
+        store.close()
+
+
+def test_contract(backend):
+    assert backend.get("histories", "h1") is None and backend.version("histories") == 0
+    assert backend.put("histories", "h1", {"title": "对话"}) == 1
+    assert backend.items("histories") == {"h1": {"title": "对话"}}
+
+    # 原子更新：返回 None 时不写入，版本号不变
+    assert backend.update("histories", "missing", lambda value: None) == (None, 1)
+    value, version = backend.update("histories", "h1", lambda value: dict(value, title="新标题"))
+    assert value == {"title": "新标题"} and version == 2
+
+    assert backend.increment("usage", {"a": {"tokens": 3}, "b": {"tokens": 1.5}}) == 1
+    backend.increment("usage", {"a": {"tokens": 2, "cost": 0.1}})
+    assert backend.items("usage") == {"a": {"tokens": 5, "cost": 0.1}, "b": {"tokens": 1.5}}
+
+    assert backend.delete("histories", "h1") == (True, 3)
+    assert backend.delete("histories", "h1") == (False, 3)
+    # 条件删除在一个事务中完成，版本号只加一；没有匹配的键时不变
+    backend.increment("usage", {"c": {"tokens": 1}, "d": {"tokens": 1}})
+    assert backend.delete_matching("usage", lambda key: key in ("a", "c", "x")) == (2, 4)
+    assert backend.delete_matching("usage", lambda key: False) == (0, 4)
+    assert backend.items("usage") == {"b": {"tokens": 1.5}, "d": {"tokens": 1}}
+    # 命名空间为空时才导入
+    assert backend.import_if_empty("histories", {"h2": {}}) is True
+    assert backend.import_if_empty("histories", {"h3": {}}) is False
+    assert backend.clear("histories") == 5 and backend.items("histories") == {}
+    # 其他命名空间不受影响
+    assert backend.version("usage") == 4
+    with pytest.raises(ValueError):
+        create_backend("redis")
+
+
+def test_changes(backend):
+    backend.put("histories", "h1", {"title": "一"})
+    backend.put("histories", "h2", {"title": "二"})
+    assert backend.changes("histories", -1) == ({"h1": {"title": "一"}, "h2": {"title": "二"}}, ["h1", "h2"], 2)
+    assert backend.changes("histories", 2) == ({}, ["h1", "h2"], 2)
+
+    # 只返回 since 之后写入的值，删除的键不在键列表中
+    backend.update("histories", "h2", lambda value: dict(value, title="新二"))
+    backend.delete("histories", "h1")
+    changed, keys, version = backend.changes("histories", 2)
+    assert (changed, keys, version) == ({"h2": {"title": "新二"}}, ["h2"], 4)
+    backend.increment("usage", {"a": {"tokens": 1}})
+    assert backend.changes("usage", 0) == ({"a": {"tokens": 1}}, ["a"], 1)
+    backend.clear("histories")
+    assert backend.changes("histories", 0) == ({}, [], 5)
+
+
+def test_legacy_schema(tmp_path):
+    path = str(tmp_path / "state.db")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE state (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+               "PRIMARY KEY (namespace, key))")
+    db.execute("CREATE TABLE versions (namespace TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+    db.execute("INSERT INTO state VALUES ('histories', 'old', '{}')")
+    db.execute("INSERT INTO versions VALUES ('histories', 3)")
+    db.commit()
+    db.close()
+    # 旧版数据库自动增加版本列，已有的行视为版本 0
+    store = SQLiteBackend(path)
+    try:
+        assert store.changes("histories", -1) == ({"old": {}}, ["old"], 3)
+        store.put("histories", "new", {})
+        assert store.changes("histories", 3) == ({"new": {}}, ["new", "old"], 4)
+    finally:
+        store.close()
+
+
+def _add_many(path: str, count: int):
+    store = SQLiteBackend(path)
+    for _ in range(count):
+        store.update("counters", "requests", lambda value: (value or 0) + 1)
+    store.close()
+
+
+def test_concurrent_workers(tmp_path):
+    path = str(tmp_path / "state.db")
+    SQLiteBackend(path).close()
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_add_many, args=(path, 50)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    assert all(worker.exitcode == 0 for worker in workers)
+    store = SQLiteBackend(path)
+    try:
+        # 4 个进程各累加 50 次，没有丢失的更新
+        assert store.get("counters", "requests") == 200 and store.version("counters") == 200
+    finally:
+        store.close()
+
+
+def test_shared_history(tmp_path):
+    legacy = tmp_path / "chat_histories.json"
+    legacy.write_text(json.dumps({"old": {"id": "old", "title": "旧对话", "updated_at": "2025-01-01",
+                                          "messages": []}}), encoding="utf-8")
+    store = SQLiteBackend(str(tmp_path / "state.db"))
+    try:
+        # 两个 worker 共享一个存储，旧的 JSON 历史只导入一次
+        first = ChatHistory(str(legacy), backend=store)
+        second = ChatHistory(str(legacy), backend=SQLiteBackend(str(tmp_path / "state.db")))
+        assert [h["id"] for h in second.get_histories()] == ["old"]
+
+        history_id = first.create_history("共享的对话")
+        assert second.add_message(history_id, {"role": "user", "content": "来自第二个 worker"})
+        assert first.add_message(history_id, {"role": "assistant", "content": "来自第一个 worker"})
+        # 版本号变化后重新读取，两个 worker 看到相同的内容
+        assert first.get_history(history_id) == second.get_history(history_id)
+        assert len(second.get_history(history_id)["messages"]) == 2
+        second.delete_history("old")
+        assert first.get_history("old") is None
+
+        # 另一个 worker 修改后只重新读取修改过的会话，其他会话沿用缓存
+        other_id = first.create_history("不变的对话")
+        assert second.get_history(other_id)
+        unchanged = second.histories[other_id]
+        first.update_history_title(history_id, "新标题")
+        second.backend.items = None
+        assert second.get_history(history_id)["title"] == "新标题"
+        assert second.histories[other_id] is unchanged
+        assert not migrate_json_file(store, "histories", str(legacy), lambda data: data)
+        second.backend.close()
+    finally:
+        store.close()
+
+
+def test_shared_config(event_loop_runner, build_mcp, mock_upstream):
+    store = MemoryBackend()
+    first = build_mcp(mock_upstream, state=store)
+    second = build_mcp(mock_upstream, providers=("openai", "anthropic"), state=store)
+    first.save_configuration("anthropic", {"model": "claude-3-5-sonnet", "api_key": "key", "base_url": mock_upstream})
+    first.switch_current_provider("anthropic")
+
+    async def run():
+        # 另一个 worker 发现存储中的配置版本变化后重新加载
+        watcher = asyncio.ensure_future(second.watch_config(interval=0.01))
+        try:
+            for _ in range(100):
+                if second._routes.current_provider == "anthropic":
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+
+    event_loop_runner(run())
+    assert second._routes.current_provider == "anthropic"
+    assert second.configurations["anthropic"]["model"] == "claude-3-5-sonnet"
+    assert store.get("config", "mcp")["current_provider"] == "anthropic"
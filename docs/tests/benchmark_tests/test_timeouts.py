@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+上游分项超时和请求截止时间基准测试
+测量调用范围内（按超时策略包装会话）一次完整调用的开销，并校验截止时间从 MCP 传到适配器、
+排队时间计入预算、流式响应的 idle 超时和按模型覆盖的超时配置。
+"""
+
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+from admission import AdmissionController
+from api_adapter import OpenAIAdapter
+from mock_provider import LatencyModel, MockProvider
+from timeouts import Deadline, DeadlineExceeded, TimeoutPolicy, call_scope
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+@pytest.fixture(scope="module")
+def slow_upstream(event_loop_runner):
+    """响应头延迟 0.5 秒、流式数据每段间隔 0.3 秒的模拟上游"""
+    provider = MockProvider(LatencyModel("fixed:0.5"), stream_chunks=3, chunk_interval=0.3)
+    runner = web.AppRunner(provider.build_app())
+    event_loop_runner(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    event_loop_runner(site.start())
+    yield f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    event_loop_runner(runner.cleanup())
+
+
+def test_scoped_roundtrip(benchmark, event_loop_runner, mock_upstream):
+    adapter = OpenAIAdapter(api_key="bench", base_url=f"{mock_upstream}/v1")
+
+    async def call():
+        with call_scope(TimeoutPolicy(first_byte=30), Deadline(60)):
+            return await adapter.chat_completion(MESSAGES, "mock-model")
+
+    assert benchmark(lambda: event_loop_runner(call()))
+    event_loop_runner(adapter.aclose())
+
+
+def test_deadline_reaches_adapter(event_loop_runner, build_mcp, slow_upstream):
+    mcp = build_mcp(slow_upstream)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        event_loop_runner(mcp.handle_request(MESSAGES, "default", deadline=Deadline(0.1)))
+    assert time.monotonic() - started < 0.4
+    # 没有截止时间时正常完成
+    assert event_loop_runner(mcp.handle_request(MESSAGES, "default"))
+
+
+def test_queue_wait_counts_against_deadline(event_loop_runner, build_mcp, slow_upstream):
+    mcp = build_mcp(slow_upstream, admission=AdmissionController(max_in_flight=1))
+
+    async def run():
+        busy = asyncio.ensure_future(mcp.handle_request(MESSAGES, "default"))
+        await asyncio.sleep(0.05)
+        try:
+            await mcp.handle_request(MESSAGES, "default", deadline=Deadline(0.1))
+        finally:
+            await busy
+
+    # 排队超时默认 10 秒，预算 0.1 秒时在排队中用完
+    with pytest.raises(DeadlineExceeded):
+        event_loop_runner(run())
+
+
+def test_idle_timeout_between_chunks(event_loop_runner, slow_upstream):
+    adapter = OpenAIAdapter(api_key="bench", base_url=f"{slow_upstream}/v1")
+
+    async def collect(policy: TimeoutPolicy):
+        with call_scope(policy):
+            return [chunk async for chunk in adapter.stream_chat_completion(MESSAGES, "mock-model")]
+
+    with pytest.raises(Exception, match="没有新数据"):
+        event_loop_runner(collect(TimeoutPolicy(idle=0.1)))
+    assert len(event_loop_runner(collect(TimeoutPolicy(idle=1)))) > 1
+    event_loop_runner(adapter.aclose())
+
+
+def test_policy_override():
+    base = TimeoutPolicy(connect=10, first_byte=None, idle=60, total=600)
+    config = {"idle": 30, "models": {"deepseek-reasoner": {"first_byte": 300, "total": 1800}, "deepseek": {"idle": 20}}}
+    assert base.override(config, "deepseek-reasoner").to_dict() == {
+        "connect": 10, "first_byte": 300, "idle": 30, "total": 1800}
+    assert base.override(config, "deepseek-chat").idle == 20
+    assert base.override(config, "other").to_dict() == {"connect": 10, "first_byte": None, "idle": 30, "total": 600}
+    with pytest.raises(ValueError):
+        base.override({"read": 5})
+    with pytest.raises(ValueError):
+        base.override({"models": {"x": {"total": -1}}})
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+上游传输层基准测试：aiohttp HTTP/1.1 与 HTTP/2（h2c 模拟上游）
+测量同一适配器并发发出多个请求时两种传输的耗时，并校验 HTTP/2 在单个连接上多路复用，
+以及流式、超时和错误状态码的行为与 aiohttp 一致。
+"""
+
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from api_adapter import OpenAIAdapter
+from mock_provider import LatencyModel, MockProvider
+from timeouts import TimeoutPolicy, call_scope
+from transport import AiohttpTransport, HttpxTransport
+
+# HTTP/2 模拟上游依赖 h2
+pytest.importorskip("h2")
+from h2_mock import H2MockServer  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "请解释一下什么是多路复用。"}]
+CONCURRENCY = 50
+
+
+@pytest.fixture(scope="module")
+def upstreams(event_loop_runner):
+    """同一延迟下的 HTTP/1.1 和 h2c 模拟上游"""
+    http1 = MockProvider(LatencyModel("fixed:0.01"))
+    runner = web.AppRunner(http1.build_app())
+    event_loop_runner(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    event_loop_runner(site.start())
+    h2 = H2MockServer(MockProvider(LatencyModel("fixed:0.01")))
+    h2_url = event_loop_runner(h2.start())
+    yield {"http1": f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}", "h2c": h2_url, "h2_server": h2}
+    event_loop_runner(h2.close())
+    event_loop_runner(runner.cleanup())
+
+
+def build_adapter(kind: str, upstreams: dict) -> OpenAIAdapter:
+    adapter = OpenAIAdapter(api_key="bench", base_url=f"{upstreams[kind]}/v1")
+    adapter.transport = AiohttpTransport() if kind == "http1" else HttpxTransport(prior_knowledge=True)
+    return adapter
+
+
+@pytest.mark.parametrize("kind", ["http1", "h2c"])
+def test_concurrent_requests(benchmark, event_loop_runner, upstreams, kind):
+    adapter = build_adapter(kind, upstreams)
+
+    async def burst():
+        return await asyncio.gather(*(adapter.chat_completion(MESSAGES, "mock-model") for _ in range(CONCURRENCY)))
+
+    results = benchmark(lambda: event_loop_runner(burst()))
+    assert len(results) == CONCURRENCY and all(results)
+    event_loop_runner(adapter.aclose())
+
+
+def test_h2_multiplexing(event_loop_runner, upstreams):
+    server = upstreams["h2_server"]
+    before = server.connections
+    adapter = build_adapter("h2c", upstreams)
+
+    async def burst():
+        await asyncio.gather(*(adapter.chat_completion(MESSAGES, "mock-model") for _ in range(CONCURRENCY)))
+        await adapter.aclose()
+
+    event_loop_runner(burst())
+    assert server.connections - before == 1
+
+
+@pytest.mark.parametrize("kind", ["http1", "h2c"])
+def test_warm_up_reuses_connection(event_loop_runner, upstreams, kind):
+    server = upstreams["h2_server"]
+    before = server.connections
+    adapter = build_adapter(kind, upstreams)
+
+    async def warm_then_call():
+        await adapter.warm_up()
+        # MCP 调用范围内按超时策略包装的会话同样支持 HEAD
+        with call_scope(TimeoutPolicy(first_byte=10)):
+            await adapter.warm_up()
+            result = await adapter.chat_completion(MESSAGES, "mock-model")
+        await adapter.aclose()
+        return result
+
+    assert event_loop_runner(warm_then_call())
+    if kind == "h2c":
+        # 预热建立的连接被之后的请求复用
+        assert server.connections - before == 1
+
+
+@pytest.mark.parametrize("kind", ["http1", "h2c"])
+def test_streaming_matches(event_loop_runner, upstreams, kind):
+    adapter = build_adapter(kind, upstreams)
+
+    async def collect():
+        chunks = [chunk async for chunk in adapter.stream_chat_completion(MESSAGES, "mock-model")]
+        await adapter.aclose()
+        return chunks
+
+    chunks = event_loop_runner(collect())
+    assert len(chunks) > 1
+    assert "".join(chunks) == event_loop_runner(build_adapter(kind, upstreams).chat_completion(MESSAGES, "mock-model"))
+
+
+@pytest.mark.parametrize("kind", ["http1", "h2c"])
+def test_timeout_and_status_match(event_loop_runner, upstreams, kind):
+    transport = AiohttpTransport() if kind == "http1" else HttpxTransport(prior_knowledge=True)
+    url = upstreams[kind]
+
+    async def run():
+        async with transport.session() as session:
+            # 上游延迟 10ms，总超时 1ms
+            with pytest.raises(asyncio.TimeoutError):
+                async with session.post(f"{url}/v1/chat/completions", json={"messages": MESSAGES},
+                                        timeout=aiohttp.ClientTimeout(total=0.001)) as response:
+                    await response.read()
+            async with session.post(f"{url}/v1/unknown", json={}) as response:
+                status = response.status
+                with pytest.raises(aiohttp.ClientResponseError):
+                    response.raise_for_status()
+        await transport.aclose()
+        return status
+
+    assert event_loop_runner(run()) == 404
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+用量和费用统计基准测试
+测量记录一次请求用量的开销（只追加到内存），并校验各提供商响应中用量、结束原因和请求ID的提取，
+按时间桶和维度合并写入存储、按提示缓存价格计算费用、按币种分组查询、写入失败时重试、多个 worker 累加、
+在一个事务中清理过期的时间桶，
+以及 MCP 返回结构化结果并记录用量（上游未返回用量时按估算值记录）。
+"""
+
+import json
+import time
+
+import pytest
+
+from api_adapter import BaseAdapter, chat_result, extract_usage
+from capabilities import CapabilityRegistry
+from state_backend import MemoryBackend
+from usage_accounting import UsageAccountant
+
+
+@pytest.fixture
+def registry(tmp_path):
+    path = tmp_path / "model_capabilities.json"
+    path.write_text(json.dumps({
+        "defaults": {"currency": "USD"},
+        "providers": {
+            "openai": {"defaults": {"cache_read_ratio": 0.5},
+                       "models": {"priced-model": {"input_price": 2, "output_price": 10}}},
+            "zhipu": {"defaults": {"currency": "CNY", "input_price": 1, "output_price": 1}},
+        },
+    }), encoding="utf-8")
+    return CapabilityRegistry(str(path))
+
+
+def test_record(benchmark, registry):
+    accountant = UsageAccountant(registry)
+    usage = {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120}
+    benchmark(accountant.record, "openai", "priced-model", usage, consumer="alice")
+    # 记录时不做任何 I/O
+    assert accountant.pending() > 0 and accountant.state.items("usage") == {}
+
+
+def test_extract_usage():
+    assert extract_usage({"usage": {"prompt_tokens": 10, "completion_tokens": 5,
+                                    "prompt_tokens_details": {"cached_tokens": 4}}}) == \
+        {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15, "cache_read_tokens": 4}
+    # Anthropic 的 input_tokens 不含缓存部分
+    assert extract_usage({"usage": {"input_tokens": 10, "output_tokens": 5, "cache_read_input_tokens": 100,
+                                    "cache_creation_input_tokens": 20}}) == \
+        {"prompt_tokens": 130, "completion_tokens": 5, "total_tokens": 135,
+         "cache_read_tokens": 100, "cache_write_tokens": 20}
+    assert extract_usage({"usageMetadata": {"promptTokenCount": 7, "candidatesTokenCount": 3}})["total_tokens"] == 10
+    assert extract_usage({"prompt_eval_count": 2, "eval_count": 1})["total_tokens"] == 3
+    assert extract_usage("不是 JSON") == {} and extract_usage({"choices": []}) == {}
+
+    result = chat_result("好的", {"id": "chatcmpl-1", "choices": [{"finish_reason": "length"}]},
+                         {"x-request-id": "req-1"})
+    assert result == "好的" and isinstance(result, str)
+    assert (result.finish_reason, result.request_id, result.usage) == ("length", "req-1", {})
+    assert chat_result("好的", {"id": "chatcmpl-1", "stop_reason": "end_turn"}).to_dict()["request_id"] == "chatcmpl-1"
+
+
+def test_flush_and_query(event_loop_runner, registry):
+    accountant = UsageAccountant(registry, bucket_seconds=60)
+    accountant.record("openai", "priced-model", {"prompt_tokens": 1000, "completion_tokens": 500,
+                                                 "cache_read_tokens": 400}, consumer="alice", conversation="c1")
+    accountant.record("openai", "priced-model", {"prompt_tokens": 10, "completion_tokens": 10},
+                      consumer="bob", estimated=True)
+    accountant.record("zhipu", "glm-4", {"prompt_tokens": 1000, "completion_tokens": 1000}, consumer="alice")
+    event_loop_runner(accountant.flush())
+    assert accountant.pending() == 0 and len(accountant.state.items("usage")) == 3
+
+    rows = accountant.query(("provider",))
+    assert [(r["provider"], r["currency"], r["requests"]) for r in rows] == [("openai", "USD", 2), ("zhipu", "CNY", 1)]
+    # 命中提示缓存的 400 个 token 按半价计费
+    openai = rows[0]
+    assert openai["cost"] == pytest.approx((600 * 2 + 400 * 2 * 0.5 + 500 * 10 + 10 * 2 + 10 * 10) / 1e6)
+    assert (openai["estimated_requests"], openai["total_tokens"], openai["cache_read_tokens"]) == (1, 1520, 400)
+
+    alice = accountant.query(("consumer", "model"), consumer="alice")
+    assert [(r["model"], r["currency"]) for r in alice] == [("glm-4", "CNY"), ("priced-model", "USD")]
+    assert accountant.query(("conversation",), conversation="c1")[0]["prompt_tokens"] == 1000
+    now = time.time()
+    assert accountant.query(since=now + 120) == [] and len(accountant.query(until=now + 120)) == 2
+    with pytest.raises(ValueError):
+        accountant.query(("region",))
+
+
+class _FailingBackend(MemoryBackend):
+    """第一次累加失败的存储"""
+
+    def __init__(self):
+        super().__init__()
+        self.failures = 1
+
+    def increment(self, namespace, deltas):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("数据库被锁定")
+        return super().increment(namespace, deltas)
+
+
+def test_retry_and_shared_store(event_loop_runner, registry):
+    store = _FailingBackend()
+    first = UsageAccountant(registry, state=store)
+    second = UsageAccountant(registry, state=store)
+    first.record("openai", "priced-model", {"prompt_tokens": 10, "completion_tokens": 1})
+    event_loop_runner(first.flush())
+    # 写入失败时记录留在内存中，下次写入
+    assert first.pending() == 1 and store.items("usage") == {}
+    second.record("openai", "priced-model", {"prompt_tokens": 5, "completion_tokens": 1})
+    event_loop_runner(first.flush())
+    event_loop_runner(second.flush())
+    # 两个 worker 的计数在同一个键上累加
+    row, = second.query(("provider", "model"))
+    assert (row["requests"], row["prompt_tokens"], row["completion_tokens"]) == (2, 15, 2)
+
+
+class _CountingBackend(MemoryBackend):
+    """记录写事务次数的存储"""
+
+    def __init__(self):
+        super().__init__()
+        self.deletes = 0
+
+    def delete(self, namespace, key):
+        self.deletes += 1
+        return super().delete(namespace, key)
+
+    def delete_matching(self, namespace, predicate):
+        self.deletes += 1
+        return super().delete_matching(namespace, predicate)
+
+
+def test_prune(event_loop_runner, registry):
+    store = _CountingBackend()
+    accountant = UsageAccountant(registry, state=store, bucket_seconds=60, retention_buckets=2)
+    now = time.time()
+    for age in range(10):
+        accountant._pending.append((now - age * 60, "openai", "priced-model", "", "", 10, 1, 0, 0, False))
+    event_loop_runner(accountant.flush())
+    # 只保留最近 2 个时间桶，过期的 7 个时间桶在一次删除中清理
+    assert len(store.items("usage")) == 3 and store.deletes == 1
+    assert store.version("usage") == 2
+    # 同一个时间桶内不再重复清理
+    accountant.record("openai", "priced-model", {"prompt_tokens": 1})
+    event_loop_runner(accountant.flush())
+    assert store.deletes == 1
+
+
+class _PlainAdapter(BaseAdapter):
+    """只返回文本、不返回用量的适配器"""
+
+    async def chat_completion(self, messages: list, model: str, **kwargs) -> str:
+        return "没有用量信息的回复"
+
+
+def test_mcp_records_usage(event_loop_runner, build_mcp, mock_upstream, registry):
+    accountant = UsageAccountant(registry)
+    mcp = build_mcp(mock_upstream, model="priced-model", usage=accountant)
+    messages = [{"role": "user", "content": "统计用量"}]
+    result = event_loop_runner(mcp.handle_request(messages, "default", consumer="alice", conversation="c1"))
+    assert result.usage["prompt_tokens"] > 0 and result.finish_reason == "stop"
+    assert result.request_id and result.latency > 0
+
+    mcp.providers["openai"] = _PlainAdapter()
+    mcp.publish_routes()
+    plain = event_loop_runner(mcp.handle_request(messages, "default", consumer="alice"))
+    assert plain.usage == {} and plain.latency is not None
+    event_loop_runner(accountant.flush())
+    row, = accountant.query(("consumer",))
+    # 上游未返回用量的请求按估算的 token 数记录并标记
+    assert (row["consumer"], row["requests"], row["estimated_requests"]) == ("alice", 2, 1)
+    assert row["prompt_tokens"] > result.usage["prompt_tokens"] and row["cost"] > 0
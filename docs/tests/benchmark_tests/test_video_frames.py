@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+视频关键帧测试
+校验从候选帧中均匀选取关键帧并按视频内容哈希缓存、上传文件准备时视频替换为关键帧图片（没有 ffmpeg 时按原视频发送）、
+只支持图片的模型在可以抽帧时接受视频；安装了 ffmpeg 时再端到端校验从文件和上传数据流抽帧。
+"""
+
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from api_adapter import BaseAdapter
+from media_cache import MediaCache
+from metrics import metrics
+from video_frames import KeyframeExtractor, _hash_file
+
+VIDEO_URL = "/static/uploads/clip.mp4"
+
+
+def write_frames(directory: str, count: int) -> list:
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(1, count + 1):
+        path = os.path.join(directory, f"cand_{i:04d}.jpg")
+        with open(path, "wb") as f:
+            f.write(b"\xff\xd8frame %d" % i)
+        paths.append(path)
+    return paths
+
+
+def test_select_keyframes(tmp_path):
+    extractor = KeyframeExtractor(str(tmp_path / "frames"), max_frames=3, ffmpeg="")
+    tmp_dir = extractor._tmp_dir()
+    write_frames(tmp_dir, 10)
+    frames = extractor._select(tmp_dir, "digest")
+    # 首帧、末帧和中间均匀分布的一帧
+    assert [os.path.basename(f) for f in frames] == ["cand_0001.jpg", "cand_0005.jpg", "cand_0010.jpg"]
+    assert os.path.dirname(frames[0]) == str(tmp_path / "frames" / "digest") and not os.path.exists(tmp_dir)
+
+    # 相同内容的视频再次抽帧时复用已有结果
+    again = extractor._tmp_dir()
+    write_frames(again, 2)
+    assert extractor._select(again, "digest") == frames and not os.path.exists(again)
+    # 没有候选帧
+    assert extractor._select(extractor._tmp_dir(), "empty") == []
+
+
+def test_prepare_replaces_video(event_loop_runner, tmp_path):
+    upload_dir = tmp_path / "uploads"
+    upload_dir.mkdir()
+    video = upload_dir / "clip.mp4"
+    video.write_bytes(b"\x00\x00\x00\x18ftypmp42" + b"0" * 1024)
+
+    # 没有 ffmpeg 时按原视频发送
+    unavailable = KeyframeExtractor(str(tmp_path / "frames"), ffmpeg="")
+    prepared = event_loop_runner(MediaCache(str(upload_dir), keyframes=unavailable).prepare([VIDEO_URL]))
+    assert [item.mime_type for item in prepared] == ["video/mp4"]
+
+    # 按内容哈希缓存的关键帧（例如重启前抽取的）直接使用，不启动 ffmpeg
+    extractor = KeyframeExtractor(str(tmp_path / "frames"), ffmpeg="/nonexistent/ffmpeg")
+    write_frames(str(tmp_path / "frames" / _hash_file(str(video))), 2)
+    hits = metrics.get("video_keyframe_cache_hits")
+    prepared = event_loop_runner(MediaCache(str(upload_dir), keyframes=extractor).prepare([VIDEO_URL, "https://example.com/a.png"]))
+    assert [(item.url, item.mime_type) for item in prepared[:2]] == [(f"{VIDEO_URL}#frame=0", "image/jpeg"),
+                                                                      (f"{VIDEO_URL}#frame=1", "image/jpeg")]
+    assert prepared[2] == "https://example.com/a.png"
+    assert metrics.get("video_keyframe_cache_hits") == hits + 1
+
+
+class _CaptureAdapter(BaseAdapter):
+    """需要内联附件的适配器，记录收到的附件"""
+    inline_media = True
+
+    async def chat_completion(self, messages: list, model: str, file_urls=None, **kwargs) -> str:
+        self.file_urls = file_urls
+        return "好的"
+
+
+def test_vision_model_accepts_video(event_loop_runner, build_mcp, mock_upstream, tmp_path):
+    upload_dir = tmp_path / "uploads"
+    upload_dir.mkdir()
+    video = upload_dir / "clip.mp4"
+    video.write_bytes(b"video")
+    extractor = KeyframeExtractor(str(tmp_path / "frames"), ffmpeg="")
+    write_frames(str(tmp_path / "frames" / _hash_file(str(video))), 3)
+    # gpt-4o 支持图片但不支持视频
+    mcp = build_mcp(mock_upstream, model="gpt-4o", media_cache=MediaCache(str(upload_dir), keyframes=extractor))
+    adapter = _CaptureAdapter()
+    mcp.providers["openai"] = adapter
+    mcp.publish_routes()
+    messages = [{"role": "user", "content": "视频里有什么"}]
+    with pytest.raises(Exception, match="不支持图片/视频输入"):
+        event_loop_runner(mcp.handle_request(messages, "default", file_urls=[VIDEO_URL]))
+
+    extractor.ffmpeg = "/nonexistent/ffmpeg"
+    event_loop_runner(mcp.handle_request(messages, "default", file_urls=[VIDEO_URL]))
+    assert [item.mime_type for item in adapter.file_urls] == ["image/jpeg"] * 3
+
+
+@pytest.mark.skipif(not shutil.which("ffmpeg"), reason="未安装 ffmpeg")
+def test_extract_with_ffmpeg(event_loop_runner, tmp_path):
+    video = tmp_path / "clip.mp4"
+    # 每秒切换一次画面的测试视频，moov 放在文件开头以便从管道解析
+    subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+                    "-i", "testsrc=duration=4:size=320x240:rate=10", "-vf", "hue=h=t*90",
+                    "-movflags", "+faststart", str(video)], check=True)
+    extractor = KeyframeExtractor(str(tmp_path / "frames"), max_frames=3, scene_threshold=0.1)
+
+    async def run():
+        frames = await extractor.frames_for(str(video))
+        # 模拟上传：边写边送入 ffmpeg，上传完成后在后台完成抽帧
+        copy = tmp_path / "upload.mp4"
+        stream = await extractor.start_stream()
+        data = video.read_bytes()
+        with open(copy, "wb") as f:
+            for i in range(0, len(data), 8192):
+                f.write(data[i:i + 8192])
+                await stream.feed(data[i:i + 8192])
+        extractor.schedule(str(copy), stream)
+        streamed = await extractor.frames_for(str(copy))
+        return frames, streamed
+
+    frames, streamed = event_loop_runner(run())
+    assert 1 <= len(frames) <= 3 and all(f.endswith(".jpg") for f in frames)
+    # 内容相同的视频共用关键帧缓存
+    assert streamed == frames
+    assert extractor._active == 0
+    assert not [name for name in os.listdir(tmp_path / "frames") if name.startswith(".tmp-")]
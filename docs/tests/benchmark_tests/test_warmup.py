@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+启动预热基准测试
+测量并发预热多个提供商（建立连接、获取百度访问令牌、可选的探测请求）的耗时，
+并校验预热失败的提供商不影响就绪状态。
+"""
+
+from api_adapter import OpenAIAdapter
+from warmup import ProviderWarmer
+
+PROVIDERS = ("openai", "baidu", "ollama")
+
+
+def test_warm_up_providers(benchmark, event_loop_runner, mock_upstream, build_mcp):
+    mcp = build_mcp(mock_upstream, PROVIDERS)
+
+    def warm():
+        warmer = ProviderWarmer(mcp, probe=True)
+        event_loop_runner(warmer.run())
+        return warmer
+
+    warmer = benchmark(warm)
+    status = warmer.status()
+    assert status["ready"]
+    assert {name: result["status"] for name, result in status["providers"].items()} == {
+        "openai": "warm", "baidu": "warm", "ollama": "warm"}
+    assert all("probe_seconds" in result for result in status["providers"].values())
+    assert mcp.providers["baidu"].access_token
+
+
+def test_failed_provider_still_ready(event_loop_runner, mock_upstream, build_mcp):
+    mcp = build_mcp(mock_upstream, PROVIDERS)
+    # 没有服务监听的端口
+    mcp.providers["openai"] = OpenAIAdapter(api_key="bench", base_url="http://127.0.0.1:9/v1")
+    mcp.publish_routes()
+    warmer = ProviderWarmer(mcp, timeout=2)
+    assert not warmer.ready
+    event_loop_runner(warmer.run())
+    assert warmer.ready
+    assert warmer.providers["openai"]["status"] == "failed"
+    assert warmer.providers["baidu"]["status"] == "warm"
+
+
+def test_probe_keyword_only_adapters(event_loop_runner, mock_upstream, build_mcp):
+    # chat_completion 只声明 **kwargs 的适配器同样要接受探测请求的 max_tokens
+    mcp = build_mcp(mock_upstream, ("google", "anthropic"))
+    warmer = ProviderWarmer(mcp, probe=True)
+    event_loop_runner(warmer.run())
+    assert {name: result["status"] for name, result in warmer.providers.items()} == {
+        "google": "warm", "anthropic": "warm"}
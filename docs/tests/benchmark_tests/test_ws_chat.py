@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+/ws/chat 多路复用测试
+用内存中的 WebSocket 驱动 ChatSocketSession，对照流式模拟上游校验一条连接上多路会话并发推送增量帧、
+按会话保存历史，取消、同一会话上的新请求取代旧请求、连接路数上限、流控窗口和断开连接时取消全部上游请求，
+格式错误的帧只回复错误帧、不中断连接，以及保存历史时等待存储写锁不阻塞同一连接上的其他帧。
+"""
+
+import asyncio
+import json
+import time
+
+import pytest
+from aiohttp import web
+
+from chat_history import ChatHistory
+from mock_provider import LatencyModel, MockProvider
+from state_backend import MemoryBackend
+from ws_chat import ChatSocketSession
+
+
+class _MemorySocket:
+    """内存中的 WebSocket：客户端帧放入 incoming（bytes 为二进制帧），服务端帧追加到 frames，放入 None 表示客户端断开"""
+
+    def __init__(self):
+        self.incoming = asyncio.Queue()
+        self.frames = []
+
+    async def receive(self) -> dict:
+        frame = await self.incoming.get()
+        if frame is None:
+            return {"type": "websocket.disconnect", "code": 1000}
+        if isinstance(frame, bytes):
+            return {"type": "websocket.receive", "bytes": frame}
+        text = frame if isinstance(frame, str) else json.dumps(frame, ensure_ascii=False)
+        return {"type": "websocket.receive", "text": text}
+
+    async def send_json(self, frame: dict):
+        self.frames.append(frame)
+
+    def of(self, request_id: str, frame_type: str) -> list:
+        return [f for f in self.frames if f.get("request_id") == request_id and f["type"] == frame_type]
+
+    async def wait_for(self, predicate, timeout: float = 5.0):
+        """等待满足条件的服务端帧出现"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while not any(predicate(frame) for frame in self.frames):
+            assert asyncio.get_running_loop().time() < deadline, f"等待帧超时，已收到: {self.frames}"
+            await asyncio.sleep(0.005)
+
+
+@pytest.fixture(scope="module")
+def stream_upstream(event_loop_runner):
+    """每个回复分 5 段、每段间隔 0.05 秒的流式模拟上游"""
+    provider = MockProvider(LatencyModel("fixed:0"), stream_chunks=5, chunk_interval=0.05)
+    runner = web.AppRunner(provider.build_app())
+    event_loop_runner(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    event_loop_runner(site.start())
+    yield f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    event_loop_runner(runner.cleanup())
+
+
+@pytest.fixture
+def chat_session(build_mcp, stream_upstream, tmp_path):
+    """返回 (会话, 内存 WebSocket, 聊天历史)，单个连接最多 2 路会话"""
+    socket = _MemorySocket()
+    history = ChatHistory(str(tmp_path / "chat_histories.json"), backend=MemoryBackend())
+    session = ChatSocketSession(socket, build_mcp(stream_upstream), history, max_streams=2)
+    return session, socket, history
+
+
+def chat(request_id: str, question: str, history_id=None, **extra) -> dict:
+    return {"type": "chat", "request_id": request_id, "history_id": history_id,
+            "messages": [{"role": "user", "content": question}], **extra}
+
+
+def test_multiplexed_streams(event_loop_runner, chat_session):
+    session, socket, history = chat_session
+    first, second = history.create_history(), history.create_history()
+
+    async def run():
+        running = asyncio.ensure_future(session.run())
+        socket.incoming.put_nowait(chat("r1", "第一个会话的问题", first))
+        socket.incoming.put_nowait(chat("r2", "第二个会话的问题", second))
+        socket.incoming.put_nowait({"type": "ping"})
+        await socket.wait_for(lambda f: f["type"] == "done" and f["request_id"] == "r1")
+        await socket.wait_for(lambda f: f["type"] == "done" and f["request_id"] == "r2")
+        socket.incoming.put_nowait("不是JSON")
+        socket.incoming.put_nowait({"type": "unknown"})
+        socket.incoming.put_nowait(None)
+        await running
+
+    event_loop_runner(run())
+    assert {"type": "pong"} in socket.frames
+    deltas = [f for f in socket.frames if f["type"] == "delta"]
+    # 两路会话的增量帧交错推送，而不是一路完成后再开始另一路
+    first_done = next(i for i, f in enumerate(socket.frames) if f["type"] == "done")
+    assert {f["request_id"] for f in socket.frames[:first_done] if f["type"] == "delta"} == {"r1", "r2"}
+    for request_id, history_id, question in (("r1", first, "第一个会话的问题"), ("r2", second, "第二个会话的问题")):
+        parts = [f for f in deltas if f["request_id"] == request_id]
+        assert [f["seq"] for f in parts] == list(range(1, len(parts) + 1))
+        done = socket.of(request_id, "done")[0]
+        assert done["content"] == "".join(f["content"] for f in parts) and question in done["content"]
+        assert [m["role"] for m in history.get_history(history_id)["messages"]] == ["user", "assistant"]
+    assert [f["status"] for f in socket.frames if f["type"] == "error"] == [400, 400]
+    assert session.streams == {}
+
+
+def test_cancel_and_supersede(event_loop_runner, chat_session):
+    session, socket, _ = chat_session
+
+    async def run():
+        running = asyncio.ensure_future(session.run())
+        socket.incoming.put_nowait(chat("r1", "要取消的问题"))
+        await socket.wait_for(lambda f: f["type"] == "delta" and f["request_id"] == "r1")
+        cancelled_task = session.streams["r1"].task
+        socket.incoming.put_nowait({"type": "cancel", "request_id": "r1"})
+        await socket.wait_for(lambda f: f["type"] == "cancelled")
+        assert cancelled_task.cancelled() or cancelled_task.done()
+
+        # 同一会话上的新请求取代旧请求
+        socket.incoming.put_nowait(chat("r2", "旧问题", "h1"))
+        await socket.wait_for(lambda f: f["type"] == "accepted" and f["request_id"] == "r2")
+        socket.incoming.put_nowait(chat("r3", "新问题", "h1"))
+        # 单个连接最多 2 路会话
+        socket.incoming.put_nowait(chat("r4", "第二路", "h2"))
+        socket.incoming.put_nowait(chat("r5", "第三路", "h3"))
+        await socket.wait_for(lambda f: f["type"] == "done" and f["request_id"] == "r3")
+        await socket.wait_for(lambda f: f["type"] == "done" and f["request_id"] == "r4")
+        socket.incoming.put_nowait(None)
+        await running
+
+    event_loop_runner(run())
+    assert socket.of("r1", "cancelled")[0]["reason"] == "client" and not socket.of("r1", "done")
+    assert socket.of("r2", "cancelled")[0]["reason"] == "superseded" and not socket.of("r2", "done")
+    assert "新问题" in socket.of("r3", "done")[0]["content"]
+    assert socket.of("r5", "error")[0]["status"] == 429
+
+
+def test_flow_control_and_disconnect(event_loop_runner, chat_session):
+    session, socket, _ = chat_session
+
+    async def run():
+        running = asyncio.ensure_future(session.run())
+        socket.incoming.put_nowait(chat("r1", "流控的问题", window=2))
+        await socket.wait_for(lambda f: f["type"] == "delta" and f["seq"] == 2)
+        # 未确认的帧达到窗口上限后暂停推送
+        await asyncio.sleep(0.2)
+        assert len(socket.of("r1", "delta")) == 2
+        socket.incoming.put_nowait({"type": "ack", "request_id": "r1", "seq": 2})
+        await socket.wait_for(lambda f: f["type"] == "delta" and f["seq"] == 3)
+        task = session.streams["r1"].task
+        # 客户端断开时取消仍在进行的请求
+        socket.incoming.put_nowait(None)
+        await running
+        await asyncio.gather(task, return_exceptions=True)
+        return task
+
+    task = event_loop_runner(run())
+    assert task.cancelled()
+    assert not socket.of("r1", "done") and session.streams == {}
+
+
+@pytest.mark.parametrize("bad_frame, detail", [
+    (b"\x00\x01", "文本帧"),
+    ({"type": "ack", "request_id": "r1", "seq": "abc"}, "seq"),
+    ({"type": "ack", "request_id": "r1", "seq": -1}, "seq"),
+    ({"type": "cancel", "history_id": ["h1"]}, "history_id"),
+    (chat({"id": 1}, "请求ID不是字符串"), "request_id"),
+    (chat("r0", "窗口不是整数", window="2"), "window"),
+    (chat("r0", "窗口为负数", window=-1), "window"),
+])
+def test_malformed_frames(event_loop_runner, chat_session, bad_frame, detail):
+    session, socket, _ = chat_session
+
+    async def run():
+        running = asyncio.ensure_future(session.run())
+        socket.incoming.put_nowait(chat("r1", "正常的问题", window=2))
+        await socket.wait_for(lambda f: f["type"] == "delta" and f["seq"] == 2)
+        socket.incoming.put_nowait(bad_frame)
+        await socket.wait_for(lambda f: f["type"] == "error")
+        # 格式错误的帧只回复 400，连接和进行中的会话不受影响
+        assert not running.done() and "r1" in session.streams
+        socket.incoming.put_nowait({"type": "ack", "request_id": "r1", "seq": 5})
+        await socket.wait_for(lambda f: f["type"] == "done" and f["request_id"] == "r1")
+        socket.incoming.put_nowait(None)
+        await running
+
+    event_loop_runner(run())
+    error, = [f for f in socket.frames if f["type"] == "error"]
+    assert error["status"] == 400 and detail in error["detail"]
+    assert not socket.of("r0", "accepted")
+
+
+class _SlowBackend(MemoryBackend):
+    """写入时等待 0.3 秒，模拟其他 worker 持有写锁"""
+
+    def update(self, namespace, key, fn):
+        time.sleep(0.3)
+        return super().update(namespace, key, fn)
+
+
+def test_history_write_does_not_block(event_loop_runner, build_mcp, stream_upstream, tmp_path):
+    socket = _MemorySocket()
+    history = ChatHistory(str(tmp_path / "chat_histories.json"), backend=_SlowBackend())
+    history_id = history.create_history()
+    session = ChatSocketSession(socket, build_mcp(stream_upstream), history)
+
+    async def run():
+        gaps = []
+
+        async def ticker():
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - before)
+
+        ticking = asyncio.ensure_future(ticker())
+        running = asyncio.ensure_future(session.run())
+        socket.incoming.put_nowait(chat("r1", "保存历史的问题", history_id))
+        await socket.wait_for(lambda f: f["type"] == "done")
+        socket.incoming.put_nowait(None)
+        await running
+        ticking.cancel()
+        return gaps
+
+    # 写入历史在线程中等待写锁，事件循环仍然及时处理其他任务
+    assert max(event_loop_runner(run())) < 0.2
+    assert [m["role"] for m in history.get_history(history_id)["messages"]] == ["user", "assistant"]
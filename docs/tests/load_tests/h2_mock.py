@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+明文 HTTP/2（h2c，prior knowledge）模拟上游服务
+实现 OpenAI 兼容的 /v1/chat/completions（含 SSE 流式），回复内容、用量和延迟与 mock_provider.MockProvider 相同，
+用于对比 HTTP/2 传输（传输类型 h2c）和 aiohttp HTTP/1.1 传输。记录建立的连接数，便于确认多路复用。
+
+用法:
+    python h2_mock.py --port 9001 --latency fixed:0.05
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import time
+import uuid
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import ConnectionTerminated, DataReceived, RequestReceived, StreamEnded, StreamReset, WindowUpdated
+
+from mock_provider import LatencyModel, MockProvider
+
+
+class _H2Protocol(asyncio.Protocol):
+    """一个 HTTP/2 连接"""
+
+    def __init__(self, server: "H2MockServer"):
+        self.server = server
+        self.conn = H2Connection(config=H2Configuration(client_side=False, header_encoding="utf-8"))
+        self.transport = None
+        self.requests = {}  # stream_id -> (请求头, 请求体)
+        self.window_open = {}  # stream_id -> 流控窗口有余量时置位的事件
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections += 1
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data: bytes):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, RequestReceived):
+                self.requests[event.stream_id] = (dict(event.headers), bytearray())
+            elif isinstance(event, DataReceived):
+                self.requests[event.stream_id][1].extend(event.data)
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, StreamEnded):
+                headers, body = self.requests.pop(event.stream_id)
+                asyncio.ensure_future(self.server.handle(self, event.stream_id, headers, bytes(body)))
+            elif isinstance(event, WindowUpdated):
+                for waiter in self.window_open.values():
+                    waiter.set()
+            elif isinstance(event, StreamReset):
+                self.requests.pop(event.stream_id, None)
+            elif isinstance(event, ConnectionTerminated):
+                self.transport.close()
+        self.flush()
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def send_headers(self, stream_id: int, status: int, headers: dict, end_stream: bool = False):
+        self.conn.send_headers(stream_id, [(":status", str(status))] + list(headers.items()), end_stream=end_stream)
+        self.flush()
+
+    async def send_data(self, stream_id: int, data: bytes, end_stream: bool = False):
+        """按流控窗口分段发送"""
+        while True:
+            window = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+            if data and window <= 0:
+                # 窗口耗尽，等待客户端 WINDOW_UPDATE
+                waiter = self.window_open.setdefault(stream_id, asyncio.Event())
+                waiter.clear()
+                await waiter.wait()
+                continue
+            chunk, data = data[:window], data[window:]
+            self.conn.send_data(stream_id, chunk, end_stream=end_stream and not data)
+            self.flush()
+            if not data:
+                break
+        self.window_open.pop(stream_id, None)
+
+    def connection_lost(self, exc):
+        for waiter in self.window_open.values():
+            waiter.set()
+
+
+class H2MockServer:
+    """h2c 模拟上游：OpenAI 兼容聊天接口"""
+
+    def __init__(self, provider: MockProvider):
+        self.provider = provider  # 复用 MockProvider 的延迟、回复和用量
+        self.connections = 0  # 累计建立的连接数
+        self.server = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """启动服务并返回地址"""
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: _H2Protocol(self), host, port)
+        return f"http://{host}:{self.server.sockets[0].getsockname()[1]}"
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, protocol: _H2Protocol, stream_id: int, headers: dict, body: bytes):
+        provider = self.provider
+        provider.requests += 1
+        if headers.get(":path", "").split("?")[0] not in ("/v1/chat/completions", "/chat/completions"):
+            if headers.get(":method") == "HEAD":
+                # HEAD 响应没有响应体（预热请求）
+                protocol.send_headers(stream_id, 404, {"content-type": "application/json"}, end_stream=True)
+                return
+            payload = json.dumps({"error": {"message": "not found"}}).encode("utf-8")
+            protocol.send_headers(stream_id, 404, {"content-type": "application/json"})
+            await protocol.send_data(stream_id, payload, end_stream=True)
+            return
+        await asyncio.sleep(provider.latency.sample())
+        request = json.loads(body or b"{}")
+        text = provider.answer(request.get("messages"))
+        if request.get("stream"):
+            protocol.send_headers(stream_id, 200, {"content-type": "text/event-stream"})
+            size = max(1, math.ceil(len(text) / provider.stream_chunks))
+            for i in range(0, len(text), size):
+                chunk = {"choices": [{"index": 0, "delta": {"content": text[i:i + size]}}], "model": request.get("model")}
+                await protocol.send_data(stream_id, f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await asyncio.sleep(provider.chunk_interval)
+            await protocol.send_data(stream_id, b"data: [DONE]\n\n", end_stream=True)
+            return
+        payload = json.dumps({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": provider.usage(json.dumps(request.get("messages"), ensure_ascii=False), text)
+        }, ensure_ascii=False).encode("utf-8")
+        protocol.send_headers(stream_id, 200, {"content-type": "application/json", "content-length": str(len(payload))})
+        await protocol.send_data(stream_id, payload, end_stream=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="h2c 模拟上游服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=9001, help="监听端口")
+    parser.add_argument("--latency", default="fixed:0.05", help="延迟分布，格式同 mock_provider.py")
+    args = parser.parse_args()
+
+    async def run():
+        server = H2MockServer(MockProvider(LatencyModel(args.latency)))
+        url = await server.start(args.host, args.port)
+        print(f"🚀 h2c 模拟上游服务已启动: {url}  延迟={args.latency}")
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+网关端到端压测脚本
+向 server.py 的 /v1/chat/completions 发起并发请求，统计吞吐量、p50/p95/p99 延迟，
+并通过 /metrics 中的 process_cpu_seconds 计算网关单请求CPU开销。
+
+配合 mock_provider.py 使用时不消耗任何真实额度：
+    # 自动启动模拟上游和网关（在临时目录中运行，不影响本地配置）
+    python load_test.py --spawn --provider openai --requests 2000 --concurrency 50 --latency lognormal:-1.5,0.5
+
+    # 对已运行的网关压测
+    python load_test.py --gateway http://127.0.0.1:8000 --requests 500 --concurrency 20
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import aiohttp
+
+# 项目根目录（server.py 所在目录）
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+# 模拟上游服务脚本
+MOCK_PROVIDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_provider.py")
+
+# 各提供商在模拟上游下的配置，{mock} 替换为模拟上游地址
+PROVIDER_CONFIGS = {
+    "openai": {"api_key": "mock-key", "model": "mock-model", "base_url": "{mock}/v1"},
+    "anthropic": {"api_key": "mock-key", "model": "mock-model", "base_url": "{mock}"},
+    "google": {"api_key": "mock-key", "model": "mock-model", "base_url": "{mock}"},
+    "ollama": {"model": "mock-model", "base_url": "{mock}"},
+    "baidu": {"api_key": "mock-key", "secret_key": "mock-secret", "model": "mock-model", "base_url": "{mock}"},
+    "replicate": {"api_key": "mock-key", "model": "mock-model", "base_url": "{mock}"},
+    "cohere": {"api_key": "mock-key", "model": "mock-model", "base_url": "{mock}"},
+    "spark": {"api_key": "mock-key", "model": "spark-v3", "base_url": "{mock}"},
+    "阿里云": {"api_key": "mock-key", "model": "mock-model", "base_url": "{mock}"},
+    "硅基流动": {"api_key": "mock-key", "model": "mock-model", "base_url": "{mock}"},
+}
+
+
+def percentile(values, pct: float) -> float:
+    """计算百分位数（最近秩法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(pct / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+class LoadTester:
+    """并发压测器"""
+
+    def __init__(self, gateway: str, total: int, concurrency: int, prompt: str, priority: str = None):
+        self.gateway = gateway.rstrip("/")
+        self.total = total
+        self.concurrency = concurrency
+        self.prompt = prompt
+        self.priority = priority
+        self.latencies = []
+        self.statuses = Counter()
+
+    async def fetch_cpu_seconds(self, session: aiohttp.ClientSession):
+        """读取网关进程累计CPU时间"""
+        try:
+            async with session.get(f"{self.gateway}/metrics") as response:
+                data = await response.json()
+                return data.get("process_cpu_seconds")
+        except Exception:
+            return None
+
+    async def one_request(self, session: aiohttp.ClientSession, index: int):
+        payload = {"messages": [{"role": "user", "content": f"{self.prompt} #{index}"}], "model": "default"}
+        if self.priority:
+            payload["priority"] = self.priority
+        started = time.perf_counter()
+        try:
+            async with session.post(f"{self.gateway}/v1/chat/completions", json=payload) as response:
+                await response.read()
+                self.statuses[response.status] += 1
+                if response.status == 200:
+                    self.latencies.append(time.perf_counter() - started)
+        except Exception as e:
+            self.statuses[type(e).__name__] += 1
+
+    async def run(self) -> dict:
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+            cpu_before = await self.fetch_cpu_seconds(session)
+            counter = iter(range(self.total))
+
+            async def worker():
+                for index in counter:
+                    await self.one_request(session, index)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            elapsed = time.perf_counter() - started
+            cpu_after = await self.fetch_cpu_seconds(session)
+
+        succeeded = len(self.latencies)
+        report = {
+            "requests": self.total,
+            "succeeded": succeeded,
+            "statuses": {str(k): v for k, v in self.statuses.items()},
+            "elapsed_seconds": round(elapsed, 3),
+            "throughput_rps": round(succeeded / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": {
+                "p50": round(percentile(self.latencies, 50) * 1000, 2),
+                "p95": round(percentile(self.latencies, 95) * 1000, 2),
+                "p99": round(percentile(self.latencies, 99) * 1000, 2),
+                "max": round(max(self.latencies, default=0) * 1000, 2),
+            },
+        }
+        if cpu_before is not None and cpu_after is not None and self.total:
+            # 包括失败请求在内，网关为每个请求付出的CPU时间
+            report["gateway_cpu_ms_per_request"] = round((cpu_after - cpu_before) * 1000 / self.total, 3)
+        return report
+
+
+async def wait_until_ready(url: str, timeout: float = 30.0):
+    """等待服务可以响应"""
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"服务启动超时: {url}")
+
+
+def spawn_services(args, workdir: str):
+    """启动模拟上游和网关，网关在临时目录中运行，使用指向模拟上游的配置"""
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    mock = subprocess.Popen([
+        sys.executable, MOCK_PROVIDER,
+        "--port", str(args.mock_port),
+        "--latency", args.latency,
+        "--error-rate", str(args.error_rate),
+    ])
+
+    config = {key: value.replace("{mock}", mock_url) for key, value in PROVIDER_CONFIGS[args.provider].items()}
+    with open(os.path.join(workdir, "mcp_config.json"), "w", encoding="utf-8") as f:
+        json.dump({"configurations": {args.provider: config}, "current_provider": args.provider},
+                  f, ensure_ascii=False, indent=2)
+
+    env = dict(os.environ, BAIYU_HOST="127.0.0.1", BAIYU_PORT=str(args.gateway_port))
+    gateway = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, "server.py")],
+        cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return mock, gateway, mock_url, f"http://127.0.0.1:{args.gateway_port}"
+
+
+async def main_async(args):
+    processes = []
+    workdir = None
+    gateway = args.gateway
+    try:
+        if args.spawn:
+            workdir = tempfile.mkdtemp(prefix="baiyu_load_")
+            mock, gateway_process, mock_url, gateway = spawn_services(args, workdir)
+            processes = [gateway_process, mock]
+            await wait_until_ready(f"{mock_url}/_mock/stats")
+            await wait_until_ready(f"{gateway}/metrics")
+            print(f"🚀 已启动模拟上游 {mock_url} 和网关 {gateway}（提供商: {args.provider}）")
+
+        if args.warmup:
+            print(f"🔥 预热 {args.warmup} 个请求...")
+            await LoadTester(gateway, args.warmup, min(args.concurrency, args.warmup), args.prompt).run()
+
+        print(f"📈 开始压测: {args.requests} 个请求，并发 {args.concurrency}")
+        report = await LoadTester(gateway, args.requests, args.concurrency, args.prompt, args.priority).run()
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        if report["succeeded"] < report["requests"]:
+            print(f"⚠️ {report['requests'] - report['succeeded']} 个请求未成功: {report['statuses']}")
+        else:
+            print("✅ 所有请求均成功")
+        return report
+    finally:
+        for process in processes:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="网关端到端压测")
+    parser.add_argument("--gateway", default="http://127.0.0.1:8000", help="网关地址（未使用 --spawn 时）")
+    parser.add_argument("--spawn", action="store_true", help="自动启动模拟上游和网关")
+    parser.add_argument("--provider", default="openai", choices=sorted(PROVIDER_CONFIGS), help="--spawn 时使用的上游协议")
+    parser.add_argument("--mock-port", type=int, default=9000, help="模拟上游端口")
+    parser.add_argument("--gateway-port", type=int, default=8765, help="--spawn 时网关端口")
+    parser.add_argument("--latency", default="fixed:0.05", help="模拟上游延迟分布")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟上游错误比例")
+    parser.add_argument("--requests", type=int, default=500, help="请求总数")
+    parser.add_argument("--concurrency", type=int, default=20, help="并发数")
+    parser.add_argument("--warmup", type=int, default=20, help="预热请求数，不计入统计")
+    parser.add_argument("--priority", default=None, help="请求优先级类别（interactive/batch）")
+    parser.add_argument("--prompt", default="你好，请简单介绍一下你自己", help="请求内容")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
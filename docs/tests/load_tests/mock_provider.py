@@ -0,0 +1,550 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟上游服务（Mock Provider）
+实现 api_adapter.py 中用到的各家接口协议，用于在不消耗真实额度的情况下测量网关开销：
+- OpenAI 兼容: /v1/chat/completions、/chat/completions（含 SSE 流式，也兼容讯飞星火的请求体）、/v1/models、/v1/files、/v1/batches（含取消）
+- 智谱: /api/paas/v4/chat/completions、/api/paas/v4/files、/api/paas/v4/batches（含取消）
+- 阿里云: /api/v1/services/aigc/chat/completions
+- Anthropic: /v1/messages、/v1/messages/batches（含取消）
+- Gemini: /v1beta/models/{model}:generateContent、/v1beta/cachedContents（上下文缓存）
+- Moonshot: /v1/chat/completions（OpenAI 兼容）、/v1/caching（上下文缓存）
+- Ollama: /api/chat
+- 百度: /oauth/2.0/token + /rpc/2.0/ai_custom/v1/wenxinworkshop/chat/{model}
+- Replicate: /v1/predictions（创建、轮询、取消）
+- Cohere: /v1/chat
+
+用法:
+    python mock_provider.py --port 9000 --latency lognormal:-1.5,0.5 --error-rate 0.01 --stream-chunks 20
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+
+class LatencyModel:
+    """可配置的延迟分布
+
+    支持的格式:
+        fixed:0.2              固定 0.2 秒
+        uniform:0.1,0.5        0.1~0.5 秒均匀分布
+        normal:0.3,0.05        均值 0.3、标准差 0.05 的正态分布（截断为非负）
+        lognormal:-1.5,0.5     对数正态分布（mu, sigma），长尾更接近真实上游
+    """
+
+    def __init__(self, spec: str = "fixed:0"):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p]
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"未知的延迟分布: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0] if self.params else 0.0
+        if self.kind == "uniform":
+            return random.uniform(self.params[0], self.params[1])
+        if self.kind == "normal":
+            return max(0.0, random.gauss(self.params[0], self.params[1]))
+        return math.exp(random.gauss(self.params[0], self.params[1]))
+
+
+class MockProvider:
+    """模拟上游服务的状态与行为"""
+
+    def __init__(self, latency: LatencyModel, error_rate: float = 0.0, error_status: int = 500,
+                 stream_chunks: int = 10, chunk_interval: float = 0.01, reply: str = "这是来自模拟上游的回复。"):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stream_chunks = stream_chunks
+        self.chunk_interval = chunk_interval
+        self.reply = reply
+        self.requests = 0
+        self.files = {}
+        self.batches = {}
+        self.batch_final_status = "completed"  # OpenAI 兼容批量任务结束时的状态（可设为 expired、failed）
+        self.predictions = {}
+        self.context_caches = {}  # 缓存名称 -> {"tokens", "expires_at"}
+        self.unavailable_caches = set()  # 引用时报告不存在、但仍然计费且可以删除的缓存
+
+    async def simulate(self):
+        """模拟上游处理时间与错误，返回错误响应或 None"""
+        self.requests += 1
+        await asyncio.sleep(self.latency.sample())
+        if self.error_rate and random.random() < self.error_rate:
+            return web.json_response({"error": {"message": "模拟的上游错误", "type": "mock_error"}},
+                                     status=self.error_status)
+        return None
+
+    def answer(self, messages) -> str:
+        """生成回复文本：回显最后一条消息的前若干字符，便于校验"""
+        last = ""
+        if isinstance(messages, list) and messages:
+            content = messages[-1].get("content", "") if isinstance(messages[-1], dict) else ""
+            last = content if isinstance(content, str) else json.dumps(content, ensure_ascii=False)
+        return f"{self.reply} 收到: {last[:50]}"
+
+    @staticmethod
+    def usage(prompt: str, completion: str) -> dict:
+        return {
+            "prompt_tokens": max(1, len(prompt) // 4),
+            "completion_tokens": max(1, len(completion) // 4),
+            "total_tokens": max(1, len(prompt) // 4) + max(1, len(completion) // 4)
+        }
+
+    # ---------- OpenAI 兼容 ----------
+    async def openai_chat(self, request: web.Request):
+        body = await request.json()
+        error = await self.simulate()
+        if error:
+            return error
+        if "payload" in body and "header" in body:
+            # 讯飞星火的请求体: header/parameter/payload.message.text
+            text = self.answer(body["payload"].get("message", {}).get("text"))
+            return web.json_response({
+                "header": {"code": 0, "message": "Success", "sid": uuid.uuid4().hex},
+                "payload": {"choices": {"status": 2, "text": [{"role": "assistant", "content": text}]}}
+            })
+        text = self.answer(body.get("messages"))
+        if body.get("stream"):
+            return await self._openai_stream(request, body, text)
+        if (body.get("temperature") or 0) > 2:
+            return web.json_response({"error": {"message": "Invalid request: temperature must be in [0, 2]",
+                                                "type": "invalid_request_error"}}, status=400)
+        usage = self.usage(json.dumps(body.get("messages"), ensure_ascii=False), text)
+        messages = body.get("messages") or []
+        if messages and isinstance(messages[0], dict) and messages[0].get("role") == "cache":
+            # Moonshot 上下文缓存引用: cache_id=xxx;reset_ttl=N
+            options = dict(item.split("=", 1) for item in messages[0].get("content", "").split(";") if "=" in item)
+            cache = self._lookup_cache(options.get("cache_id", ""))
+            if not cache or options.get("cache_id") in self.unavailable_caches:
+                return web.json_response({"error": {"message": "cache not found", "type": "invalid_request_error"}},
+                                         status=404)
+            if options.get("reset_ttl"):
+                cache["expires_at"] = time.time() + float(options["reset_ttl"])
+            usage["cached_tokens"] = cache["tokens"]
+            usage["prompt_tokens"] += cache["tokens"]
+            usage["total_tokens"] += cache["tokens"]
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": usage
+        }, headers={"x-request-id": uuid.uuid4().hex})
+
+    async def _openai_stream(self, request: web.Request, body: dict, text: str):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        size = max(1, math.ceil(len(text) / self.stream_chunks))
+        for i in range(0, len(text), size):
+            chunk = {"choices": [{"index": 0, "delta": {"content": text[i:i + size]}}], "model": body.get("model")}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await asyncio.sleep(self.chunk_interval)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def openai_models(self, request: web.Request):
+        return web.json_response({"object": "list", "data": [
+            {"id": "mock-model", "object": "model"},
+            {"id": "mock-vision-model", "object": "model"}
+        ]})
+
+    async def upload_file(self, request: web.Request):
+        data = await request.post()
+        upload = data["file"]
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self.files[file_id] = upload.file.read().decode("utf-8")
+        return web.json_response({"id": file_id, "object": "file", "purpose": data.get("purpose")})
+
+    async def create_batch(self, request: web.Request):
+        body = await request.json()
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        lines = [json.loads(line) for line in self.files.get(body.get("input_file_id"), "").splitlines() if line.strip()]
+        output, errors = [], []
+        for line in lines:
+            custom_id = line.get("custom_id")
+            record = {"id": f"req_{uuid.uuid4().hex[:8]}", "custom_id": custom_id, "response": None, "error": None}
+            outcome = self.batch_outcome(custom_id)
+            if outcome == "expired":
+                # 完成窗口内未执行的请求只出现在错误文件中
+                record["error"] = {"code": "batch_expired",
+                                   "message": "This request could not be executed before the completion window expired."}
+                errors.append(json.dumps(record, ensure_ascii=False))
+                continue
+            if outcome == "failed":
+                record["response"] = {"status_code": 400, "body": {
+                    "error": {"message": "模拟的请求错误", "type": "invalid_request_error"}
+                }}
+                errors.append(json.dumps(record, ensure_ascii=False))
+                continue
+            text = self.answer(line.get("body", {}).get("messages"))
+            record["response"] = {"status_code": 200, "body": {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}}],
+                "usage": self.usage(json.dumps(line.get("body", {}).get("messages"), ensure_ascii=False), text)
+            }}
+            output.append(json.dumps(record, ensure_ascii=False))
+        # 模拟异步处理：第一次查询为 in_progress，之后为 completed
+        batch = {"id": batch_id, "object": "batch", "status": "in_progress", "_polls": 0}
+        for file_key, content in (("output_file_id", output), ("error_file_id", errors)):
+            if content:
+                file_id = f"file-{uuid.uuid4().hex[:12]}"
+                self.files[file_id] = "\n".join(content)
+                batch[file_key] = file_id
+        self.batches[batch_id] = batch
+        return web.json_response(self._public_batch(batch_id))
+
+    @staticmethod
+    def batch_outcome(custom_id) -> str:
+        """批量请求的模拟结果：custom_id 以 fail 开头的请求失败，以 expire 开头的请求过期，其余成功"""
+        custom_id = str(custom_id or "")
+        if custom_id.startswith("fail"):
+            return "failed"
+        if custom_id.startswith("expire"):
+            return "expired"
+        return "succeeded"
+
+    def _public_batch(self, batch_id: str) -> dict:
+        return {k: v for k, v in self.batches[batch_id].items() if not k.startswith("_")}
+
+    async def get_batch(self, request: web.Request):
+        batch_id = request.match_info["batch_id"]
+        if batch_id not in self.batches:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        batch = self.batches[batch_id]
+        batch["_polls"] += 1
+        if batch["status"] == "cancelling":
+            batch["status"] = "cancelled"
+        elif batch["_polls"] > 1 and batch["status"] == "in_progress":
+            batch["status"] = self.batch_final_status
+        return web.json_response(self._public_batch(batch_id))
+
+    async def cancel_batch(self, request: web.Request):
+        batch = self.batches.get(request.match_info["batch_id"])
+        if not batch:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        if batch["status"] != "in_progress":
+            return web.json_response({"error": {"message": f"Cannot cancel a batch with status '{batch['status']}'."}},
+                                     status=400)
+        # 取消需要一段时间：先进入 cancelling，下一次查询时为 cancelled
+        batch["status"] = "cancelling"
+        return web.json_response(self._public_batch(batch["id"]))
+
+    async def file_content(self, request: web.Request):
+        file_id = request.match_info["file_id"]
+        if file_id not in self.files:
+            return web.json_response({"error": {"message": "file not found"}}, status=404)
+        return web.Response(text=self.files[file_id], content_type="application/jsonl")
+
+    # ---------- 上下文缓存（Gemini cachedContents、Moonshot caching） ----------
+    def _create_cache(self, name: str, content, ttl: float) -> dict:
+        self.context_caches[name] = {"tokens": max(1, len(json.dumps(content, ensure_ascii=False)) // 4),
+                                     "expires_at": time.time() + ttl}
+        return self.context_caches[name]
+
+    def _lookup_cache(self, name: str):
+        cache = self.context_caches.get(name)
+        if cache and cache["expires_at"] < time.time():
+            del self.context_caches[name]
+            return None
+        return cache
+
+    async def gemini_create_cache(self, request: web.Request):
+        body = await request.json()
+        name = f"cachedContents/{uuid.uuid4().hex[:12]}"
+        ttl = float(str(body.get("ttl", "3600s")).rstrip("s"))
+        self._create_cache(name, [body.get("systemInstruction"), body.get("contents")], ttl)
+        return web.json_response({"name": name, "model": body.get("model")})
+
+    async def gemini_update_cache(self, request: web.Request):
+        name = f"cachedContents/{request.match_info['cache_id']}"
+        cache = self._lookup_cache(name)
+        if not cache:
+            return web.json_response({"error": {"message": "cached content not found"}}, status=404)
+        if request.method == "DELETE":
+            del self.context_caches[name]
+            return web.json_response({})
+        body = await request.json()
+        cache["expires_at"] = time.time() + float(str(body.get("ttl", "3600s")).rstrip("s"))
+        return web.json_response({"name": name})
+
+    async def moonshot_create_cache(self, request: web.Request):
+        body = await request.json()
+        name = f"cache-{uuid.uuid4().hex[:12]}"
+        self._create_cache(name, body.get("messages"), float(body.get("ttl", 300)))
+        return web.json_response({"id": name, "status": "ready", "model": body.get("model")})
+
+    async def moonshot_update_cache(self, request: web.Request):
+        name = request.match_info["cache_id"]
+        cache = self._lookup_cache(name)
+        if not cache:
+            return web.json_response({"error": {"message": "cache not found"}}, status=404)
+        if request.method == "DELETE":
+            del self.context_caches[name]
+            return web.json_response({"deleted": True, "id": name})
+        body = await request.json()
+        cache["expires_at"] = time.time() + float(body.get("ttl", 300))
+        return web.json_response({"id": name})
+
+    # ---------- Anthropic ----------
+    async def anthropic_messages(self, request: web.Request):
+        body = await request.json()
+        error = await self.simulate()
+        if error:
+            return error
+        text = self.answer(body.get("messages"))
+        usage = self.usage(json.dumps(body.get("messages"), ensure_ascii=False), text)
+        return web.json_response({
+            "id": f"msg_{uuid.uuid4().hex[:12]}",
+            "type": "message",
+            "role": "assistant",
+            "model": body.get("model"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": usage["prompt_tokens"], "output_tokens": usage["completion_tokens"]}
+        })
+
+    async def anthropic_create_batch(self, request: web.Request):
+        body = await request.json()
+        batch_id = f"msgbatch_{uuid.uuid4().hex[:12]}"
+        results = []
+        for item in body.get("requests", []):
+            outcome = self.batch_outcome(item.get("custom_id"))
+            if outcome == "failed":
+                result = {"type": "errored", "error": {"type": "invalid_request_error", "message": "模拟的请求错误"}}
+            elif outcome == "expired":
+                result = {"type": "expired"}
+            else:
+                messages = item.get("params", {}).get("messages")
+                text = self.answer(messages)
+                usage = self.usage(json.dumps(messages, ensure_ascii=False), text)
+                result = {"type": "succeeded", "message": {
+                    "content": [{"type": "text", "text": text}],
+                    "usage": {"input_tokens": usage["prompt_tokens"], "output_tokens": usage["completion_tokens"]}
+                }}
+            results.append(json.dumps({"custom_id": item.get("custom_id"), "result": result}, ensure_ascii=False))
+        self.batches[batch_id] = {"id": batch_id, "type": "message_batch", "processing_status": "in_progress",
+                                  "_results": "\n".join(results), "_polls": 0}
+        return web.json_response(self._public_batch(batch_id))
+
+    async def anthropic_get_batch(self, request: web.Request):
+        batch_id = request.match_info["batch_id"]
+        if batch_id not in self.batches:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        batch = self.batches[batch_id]
+        batch["_polls"] += 1
+        if batch["_polls"] > 1 or batch["processing_status"] == "canceling":
+            batch["processing_status"] = "ended"
+            batch["results_url"] = f"{request.scheme}://{request.host}/v1/messages/batches/{batch_id}/results"
+        return web.json_response(self._public_batch(batch_id))
+
+    async def anthropic_cancel_batch(self, request: web.Request):
+        batch = self.batches.get(request.match_info["batch_id"])
+        if not batch:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        if batch["processing_status"] == "in_progress":
+            # 尚未执行的请求以 canceled 结束
+            batch["processing_status"] = "canceling"
+            batch["_results"] = "\n".join(json.dumps({"custom_id": json.loads(line)["custom_id"],
+                                                      "result": {"type": "canceled"}}, ensure_ascii=False)
+                                          for line in batch["_results"].splitlines())
+        return web.json_response(self._public_batch(batch["id"]))
+
+    async def anthropic_batch_results(self, request: web.Request):
+        batch = self.batches.get(request.match_info["batch_id"])
+        if not batch:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        return web.Response(text=batch["_results"], content_type="application/jsonl")
+
+    # ---------- Gemini ----------
+    async def gemini_generate(self, request: web.Request):
+        model, _, action = request.match_info["model_action"].partition(":")
+        if action != "generateContent":
+            return web.json_response({"error": {"message": f"unsupported action {action}"}}, status=404)
+        body = await request.json()
+        error = await self.simulate()
+        if error:
+            return error
+        if (body.get("generationConfig") or {}).get("temperature", 0) > 2:
+            return web.json_response({"error": {"code": 400, "status": "INVALID_ARGUMENT", "message":
+                                                "* GenerateContentRequest.generation_config.temperature: "
+                                                "must be in [0, 2]"}}, status=400)
+        contents = body.get("contents") or []
+        last_parts = contents[-1].get("parts", []) if contents else []
+        last_text = next((p.get("text") for p in last_parts if "text" in p), "")
+        text = self.answer([{"content": last_text}])
+        usage = {"promptTokenCount": max(1, len(json.dumps(contents)) // 4),
+                 "candidatesTokenCount": max(1, len(text) // 4)}
+        if body.get("cachedContent"):
+            cache = self._lookup_cache(body["cachedContent"])
+            if not cache or body["cachedContent"] in self.unavailable_caches:
+                return web.json_response({"error": {"code": 403, "message": "CachedContent not found",
+                                                    "status": "PERMISSION_DENIED"}}, status=403)
+            usage["cachedContentTokenCount"] = cache["tokens"]
+            usage["promptTokenCount"] += cache["tokens"]
+        return web.json_response({
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP"}],
+            "usageMetadata": usage
+        })
+
+    # ---------- Ollama ----------
+    async def ollama_chat(self, request: web.Request):
+        body = await request.json()
+        error = await self.simulate()
+        if error:
+            return error
+        text = self.answer(body.get("messages"))
+        return web.json_response({
+            "model": body.get("model"),
+            "message": {"role": "assistant", "content": text},
+            "done": True,
+            "prompt_eval_count": max(1, len(json.dumps(body.get("messages"))) // 4),
+            "eval_count": max(1, len(text) // 4)
+        })
+
+    async def ollama_tags(self, request: web.Request):
+        return web.json_response({"models": [{"name": "mock-model"}, {"name": "mock-vision-model"}]})
+
+    # ---------- 百度 ----------
+    async def baidu_token(self, request: web.Request):
+        return web.json_response({"access_token": f"mock-token-{uuid.uuid4().hex[:8]}", "expires_in": 2592000})
+
+    async def baidu_chat(self, request: web.Request):
+        if not request.query.get("access_token"):
+            return web.json_response({"error_code": 110, "error_msg": "Access token invalid"})
+        body = await request.json()
+        error = await self.simulate()
+        if error:
+            return error
+        text = self.answer(body.get("messages"))
+        return web.json_response({"id": f"as-{uuid.uuid4().hex[:10]}", "result": text,
+                                  "usage": self.usage(json.dumps(body.get("messages")), text)})
+
+    # ---------- Replicate ----------
+    async def replicate_create(self, request: web.Request):
+        body = await request.json()
+        error = await self.simulate()
+        if error:
+            return error
+        prediction_id = uuid.uuid4().hex[:16]
+        self.predictions[prediction_id] = {
+            "id": prediction_id,
+            "status": "processing",
+            "output": [self.answer(body.get("input", {}).get("messages"))],
+            "_polls": 0
+        }
+        return web.json_response({"id": prediction_id, "status": "starting"}, status=201)
+
+    async def replicate_get(self, request: web.Request):
+        prediction = self.predictions.get(request.match_info["prediction_id"])
+        if not prediction:
+            return web.json_response({"detail": "not found"}, status=404)
+        prediction["_polls"] += 1
+        if prediction["status"] == "processing" and prediction["_polls"] > 1:
+            prediction["status"] = "succeeded"
+        return web.json_response({k: v for k, v in prediction.items() if not k.startswith("_")})
+
+    async def replicate_cancel(self, request: web.Request):
+        prediction = self.predictions.get(request.match_info["prediction_id"])
+        if not prediction:
+            return web.json_response({"detail": "not found"}, status=404)
+        prediction["status"] = "canceled"
+        return web.json_response({"id": prediction["id"], "status": "canceled"})
+
+    # ---------- Cohere ----------
+    async def cohere_chat(self, request: web.Request):
+        body = await request.json()
+        error = await self.simulate()
+        if error:
+            return error
+        text = self.answer([{"content": body.get("message", "")}])
+        return web.json_response({
+            "response_id": uuid.uuid4().hex,
+            "text": text,
+            "finish_reason": "COMPLETE",
+            "meta": {"billed_units": {"input_tokens": max(1, len(body.get("message", "")) // 4),
+                                      "output_tokens": max(1, len(text) // 4)}}
+        })
+
+    # ---------- 状态 ----------
+    async def stats(self, request: web.Request):
+        return web.json_response({"requests": self.requests})
+
+    def build_app(self) -> web.Application:
+        app = web.Application(client_max_size=100 * 1024 * 1024)
+        app.add_routes([
+            web.post("/v1/chat/completions", self.openai_chat),
+            web.post("/chat/completions", self.openai_chat),
+            web.post("/api/paas/v4/chat/completions", self.openai_chat),
+            web.post("/api/v1/services/aigc/chat/completions", self.openai_chat),
+            web.get("/v1/models", self.openai_models),
+            web.get("/models", self.openai_models),
+            web.post("/v1/files", self.upload_file),
+            web.post("/api/paas/v4/files", self.upload_file),
+            web.post("/v1/batches", self.create_batch),
+            web.post("/api/paas/v4/batches", self.create_batch),
+            web.get("/v1/batches/{batch_id}", self.get_batch),
+            web.get("/api/paas/v4/batches/{batch_id}", self.get_batch),
+            web.post("/v1/batches/{batch_id}/cancel", self.cancel_batch),
+            web.post("/api/paas/v4/batches/{batch_id}/cancel", self.cancel_batch),
+            web.get("/v1/files/{file_id}/content", self.file_content),
+            web.get("/api/paas/v4/files/{file_id}/content", self.file_content),
+            web.post("/v1/messages", self.anthropic_messages),
+            web.post("/v1/messages/batches", self.anthropic_create_batch),
+            web.get("/v1/messages/batches/{batch_id}", self.anthropic_get_batch),
+            web.get("/v1/messages/batches/{batch_id}/results", self.anthropic_batch_results),
+            web.post("/v1/messages/batches/{batch_id}/cancel", self.anthropic_cancel_batch),
+            web.post("/v1beta/models/{model_action}", self.gemini_generate),
+            web.post("/v1beta/cachedContents", self.gemini_create_cache),
+            web.patch("/v1beta/cachedContents/{cache_id}", self.gemini_update_cache),
+            web.delete("/v1beta/cachedContents/{cache_id}", self.gemini_update_cache),
+            web.post("/v1/caching", self.moonshot_create_cache),
+            web.put("/v1/caching/{cache_id}", self.moonshot_update_cache),
+            web.delete("/v1/caching/{cache_id}", self.moonshot_update_cache),
+            web.post("/api/chat", self.ollama_chat),
+            web.get("/api/tags", self.ollama_tags),
+            web.post("/oauth/2.0/token", self.baidu_token),
+            web.post("/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/{model}", self.baidu_chat),
+            web.post("/v1/predictions", self.replicate_create),
+            web.get("/v1/predictions/{prediction_id}", self.replicate_get),
+            web.post("/v1/predictions/{prediction_id}/cancel", self.replicate_cancel),
+            web.post("/v1/chat", self.cohere_chat),
+            web.get("/_mock/stats", self.stats),
+        ])
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟上游服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=9000, help="监听端口")
+    parser.add_argument("--latency", default="fixed:0.05", help="延迟分布，如 fixed:0.2 / uniform:0.1,0.5 / lognormal:-1.5,0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机错误比例（0~1）")
+    parser.add_argument("--error-status", type=int, default=500, help="随机错误的HTTP状态码")
+    parser.add_argument("--stream-chunks", type=int, default=10, help="流式响应拆分的块数")
+    parser.add_argument("--chunk-interval", type=float, default=0.01, help="流式响应块之间的间隔（秒）")
+    args = parser.parse_args()
+
+    provider = MockProvider(
+        LatencyModel(args.latency),
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        stream_chunks=args.stream_chunks,
+        chunk_interval=args.chunk_interval
+    )
+    print(f"🚀 模拟上游服务已启动: http://{args.host}:{args.port}  延迟={args.latency}  错误率={args.error_rate}")
+    web.run_app(provider.build_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
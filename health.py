@@ -0,0 +1,207 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于后台探测任务
+import asyncio
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 time 模块，用于计时
+import time
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional, Tuple
+
+# 导入准入拒绝异常，提供商不可用时同样以 503 和 Retry-After 快速失败
+from admission import AdmissionRejected
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 探测请求的内容（只在开启补全探测时使用）
+PROBE_MESSAGES = [{"role": "user", "content": "ping"}]
+
+
+# 定义 ProviderHealth 类，在后台定期探测各提供商并缓存模型列表
+class ProviderHealth:
+    """提供商健康状态和模型列表缓存
+
+    每 interval 秒并发探测一次路由快照中的所有提供商：支持模型列表接口的提供商查询模型列表（不产生费用，
+    结果同时写入模型列表缓存），其余提供商在 probe_completions=True 时发一次 max_tokens=1 的聊天请求，
+    否则只检查能否建立连接。连续失败 failure_threshold 次视为不健康，一次成功即恢复。
+    健康状态表是普通字典，is_healthy / latency 查询为 O(1)；fail_fast=True 时 MCP 对不健康的提供商直接拒绝请求。
+    """
+
+    def __init__(self, mcp, interval: float = 30.0, timeout: float = 10.0, failure_threshold: int = 2,
+                 catalogue_ttl: float = 3600.0, probe_completions: bool = False, fail_fast: bool = False):
+        self.mcp = mcp  # MCP 实例
+        self.interval = interval  # 探测间隔（秒）
+        self.timeout = timeout  # 单次探测的最长时间（秒）
+        self.failure_threshold = failure_threshold  # 连续失败多少次视为不健康
+        self.catalogue_ttl = catalogue_ttl  # 模型列表缓存的有效期（秒）
+        self.probe_completions = probe_completions  # 不支持模型列表的提供商是否用聊天请求探测（会产生少量费用）
+        self.fail_fast = fail_fast  # 是否直接拒绝发往不健康提供商的请求
+        self.table: Dict[str, dict] = {}  # 提供商名称 -> 健康状态
+        self._catalogue: Dict[str, Tuple[float, List[str]]] = {}  # 提供商名称 -> (过期时刻, 模型列表)
+        self._refreshing: Dict[str, asyncio.Task] = {}  # 进行中的模型列表查询，同一提供商只查询一次
+        self._task: Optional[asyncio.Task] = None
+
+    # ---------- 健康状态 ----------
+
+    def is_healthy(self, name: str) -> bool:
+        """尚未探测过的提供商视为健康"""
+        entry = self.table.get(name)
+        return entry is None or entry["healthy"]
+
+    def latency(self, name: str) -> Optional[float]:
+        """探测延迟的滑动平均（秒）"""
+        entry = self.table.get(name)
+        return entry["latency"] if entry else None
+
+    def check(self, name: str):
+        """fail_fast 时提供商不健康则抛出 AdmissionRejected(503)"""
+        if not self.fail_fast or self.is_healthy(name):
+            return
+        metrics.incr("provider_unavailable_rejected", provider=name)
+        raise AdmissionRejected(503, f"提供商 {name} 当前不可用: {self.table[name].get('error')}",
+                                max(1, int(self.interval)))
+
+    def start(self):
+        """在后台开始定期探测"""
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"提供商健康探测失败: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def probe_all(self):
+        """并发探测当前路由快照中的所有提供商，移除已删除提供商的记录"""
+        with self.mcp.pin_routes() as routes:
+            providers = dict(routes.providers)
+            await asyncio.gather(*(self.probe(name, adapter) for name, adapter in providers.items()))
+        for name in list(self.table):
+            if name not in providers:
+                del self.table[name]
+                self._catalogue.pop(name, None)
+
+    async def probe(self, name: str, adapter):
+        """探测一个提供商并更新健康状态"""
+        started = time.monotonic()
+        try:
+            method = await asyncio.wait_for(self._probe(name, adapter), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record(name, False, None, None, str(e) or type(e).__name__)
+            return
+        self._record(name, True, time.monotonic() - started, method, None)
+
+    async def _probe(self, name: str, adapter) -> str:
+        """返回使用的探测方式"""
+        if adapter.models_url() is not None:
+            self._store_catalogue(name, await adapter.list_models())
+            return "models"
+        if self.probe_completions:
+            # 直接发给提供商，不经过准入控制：网关过载时的排队和拒绝不计为提供商故障
+            await self.mcp.complete(PROBE_MESSAGES, name, max_tokens=1, consumer="health", bypass_admission=True)
+            return "completion"
+        await adapter.warm_up()
+        return "connect"
+
+    def _record(self, name: str, ok: bool, latency: Optional[float], method: Optional[str], error: Optional[str]):
+        entry = self.table.get(name) or {"healthy": True, "latency": None, "failures": 0}
+        entry = dict(entry)
+        entry["checked_at"] = time.time()
+        if ok:
+            if not entry["healthy"]:
+                logger.info(f"提供商 {name} 已恢复")
+            entry.update(healthy=True, failures=0, error=None, method=method, last_latency=round(latency, 3))
+            entry["latency"] = latency if entry["latency"] is None else 0.7 * entry["latency"] + 0.3 * latency
+        else:
+            entry["failures"] += 1
+            entry["error"] = error
+            if entry["healthy"] and entry["failures"] >= self.failure_threshold:
+                logger.warning(f"提供商 {name} 连续 {entry['failures']} 次探测失败，标记为不健康: {error}")
+                entry["healthy"] = False
+        # 整体替换条目，读取方不会看到更新到一半的状态
+        self.table[name] = entry
+        metrics.incr("provider_probes", provider=name, status="ok" if ok else "failed")
+
+    # ---------- 模型列表缓存 ----------
+
+    def _store_catalogue(self, name: str, models: List[str]):
+        self._catalogue[name] = (time.monotonic() + self.catalogue_ttl, models)
+
+    def cached_models(self, name: str) -> Optional[List[str]]:
+        """已缓存的模型列表（可能已过期），从未查询成功时返回 None；不访问上游"""
+        cached = self._catalogue.get(name)
+        return cached[1] if cached else None
+
+    def models(self, name: str) -> dict:
+        """设置页面使用：立即返回缓存的模型列表，过期或没有缓存时在后台刷新"""
+        cached = self._catalogue.get(name)
+        stale = cached is None or cached[0] <= time.monotonic()
+        if stale:
+            self.refresh_models(name)
+        return {"models": cached[1] if cached else None, "stale": stale,
+                "refreshing": name in self._refreshing}
+
+    def refresh_models(self, name: str) -> Optional[asyncio.Task]:
+        """在后台查询模型列表，提供商不存在或不支持时返回 None"""
+        if name in self._refreshing:
+            return self._refreshing[name]
+        adapter = self.mcp.providers.get(name)
+        if adapter is None or adapter.models_url() is None:
+            return None
+        task = asyncio.ensure_future(self._refresh(name, adapter))
+        self._refreshing[name] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(name, None))
+        return task
+
+    async def _refresh(self, name: str, adapter):
+        try:
+            self._store_catalogue(name, await asyncio.wait_for(adapter.list_models(), self.timeout))
+        except Exception as e:
+            logger.warning(f"查询提供商 {name} 的模型列表失败: {str(e) or type(e).__name__}")
+
+    def validate_model(self, name: str, model: Optional[str]) -> Optional[str]:
+        """按缓存的模型列表检查配置的模型，不在列表中时返回提示，没有缓存时不检查"""
+        models = self.cached_models(name)
+        if not model or models is None or model in models:
+            return None
+        return f"模型 {model} 不在提供商 {name} 的模型列表中"
+
+    def status(self) -> dict:
+        return {"interval": self.interval, "fail_fast": self.fail_fast,
+                "providers": {name: dict(entry, latency=round(entry["latency"], 3) if entry["latency"] is not None else None)
+                              for name, entry in self.table.items()},
+                "catalogue": {name: len(models) for name, (_, models) in self._catalogue.items()}}
+
+    async def close(self):
+        """停止探测和进行中的模型列表查询"""
+        tasks = list(self._refreshing.values())
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
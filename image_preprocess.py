@@ -0,0 +1,144 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 base64 模块，用于编码处理结果
+import base64
+# 导入 io 模块，用于内存中的图片编码
+import io
+# 导入 json 模块，用于读取自定义配置
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 os 模块，用于读取配置文件
+import os
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional, Tuple
+
+# Pillow 为可选依赖，未安装时不做预处理，按原图发送
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    Image = None
+    ImageOps = None
+    PIL_AVAILABLE = False
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+
+# 图片预处理配置
+class ImageProfile:
+    """缩放到模型的有效分辨率并重新编码"""
+
+    def __init__(self, name: str, max_side: int, max_pixels: int, fmt: str = "JPEG", quality: int = 85):
+        self.name = name  # 配置名称
+        self.max_side = max_side  # 长边上限（像素）
+        self.max_pixels = max_pixels  # 总像素上限
+        self.fmt = fmt.upper()  # 输出格式：JPEG 或 WEBP
+        self.quality = quality  # 输出质量（1~100）
+
+    @property
+    def key(self) -> str:
+        """缓存键的一部分，参数变化后旧的缓存自动失效"""
+        return f"{self.name}:{self.max_side}:{self.max_pixels}:{self.fmt}:{self.quality}"
+
+    def params(self) -> dict:
+        return {"max_side": self.max_side, "max_pixels": self.max_pixels, "fmt": self.fmt, "quality": self.quality}
+
+
+# 默认的预处理配置，取各家视觉模型内部缩放后的分辨率
+IMAGE_PROFILES: Dict[str, ImageProfile] = {
+    # OpenAI 高精度模式先缩放到 2048 以内，再把短边缩到 768
+    "openai": ImageProfile("openai", max_side=2048, max_pixels=2048 * 768),
+    # Anthropic 建议长边不超过 1568、约 1.15MP
+    "anthropic": ImageProfile("anthropic", max_side=1568, max_pixels=1_150_000),
+    # Gemini 按 768x768 分块计费
+    "google": ImageProfile("google", max_side=1536, max_pixels=1536 * 1536),
+    # 其他提供商
+    "default": ImageProfile("default", max_side=2048, max_pixels=2_000_000),
+}
+
+# 按模型名匹配的配置（模型名包含该关键字即命中），优先于按提供商匹配
+MODEL_PROFILES: List[Tuple[str, str]] = []
+
+
+def load_profiles(path: Optional[str]):
+    """从 JSON 文件加载自定义配置
+
+    格式: {"profiles": {"名称": {"max_side", "max_pixels", "fmt", "quality"}},
+           "models": {"模型关键字": "配置名称"}}
+    """
+    if not path or not os.path.exists(path):
+        return
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        for name, params in data.get("profiles", {}).items():
+            IMAGE_PROFILES[name] = ImageProfile(name, **params)
+        for pattern, profile_name in data.get("models", {}).items():
+            if profile_name not in IMAGE_PROFILES:
+                raise ValueError(f"模型 {pattern} 引用了未定义的预处理配置: {profile_name}")
+            MODEL_PROFILES.append((pattern.lower(), profile_name))
+        logger.info(f"已加载图片预处理配置: {path}")
+    except Exception as e:
+        logger.error(f"加载图片预处理配置失败: {str(e)}")
+
+
+def profile_for(provider: Optional[str], model: Optional[str]) -> Optional[ImageProfile]:
+    """选择模型对应的预处理配置，Pillow 不可用时返回 None"""
+    if not PIL_AVAILABLE:
+        return None
+    model_key = str(model or "").lower()
+    for pattern, profile_name in MODEL_PROFILES:
+        if pattern in model_key:
+            return IMAGE_PROFILES[profile_name]
+    return IMAGE_PROFILES.get(str(provider or "").lower(), IMAGE_PROFILES["default"])
+
+
+def preprocess_image(path: str, max_side: int, max_pixels: int, fmt: str, quality: int) -> Tuple[str, str]:
+    """缩放、去除元数据并重新编码图片，返回 (MIME 类型, base64 数据)
+
+    在进程池中执行，参数和返回值都需可序列化。动图和无法识别的图片按原样返回。
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        with Image.open(io.BytesIO(raw)) as img:
+            if getattr(img, "is_animated", False):
+                return Image.MIME.get(img.format, "image/gif"), base64.b64encode(raw).decode("ascii")
+            # 先按 EXIF 方向旋转，再丢弃所有元数据
+            img = ImageOps.exif_transpose(img)
+            width, height = img.size
+            scale = min(1.0, max_side / max(width, height), (max_pixels / float(width * height)) ** 0.5)
+            if scale < 1.0:
+                img = img.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+            if fmt == "JPEG" and img.mode not in ("RGB", "L"):
+                # JPEG 不支持透明通道，铺白底
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                rgba = img.convert("RGBA")
+                background.paste(rgba, mask=rgba.split()[-1])
+                img = background
+            out = io.BytesIO()
+            img.save(out, format=fmt, quality=quality, optimize=True)
+    except Exception as e:
+        logger.warning(f"图片预处理失败，按原图发送: {path}: {str(e)}")
+        return "", base64.b64encode(raw).decode("ascii")
+    data = out.getvalue()
+    logger.debug(f"图片预处理: {path} {len(raw)} -> {len(data)} 字节")
+    return f"image/{fmt.lower()}", base64.b64encode(data).decode("ascii")
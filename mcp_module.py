@@ -22,21 +22,102 @@ import logging
 # 从 typing 模块导入 Dict 和 Any，用于类型提示
 from typing import Dict, Any, Optional, List
 # 从 api_adapter 模块导入 BaseAdapter，用于继承
-from api_adapter import BaseAdapter, OllamaAdapter, OpenAIAdapter, AnthropicAdapter, MetaAdapter, GoogleAdapter, CohereAdapter, ReplicateAdapter, AliyunAdapter, BaiduAdapter, DeepSeekAdapter, MoonshotAdapter, ZhipuAdapter, SparkAdapter, MinimaxAdapter, SenseChatAdapter, XunfeiAdapter, CustomAdapter, SiliconFlowAdapter
+from api_adapter import BaseAdapter, OllamaAdapter, OpenAIAdapter, AnthropicAdapter, MetaAdapter, GoogleAdapter, CohereAdapter, ReplicateAdapter, AliyunAdapter, BaiduAdapter, DeepSeekAdapter, MoonshotAdapter, ZhipuAdapter, SparkAdapter, MinimaxAdapter, SenseChatAdapter, XunfeiAdapter, CustomAdapter, SiliconFlowAdapter, ChatResult
 import json
 import os
+# 导入 asyncio 模块，用于合并配置写入并在线程池中执行
+import asyncio
+# 导入 tempfile 模块，用于原子写入配置文件
+import tempfile
+# 导入 copy 模块，用于生成配置快照
+import copy
+# 从 contextlib 导入 contextmanager，用于在请求期间固定路由快照
+from contextlib import asynccontextmanager, contextmanager
+# 导入运行指标记录模块
+from metrics import metrics
+# 导入共享状态存储（多 worker 部署时保存配置）
+from state_backend import StateBackend, migrate_json_file
+# 导入 mimetypes 模块，用于区分图片和视频附件
+import mimetypes
+# 导入 inspect 模块，用于检查适配器支持的调用参数
+import inspect
+# 导入准入控制模块
+from admission import AdmissionController, AdmissionRejected, DEFAULT_PRIORITY
+# 导入上传文件内联编码缓存
+from media_cache import MediaCache
+# 导入图片预处理配置
+from image_preprocess import profile_for
+# 导入模型能力索引
+from capabilities import CapabilityRegistry, ModelCapabilities, estimate_tokens, fit_to_context
+# 导入用量和费用统计
+from usage_accounting import UsageAccountant
+# 导入上游 HTTP 传输层
+from transport import create_transport
+# 导入语义缓存
+from semantic_cache import Lookup, SemanticCache
+# 导入上游请求的分项超时和截止时间
+from timeouts import Deadline, TimeoutPolicy, call_scope
+# 导入提供商健康状态
+from health import ProviderHealth
+# 导入 time 模块，用于记录上游耗时
+import time
 
 # 获取一个 logger 实例，用于记录日志
 logger = logging.getLogger(__name__)
 
+# 配置在共享状态存储中的位置
+CONFIG_NAMESPACE = "config"
+CONFIG_KEY = "mcp"
+
+# 定义 RoutingSnapshot 类，表示某一版本的路由表
+class RoutingSnapshot:
+    """发布后不再修改的路由表：适配器实例、当前提供商和配置
+
+    请求开始时固定当时的快照并增加引用计数，配置变更只发布新快照，
+    旧快照在最后一个请求结束后退役，只被它引用的适配器随后关闭。
+    """
+
+    def __init__(self, version: int, providers: Dict[str, BaseAdapter], current_provider: Optional[str],
+                 configurations: Dict[str, Dict]):
+        self.version = version  # 版本号，每次发布加一
+        self.providers = providers  # 提供商名称 -> 适配器实例
+        self.current_provider = current_provider  # 当前提供商
+        self.configurations = configurations  # 配置的深拷贝
+        self.active = 0  # 正在使用该快照的请求数
+        self.retired = False  # 是否已被新快照替换
+
+
 # 定义 MCP 类，用于管理 LLM 服务提供商
 class MCP:
     # 构造函数，初始化提供商字典、当前提供商名称和配置字典
-    def __init__(self, config_file="mcp_config.json"):
+    def __init__(self, config_file="mcp_config.json", admission: Optional[AdmissionController] = None,
+                 media_cache: Optional[MediaCache] = None, capabilities: Optional[CapabilityRegistry] = None,
+                 save_delay: float = 0.5, state: Optional[StateBackend] = None,
+                 usage: Optional[UsageAccountant] = None, semantic_cache: Optional[SemanticCache] = None,
+                 timeouts: Optional[TimeoutPolicy] = None):
         self.providers: Dict[str, BaseAdapter] = {}  # 存储 LLM 服务提供商实例
         self.current_provider: Optional[str] = None  # 当前使用的 LLM 服务提供商名称
         self.configurations: Dict[str, Dict] = {}  # 存储提供商的配置信息
         self.config_file = config_file  # 配置文件路径
+        self.state = state  # 共享状态存储，设置后配置保存在存储中（多 worker 共享），配置文件只用于首次迁移
+        self.admission = admission or AdmissionController()  # 请求准入控制（有界优先级队列）
+        self.media_cache = media_cache  # 上传文件内联编码缓存，None 表示按原URL发送
+        self.usage = usage  # 用量和费用统计，None 表示不统计
+        self.semantic_cache = semantic_cache  # 语义缓存，None 表示不启用
+        self.timeouts = timeouts or TimeoutPolicy()  # 默认的上游分项超时，可按提供商和模型在配置的 timeouts 中覆盖
+        self.health: Optional[ProviderHealth] = None  # 提供商健康探测（依赖 MCP 实例，创建后设置），None 表示不探测
+        # 模型能力索引（上下文窗口、多模态、流式、批量等）
+        self.capabilities = capabilities or CapabilityRegistry(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_capabilities.json"))
+        self.save_delay = save_delay  # 配置写入的合并窗口（秒），窗口内的多次修改只写一次文件
+        self._save_handle: Optional[asyncio.TimerHandle] = None  # 已安排的延迟写入
+        self._save_lock: Optional[asyncio.Lock] = None  # 保证写入按顺序进行
+        self._save_loop: Optional[asyncio.AbstractEventLoop] = None  # 安排写入的事件循环
+        self._dirty = False  # 是否有尚未写入文件的修改
+        self._config_token: Optional[int] = None  # 最近一次读写后配置文件的修改时间或存储的版本号，用于识别外部修改
+        self._fingerprints: Dict[str, str] = {}  # 提供商名称 -> 创建适配器时的连接参数，参数变化时重建适配器
+        self._routes = RoutingSnapshot(0, {}, None, {})  # 当前路由快照
+        self._draining: List[RoutingSnapshot] = []  # 已退役但仍有请求在使用的快照
         
         # 确保配置目录存在
         self._ensure_config_dir()
@@ -56,48 +137,191 @@ class MCP:
     
     def set_config_file(self, config_file: str):
         """设置配置文件路径"""
+        # 尚未写入的修改先保存到原文件
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        if self._dirty:
+            self._write_now()
         self.config_file = config_file
         self._ensure_config_dir()
-        # 重新加载配置
-        self.load_configurations()
+        if self.state is not None:
+            # 使用共享存储时把新文件中的配置写入存储，所有 worker 随之切换
+            self._import_config_file()
+        else:
+            # 重新加载配置
+            self.load_configurations()
+
+    def _import_config_file(self):
+        """把配置文件的内容导入共享存储"""
+        if not os.path.exists(self.config_file):
+            print("配置文件不存在，保留当前配置")
+            return
+        try:
+            data = self._read_json_file(self.config_file)
+        except Exception as e:
+            print(f"加载配置失败: {str(e)}")
+            return
+        self.configurations = data.get('configurations', {})
+        self.current_provider = data.get('current_provider')
+        self._create_providers_from_config()
+        self._write_now()
         
     def load_configurations(self):
-        """从文件加载配置"""
+        """从文件（或共享存储）加载配置"""
         try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.configurations = data.get('configurations', {})
-                    self.current_provider = data.get('current_provider')
-                    print(f"已加载配置: {len(self.configurations)} 个提供商")
-                    if self.current_provider:
-                        print(f"当前提供商: {self.current_provider}")
-                    
-                    # 根据加载的配置自动创建适配器实例
-                    self._create_providers_from_config()
+            if self.state is not None:
+                # 首次使用共享存储时导入原有的配置文件
+                migrate_json_file(self.state, CONFIG_NAMESPACE, self.config_file,
+                                  lambda data: {CONFIG_KEY: data} if isinstance(data, dict) else {})
+            if self.state is not None or os.path.exists(self.config_file):
+                self._config_token = self._current_token()
+                data = self._read_config()
+                self.configurations = data.get('configurations', {})
+                self.current_provider = data.get('current_provider')
+                print(f"已加载配置: {len(self.configurations)} 个提供商")
+                if self.current_provider:
+                    print(f"当前提供商: {self.current_provider}")
+                
+                # 根据加载的配置自动创建适配器实例
+                self._create_providers_from_config()
             else:
                 print("配置文件不存在，将创建新的配置")
         except Exception as e:
             print(f"加载配置失败: {str(e)}")
             self.configurations = {}
             self.current_provider = None
+            self.publish_routes()
     
-    def save_configurations(self):
-        """保存配置到文件"""
+    def _serialize(self) -> str:
+        """序列化当前配置（在事件循环中调用，得到一致的快照）"""
+        data = {
+            'configurations': self.configurations,
+            'current_provider': self.current_provider
+        }
+        return json.dumps(data, ensure_ascii=False, indent=2)
+
+    @staticmethod
+    def _write_atomic(path: str, text: str) -> int:
+        """原子写入：写临时文件并 fsync，再重命名覆盖原文件，中途崩溃不会损坏原配置，返回写入后的修改时间"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            mtime = os.stat(path).st_mtime_ns
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        # 同步目录项，确保重命名本身落盘
+        if hasattr(os, "O_DIRECTORY"):
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        return mtime
+
+    def _persist(self, path: str, text: str) -> int:
+        """写入配置文件或共享存储，返回写入后的修改时间或版本号"""
+        if self.state is not None:
+            return self.state.put(CONFIG_NAMESPACE, CONFIG_KEY, json.loads(text))
+        return self._write_atomic(path, text)
+
+    def _current_token(self) -> int:
+        """配置文件的修改时间或共享存储中配置的版本号"""
+        if self.state is not None:
+            return self.state.version(CONFIG_NAMESPACE)
+        return os.stat(self.config_file).st_mtime_ns
+
+    def _read_config(self) -> dict:
+        if self.state is not None:
+            return self.state.get(CONFIG_NAMESPACE, CONFIG_KEY) or {}
+        return self._read_json_file(self.config_file)
+
+    @staticmethod
+    def _read_json_file(path: str) -> dict:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("配置文件格式错误")
+        return data
+
+    def _write_now(self):
+        """立即同步写入配置"""
+        self._dirty = False
         try:
-            data = {
-                'configurations': self.configurations,
-                'current_provider': self.current_provider
-            }
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            print(f"配置已保存到: {self.config_file}")
+            self._config_token = self._persist(self.config_file, self._serialize())
+            metrics.incr("config_writes")
+            print(f"配置已保存到: {'共享状态存储' if self.state is not None else self.config_file}")
         except Exception as e:
             print(f"保存配置失败: {str(e)}")
-        
+            logger.error(f"保存配置失败: {str(e)}")
+
+    def save_configurations(self):
+        """保存配置到文件
+
+        在事件循环中调用时只安排一次延迟写入，save_delay 内的多次修改合并为一次写入，
+        文件写入在线程池中执行；没有运行中的事件循环时（例如脚本中使用）立即写入。
+        同时发布新的路由快照，之后的请求使用修改后的配置。
+        """
+        self._sync_providers()
+        self.publish_routes()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write_now()
+            return
+        self._dirty = True
+        if self._save_loop is not loop:
+            # 事件循环已更换（例如测试中多次启动应用），旧的定时器和锁不再有效
+            self._save_loop = loop
+            self._save_handle = None
+            self._save_lock = asyncio.Lock()
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(self.save_delay, self._start_flush)
+        metrics.incr("config_saves_requested")
+
+    def _start_flush(self):
+        self._save_handle = None
+        asyncio.ensure_future(self.flush_configurations())
+
+    async def flush_configurations(self):
+        """立即写入尚未保存的配置（关闭服务时调用）"""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        loop = asyncio.get_running_loop()
+        if self._save_loop is not loop:
+            self._save_loop = loop
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            path, text = self.config_file, self._serialize()
+            try:
+                token = await asyncio.to_thread(self._persist, path, text)
+                if path == self.config_file:
+                    self._config_token = token
+                metrics.incr("config_writes")
+                print(f"配置已保存到: {'共享状态存储' if self.state is not None else path}")
+            except Exception as e:
+                # 写入失败，保留修改标记，下次保存或关闭时重试
+                self._dirty = True
+                print(f"保存配置失败: {str(e)}")
+                logger.error(f"保存配置失败: {str(e)}")
+
     # 保存提供商配置的方法
     def save_configuration(self, name: str, config: Dict[str, Any]):
-        """保存提供商配置"""
+        """保存提供商配置，超时配置无效时抛出 ValueError"""
+        self.timeouts.override(config.get('timeouts'))
         self.configurations[name] = config
         self.save_configurations()
         
@@ -115,9 +339,23 @@ class MCP:
     def add_provider(self, name: str, config: Dict[str, Any]):
         """注册新的LLM服务提供商"""
         print(f"正在添加提供商: {name}")
-        name_lower = name.lower()
-        
-        # 提取构造函数需要的参数
+        if name in self.providers and self._fingerprints.get(name) == self._fingerprint(config):
+            # 连接参数未变化，继续使用现有实例
+            print(f"提供商 {name} 的适配器实例已存在，跳过创建")
+            return
+        adapter = self._create_adapter(name, config)
+        # 复制后修改，正在进行的请求仍使用旧的路由快照
+        providers = dict(self.providers)
+        providers[name] = adapter
+        self.providers = providers
+        self._fingerprints[name] = self._fingerprint(config)
+        print(f"提供商 {name} 添加成功")
+        self.publish_routes()
+
+    # 适配器构造参数
+    @staticmethod
+    def _constructor_params(config: Dict[str, Any]) -> Dict[str, Any]:
+        """提取构造函数需要的参数"""
         constructor_params = {}
         if 'api_key' in config:
             constructor_params['api_key'] = config['api_key']
@@ -134,81 +372,216 @@ class MCP:
         if 'api_secret' in config:
             constructor_params['api_secret'] = config['api_secret']
         
+        return constructor_params
+
+    def _fingerprint(self, config: Dict[str, Any]) -> str:
+        """连接参数的指纹（密钥、地址等），只修改模型或采样参数时不需要重建适配器"""
+        params = dict(self._constructor_params(config), prompt_cache=config.get('prompt_cache', True),
+                      context_cache=config.get('context_cache', False),
+                      context_cache_ttl=config.get('context_cache_ttl'), transport=config.get('transport'))
+        return json.dumps(params, sort_keys=True, ensure_ascii=False)
+
+    # 根据提供商名称创建适配器实例
+    def _create_adapter(self, name: str, config: Dict[str, Any]) -> BaseAdapter:
+        """创建适配器实例，不支持的提供商类型抛出 ValueError"""
+        name_lower = name.lower()
+        constructor_params = self._constructor_params(config)
         print(f"构造参数: {constructor_params}")
         
         # 根据提供商名称创建相应的适配器实例
         if name_lower == 'ollama':
-            self.providers[name] = OllamaAdapter(**constructor_params)
+            adapter = OllamaAdapter(**constructor_params)
         elif name_lower == 'openai':
-            self.providers[name] = OpenAIAdapter(**constructor_params)
+            adapter = OpenAIAdapter(**constructor_params)
         elif name_lower == 'anthropic':
-            self.providers[name] = AnthropicAdapter(**constructor_params)
+            # 配置中 prompt_cache 为 false 时不设置提示缓存断点
+            adapter = AnthropicAdapter(**constructor_params, prompt_cache=bool(config.get('prompt_cache', True)))
         elif name_lower == 'meta':
-            self.providers[name] = MetaAdapter(**constructor_params)
+            adapter = MetaAdapter(**constructor_params)
         elif name_lower == 'google':
-            self.providers[name] = GoogleAdapter(**constructor_params)
+            adapter = GoogleAdapter(**constructor_params)
         elif name_lower == 'cohere':
-            self.providers[name] = CohereAdapter(**constructor_params)
+            adapter = CohereAdapter(**constructor_params)
         elif name_lower == 'replicate':
-            self.providers[name] = ReplicateAdapter(**constructor_params)
+            adapter = ReplicateAdapter(**constructor_params)
         elif name_lower == 'aliyun' or name == '阿里云':
             print(f"创建阿里云适配器: {name}")
-            self.providers[name] = AliyunAdapter(**constructor_params)
+            adapter = AliyunAdapter(**constructor_params)
         elif name_lower == 'baidu':
-            self.providers[name] = BaiduAdapter(**constructor_params)
+            adapter = BaiduAdapter(**constructor_params)
         elif name_lower == 'deepseek':
-            self.providers[name] = DeepSeekAdapter(**constructor_params)
+            adapter = DeepSeekAdapter(**constructor_params)
         elif name_lower == 'moonshot':
-            self.providers[name] = MoonshotAdapter(**constructor_params)
+            adapter = MoonshotAdapter(**constructor_params)
         elif name_lower == 'zhipu' or name == '智谱':
             print(f"创建智谱适配器: {name}")
-            self.providers[name] = ZhipuAdapter(**constructor_params)
+            adapter = ZhipuAdapter(**constructor_params)
         elif name_lower == 'spark':
-            self.providers[name] = SparkAdapter(**constructor_params)
+            adapter = SparkAdapter(**constructor_params)
         elif name_lower == 'minimax':
-            self.providers[name] = MinimaxAdapter(**constructor_params)
+            adapter = MinimaxAdapter(**constructor_params)
         elif name_lower == 'sensechat':
-            self.providers[name] = SenseChatAdapter(**constructor_params)
+            adapter = SenseChatAdapter(**constructor_params)
         elif name_lower == 'xunfei':
-            self.providers[name] = XunfeiAdapter(**constructor_params)
+            adapter = XunfeiAdapter(**constructor_params)
         elif name_lower == 'custom' or name == '其他':
             print(f"创建自定义适配器: {name}")
             # 为自定义提供商提供默认的base_url
             if 'base_url' not in constructor_params:
                 constructor_params['base_url'] = "https://api.example.com"  # 默认URL，用户需要根据实际情况修改
-            self.providers[name] = CustomAdapter(**constructor_params)
+            adapter = CustomAdapter(**constructor_params)
         elif name == '硅基流动':
             print(f"创建硅基流动适配器: {name}")
             # 为硅基流动提供默认的base_url
             if 'base_url' not in constructor_params:
                 constructor_params['base_url'] = "https://api.siliconflow.cn"
-            self.providers[name] = SiliconFlowAdapter(**constructor_params)
+            adapter = SiliconFlowAdapter(**constructor_params)
         else:
             # 如果是不支持的提供商类型，则抛出 ValueError 异常
             print(f"不支持的提供商类型: {name}")
             raise ValueError(f"不支持的提供商类型: {name}")
+
+        # 配置中 transport 为 http2 / h2c 时使用 HTTP/2 传输，同一主机的并发请求复用一个连接
+        if config.get('transport'):
+            adapter.transport = create_transport(config['transport'])
+
+        # 配置中 context_cache 为 true 时启用服务端上下文缓存（Gemini、Moonshot）
+        if config.get('context_cache') and adapter.supports_context_cache:
+            adapter.enable_context_cache(ttl=float(config.get('context_cache_ttl') or 3600))
         
-        print(f"提供商 {name} 添加成功")
+        return adapter
 
-    def _create_providers_from_config(self):
-        """根据配置文件中的配置自动创建适配器实例"""
-        print("正在根据配置创建适配器实例...")
+
+    def _sync_providers(self):
+        """按配置创建或重建适配器：新增的提供商创建实例，连接参数变化（例如更换密钥）时重建，删除的配置移除实例"""
+        providers = dict(self.providers)
         for provider_name, config in self.configurations.items():
+            fingerprint = self._fingerprint(config)
+            if provider_name in providers and self._fingerprints.get(provider_name) in (None, fingerprint):
+                continue
             try:
-                # 检查是否已经存在该提供商的适配器实例
-                if provider_name not in self.providers:
-                    print(f"为配置的提供商 {provider_name} 创建适配器实例...")
-                    self.add_provider(provider_name, config)
-                else:
-                    print(f"提供商 {provider_name} 的适配器实例已存在，跳过创建")
+                print(f"为配置的提供商 {provider_name} 创建适配器实例...")
+                providers[provider_name] = self._create_adapter(provider_name, config)
+                self._fingerprints[provider_name] = fingerprint
             except Exception as e:
                 print(f"为提供商 {provider_name} 创建适配器实例失败: {str(e)}")
-                # 如果创建失败，从配置中移除该提供商
                 if provider_name == self.current_provider:
                     print(f"当前提供商 {provider_name} 创建失败，清除当前提供商设置")
                     self.current_provider = None
+        # 配置已删除的提供商不再接收新请求
+        for provider_name in list(self._fingerprints):
+            if provider_name not in self.configurations:
+                providers.pop(provider_name, None)
+                del self._fingerprints[provider_name]
+        self.providers = providers
+
+    def _create_providers_from_config(self):
+        """根据配置文件中的配置自动创建适配器实例"""
+        print("正在根据配置创建适配器实例...")
+        self._sync_providers()
+        self.publish_routes()
         print(f"适配器实例创建完成，当前共有 {len(self.providers)} 个提供商")
 
+    # 发布新的路由快照
+    def publish_routes(self):
+        """用当前的适配器、提供商和配置生成新快照并原子替换，旧快照在请求结束后退役"""
+        old = self._routes
+        self._routes = RoutingSnapshot(old.version + 1, dict(self.providers), self.current_provider,
+                                       copy.deepcopy(self.configurations))
+        old.retired = True
+        self._draining.append(old)
+        self._release(old)
+        metrics.incr("routing_snapshots_published")
+        logger.info(f"已发布路由快照 v{self._routes.version}: 当前提供商={self.current_provider}")
+
+    def routing_status(self) -> dict:
+        """路由快照状态"""
+        return {
+            "version": self._routes.version,
+            "active": self._routes.active,
+            "draining": [{"version": r.version, "active": r.active} for r in self._draining],
+            # 启用了服务端上下文缓存的提供商
+            "context_caches": {name: adapter.context_cache.status()
+                               for name, adapter in self._routes.providers.items() if adapter.context_cache is not None},
+            # 各提供商的上游传输类型
+            "transports": {name: adapter.transport.kind if adapter.transport is not None else "http1"
+                           for name, adapter in self._routes.providers.items()},
+            # 各提供商所配置模型的上游分项超时
+            "timeouts": {name: self.timeout_policy(name, config.get('model')).to_dict()
+                         for name, config in self._routes.configurations.items()},
+        }
+
+    @contextmanager
+    def pin_routes(self):
+        """在请求期间固定当前路由快照"""
+        routes = self._routes
+        routes.active += 1
+        try:
+            yield routes
+        finally:
+            routes.active -= 1
+            if routes.retired:
+                self._release(routes)
+
+    def _release(self, routes: RoutingSnapshot):
+        """退役快照的请求全部结束后，关闭不再被任何快照引用的适配器"""
+        if routes.active > 0 or routes not in self._draining:
+            return
+        self._draining.remove(routes)
+        in_use = {id(a) for r in [self._routes, *self._draining] for a in r.providers.values()}
+        for adapter in routes.providers.values():
+            if id(adapter) not in in_use:
+                self._close_adapter(adapter)
+
+    @staticmethod
+    def _close_adapter(adapter: BaseAdapter):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = asyncio.ensure_future(adapter.aclose())
+
+        def _done(t: asyncio.Task):
+            if not t.cancelled() and t.exception() is not None:
+                logger.warning(f"关闭适配器失败: {str(t.exception())}")
+
+        task.add_done_callback(_done)
+        metrics.incr("adapters_closed")
+
+    async def aclose(self):
+        """关闭所有快照中的适配器（服务关闭时调用）"""
+        adapters = {id(a): a for r in [self._routes, *self._draining] for a in r.providers.values()}
+        for adapter in adapters.values():
+            try:
+                await adapter.aclose()
+            except Exception as e:
+                logger.warning(f"关闭适配器失败: {str(e)}")
+
+    async def watch_config(self, interval: float = 2.0):
+        """监视配置文件或共享存储，被外部修改（运维更换密钥、其他 worker 保存配置）后重新加载并发布新的路由快照"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                token = await asyncio.to_thread(self._current_token)
+            except Exception:
+                continue
+            # 自己的写入尚未完成时跳过
+            if token == self._config_token or self._dirty or (self._save_lock is not None and self._save_lock.locked()):
+                continue
+            try:
+                data = await asyncio.to_thread(self._read_config)
+            except Exception as e:
+                # 文件可能正在被编辑，保留当前配置，下次检查时重试
+                logger.warning(f"重新加载配置失败，继续使用当前配置: {str(e)}")
+                continue
+            self._config_token = token
+            self.configurations = data.get('configurations', {})
+            self.current_provider = data.get('current_provider')
+            self._sync_providers()
+            self.publish_routes()
+            metrics.incr("config_reloads")
+            logger.info("配置已被外部修改，重新加载")
+
     # 切换当前使用的 LLM 服务的方法
     def switch_current_provider(self, name: str):
         """切换当前使用的LLM服务"""
@@ -220,21 +593,102 @@ class MCP:
         logger.info(f"已切换到LLM服务提供商: {name}")  # 记录日志
 
     # 处理聊天请求并路由到当前提供商的方法
-    async def handle_request(self, messages: list, model: str, file_urls: Optional[list] = None) -> str:
-        """处理聊天请求并路由到当前提供商"""
-        print(f"处理聊天请求: 当前提供商={self.current_provider}, 传入模型={model}, 文件数={len(file_urls) if file_urls else 0}")
-        
+    async def handle_request(self, messages: list, model: str, file_urls: Optional[list] = None,
+                             priority: str = DEFAULT_PRIORITY, consumer: Optional[str] = None,
+                             conversation: Optional[str] = None, use_cache: bool = True,
+                             deadline: Optional[Deadline] = None) -> ChatResult:
+        """处理聊天请求并路由到当前提供商（先经过准入控制），conversation 为用量统计使用的会话ID
+
+        启用语义缓存时，命中的请求直接返回缓存的回复，不占用准入名额；use_cache=False 时跳过缓存。
+        deadline 为请求的截止时间，排队和上游调用只使用剩余的预算，用完时抛出 DeadlineExceeded。
+        """
+        lookup = await self._cache_lookup(messages, model, file_urls, use_cache)
+        if lookup is not None and lookup.entry is not None:
+            self.semantic_cache.maybe_verify(lookup, lambda: self._verify_fetch(messages, model, consumer, conversation))
+            return self._cached_result(lookup)
+        async with self._admitted(priority, consumer, deadline):
+            result = await self._dispatch_request(messages, model, file_urls, consumer, conversation, deadline)
+        self._cache_store(lookup, result, result.finish_reason)
+        return result
+
+    # 占用准入槽位
+    @asynccontextmanager
+    async def _admitted(self, priority: str, consumer: Optional[str], deadline: Optional[Deadline]):
+        """有截止时间时排队时间不超过剩余预算，预算在排队中用完时抛出 DeadlineExceeded"""
+        queue_timeout = None
+        if deadline is not None:
+            deadline.check("排队前")
+            queue_timeout = deadline.cap(self.admission.queue_timeouts.get(priority))
+        try:
+            async with self.admission.slot(priority, consumer, queue_timeout):
+                yield
+        except AdmissionRejected as e:
+            if deadline is not None and deadline.expired:
+                raise deadline.exceeded("排队") from e
+            raise
+
+    # 提供商和模型的上游超时策略
+    def timeout_policy(self, provider_name: str, model: str, routes: Optional[RoutingSnapshot] = None) -> TimeoutPolicy:
+        """默认策略按提供商配置的 timeouts 覆盖，配置无效（例如手动修改了配置文件）时使用默认策略"""
+        routes = routes or self._routes
+        try:
+            return self.timeouts.override(routes.configurations.get(provider_name, {}).get('timeouts'), model)
+        except ValueError as e:
+            logger.warning(f"提供商 {provider_name} 的超时配置无效，使用默认值: {str(e)}")
+            return self.timeouts
+
+    # 在语义缓存中查找
+    async def _cache_lookup(self, messages: list, model: str, file_urls: Optional[list],
+                            use_cache: bool) -> Optional[Lookup]:
+        """不可缓存（未启用、带附件、多轮对话等）时返回 None"""
+        if self.semantic_cache is None or not use_cache or file_urls:
+            return None
+        routes = self._routes
+        if not routes.current_provider:
+            return None
+        actual_model = routes.configurations.get(routes.current_provider, {}).get('model', model)
+        try:
+            return await self.semantic_cache.lookup(routes.current_provider, actual_model, messages)
+        except Exception as e:
+            logger.warning(f"语义缓存查询失败: {str(e)}")
+            return None
+
+    @staticmethod
+    def _cached_result(lookup: Lookup) -> ChatResult:
+        entry = lookup.entry
+        return ChatResult(entry.answer, finish_reason=entry.meta.get("finish_reason"),
+                          cache={"id": entry.id, "similarity": round(lookup.similarity, 4)})
+
+    def _cache_store(self, lookup: Optional[Lookup], text: str, finish_reason: Optional[str]):
+        """写入完整的回复，因长度截断的回复不缓存"""
+        if lookup is None or str(finish_reason).lower() in ("length", "max_tokens"):
+            return
+        self.semantic_cache.store(lookup, text, {"finish_reason": finish_reason})
+
+    async def _verify_fetch(self, messages: list, model: str, consumer: Optional[str],
+                            conversation: Optional[str]) -> ChatResult:
+        """语义缓存抽样校验：以批量优先级请求上游"""
+        async with self.admission.slot("batch", consumer):
+            return await self._dispatch_request(messages, model, None, consumer, conversation)
+
+    # 解析当前路由：提供商实例、实际模型和聊天参数
+    def resolve_route(self, model: str, routes: Optional[RoutingSnapshot] = None):
+        """返回 (提供商名称, 适配器实例, 实际模型, 聊天参数)，routes 为请求固定的路由快照"""
+        routes = routes or self._routes
         # 检查是否已选择 LLM 服务提供商
-        if not self.current_provider:
+        if not routes.current_provider:
             raise RuntimeError("未选择LLM服务提供商")
         
         # 获取当前提供商实例
-        provider = self.providers.get(self.current_provider)
+        provider = routes.providers.get(routes.current_provider)
         if not provider:
-            raise RuntimeError(f"无效的当前提供商: {self.current_provider}")
+            raise RuntimeError(f"无效的当前提供商: {routes.current_provider}")
+        # 已知不可用的提供商快速失败，不必等到上游超时
+        if self.health is not None:
+            self.health.check(routes.current_provider)
 
         # 获取保存的配置参数
-        saved_config = self.configurations.get(self.current_provider, {})
+        saved_config = routes.configurations.get(routes.current_provider, {})
         print(f"保存的配置: {saved_config}")
         
         # 使用配置中保存的模型名称，如果没有则使用传入的模型名称
@@ -258,35 +712,26 @@ class MCP:
             chat_params['top_p'] = saved_config['top_p']
 
         print(f"聊天参数: {chat_params}")
+        return routes.current_provider, provider, actual_model, chat_params
 
-        # 多模态支持列表（可根据实际扩展）
-        multimodal_providers = {
-            'openai': ['gpt-4-vision-preview', 'gpt-4o', 'gpt-4v'],
-            'zhipu': ['glm-4v', 'glm-4v-32k'],
-            'aliyun': ['qwen-vl-plus', 'qwen-vl-max'],
-            'baidu': ['ernie-vil', 'ernie-bot-multimodal'],
-            'google': ['gemini-1.5-pro', 'gemini-1.5-flash'],
-            # ...可扩展
-        }
-        provider_key = str(self.current_provider).lower()
-        model_key = str(model).lower()
-        # 检查多模态支持
-        if file_urls:
-            support = False
-            if provider_key in multimodal_providers:
-                for m in multimodal_providers[provider_key]:
-                    if m in model_key:
-                        support = True
-                        break
-            if not support:
-                logger.error(f"多模态请求被拒绝：当前模型不支持多模态，provider={provider_key}, model={model_key}, file_urls={file_urls}")
-                raise ValueError(f"当前模型({self.current_provider}/{model})暂不支持图片/视频输入，请切换支持多模态的模型。")
-
+    # 将已准入的聊天请求路由到当前提供商
+    async def _dispatch_request(self, messages: list, model: str, file_urls: Optional[list] = None,
+                                consumer: Optional[str] = None, conversation: Optional[str] = None,
+                                deadline: Optional[Deadline] = None) -> ChatResult:
+        """路由聊天请求到当前提供商"""
+        print(f"处理聊天请求: 当前提供商={self.current_provider}, 传入模型={model}, 文件数={len(file_urls) if file_urls else 0}")
         try:
-            extra_params = chat_params.copy()
-            if file_urls is not None and isinstance(file_urls, list):
-                extra_params['file_urls'] = file_urls
-            result = await provider.chat_completion(messages, actual_model, **extra_params)
+            with self.pin_routes() as routes:
+                provider_name, provider, actual_model, chat_params = self.resolve_route(model, routes)
+                messages, extra_params = await self._prepare_call(provider_name, provider, actual_model,
+                                                                  chat_params, messages, file_urls)
+                started = time.perf_counter()
+                with call_scope(self.timeout_policy(provider_name, actual_model, routes), deadline):
+                    result = await provider.chat_completion(messages, actual_model, **extra_params)
+                if not isinstance(result, ChatResult):
+                    result = ChatResult(result)
+                result.latency = time.perf_counter() - started
+            self._record_usage(provider_name, actual_model, messages, result, result.usage, consumer, conversation)
             print(f"聊天请求处理成功，响应长度: {len(result)}")
             return result
         except Exception as e:
@@ -296,6 +741,131 @@ class MCP:
             # 重新抛出异常
             raise
 
+    # 流式处理聊天请求，逐段产出回复文本（同样经过准入控制）
+    async def stream_request(self, messages: list, model: str, file_urls: Optional[list] = None,
+                             priority: str = DEFAULT_PRIORITY, consumer: Optional[str] = None,
+                             conversation: Optional[str] = None, use_cache: bool = True,
+                             deadline: Optional[Deadline] = None):
+        """流式处理聊天请求并路由到当前提供商，语义缓存命中时一次性产出缓存的回复，deadline 同 handle_request"""
+        lookup = await self._cache_lookup(messages, model, file_urls, use_cache)
+        if lookup is not None and lookup.entry is not None:
+            self.semantic_cache.maybe_verify(lookup, lambda: self._verify_fetch(messages, model, consumer, conversation))
+            yield self._cached_result(lookup)
+            return
+        async with self._admitted(priority, consumer, deadline):
+            with self.pin_routes() as routes:
+                provider_name, provider, actual_model, chat_params = self.resolve_route(model, routes)
+                messages, extra_params = await self._prepare_call(provider_name, provider, actual_model,
+                                                                  chat_params, messages, file_urls)
+                parts = []
+                try:
+                    with call_scope(self.timeout_policy(provider_name, actual_model, routes), deadline):
+                        async for chunk in provider.stream_chat_completion(messages, actual_model, **extra_params):
+                            parts.append(chunk)
+                            yield chunk
+                    finish_reason = parts[0].finish_reason if len(parts) == 1 and isinstance(parts[0], ChatResult) else None
+                    self._cache_store(lookup, "".join(parts), finish_reason)
+                finally:
+                    # 不支持流式的提供商一次性返回 ChatResult，带有上游用量；
+                    # 其余流式接口不返回用量，按已产出的内容估算（中途取消的请求同样计入）
+                    if parts:
+                        usage = parts[0].usage if len(parts) == 1 and isinstance(parts[0], ChatResult) else None
+                        self._record_usage(provider_name, actual_model, messages, "".join(parts), usage,
+                                           consumer, conversation)
+
+    # 网关内部的补全请求（如对话摘要），可指定提供商和模型
+    async def complete(self, messages: list, provider_name: Optional[str] = None, model: Optional[str] = None,
+                       max_tokens: Optional[int] = None, priority: str = "batch", consumer: Optional[str] = None,
+                       conversation: Optional[str] = None, bypass_admission: bool = False) -> ChatResult:
+        """provider_name/model 为空时使用当前提供商和其配置的模型；默认以批量优先级排队，不影响交互请求
+
+        bypass_admission=True 时不经过准入控制（用于健康探测：过载时排队或被拒绝不代表提供商故障）。
+        """
+        if bypass_admission:
+            return await self._complete(messages, provider_name, model, max_tokens, consumer, conversation)
+        async with self.admission.slot(priority, consumer):
+            return await self._complete(messages, provider_name, model, max_tokens, consumer, conversation)
+
+    async def _complete(self, messages: list, provider_name: Optional[str], model: Optional[str],
+                        max_tokens: Optional[int], consumer: Optional[str], conversation: Optional[str]) -> ChatResult:
+        with self.pin_routes() as routes:
+            provider_name = provider_name or routes.current_provider
+            provider = routes.providers.get(provider_name)
+            if provider is None:
+                raise RuntimeError(f"无效的提供商: {provider_name}")
+            actual_model = model or routes.configurations.get(provider_name, {}).get('model')
+            if not actual_model:
+                raise ValueError(f"提供商 {provider_name} 未配置模型")
+            # 不支持 max_tokens 参数的适配器（如百度）不限制输出长度
+            chat_params = {'max_tokens': max_tokens} if max_tokens and self._accepts(provider, 'max_tokens') else {}
+            messages, extra_params = await self._prepare_call(provider_name, provider, actual_model,
+                                                              chat_params, messages, None)
+            started = time.perf_counter()
+            with call_scope(self.timeout_policy(provider_name, actual_model, routes)):
+                result = await provider.chat_completion(messages, actual_model, **extra_params)
+            if not isinstance(result, ChatResult):
+                result = ChatResult(result)
+            result.latency = time.perf_counter() - started
+        self._record_usage(provider_name, actual_model, messages, result, result.usage, consumer, conversation)
+        return result
+
+    @staticmethod
+    def _accepts(provider: BaseAdapter, name: str) -> bool:
+        """适配器的 chat_completion 是否接受参数 name"""
+        parameters = inspect.signature(provider.chat_completion).parameters
+        return name in parameters or any(p.kind == p.VAR_KEYWORD for p in parameters.values())
+
+    # 记录一次请求的用量
+    def _record_usage(self, provider_name: str, model: str, messages: list, text: str, usage: Optional[dict],
+                      consumer: Optional[str], conversation: Optional[str]):
+        """上游未返回用量时按消息和回复长度估算"""
+        if self.usage is None:
+            return
+        estimated = not usage
+        if estimated:
+            prompt = estimate_tokens(messages)
+            completion = estimate_tokens([{"content": text}])
+            usage = {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion}
+        self.usage.record(provider_name, model, usage, consumer=consumer, conversation=conversation,
+                          estimated=estimated)
+
+    # 为需要内联附件的提供商准备媒体文件
+    async def _prepare_media(self, provider_name: str, provider: BaseAdapter, model: str, file_urls: list) -> list:
+        """本地上传文件按模型的预处理配置缩放后替换为缓存的编码结果，其余提供商保持原URL"""
+        if not file_urls or self.media_cache is None or not provider.inline_media:
+            return file_urls
+        return await self.media_cache.prepare(file_urls, profile_for(provider_name, model))
+
+    # 按模型能力校验和整理请求
+    async def _prepare_call(self, provider_name: str, provider: BaseAdapter, model: str, chat_params: dict,
+                            messages: list, file_urls: Optional[list]):
+        """返回 (裁剪后的消息, 调用参数)：校验附件、限制输出长度、按上下文窗口裁剪、准备媒体文件"""
+        caps = self.capabilities.lookup(provider_name, model)
+        self._check_multimodal(caps, provider_name, provider, file_urls)
+        extra_params = chat_params.copy()
+        # 只有数据文件中列出的模型才按已知上限限制输出长度，未知模型使用配置的 max_tokens
+        if caps.matched is not None and extra_params.get('max_tokens') and extra_params['max_tokens'] > caps.max_output:
+            extra_params['max_tokens'] = caps.max_output
+        messages = fit_to_context(messages, caps, extra_params.get('max_tokens'))
+        if file_urls is not None and isinstance(file_urls, list):
+            extra_params['file_urls'] = await self._prepare_media(provider_name, provider, model, file_urls)
+        return messages, extra_params
+
+    # 检查当前模型是否支持多模态输入
+    def _check_multimodal(self, caps: ModelCapabilities, provider_name: str, provider: BaseAdapter,
+                          file_urls: Optional[list]):
+        """不支持多模态时抛出 ValueError，provider_name 为请求固定的快照中的当前提供商"""
+        if not file_urls:
+            return
+        has_video = any((mimetypes.guess_type(str(url))[0] or "").startswith("video/") for url in file_urls)
+        # 视频可以转为关键帧发给支持图片的模型
+        keyframes = (self.media_cache is not None and provider.inline_media
+                     and self.media_cache.keyframes is not None and self.media_cache.keyframes.available)
+        support = caps.vision and (not has_video or caps.video or keyframes)
+        if not support:
+            logger.error(f"多模态请求被拒绝：当前模型不支持多模态，provider={caps.provider}, model={caps.model}, file_urls={file_urls}")
+            raise ValueError(f"当前模型({provider_name}/{caps.model})暂不支持图片/视频输入，请切换支持多模态的模型。")
+
     # 导出所有 MCP 配置的方法
     def export_configuration(self) -> Dict[str, Any]:
         """导出所有MCP配置"""
@@ -308,9 +878,7 @@ class MCP:
         if not isinstance(config, dict):
             raise ValueError("导入的配置必须是字典格式")
         self.configurations.update(config)  # 更新配置
-        self.save_configurations()  # 保存配置
-        
-        # 根据导入的配置创建适配器实例
-        self._create_providers_from_config()
+        # 根据导入的配置创建适配器实例，所有修改完成后只发布一个路由快照并保存配置
+        self.save_configurations()
         
         logger.info("MCP配置已成功导入")  # 记录日志
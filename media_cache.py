@@ -0,0 +1,267 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于把文件读取和编码放到线程池中执行
+import asyncio
+# 导入 functools 模块，用于向进程池传递关键字参数
+import functools
+# 导入 base64 模块，用于内联编码
+import base64
+# 导入 hashlib 模块，用于计算内容哈希
+import hashlib
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 mimetypes 模块，用于推断文件类型
+import mimetypes
+# 导入 os 模块，用于文件路径处理
+import os
+# 导入 threading 模块，用于保护缓存的并发访问
+import threading
+# 从 collections 导入 OrderedDict，用于实现 LRU 缓存
+from collections import OrderedDict
+# 从 concurrent.futures 导入 ProcessPoolExecutor，图片缩放和编码是CPU密集型操作
+from concurrent.futures import ProcessPoolExecutor
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional, Tuple, Union
+# 从 urllib.parse 导入 urlparse，用于解析上传文件URL
+from urllib.parse import urlparse, unquote
+
+# 导入运行指标记录模块
+from metrics import metrics
+# 导入图片预处理（缩放、去除元数据、重新编码）
+from image_preprocess import ImageProfile, preprocess_image
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 上传文件的URL前缀（见 server.py 中的静态文件挂载）
+UPLOAD_URL_PREFIX = "/static/uploads/"
+
+
+# 已编码的媒体文件
+class EncodedMedia:
+    """本地上传文件的内联编码结果，按内容哈希缓存"""
+
+    def __init__(self, url: str, mime_type: str, digest: str, data: str):
+        self.url = url  # 原始URL
+        self.mime_type = mime_type  # MIME 类型
+        self.digest = digest  # 内容的 SHA-256 哈希
+        self.data = data  # base64 编码后的内容
+
+    @property
+    def is_image(self) -> bool:
+        return self.mime_type.startswith("image/")
+
+    def data_url(self) -> str:
+        """data URL 形式（OpenAI 兼容接口的 image_url）"""
+        return f"data:{self.mime_type};base64,{self.data}"
+
+
+# 媒体引用：本地文件为 EncodedMedia，外部URL保持原样
+MediaRef = Union[EncodedMedia, str]
+
+
+# 定义 MediaCache 类，把本地上传文件解析并编码为各提供商接受的内联格式
+class MediaCache:
+    """上传文件的解析与编码缓存
+
+    /static/uploads/ 下的文件对云端提供商不可访问，需要内联发送。
+    编码结果按内容哈希和预处理配置缓存（LRU，按编码后字节数限制总大小），
+    并记录 (路径, 修改时间, 大小) 到哈希的映射，同一文件在多轮对话中不会被重复读取和编码。
+    传入预处理配置时，图片在进程池中缩放并重新编码后再内联。
+    配置了关键帧抽取器时，视频替换为若干关键帧图片，任何支持图片的模型都可以回答视频相关的问题。
+    """
+
+    def __init__(self, upload_dir: str, max_bytes: int = 256 * 1024 * 1024, workers: int = 2,
+                 keyframes=None):
+        self.upload_dir = upload_dir  # 上传文件目录
+        self.keyframes = keyframes  # 视频关键帧抽取器（KeyframeExtractor），None 表示按原文件发送视频
+        self.max_bytes = max_bytes  # 缓存的编码数据总大小上限
+        self.workers = workers  # 图片预处理进程数
+        self._pool: Optional[ProcessPoolExecutor] = None  # 图片预处理进程池，首次使用时创建
+        self._entries: "OrderedDict[str, EncodedMedia]" = OrderedDict()  # 缓存键 -> 编码结果
+        self._digests: Dict[Tuple[str, int, int], str] = {}  # (路径, mtime_ns, 大小) -> 内容哈希
+        self._size = 0  # 当前缓存的编码数据大小
+        self._lock = threading.Lock()  # 编码在线程池中执行，需要加锁
+
+    def resolve(self, url: str) -> Optional[str]:
+        """把上传文件URL解析为本地路径，不是本地上传文件时返回 None"""
+        if not isinstance(url, str):
+            return None
+        path = unquote(urlparse(url).path)
+        if not path.startswith(UPLOAD_URL_PREFIX):
+            return None
+        # 只取文件名，防止路径穿越
+        filename = os.path.basename(path)
+        if not filename:
+            return None
+        local_path = os.path.join(self.upload_dir, filename)
+        return local_path if os.path.isfile(local_path) else None
+
+    def _lookup(self, key: str) -> Optional[EncodedMedia]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key: str, entry: EncodedMedia):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = entry
+            self._size += len(entry.data)
+            # 超出上限时淘汰最久未使用的条目
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.data)
+                metrics.incr("media_cache_evictions")
+            live = {e.digest for e in self._entries.values()}
+            if len(self._digests) > 4 * len(live):
+                self._digests = {k: v for k, v in self._digests.items() if v in live}
+
+    def _digest(self, path: str) -> Tuple[str, Optional[bytes]]:
+        """计算文件的内容哈希（同步，在线程池中调用）
+
+        文件未变化时直接使用记录的哈希，不读取文件；否则返回读取到的原始内容以免重复读取。
+        """
+        stat = os.stat(path)
+        file_key = (path, stat.st_mtime_ns, stat.st_size)
+        digest = self._digests.get(file_key)
+        if digest:
+            return digest, None
+        with open(path, "rb") as f:
+            raw = f.read()
+        digest = hashlib.sha256(raw).hexdigest()
+        with self._lock:
+            self._digests[file_key] = digest
+        return digest, raw
+
+    @staticmethod
+    def _encode_raw(path: str, raw: Optional[bytes]) -> str:
+        """base64 编码原始内容（同步，在线程池中调用）"""
+        if raw is None:
+            with open(path, "rb") as f:
+                raw = f.read()
+        return base64.b64encode(raw).decode("ascii")
+
+    def _process_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    async def encode_file(self, url: str, path: str, profile: Optional[ImageProfile] = None) -> EncodedMedia:
+        """读取并编码本地文件，图片按预处理配置缩放后编码"""
+        digest, raw = await asyncio.to_thread(self._digest, path)
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        use_profile = profile is not None and mime_type.startswith("image/")
+        key = f"{digest}:{profile.key}" if use_profile else digest
+        entry = self._lookup(key)
+        if entry is not None:
+            metrics.incr("media_cache_hits")
+            return entry
+
+        metrics.incr("media_cache_misses")
+        if use_profile:
+            # 缩放和重新编码在进程池中执行，不阻塞事件循环，也不受 GIL 限制
+            loop = asyncio.get_running_loop()
+            processed_type, data = await loop.run_in_executor(
+                self._process_pool(), functools.partial(preprocess_image, path, **profile.params())
+            )
+            mime_type = processed_type or mime_type
+            metrics.incr("media_images_preprocessed", profile=profile.name)
+        else:
+            data = await asyncio.to_thread(self._encode_raw, path, raw)
+        entry = EncodedMedia(url, mime_type, digest, data)
+        self._store(key, entry)
+        return entry
+
+    async def prepare(self, file_urls: Optional[list], profile: Optional[ImageProfile] = None) -> List[MediaRef]:
+        """把本地上传文件URL替换为编码结果，外部URL保持不变"""
+        prepared: List[MediaRef] = []
+        for url in file_urls or []:
+            path = self.resolve(url)
+            if path is None:
+                prepared.append(url)
+                continue
+            if self.keyframes is not None and self.keyframes.available \
+                    and (mimetypes.guess_type(path)[0] or "").startswith("video/"):
+                frames = await self.keyframes.frames_for(path)
+                if frames:
+                    for i, frame in enumerate(frames):
+                        prepared.append(await self.encode_file(f"{url}#frame={i}", frame, profile))
+                    continue
+            prepared.append(await self.encode_file(url, path, profile))
+        return prepared
+
+    def close(self):
+        """关闭图片预处理进程池"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def status(self) -> dict:
+        """缓存状态"""
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes}
+
+
+# ---------- 各提供商的内联格式 ----------
+
+def openai_content_parts(text, media: List[MediaRef]) -> list:
+    """OpenAI 兼容接口的多模态 content 列表"""
+    parts = [{"type": "text", "text": text}] if isinstance(text, str) else list(text or [])
+    for item in media:
+        if isinstance(item, EncodedMedia):
+            if not item.is_image:
+                logger.warning(f"OpenAI兼容接口不支持的文件类型，已跳过: {item.mime_type}")
+                continue
+            parts.append({"type": "image_url", "image_url": {"url": item.data_url()}})
+        else:
+            parts.append({"type": "image_url", "image_url": {"url": item}})
+    return parts
+
+
+def gemini_part(item: MediaRef) -> dict:
+    """Gemini generateContent 的图片/视频 part"""
+    if isinstance(item, EncodedMedia):
+        return {"inline_data": {"mime_type": item.mime_type, "data": item.data}}
+    mime_type, _ = mimetypes.guess_type(item)
+    return {"file_data": {"mime_type": mime_type or "image/png", "file_uri": item}}
+
+
+def anthropic_image_block(item: MediaRef) -> Optional[dict]:
+    """Anthropic Messages 接口的图片内容块"""
+    if isinstance(item, EncodedMedia):
+        if not item.is_image:
+            logger.warning(f"Anthropic接口不支持的文件类型，已跳过: {item.mime_type}")
+            return None
+        return {"type": "image", "source": {"type": "base64", "media_type": item.mime_type, "data": item.data}}
+    return {"type": "image", "source": {"type": "url", "url": item}}
+
+
+def attach_to_last_user(messages: list, build) -> list:
+    """复制消息列表，用 build(原内容) 替换最后一条用户消息的内容"""
+    result = list(messages)
+    for i in range(len(result) - 1, -1, -1):
+        msg = result[i]
+        if isinstance(msg, dict) and msg.get("role") == "user":
+            result[i] = dict(msg, content=build(msg.get("content", "")))
+            break
+    return result
@@ -0,0 +1,106 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 threading 模块，用于保护计数器的并发访问
+import threading
+# 从 typing 模块导入类型提示
+from typing import Dict, Tuple, List, Any, Sequence
+
+
+# 定义 Metrics 类，用于记录进程内的运行指标
+class Metrics:
+    """进程内的简单指标记录器（带标签的计数器）"""
+
+    def __init__(self):
+        # 计数器字典，键为 (指标名, 排序后的标签元组)
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        # 锁，计数器可能在线程池中被更新
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]):
+        """生成计数器的键"""
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def incr(self, name: str, value: float = 1, **labels):
+        """增加计数器的值"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def get(self, name: str, **labels) -> float:
+        """读取计数器的当前值"""
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def snapshot(self) -> Dict[str, List[dict]]:
+        """导出所有计数器，按指标名分组"""
+        result: Dict[str, List[dict]] = {}
+        with self._lock:
+            items = list(self._counters.items())
+        for (name, labels), value in items:
+            result.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return result
+
+    def reset(self):
+        """清空所有计数器"""
+        with self._lock:
+            self._counters.clear()
+
+
+# 定义 Histogram 类，记录数值分布（如事件循环延迟）
+class Histogram:
+    """固定分桶的直方图，导出格式与 Prometheus 一致（累计计数，le 为桶上界）"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(sorted(buckets))  # 各桶上界，最后隐含一个 +Inf 桶
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        """记录一个值"""
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._max = max(self._max, value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts, total, maximum = list(self._counts), self._sum, self._max
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            buckets.append({"le": bound if bound != float("inf") else "+Inf", "count": cumulative})
+        return {"count": cumulative, "sum": total, "max": maximum, "buckets": buckets}
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._sum = 0.0
+            self._max = 0.0
+
+
+# 全局指标实例，供服务端各模块共享
+metrics = Metrics()
@@ -0,0 +1,121 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 hashlib 模块，用于计算消息前缀的摘要
+import hashlib
+# 导入 json 模块，用于序列化消息内容
+import json
+# 导入 time 模块，用于缓存过期判断
+import time
+# 从 collections 导入 OrderedDict，按最近使用顺序淘汰记录
+from collections import OrderedDict
+# 从 typing 模块导入类型提示
+from typing import List, Optional, Tuple
+
+# 导入 token 估算
+from capabilities import estimate_tokens
+
+# Anthropic 缓存断点的标记
+EPHEMERAL = {"type": "ephemeral"}
+
+
+# 定义 PromptCachePolicy 类，决定在哪些位置设置提示缓存断点
+class PromptCachePolicy:
+    """Anthropic 提示缓存断点选择
+
+    记录最近发送过的消息前缀（按 系统提示 + 消息 逐条累积的摘要），据此决定：
+    - 系统提示：足够长且近期重复出现时缓存；
+    - 读取点：本次请求中最长的、此前已写入缓存且尚未过期的前缀，命中后按缓存价格计费；
+    - 写入点：本次请求延续了近期的会话（前缀与之前的请求相同）时缓存到最后一条消息，
+      一次性的请求不写入，避免多付写入费用。
+    上游缓存在 ttl 秒未使用后失效，每次命中会刷新。
+    """
+
+    def __init__(self, ttl: float = 300.0, session_ttl: float = 3600.0, max_entries: int = 10000):
+        self.ttl = ttl  # 上游缓存的有效期（秒）
+        self.session_ttl = session_ttl  # 判断会话仍在继续的时间窗口（秒）
+        self.max_entries = max_entries  # 最多记录的前缀数
+        self._cached: "OrderedDict[str, float]" = OrderedDict()  # 已写入缓存的前缀摘要 -> 过期时间
+        self._sent: "OrderedDict[str, float]" = OrderedDict()  # 发送过的完整请求摘要 -> 过期时间
+
+    @staticmethod
+    def min_tokens(model: str) -> int:
+        """可缓存的最短前缀：Haiku 为 2048 tokens，其余模型为 1024 tokens"""
+        return 2048 if "haiku" in str(model).lower() else 1024
+
+    @staticmethod
+    def _digest(previous: str, item) -> str:
+        data = json.dumps(item, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(previous.encode("ascii") + data).hexdigest()
+
+    def _touch(self, table: "OrderedDict[str, float]", digest: str, expires: float):
+        table[digest] = expires
+        table.move_to_end(digest)
+        while len(table) > self.max_entries:
+            table.popitem(last=False)
+
+    @staticmethod
+    def _alive(table: "OrderedDict[str, float]", digest: str, now: float) -> bool:
+        expires = table.get(digest)
+        if expires is None:
+            return False
+        if expires < now:
+            del table[digest]
+            return False
+        return True
+
+    def plan(self, model: str, system: Optional[str], messages: List[dict]) -> Tuple[bool, List[int]]:
+        """返回 (是否缓存系统提示, 需要设置断点的消息下标)，并记录本次请求的前缀"""
+        now = time.monotonic()
+        threshold = self.min_tokens(model)
+        chain = [self._digest("", ["system", system or ""])]
+        for msg in messages:
+            chain.append(self._digest(chain[-1], msg))
+
+        cache_system = False
+        if system and estimate_tokens([{"content": system}]) >= threshold:
+            # 重复出现的系统提示才缓存
+            cache_system = self._alive(self._sent, chain[0], now) or self._alive(self._cached, chain[0], now)
+            self._touch(self._sent, chain[0], now + self.session_ttl)
+            if cache_system:
+                self._touch(self._cached, chain[0], now + self.ttl)
+
+        breakpoints = []
+        # 读取点：最长的已缓存前缀（不含最后一条消息）
+        for index in range(len(messages) - 1, 0, -1):
+            if self._alive(self._cached, chain[index], now):
+                breakpoints.append(index - 1)
+                self._touch(self._cached, chain[index], now + self.ttl)
+                break
+        # 写入点：延续之前请求的会话，且整个前缀达到可缓存长度
+        continuing = bool(breakpoints) or any(self._alive(self._sent, digest, now) for digest in chain[1:-1])
+        if continuing and estimate_tokens(([{"content": system}] if system else []) + messages) >= threshold:
+            breakpoints.append(len(messages) - 1)
+            self._touch(self._cached, chain[-1], now + self.ttl)
+        self._touch(self._sent, chain[-1], now + self.session_ttl)
+        return cache_system, breakpoints
+
+
+def with_cache_control(content):
+    """给消息内容的最后一个块加上缓存断点，字符串内容转换为文本块"""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, "cache_control": EPHEMERAL}]
+    blocks = [dict(block) for block in content]
+    if blocks:
+        blocks[-1]["cache_control"] = EPHEMERAL
+    return blocks
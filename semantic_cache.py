@@ -0,0 +1,375 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于后台抽样校验
+import asyncio
+# 导入 hashlib 模块，用于计算上下文摘要
+import hashlib
+# 导入 importlib 模块，用于加载自定义的向量化实现
+import importlib
+# 导入 json 模块，用于序列化上下文
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 random 模块，用于抽样校验
+import random
+# 导入 re 模块，用于文本归一化
+import re
+# 导入 time 模块，用于过期判断
+import time
+# 导入 uuid 模块，用于生成缓存条目ID
+import uuid
+# 导入 zlib 模块，使用 crc32 作为稳定的 n-gram 哈希
+import zlib
+# 从 abc 模块导入 ABC 和 abstractmethod，用于定义向量化接口
+from abc import ABC, abstractmethod
+# 从 collections 导入 OrderedDict，按最近命中顺序淘汰条目
+from collections import OrderedDict
+# 从 typing 模块导入类型提示
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+# NumPy 为可选依赖，未安装时不能启用语义缓存
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 归一化时去掉的标点和空白
+_PUNCTUATION = re.compile(r"[\s\.,!?;:'\"()\[\]{}<>，。！？；：、“”‘’（）【】《》…·~～-]+")
+
+
+# 定义向量化接口
+class Embedder(ABC):
+    """把文本转换为 L2 归一化的向量"""
+
+    dim: int = 0  # 向量维度
+
+    @abstractmethod
+    async def embed(self, texts: List[str]) -> "np.ndarray":
+        """返回 (len(texts), dim) 的 float32 矩阵，每行的 L2 范数为 1"""
+
+
+# 定义本地哈希 n-gram 向量化，无需网络和模型文件
+class HashingEmbedder(Embedder):
+    """字符 n-gram 特征哈希到固定维度（带符号，减少碰撞的影响）
+
+    对中文按字、对英文按字符片段取 n-gram，对改写、增删少量字词的问题相似度仍然较高，
+    但不理解同义词。需要更好的召回时可换成调用嵌入模型的实现。
+    """
+
+    def __init__(self, dim: int = 1024, ngrams: Tuple[int, ...] = (1, 2, 3), max_chars: int = 2000):
+        self.dim = dim  # 向量维度
+        self.ngrams = ngrams  # 使用的 n-gram 长度
+        self.max_chars = max_chars  # 只取文本开头的字符数
+
+    def _vector(self, text: str) -> "np.ndarray":
+        text = _PUNCTUATION.sub(" ", text.lower()).strip()[:self.max_chars]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for n in self.ngrams:
+            weight = float(n)  # 越长的片段越有区分度
+            for i in range(max(len(text) - n + 1, 0)):
+                gram = text[i:i + n]
+                if gram.isspace():
+                    continue
+                h = zlib.crc32(gram.encode("utf-8"))
+                vector[h % self.dim] += weight if (h >> 31) & 1 else -weight
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    async def embed(self, texts: List[str]) -> "np.ndarray":
+        return np.stack([self._vector(text) for text in texts]) if texts else np.zeros((0, self.dim), np.float32)
+
+
+def load_embedder(spec: Optional[str]) -> Embedder:
+    """按名称创建向量化实现：hashing（默认）或 "模块:工厂函数"（返回 Embedder 实例）"""
+    if not spec or spec == "hashing":
+        return HashingEmbedder()
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        raise ValueError(f"无效的向量化实现: {spec}，应为 hashing 或 模块:工厂函数")
+    factory = getattr(importlib.import_module(module_name), attr)
+    embedder = factory()
+    if not isinstance(embedder, Embedder):
+        raise ValueError(f"{spec} 返回的不是 Embedder 实例")
+    return embedder
+
+
+# 定义向量索引，容量固定，使用随机超平面哈希做近似最近邻搜索
+class VectorIndex:
+    """预分配的向量矩阵 + 随机超平面 LSH
+
+    每个向量按 8 个随机超平面的符号得到一个编码，查询时只计算编码汉明距离不超过 probe_radius 的
+    候选向量的内积（多探针 LSH）。条目数少于 exact_below 时直接计算全部内积。
+    矩阵先按 initial 行分配，写满后翻倍，最多 capacity 行。
+    """
+
+    def __init__(self, dim: int, capacity: int, probe_radius: int = 2, exact_below: int = 2048, seed: int = 0,
+                 initial: Optional[int] = None):
+        self.dim = dim
+        self.capacity = capacity  # 最多保存的向量数
+        self.probe_radius = probe_radius
+        self.exact_below = exact_below
+        allocated = min(capacity, initial or capacity)  # 已分配的行数
+        self._vectors = np.zeros((allocated, dim), dtype=np.float32)
+        self._codes = np.zeros(allocated, dtype=np.uint8)
+        self._used = np.zeros(allocated, dtype=bool)
+        self._planes = np.random.default_rng(seed).standard_normal((dim, 8)).astype(np.float32)
+        self._weights = (1 << np.arange(8)).astype(np.uint16)
+        self._popcount = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+        self._free = list(range(allocated - 1, -1, -1))  # 空闲位置
+
+    def __len__(self) -> int:
+        return len(self._used) - len(self._free)
+
+    def _grow(self):
+        """已分配的行写满时翻倍（不超过 capacity）"""
+        allocated = len(self._used)
+        size = min(self.capacity, allocated * 2)
+        extra = size - allocated
+        self._vectors = np.concatenate([self._vectors, np.zeros((extra, self.dim), dtype=np.float32)])
+        self._codes = np.concatenate([self._codes, np.zeros(extra, dtype=np.uint8)])
+        self._used = np.concatenate([self._used, np.zeros(extra, dtype=bool)])
+        self._free = list(range(size - 1, allocated - 1, -1)) + self._free
+
+    def _code(self, vector: "np.ndarray") -> int:
+        return int(((vector @ self._planes) > 0) @ self._weights)
+
+    def add(self, vector: "np.ndarray") -> int:
+        """写入向量，返回位置；已满时抛出 IndexError"""
+        if not self._free and len(self._used) < self.capacity:
+            self._grow()
+        if not self._free:
+            raise IndexError("向量索引已满")
+        slot = self._free.pop()
+        self._vectors[slot] = vector
+        self._codes[slot] = self._code(vector)
+        self._used[slot] = True
+        return slot
+
+    def remove(self, slot: int):
+        if self._used[slot]:
+            self._used[slot] = False
+            self._free.append(slot)
+
+    def search(self, vector: "np.ndarray") -> Tuple[Optional[int], float]:
+        """返回 (最相似的位置, 余弦相似度)，索引为空时返回 (None, 0)"""
+        if len(self) < self.exact_below:
+            candidates = np.flatnonzero(self._used)
+        else:
+            distance = self._popcount[self._codes ^ np.uint8(self._code(vector))]
+            candidates = np.flatnonzero(self._used & (distance <= self.probe_radius))
+        if candidates.size == 0:
+            return None, 0.0
+        scores = self._vectors[candidates] @ vector
+        best = int(np.argmax(scores))
+        return int(candidates[best]), float(scores[best])
+
+
+# 一条缓存的回复
+class CachedAnswer:
+    def __init__(self, slot: int, question: str, answer: str, meta: dict):
+        now = time.monotonic()
+        self.id = uuid.uuid4().hex  # 条目ID，用于反馈误命中
+        self.slot = slot  # 在向量索引中的位置
+        self.question = question  # 原始问题
+        self.answer = answer  # 缓存的回复
+        self.meta = meta  # 回复的结束原因等
+        self.created_at = now
+        self.last_hit = now
+        self.hits = 0
+
+
+# 一个缓存范围（提供商 + 模型 + 系统提示）
+class _Scope:
+    def __init__(self, dim: int, capacity: int):
+        # 多数范围只有少量条目，按需扩容
+        self.index = VectorIndex(dim, capacity, initial=min(capacity, 64))
+        self.entries: Dict[int, CachedAnswer] = {}  # 位置 -> 条目
+
+
+# 查询结果，未命中时用于写入
+class Lookup:
+    def __init__(self, scope_key: Optional[tuple], question: str, vector, entry: Optional[CachedAnswer] = None,
+                 similarity: float = 0.0):
+        self.scope_key = scope_key
+        self.question = question
+        self.vector = vector
+        self.entry = entry  # 命中的条目，未命中为 None
+        self.similarity = similarity
+
+
+# 定义 SemanticCache 类，对意思相同的问题直接返回缓存的回复
+class SemanticCache:
+    """语义缓存
+
+    只缓存单轮问答（系统提示 + 一条用户消息，不含附件）：最后一条用户消息向量化后，
+    在同一提供商、模型和系统提示的范围内查找最相似的问题，相似度不低于 threshold 时返回缓存的回复。
+    所有范围合计最多 max_entries 条，满时淘汰全局最久未命中的条目（不同系统提示不会各占一份上限），
+    超过 ttl 秒的条目不再使用。
+
+    误命中统计：按 verify_rate 抽样，命中后在后台仍然请求上游，回复相似度低于 answer_threshold 时
+    计为误命中并删除该条目；调用方也可以通过 report_false_hit 反馈。
+    """
+
+    def __init__(self, embedder: Optional[Embedder] = None, threshold: float = 0.92, max_entries: int = 10000,
+                 ttl: float = 86400.0, verify_rate: float = 0.0, answer_threshold: float = 0.5):
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("语义缓存需要安装 numpy")
+        self.embedder = embedder or HashingEmbedder()
+        self.threshold = threshold  # 命中所需的最低余弦相似度
+        self.max_entries = max_entries  # 所有范围合计的最大条目数
+        self.ttl = ttl  # 条目有效期（秒）
+        self.verify_rate = verify_rate  # 命中后抽样校验的比例
+        self.answer_threshold = answer_threshold  # 校验时回复相似度低于该值视为误命中
+        self._scopes: Dict[tuple, _Scope] = {}
+        # 条目ID -> (范围, 条目)，按最近命中排序，最前面的最先淘汰
+        self._by_id: "OrderedDict[str, Tuple[tuple, CachedAnswer]]" = OrderedDict()
+        self._stats = {"lookups": 0, "hits": 0, "stores": 0, "evictions": 0, "expired": 0,
+                       "verified": 0, "false_hits": 0, "reported_false_hits": 0}
+        self._verifying: set = set()  # 进行中的校验任务
+
+    @staticmethod
+    def question_of(messages: list) -> Optional[Tuple[str, list]]:
+        """可缓存的请求返回 (用户问题, 系统消息)，否则返回 None"""
+        if not isinstance(messages, list) or not messages:
+            return None
+        system = messages[:-1]
+        last = messages[-1]
+        if not all(isinstance(m, dict) and m.get("role") == "system" for m in system):
+            return None
+        if not isinstance(last, dict) or last.get("role") != "user" or not isinstance(last.get("content"), str):
+            return None
+        question = last["content"].strip()
+        return (question, system) if question else None
+
+    @staticmethod
+    def _scope_key(provider: str, model: str, system: list) -> tuple:
+        digest = hashlib.sha256(json.dumps(system, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        return (provider or "", model or "", digest)
+
+    def _count(self, name: str, **labels):
+        self._stats[name] += 1
+        metrics.incr(f"semantic_cache_{name}", **labels)
+
+    async def lookup(self, provider: str, model: str, messages: list) -> Optional[Lookup]:
+        """查找缓存的回复；请求不可缓存时返回 None，否则返回 Lookup（entry 为 None 表示未命中）"""
+        parsed = self.question_of(messages)
+        if parsed is None:
+            return None
+        question, system = parsed
+        scope_key = self._scope_key(provider, model, system)
+        vector = (await self.embedder.embed([question]))[0]
+        self._stats["lookups"] += 1
+        scope = self._scopes.get(scope_key)
+        if scope is not None:
+            slot, similarity = scope.index.search(vector)
+            entry = scope.entries.get(slot) if slot is not None else None
+            if entry is not None and time.monotonic() - entry.created_at > self.ttl:
+                self._remove(scope_key, entry)
+                self._count("expired")
+            elif entry is not None and similarity >= self.threshold:
+                entry.hits += 1
+                entry.last_hit = time.monotonic()
+                self._by_id.move_to_end(entry.id)
+                self._count("hits", provider=provider)
+                metrics.incr("semantic_cache_lookups", result="hit", provider=provider)
+                return Lookup(scope_key, question, vector, entry, similarity)
+        metrics.incr("semantic_cache_lookups", result="miss", provider=provider)
+        return Lookup(scope_key, question, vector)
+
+    def store(self, lookup: Lookup, answer: str, meta: Optional[dict] = None):
+        """写入未命中请求的回复"""
+        if lookup is None or lookup.entry is not None or not answer:
+            return
+        # 先淘汰再取范围：淘汰可能删除变空的范围
+        while len(self._by_id) >= self.max_entries:
+            _, (scope_key, victim) = self._by_id.popitem(last=False)
+            self._remove(scope_key, victim)
+            self._count("evictions")
+        scope = self._scopes.get(lookup.scope_key)
+        if scope is None:
+            scope = self._scopes[lookup.scope_key] = _Scope(self.embedder.dim, self.max_entries)
+        slot = scope.index.add(lookup.vector)
+        entry = CachedAnswer(slot, lookup.question, str(answer), meta or {})
+        scope.entries[slot] = entry
+        self._by_id[entry.id] = (lookup.scope_key, entry)
+        self._count("stores")
+
+    def _remove(self, scope_key: tuple, entry: CachedAnswer):
+        scope = self._scopes.get(scope_key)
+        if scope is None or scope.entries.get(entry.slot) is not entry:
+            return
+        del scope.entries[entry.slot]
+        scope.index.remove(entry.slot)
+        self._by_id.pop(entry.id, None)
+        if not scope.entries:
+            del self._scopes[scope_key]
+
+    def maybe_verify(self, lookup: Lookup, fetch: Callable[[], Awaitable[str]]):
+        """按 verify_rate 抽样，在后台请求上游并比较回复，判断是否误命中"""
+        if lookup is None or lookup.entry is None or random.random() >= self.verify_rate:
+            return
+        task = asyncio.ensure_future(self._verify(lookup, fetch))
+        self._verifying.add(task)
+        task.add_done_callback(self._verifying.discard)
+
+    async def _verify(self, lookup: Lookup, fetch: Callable[[], Awaitable[str]]):
+        try:
+            fresh = await fetch()
+            vectors = await self.embedder.embed([lookup.entry.answer, str(fresh)])
+        except Exception as e:
+            logger.warning(f"语义缓存校验失败: {str(e)}")
+            return
+        self._count("verified")
+        similarity = float(vectors[0] @ vectors[1])
+        if similarity < self.answer_threshold:
+            self._count("false_hits")
+            logger.info(f"语义缓存误命中: 问题={lookup.question[:50]!r}, 缓存问题={lookup.entry.question[:50]!r}, "
+                        f"问题相似度={lookup.similarity:.3f}, 回复相似度={similarity:.3f}")
+            self._remove(lookup.scope_key, lookup.entry)
+
+    def report_false_hit(self, entry_id: str) -> bool:
+        """调用方反馈误命中，删除该条目"""
+        item = self._by_id.get(entry_id)
+        if item is None:
+            return False
+        self._count("reported_false_hits")
+        self._remove(*item)
+        return True
+
+    def clear(self):
+        self._scopes = {}
+        self._by_id = OrderedDict()
+
+    def status(self) -> dict:
+        stats = dict(self._stats)
+        stats["hit_rate"] = round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        verified = stats["verified"]
+        stats["false_hit_rate"] = round(stats["false_hits"] / verified, 4) if verified else None
+        stats["entries"] = sum(len(scope.entries) for scope in self._scopes.values())
+        stats["scopes"] = len(self._scopes)
+        stats["threshold"] = self.threshold
+        return stats
@@ -17,27 +17,93 @@
 
 
 # 从 fastapi 库导入 FastAPI 和 HTTPException
-from fastapi import FastAPI, HTTPException, File, UploadFile
+from fastapi import FastAPI, HTTPException, File, UploadFile, Request, WebSocket
 # 从 fastapi.middleware.cors 导入 CORSMiddleware，用于处理跨域请求
 from fastapi.middleware.cors import CORSMiddleware
+# 导入响应压缩和请求体解压中间件
+from compression import CompressionMiddleware
 # 从 pydantic 库导入 BaseModel，用于数据模型定义
 from pydantic import BaseModel
 # 从 mcp_module 导入 MCP 类
 from mcp_module import MCP
+# 导入准入控制模块
+from admission import AdmissionController, AdmissionRejected, PRIORITY_CLASSES, DEFAULT_PRIORITY
 # 导入 api_adapter 模块
 import api_adapter
 # 导入聊天历史记录管理模块
 from chat_history import ChatHistory  # 取消注释，已实现
+# 导入共享状态存储（多 worker 部署时共享配置和聊天历史）
+from state_backend import create_backend
+# 导入运行指标记录模块
+from metrics import metrics
+# 导入批量请求执行模块
+from batch_runner import BatchRunner
+# 导入 WebSocket 聊天会话模块
+from ws_chat import ChatSocketSession
+# 导入上传文件内联编码缓存
+from media_cache import MediaCache
+# 导入图片预处理配置加载
+from image_preprocess import load_profiles
+# 导入视频关键帧抽取
+from video_frames import KeyframeExtractor, VIDEO_EXTENSIONS
+# 导入模型能力索引
+from capabilities import CapabilityRegistry
+# 导入用量和费用统计
+from usage_accounting import UsageAccountant, USAGE_DIMENSIONS
+# 导入语义缓存
+from semantic_cache import NUMPY_AVAILABLE, SemanticCache, load_embedder
+# 导入长对话滚动摘要
+from conversation_summary import ConversationCompactor
+# 导入上游请求的分项超时和请求截止时间
+from timeouts import Deadline, DeadlineExceeded, TimeoutPolicy
+# 导入启动预热
+from warmup import ProviderWarmer
+# 导入提供商健康探测和模型列表缓存
+from health import ProviderHealth
+# 导入事件循环延迟监控和采样分析器
+from diagnostics import LoopMonitor, SamplingProfiler
 # 导入Optional类型
 from typing import Optional, List
 import datetime
 import os
 import json
-from fastapi.responses import JSONResponse
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+import hmac
 from fastapi.staticfiles import StaticFiles
 
+# 应用生命周期：关闭时写入尚未保存的配置并释放资源
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 监视配置文件的外部修改，重新加载后发布新的路由快照
+    watcher = asyncio.ensure_future(mcp.watch_config(CONFIG_WATCH_INTERVAL)) if CONFIG_WATCH_INTERVAL > 0 else None
+    # 定期把用量统计写入共享存储
+    usage_flusher = asyncio.ensure_future(usage.run())
+    # 配置已在创建 MCP 时加载，后台预热各提供商，完成后 /ready 返回 200
+    warmer.start()
+    # 定期探测各提供商的健康状态
+    health.start()
+    # 采样事件循环延迟，检测阻塞事件循环的慢回调
+    loop_monitor.start()
+    yield
+    await loop_monitor.close()
+    await warmer.close()
+    await health.close()
+    if watcher is not None:
+        watcher.cancel()
+    usage_flusher.cancel()
+    if compactor is not None:
+        await compactor.close()
+    await usage.flush()
+    await mcp.flush_configurations()
+    await mcp.aclose()
+    mcp.media_cache.close()
+    state.close()
+
 # 创建 FastAPI 应用实例
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # 允许跨域请求 (CORS) 配置
 app.add_middleware(
@@ -48,11 +114,151 @@ app.add_middleware(
     allow_headers=["*"],  # 允许所有请求头
 )
 
+# 响应压缩（br/zstd 需要安装 brotli/zstandard，否则使用 gzip）和压缩请求体的解压
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=int(os.environ.get("BAIYU_COMPRESS_MIN_SIZE", "1024")),  # 小于该字节数的响应不压缩
+    level=int(os.environ.get("BAIYU_COMPRESS_LEVEL", "6")),  # 压缩级别
+    max_request_size=int(os.environ.get("BAIYU_MAX_REQUEST_MB", "32")) * 1024 * 1024,  # 解压后请求体上限
+)
+
+# 准入控制配置，可通过环境变量调整
+MAX_IN_FLIGHT = int(os.environ.get("BAIYU_MAX_IN_FLIGHT", "32"))  # 最大并发上游请求数
+MAX_QUEUED = int(os.environ.get("BAIYU_MAX_QUEUED", "128"))  # 最大排队请求数
+MAX_QUEUED_PER_CONSUMER = int(os.environ.get("BAIYU_MAX_QUEUED_PER_CONSUMER", "0")) or None  # 单个调用方最大排队数，0表示不限制
+INTERACTIVE_QUEUE_TIMEOUT = float(os.environ.get("BAIYU_INTERACTIVE_QUEUE_TIMEOUT", "10"))  # 交互请求最长排队秒数
+BATCH_QUEUE_TIMEOUT = float(os.environ.get("BAIYU_BATCH_QUEUE_TIMEOUT", "300"))  # 批量请求最长排队秒数
+
+# 上传文件配置
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), 'uploads')
+# 多个 worker 同时启动时可能同时创建
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+MEDIA_CACHE_MB = int(os.environ.get("BAIYU_MEDIA_CACHE_MB", "256"))  # 上传文件内联编码缓存上限（MB）
+MEDIA_WORKERS = int(os.environ.get("BAIYU_MEDIA_WORKERS", "2"))  # 图片预处理进程数
+VIDEO_FRAMES_DIR = os.path.join(os.path.dirname(__file__), 'video_frames')  # 视频关键帧缓存目录
+VIDEO_MAX_FRAMES = int(os.environ.get("BAIYU_VIDEO_MAX_FRAMES", "6"))  # 每个视频保留的关键帧数
+VIDEO_SCENE_THRESHOLD = float(os.environ.get("BAIYU_VIDEO_SCENE_THRESHOLD", "0.3"))  # 场景切换阈值
+VIDEO_WORKERS = int(os.environ.get("BAIYU_VIDEO_WORKERS", "2"))  # 同时运行的 ffmpeg 进程数
+CONFIG_SAVE_DELAY = float(os.environ.get("BAIYU_CONFIG_SAVE_DELAY", "0.5"))  # 配置写入合并窗口（秒）
+CONFIG_WATCH_INTERVAL = float(os.environ.get("BAIYU_CONFIG_WATCH_INTERVAL", "2"))  # 配置修改检查间隔（秒），0表示不监视
+# 共享状态存储：sqlite（默认，uvicorn --workers N 时各 worker 共享配置和聊天历史）或 memory（单进程）
+STATE_BACKEND = os.environ.get("BAIYU_STATE_BACKEND", "sqlite")
+STATE_DB = os.environ.get("BAIYU_STATE_DB", "baiyu_state.db")  # SQLite 数据库文件路径
+USAGE_BUCKET_SECONDS = int(os.environ.get("BAIYU_USAGE_BUCKET_SECONDS", "3600"))  # 用量统计时间桶长度（秒）
+USAGE_FLUSH_INTERVAL = float(os.environ.get("BAIYU_USAGE_FLUSH_INTERVAL", "5"))  # 用量统计写入间隔（秒）
+USAGE_RETENTION_BUCKETS = int(os.environ.get("BAIYU_USAGE_RETENTION_BUCKETS", str(24 * 90)))  # 保留的时间桶数，0表示不删除
+# 语义缓存（默认关闭）：意思相同的单轮问题直接返回缓存的回复，需要 numpy
+SEMANTIC_CACHE = os.environ.get("BAIYU_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("BAIYU_SEMANTIC_CACHE_THRESHOLD", "0.92"))  # 命中所需的最低相似度
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("BAIYU_SEMANTIC_CACHE_MAX_ENTRIES", "10000"))  # 所有提供商/模型合计的最大条目数
+SEMANTIC_CACHE_TTL = float(os.environ.get("BAIYU_SEMANTIC_CACHE_TTL", "86400"))  # 条目有效期（秒）
+SEMANTIC_CACHE_EMBEDDER = os.environ.get("BAIYU_SEMANTIC_CACHE_EMBEDDER", "hashing")  # hashing 或 模块:工厂函数
+SEMANTIC_CACHE_VERIFY_RATE = float(os.environ.get("BAIYU_SEMANTIC_CACHE_VERIFY_RATE", "0.01"))  # 命中后抽样校验的比例
+# 长对话滚动摘要（默认关闭）：较早的对话在后台用较便宜的模型压缩为摘要
+SUMMARY_ENABLED = os.environ.get("BAIYU_SUMMARY", "0") == "1"
+SUMMARY_PROVIDER = os.environ.get("BAIYU_SUMMARY_PROVIDER") or None  # 摘要使用的提供商，默认为当前提供商
+SUMMARY_MODEL = os.environ.get("BAIYU_SUMMARY_MODEL") or None  # 摘要使用的模型，默认为该提供商配置的模型
+SUMMARY_THRESHOLD_TOKENS = int(os.environ.get("BAIYU_SUMMARY_THRESHOLD_TOKENS", "6000"))  # 未摘要的对话超过该值时压缩
+SUMMARY_KEEP_TOKENS = int(os.environ.get("BAIYU_SUMMARY_KEEP_TOKENS", "2000"))  # 保留原文的最近对话长度
+SUMMARY_MAX_TOKENS = int(os.environ.get("BAIYU_SUMMARY_MAX_TOKENS", "800"))  # 摘要的最大长度
+# 上游请求的默认分项超时（秒），设为空字符串表示不单独限制；可在提供商配置的 timeouts 中按提供商和模型覆盖
+TIMEOUT_CONNECT = os.environ.get("BAIYU_TIMEOUT_CONNECT", "10")  # 建立连接
+TIMEOUT_FIRST_BYTE = os.environ.get("BAIYU_TIMEOUT_FIRST_BYTE", "")  # 等待响应头（非流式请求即整个生成过程）
+TIMEOUT_IDLE = os.environ.get("BAIYU_TIMEOUT_IDLE", "60")  # 流式响应两段数据之间
+TIMEOUT_TOTAL = os.environ.get("BAIYU_TIMEOUT_TOTAL", "600")  # 整个请求
+# 启动预热：建立到各提供商的连接、获取鉴权令牌，结束前 /ready 返回 503
+WARMUP_ENABLED = os.environ.get("BAIYU_WARMUP", "1") == "1"
+WARMUP_PROBE = os.environ.get("BAIYU_WARMUP_PROBE", "0") == "1"  # 是否再发一次 max_tokens=1 的探测请求（会产生少量费用）
+WARMUP_TIMEOUT = float(os.environ.get("BAIYU_WARMUP_TIMEOUT", "10"))  # 单个提供商预热的最长时间（秒）
+# 提供商健康探测：定期查询模型列表（或建立连接）并缓存模型列表，0表示不探测
+HEALTH_INTERVAL = float(os.environ.get("BAIYU_HEALTH_INTERVAL", "30"))  # 探测间隔（秒）
+HEALTH_TIMEOUT = float(os.environ.get("BAIYU_HEALTH_TIMEOUT", "10"))  # 单次探测的最长时间（秒）
+HEALTH_FAILURES = int(os.environ.get("BAIYU_HEALTH_FAILURES", "2"))  # 连续失败多少次视为不健康
+HEALTH_PROBE_COMPLETIONS = os.environ.get("BAIYU_HEALTH_PROBE_COMPLETIONS", "0") == "1"  # 不支持模型列表时用 max_tokens=1 的请求探测
+HEALTH_FAIL_FAST = os.environ.get("BAIYU_HEALTH_FAIL_FAST", "0") == "1"  # 直接以 503 拒绝发往不健康提供商的请求
+MODEL_CATALOGUE_TTL = float(os.environ.get("BAIYU_MODEL_CATALOGUE_TTL", "3600"))  # 模型列表缓存有效期（秒）
+# 事件循环监控：延迟直方图见 /metrics，慢回调的调用栈和采样分析需要调试令牌
+LOOP_MONITOR_INTERVAL = float(os.environ.get("BAIYU_LOOP_MONITOR_INTERVAL", "0.5"))  # 延迟采样间隔（秒），0表示不监控
+SLOW_CALLBACK_MS = float(os.environ.get("BAIYU_SLOW_CALLBACK_MS", "100"))  # 单个回调阻塞事件循环超过该毫秒数时记录调用栈，0表示不检测
+DEBUG_TOKEN = os.environ.get("BAIYU_DEBUG_TOKEN", "")  # /debug/* 接口的访问令牌，未设置时这些接口不可用
+PROFILE_MAX_SECONDS = float(os.environ.get("BAIYU_PROFILE_MAX_SECONDS", "60"))  # 单次采样分析的最长时间（秒）
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 上传文件分块写入的大小
+# 自定义的图片预处理配置文件（按模型设置缩放分辨率、格式和质量）
+load_profiles(os.environ.get("BAIYU_IMAGE_PROFILES"))
+
+# 创建视频关键帧抽取实例（需要 ffmpeg，可通过 BAIYU_FFMPEG 指定路径）
+keyframes = KeyframeExtractor(VIDEO_FRAMES_DIR, max_frames=VIDEO_MAX_FRAMES,
+                              scene_threshold=VIDEO_SCENE_THRESHOLD, workers=VIDEO_WORKERS,
+                              ffmpeg=os.environ.get("BAIYU_FFMPEG"))
+
+# 模型能力数据文件（上下文窗口、最大输出、多模态、流式、批量），修改后自动重新加载
+capabilities = CapabilityRegistry(os.environ.get(
+    "BAIYU_MODEL_CAPABILITIES", os.path.join(os.path.dirname(__file__), 'model_capabilities.json')))
+
+# 创建共享状态存储，首次启动时自动导入 mcp_config.json 和 chat_histories.json
+state = create_backend(STATE_BACKEND, STATE_DB)
+
+# 创建用量统计实例，按提供商、模型、调用方和会话汇总 token 和费用
+usage = UsageAccountant(capabilities, state, bucket_seconds=USAGE_BUCKET_SECONDS,
+                        flush_interval=USAGE_FLUSH_INTERVAL, retention_buckets=USAGE_RETENTION_BUCKETS)
+
+# 创建语义缓存实例
+semantic_cache = None
+if SEMANTIC_CACHE and not NUMPY_AVAILABLE:
+    print("未安装 numpy，语义缓存不可用")
+elif SEMANTIC_CACHE:
+    semantic_cache = SemanticCache(load_embedder(SEMANTIC_CACHE_EMBEDDER), threshold=SEMANTIC_CACHE_THRESHOLD,
+                                   max_entries=SEMANTIC_CACHE_MAX_ENTRIES, ttl=SEMANTIC_CACHE_TTL,
+                                   verify_rate=SEMANTIC_CACHE_VERIFY_RATE)
+
 # 创建 MCP 实例，用于管理 LLM 服务提供商
-mcp = MCP()
+mcp = MCP(admission=AdmissionController(
+    max_in_flight=MAX_IN_FLIGHT,
+    max_queued=MAX_QUEUED,
+    queue_timeouts={"interactive": INTERACTIVE_QUEUE_TIMEOUT, "batch": BATCH_QUEUE_TIMEOUT},
+    max_queued_per_consumer=MAX_QUEUED_PER_CONSUMER
+), media_cache=MediaCache(UPLOAD_DIR, max_bytes=MEDIA_CACHE_MB * 1024 * 1024, workers=MEDIA_WORKERS,
+                                keyframes=keyframes), capabilities=capabilities,
+          save_delay=CONFIG_SAVE_DELAY, state=state, usage=usage, semantic_cache=semantic_cache,
+          timeouts=TimeoutPolicy(*(float(value) if value else None
+                                   for value in (TIMEOUT_CONNECT, TIMEOUT_FIRST_BYTE, TIMEOUT_IDLE, TIMEOUT_TOTAL))))
 
 # 创建聊天历史记录管理实例
-chat_history = ChatHistory()  # 取消注释，已实现
+chat_history = ChatHistory(backend=state)  # 取消注释，已实现
+
+# 创建长对话摘要实例
+compactor = ConversationCompactor(chat_history, mcp, provider=SUMMARY_PROVIDER, model=SUMMARY_MODEL,
+                                  threshold_tokens=SUMMARY_THRESHOLD_TOKENS, keep_recent_tokens=SUMMARY_KEEP_TOKENS,
+                                  max_summary_tokens=SUMMARY_MAX_TOKENS) if SUMMARY_ENABLED else None
+
+# 创建启动预热实例
+warmer = ProviderWarmer(mcp, probe=WARMUP_PROBE, timeout=WARMUP_TIMEOUT, enabled=WARMUP_ENABLED)
+
+# 创建提供商健康探测实例，MCP 路由时查询健康状态
+health = ProviderHealth(mcp, interval=HEALTH_INTERVAL, timeout=HEALTH_TIMEOUT, failure_threshold=HEALTH_FAILURES,
+                        catalogue_ttl=MODEL_CATALOGUE_TTL, probe_completions=HEALTH_PROBE_COMPLETIONS,
+                        fail_fast=HEALTH_FAIL_FAST)
+mcp.health = health
+
+# 创建事件循环监控和采样分析实例
+loop_monitor = LoopMonitor(interval=LOOP_MONITOR_INTERVAL, slow_callback=SLOW_CALLBACK_MS / 1000)
+profiler = SamplingProfiler(max_seconds=PROFILE_MAX_SECONDS)
+
+# 批量请求配置
+BATCH_OUTPUT_DIR = os.path.join(os.path.dirname(__file__), 'batch_outputs')  # 批量结果输出目录
+BATCH_CONCURRENCY = int(os.environ.get("BAIYU_BATCH_CONCURRENCY", "4"))  # 单个批次默认并发数
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BAIYU_BATCH_MAX_CONCURRENCY", "16"))  # 单个提供商上批量请求总并发上限
+NATIVE_BATCH_MIN_ITEMS = int(os.environ.get("BAIYU_NATIVE_BATCH_MIN_ITEMS", "100"))  # 自动改用原生批量接口的最小请求数
+NATIVE_BATCH_POLL_INTERVAL = float(os.environ.get("BAIYU_NATIVE_BATCH_POLL_INTERVAL", "30"))  # 原生批量任务轮询间隔（秒）
+BATCH_KEEP_JOBS = int(os.environ.get("BAIYU_BATCH_KEEP_JOBS", "100"))  # 保留状态的已结束批量任务数
+
+# 创建批量请求执行实例
+batch_runner = BatchRunner(mcp, output_dir=BATCH_OUTPUT_DIR,
+                           default_concurrency=BATCH_CONCURRENCY,
+                           max_concurrency=BATCH_MAX_CONCURRENCY,
+                           native_min_items=NATIVE_BATCH_MIN_ITEMS,
+                           native_poll_interval=NATIVE_BATCH_POLL_INTERVAL,
+                           max_finished_jobs=BATCH_KEEP_JOBS)
 
 # 定义聊天请求的数据模型
 class ChatRequest(BaseModel):
@@ -60,6 +266,8 @@ class ChatRequest(BaseModel):
     model: str = "default"  # 模型名称，默认为 "default"
     history_id: Optional[str] = None  # 聊天历史ID，可选
     file_urls: Optional[list] = None  # 新增，图片/视频URL列表
+    priority: Optional[str] = None  # 优先级类别（interactive/batch），也可通过 X-Priority 请求头指定
+    timeout: Optional[float] = None  # 本次请求的时间预算（秒），也可通过 X-Request-Timeout 请求头指定
 
 # 定义聊天历史记录的数据模型
 class HistoryRequest(BaseModel):
@@ -69,10 +277,53 @@ class HistoryRequest(BaseModel):
 class HistoryTitleRequest(BaseModel):
     title: str  # 历史记录标题
 
+# 客户端断开检测的轮询间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.25
+
+# 客户端断开连接时抛出的异常
+class ClientDisconnected(Exception):
+    pass
+
+async def run_until_disconnect(http_request: Request, coro, provider: Optional[str] = None):
+    """在后台任务中执行上游调用，客户端断开或请求处理被取消时取消上游任务"""
+    task = asyncio.ensure_future(coro)
+    reason = "client_disconnect"
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                break
+    except asyncio.CancelledError:
+        # 请求处理协程本身被取消时，也要取消上游任务
+        reason = "handler_cancelled"
+        raise
+    finally:
+        if not task.done():
+            # 取消上游任务：进行中的上游请求被中止，其连接直接关闭而不放回连接池；
+            # 适配器在取消时清理上游状态（如 Replicate 取消预测），等它处理完再返回
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                print(f"取消上游请求时出现异常: {str(e)}")
+            metrics.incr("chat_requests_cancelled", reason=reason, provider=provider or "")
+    print("客户端已断开连接，已取消上游请求")
+    raise ClientDisconnected()
+
 # 定义聊天补全的 POST 接口
 @app.post("/v1/chat/completions")
-async def chat_completions(request: ChatRequest):
+async def chat_completions(request: ChatRequest, http_request: Request):
     try:
+        # 请求的截止时间从收到请求开始计算，排队和上游调用只使用剩余的预算
+        try:
+            deadline = Deadline.parse(request.timeout if request.timeout is not None
+                                      else http_request.headers.get("X-Request-Timeout"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         print(f"收到聊天请求: 消息数={len(request.messages)}, 模型={request.model}, 文件数={len(request.file_urls) if request.file_urls else 0}")
         
         # 检查MCP实例是否有当前提供商
@@ -95,36 +346,144 @@ async def chat_completions(request: ChatRequest):
                         last_user_msg = msg
                         break
                 if last_user_msg:
-                    chat_history.add_message(history_id, last_user_msg)
+                    # 写入共享存储可能等待其他 worker 的写锁，放到线程中执行，不阻塞事件循环
+                    await asyncio.to_thread(chat_history.add_message, history_id, last_user_msg)
+        
+        # 确定优先级类别和调用方
+        priority = request.priority or http_request.headers.get("X-Priority") or DEFAULT_PRIORITY
+        if priority not in PRIORITY_CLASSES:
+            raise HTTPException(status_code=400, detail=f"未知的优先级类别: {priority}")
+        consumer = http_request.headers.get("X-API-Consumer")
+        # Cache-Control: no-cache 时跳过语义缓存
+        use_cache = "no-cache" not in http_request.headers.get("Cache-Control", "").lower()
+        
+        # 较早的对话已有摘要时用摘要代替
+        messages = compactor.assemble(history_id, request.messages) if compactor is not None else request.messages
         
         # 调用 MCP 实例处理聊天请求，传递 file_urls
         file_urls = request.file_urls if isinstance(request.file_urls, list) else None
-        response = await mcp.handle_request(request.messages, request.model, file_urls=file_urls)
+        response = await run_until_disconnect(
+            http_request,
+            mcp.handle_request(messages, request.model, file_urls=file_urls,
+                               priority=priority, consumer=consumer, conversation=history_id,
+                               use_cache=use_cache, deadline=deadline),
+            provider=mcp.current_provider
+        )
         print(f"聊天请求处理成功，响应长度: {len(response)}")
         
         # 保存AI回复到历史
         if history_id:
             ai_msg = {"role": "assistant", "content": response}
-            chat_history.add_message(history_id, ai_msg)
+            await asyncio.to_thread(chat_history.add_message, history_id, ai_msg)
+            if compactor is not None:
+                compactor.schedule(history_id)
         
         # 返回聊天补全结果
-        return {
+        result = {
             "object": "chat.completion",
             "choices": [{
                 "message": {
                     "role": "assistant",
                     "content": response
-                }
+                },
+                "finish_reason": getattr(response, "finish_reason", None)
             }]
         }
+        # 上游返回了用量时一并返回
+        if getattr(response, "usage", None):
+            result["usage"] = response.usage
+        if getattr(response, "request_id", None):
+            result["id"] = response.request_id
+        # 语义缓存命中时返回条目ID和相似度，回复不对时可通过 /semantic_cache/feedback 反馈
+        if getattr(response, "cache", None):
+            result["cache"] = response.cache
+        return result
     except HTTPException:
         # 重新抛出HTTP异常
         raise
+    except ClientDisconnected:
+        # 客户端已离开，返回 499（客户端关闭请求），不再保存回复
+        raise HTTPException(status_code=499, detail="客户端已断开连接，请求已取消")
+    except AdmissionRejected as e:
+        # 过载时快速失败，并告知客户端何时重试
+        raise HTTPException(status_code=e.status_code, detail=e.reason,
+                            headers={"Retry-After": str(e.retry_after)})
+    except DeadlineExceeded as e:
+        # 时间预算用完，返回 504
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         print(f"聊天请求处理失败: {str(e)}")
         # 捕获异常并返回 HTTP 500 错误
         raise HTTPException(status_code=500, detail=f"聊天请求处理失败: {str(e)}")
 
+# 定义批量聊天补全的 POST 接口，请求体为 JSONL（每行一个聊天请求）
+@app.post("/v1/batch")
+async def create_batch(http_request: Request, output_file: Optional[str] = None,
+                       resume: bool = False, concurrency: Optional[int] = None,
+                       mode: str = "auto", latency_tolerant: bool = False):
+    """执行批量聊天补全
+
+    未指定 output_file 时以 NDJSON 流式返回结果（按完成顺序）；
+    指定 output_file 时在后台执行并逐行写入文件，resume=true 时跳过已成功的请求。
+    后台任务在请求量较大且 latency_tolerant=true 时自动改用提供商原生批量接口（mode 可强制指定）。
+    """
+    try:
+        body = await http_request.body()
+        items = batch_runner.parse_jsonl(body.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"批量请求格式错误: {str(e)}")
+    if not items:
+        raise HTTPException(status_code=400, detail="批量请求为空")
+    if not mcp.current_provider:
+        raise HTTPException(status_code=500, detail="未配置AI服务提供商，请先在设置页面配置")
+    print(f"收到批量请求: 请求数={len(items)}, 输出文件={output_file}, 续跑={resume}")
+
+    if output_file:
+        try:
+            output_path = batch_runner.resolve_output_path(output_file)
+            job = batch_runner.start_job(items, output_path, resume=resume, concurrency=concurrency,
+                                         mode=mode, latency_tolerant=latency_tolerant)
+        except FileExistsError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"status": "success", "batch": job}
+
+    async def ndjson_stream():
+        async for record in batch_runner.run(items, concurrency=concurrency):
+            yield json.dumps(record, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(ndjson_stream(), media_type="application/x-ndjson")
+
+# 定义查询批量任务状态的 GET 接口
+@app.get("/v1/batch/{batch_id}")
+async def get_batch(batch_id: str):
+    job = batch_runner.jobs.get(batch_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="批量任务不存在")
+    return {"status": "success", "batch": job}
+
+# 定义取消批量任务的 DELETE 接口
+@app.delete("/v1/batch/{batch_id}")
+async def cancel_batch(batch_id: str):
+    if not batch_runner.cancel_job(batch_id):
+        raise HTTPException(status_code=404, detail="批量任务不存在或已结束")
+    return {"status": "success"}
+
+# WebSocket 单个连接上的最大并发会话数
+WS_MAX_STREAMS = int(os.environ.get("BAIYU_WS_MAX_STREAMS", "8"))
+
+# 定义 WebSocket 聊天接口，一个连接上按 history_id 复用多路会话并流式推送回复
+@app.websocket("/ws/chat")
+async def websocket_chat(websocket: WebSocket):
+    await websocket.accept()
+    consumer = websocket.headers.get("X-API-Consumer") or websocket.query_params.get("consumer")
+    print(f"WebSocket聊天连接已建立: 调用方={consumer}")
+    session = ChatSocketSession(websocket, mcp, chat_history, consumer=consumer, max_streams=WS_MAX_STREAMS,
+                                compactor=compactor)
+    await session.run()
+    print("WebSocket聊天连接已关闭")
+
 # 定义 MCP 配置的数据模型
 class MCPConfig(BaseModel):
     provider_name: str  # 提供商名称
@@ -193,7 +552,10 @@ async def save_mcp_config(request: MCPSaveConfigRequest):
         if request.mcp_config:
             mcp.import_configuration(request.mcp_config)
         print(f"MCP配置保存成功: {request.provider_name}")
-        return {"status": "success"}
+        # 按缓存的模型列表检查模型名称（不同步访问上游），同时在后台刷新该提供商的模型列表
+        warning = health.validate_model(request.provider_name, request.config.get("model"))
+        health.refresh_models(request.provider_name)
+        return {"status": "success", "warnings": [warning] if warning else []}
     except Exception as e:
         print(f"MCP配置保存失败: {str(e)}")
         # 捕获异常并返回详细的错误信息
@@ -224,25 +586,25 @@ async def create_chat_history(request: Optional[HistoryRequest] = None):
     title = None
     if request and request.title:
         title = request.title
-    history_id = chat_history.create_history(title)
+    history_id = await asyncio.to_thread(chat_history.create_history, title)
     return {"status": "success", "history_id": history_id}
 
 # 获取所有聊天历史记录
 @app.get("/chat/histories")
 async def get_chat_histories():
-    histories = chat_history.get_histories()
+    histories = await asyncio.to_thread(chat_history.get_histories)
     return {"status": "success", "histories": histories}
 
 # 获取收藏的聊天历史记录
 @app.get("/chat/favorites")
 async def get_favorite_histories():
-    favorites = chat_history.get_favorites()
+    favorites = await asyncio.to_thread(chat_history.get_favorites)
     return {"status": "success", "favorites": favorites}
 
 # 获取指定聊天历史记录
 @app.get("/chat/histories/{history_id}")
 async def get_chat_history(history_id: str):
-    history = chat_history.get_history(history_id)
+    history = await asyncio.to_thread(chat_history.get_history, history_id)
     if not history:
         raise HTTPException(status_code=404, detail="聊天历史记录不存在")
     return {"status": "success", "history": history}
@@ -250,7 +612,7 @@ async def get_chat_history(history_id: str):
 # 更新聊天历史记录标题
 @app.put("/chat/histories/{history_id}/title")
 async def update_chat_history_title(history_id: str, request: HistoryTitleRequest):
-    success = chat_history.update_history_title(history_id, request.title)
+    success = await asyncio.to_thread(chat_history.update_history_title, history_id, request.title)
     if not success:
         raise HTTPException(status_code=404, detail="聊天历史记录不存在")
     return {"status": "success"}
@@ -258,7 +620,7 @@ async def update_chat_history_title(history_id: str, request: HistoryTitleReques
 # 切换聊天历史记录收藏状态
 @app.put("/chat/histories/{history_id}/favorite")
 async def toggle_chat_history_favorite(history_id: str):
-    success = chat_history.toggle_favorite(history_id)
+    success = await asyncio.to_thread(chat_history.toggle_favorite, history_id)
     if not success:
         raise HTTPException(status_code=404, detail="聊天历史记录不存在")
     return {"status": "success"}
@@ -266,7 +628,7 @@ async def toggle_chat_history_favorite(history_id: str):
 # 删除聊天历史记录
 @app.delete("/chat/histories/{history_id}")
 async def delete_chat_history(history_id: str):
-    success = chat_history.delete_history(history_id)
+    success = await asyncio.to_thread(chat_history.delete_history, history_id)
     if not success:
         raise HTTPException(status_code=404, detail="聊天历史记录不存在")
     return {"status": "success"}
@@ -274,7 +636,7 @@ async def delete_chat_history(history_id: str):
 # 清空所有聊天历史记录
 @app.delete("/chat/histories")
 async def clear_chat_histories():
-    chat_history.clear_all_histories()
+    await asyncio.to_thread(chat_history.clear_all_histories)
     return {"status": "success"}
 
 # 定义获取当前配置的 GET 接口
@@ -470,6 +832,154 @@ async def get_debug_info():
         print(f"获取调试信息失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"获取调试信息失败: {str(e)}")
 
+def check_debug_token(http_request: Request):
+    """校验 Authorization: Bearer <令牌> 或 X-Debug-Token 请求头，未设置 BAIYU_DEBUG_TOKEN 时返回 404"""
+    if not DEBUG_TOKEN:
+        raise HTTPException(status_code=404, detail="调试接口未启用")
+    authorization = http_request.headers.get("Authorization", "")
+    token = authorization[7:] if authorization.startswith("Bearer ") else http_request.headers.get("X-Debug-Token", "")
+    if not hmac.compare_digest(token.encode(), DEBUG_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="调试令牌无效")
+
+# 定义事件循环状态的 GET 接口（包含慢回调的调用栈）
+@app.get("/debug/event_loop")
+async def get_event_loop_status(http_request: Request):
+    """事件循环延迟直方图和最近的慢回调（含阻塞时事件循环线程的调用栈）"""
+    check_debug_token(http_request)
+    return {"status": "success", **loop_monitor.status(stacks=True)}
+
+# 定义采样分析的 GET 接口
+@app.get("/debug/profile")
+async def get_profile(http_request: Request, seconds: float = 10, interval_ms: float = 5, loop_only: bool = False):
+    """对运行中的进程采样 seconds 秒，返回折叠调用栈（可用 flamegraph.pl 或 speedscope 生成火焰图）"""
+    check_debug_token(http_request)
+    try:
+        folded = await profiler.profile(seconds, interval_ms / 1000, loop_only=loop_only)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(folded)
+
+# 定义运行指标的 GET 接口
+@app.get("/metrics")
+async def get_metrics():
+    """获取运行指标"""
+    return {
+        "status": "success",
+        "metrics": metrics.snapshot(),
+        "admission": mcp.admission.status(),
+        "media_cache": mcp.media_cache.status(),
+        "routing": mcp.routing_status(),
+        "summaries": compactor.status() if compactor is not None else None,
+        "warmup": warmer.status(),
+        "health": health.status(),
+        "event_loop": loop_monitor.status(),
+        # 进程累计CPU时间（秒），压测时用于计算单请求CPU开销
+        "process_cpu_seconds": time.process_time()
+    }
+
+# 定义就绪检查的 GET 接口，负载均衡器只把请求转发给已预热的 worker
+@app.get("/ready")
+async def ready():
+    """启动预热结束后返回 200，预热中返回 503；各提供商的预热结果见 providers"""
+    status = warmer.status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
+# 定义提供商健康状态的 GET 接口
+@app.get("/health")
+async def get_health():
+    """各提供商最近一次探测的结果、探测延迟和模型列表缓存"""
+    return {"status": "success", **health.status()}
+
+# 定义提供商模型列表的 GET 接口（设置页面使用）
+@app.get("/providers/{provider_name}/models")
+async def get_provider_models(provider_name: str):
+    """立即返回缓存的模型列表，缓存过期或不存在时在后台刷新；models 为 null 表示尚未查询成功"""
+    if provider_name not in mcp.providers:
+        raise HTTPException(status_code=404, detail=f"提供商 {provider_name} 不存在")
+    if mcp.providers[provider_name].models_url() is None:
+        raise HTTPException(status_code=400, detail=f"提供商 {provider_name} 不支持查询模型列表")
+    return {"status": "success", "provider": provider_name, **health.models(provider_name)}
+
+# 定义模型能力查询的 GET 接口
+@app.get("/capabilities")
+async def get_capabilities(provider: Optional[str] = None, model: Optional[str] = None):
+    """查询模型能力，不传参数时查询当前提供商和模型，传 provider=* 时返回全部数据"""
+    try:
+        if provider == "*":
+            return {"status": "success", "capabilities": capabilities.all()}
+        provider = provider or mcp.current_provider
+        if model is None:
+            model = mcp.configurations.get(provider, {}).get("model")
+        return {"status": "success", "capabilities": capabilities.lookup(provider, model).to_dict()}
+    except Exception as e:
+        print(f"查询模型能力失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"查询模型能力失败: {str(e)}")
+
+# 定义用量和费用统计的 GET 接口
+@app.get("/usage")
+async def get_usage(group_by: str = "provider,model", since: Optional[float] = None, until: Optional[float] = None,
+                    provider: Optional[str] = None, model: Optional[str] = None,
+                    consumer: Optional[str] = None, conversation: Optional[str] = None):
+    """按维度汇总 token 用量和费用
+
+    group_by 为逗号分隔的维度（bucket、provider、model、consumer、conversation），
+    since/until 为 Unix 时间戳，其余参数按维度精确过滤。
+    """
+    try:
+        # 先写入本进程尚未写入的记录
+        await usage.flush()
+        dimensions = tuple(name.strip() for name in group_by.split(",") if name.strip())
+        for name in dimensions:
+            if name not in USAGE_DIMENSIONS:
+                raise HTTPException(status_code=400, detail=f"未知的统计维度: {name}")
+        rows = await asyncio.to_thread(usage.query, dimensions, since, until, provider=provider, model=model,
+                                       consumer=consumer, conversation=conversation)
+        return {"status": "success", "bucket_seconds": usage.bucket_seconds, "usage": rows}
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"查询用量统计失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"查询用量统计失败: {str(e)}")
+
+# 定义语义缓存状态的 GET 接口
+@app.get("/semantic_cache")
+async def get_semantic_cache():
+    """查询语义缓存的条目数、命中率和误命中率"""
+    if semantic_cache is None:
+        return {"status": "success", "enabled": False}
+    return {"status": "success", "enabled": True, "semantic_cache": semantic_cache.status()}
+
+# 定义语义缓存误命中反馈的请求体模型
+class SemanticCacheFeedback(BaseModel):
+    id: str  # 聊天响应中 cache.id 的值
+
+# 定义语义缓存误命中反馈的 POST 接口
+@app.post("/semantic_cache/feedback")
+async def semantic_cache_feedback(request: SemanticCacheFeedback):
+    """反馈缓存的回复与问题不符，删除该条目"""
+    if semantic_cache is None:
+        raise HTTPException(status_code=400, detail="语义缓存未启用")
+    if not semantic_cache.report_false_hit(request.id):
+        raise HTTPException(status_code=404, detail=f"缓存条目 {request.id} 不存在")
+    return {"status": "success", "message": "已删除该缓存条目"}
+
+# 定义清空语义缓存的 DELETE 接口
+@app.delete("/semantic_cache")
+async def clear_semantic_cache():
+    """清空语义缓存"""
+    if semantic_cache is not None:
+        semantic_cache.clear()
+    return {"status": "success", "message": "语义缓存已清空"}
+
+# 定义重新加载模型能力数据的 POST 接口
+@app.post("/capabilities/reload")
+async def reload_capabilities():
+    """立即重新加载模型能力数据文件"""
+    capabilities.reload()
+    return {"status": "success", "message": "模型能力数据已重新加载"}
+
 # 定义配置编辑的请求体模型
 class EditConfigRequest(BaseModel):
     provider_name: str  # 提供商名称
@@ -515,22 +1025,15 @@ async def get_chat_configs():
         print(f"获取聊天配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"获取配置失败: {str(e)}")
 
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), 'uploads')
-if not os.path.exists(UPLOAD_DIR):
-    os.makedirs(UPLOAD_DIR)
-
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.mp4', '.mov', '.avi', '.webm'}
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
 
-@app.post('/chat/upload')
-async def upload_file(file: UploadFile = File(...)):
-    filename = file.filename or ""
+async def save_upload(filename: str, chunks):
+    """分块保存上传文件；视频在写入的同时送入 ffmpeg 抽取关键帧"""
+    filename = os.path.basename(filename or "")
     ext = os.path.splitext(filename)[1].lower()
     if ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(status_code=400, detail=f"不支持的文件类型: {ext}")
-    contents = await file.read()
-    if len(contents) > MAX_FILE_SIZE:
-        raise HTTPException(status_code=400, detail="文件过大，最大支持50MB")
     save_path = os.path.join(UPLOAD_DIR, filename)
     # 防止重名覆盖
     base, ext = os.path.splitext(filename)
@@ -538,17 +1041,51 @@ async def upload_file(file: UploadFile = File(...)):
     while os.path.exists(save_path):
         save_path = os.path.join(UPLOAD_DIR, f"{base}_{counter}{ext}")
         counter += 1
-    with open(save_path, 'wb') as f:
-        f.write(contents)
+    stream = await keyframes.start_stream() if ext in VIDEO_EXTENSIONS else None
+    size = 0
+    try:
+        with open(save_path, 'wb') as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > MAX_FILE_SIZE:
+                    raise HTTPException(status_code=400, detail="文件过大，最大支持50MB")
+                f.write(chunk)
+                if stream is not None:
+                    await stream.feed(chunk)
+    except BaseException:
+        # 上传失败或客户端断开，删除不完整的文件
+        if stream is not None:
+            keyframes.abort(stream)
+        if os.path.exists(save_path):
+            os.remove(save_path)
+        raise
+    if ext in VIDEO_EXTENSIONS:
+        # 关键帧在后台完成，聊天请求引用该视频时会等待抽帧结束
+        keyframes.schedule(save_path, stream)
     # 返回相对URL，前端可用/static/访问
     file_url = f"/static/uploads/{os.path.basename(save_path)}"
     return JSONResponse({"url": file_url, "filename": os.path.basename(save_path)})
 
+@app.post('/chat/upload')
+async def upload_file(file: UploadFile = File(...)):
+    async def chunks():
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    return await save_upload(file.filename, chunks())
+
+@app.put('/chat/upload/{filename}')
+async def upload_file_stream(filename: str, request: Request):
+    """以原始请求体上传文件，数据边接收边写入，适合大视频（抽帧与上传同时进行）"""
+    return await save_upload(filename, request.stream())
+
 # 静态文件路由，供前端访问上传的文件
 app.mount("/static/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 # 当作为主程序运行时
 if __name__ == "__main__":
     import uvicorn
-    # 运行 FastAPI 应用，监听所有网络接口的 8000 端口
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # 运行 FastAPI 应用，默认监听所有网络接口的 8000 端口，可通过环境变量修改
+    uvicorn.run(app, host=os.environ.get("BAIYU_HOST", "0.0.0.0"), port=int(os.environ.get("BAIYU_PORT", "8000")))
\ No newline at end of file
@@ -0,0 +1,381 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 copy 模块，内存存储返回副本，避免调用方修改共享数据
+import copy
+# 导入 json 模块，用于序列化存储的值
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 os 模块，用于读取旧的 JSON 数据文件
+import os
+# 导入 sqlite3 模块，默认的共享状态存储
+import sqlite3
+# 导入 threading 模块，用于保护内存存储和管理每个线程的数据库连接
+import threading
+# 从 abc 模块导入 ABC 和 abstractmethod，用于定义存储接口
+from abc import ABC, abstractmethod
+# 从 contextlib 导入 contextmanager，用于管理数据库事务
+from contextlib import contextmanager
+# 从 typing 模块导入类型提示
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+
+# 定义共享状态存储的抽象基类
+class StateBackend(ABC):
+    """多个 worker 进程共享的状态存储
+
+    数据按命名空间分组（配置、聊天历史等），值为可 JSON 序列化的对象。
+    每个命名空间有一个单调递增的版本号，任何写入都会使其加一，
+    其他 worker 比较版本号即可得知数据已被修改（变更通知）。
+    Redis 兼容的存储可以用 HASH 保存命名空间、INCR 维护版本号、WATCH/MULTI 实现 update、
+    HINCRBYFLOAT 实现 increment、有序集合记录各键的写入版本实现 changes。
+    """
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        """读取一个值，不存在时返回 None"""
+
+    @abstractmethod
+    def items(self, namespace: str) -> Dict[str, Any]:
+        """读取命名空间中的所有值"""
+
+    @abstractmethod
+    def changes(self, namespace: str, since: int) -> Tuple[Dict[str, Any], List[str], int]:
+        """增量读取：返回 (版本号 since 之后写入的值, 当前所有键, 当前版本号)
+
+        不在键列表中的缓存值已被删除；只读取修改过的值，缓存方不需要每次重新读取整个命名空间。
+        """
+
+    @abstractmethod
+    def put(self, namespace: str, key: str, value: Any) -> int:
+        """写入一个值，返回命名空间的新版本号"""
+
+    @abstractmethod
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Any]) -> Tuple[Any, int]:
+        """原子地读取-修改-写入：fn 接收当前值（不存在时为 None），返回新值；返回 None 时不写入
+
+        返回 (新值, 版本号)，并发写同一个键的 worker 不会互相覆盖对方的修改。
+        """
+
+    @abstractmethod
+    def increment(self, namespace: str, deltas: Dict[str, Dict[str, float]]) -> int:
+        """在一个事务中把 deltas 的各数值字段累加到对应键的值上（不存在时从 0 开始），返回新版本号"""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> Tuple[bool, int]:
+        """删除一个值，返回 (是否存在, 版本号)"""
+
+    @abstractmethod
+    def delete_matching(self, namespace: str, predicate: Callable[[str], bool]) -> Tuple[int, int]:
+        """在一个事务中删除 predicate(键) 为真的所有值（只读取键，不解析值），返回 (删除的数量, 版本号)"""
+
+    @abstractmethod
+    def clear(self, namespace: str) -> int:
+        """清空命名空间，返回新版本号"""
+
+    @abstractmethod
+    def import_if_empty(self, namespace: str, values: Dict[str, Any]) -> bool:
+        """命名空间为空时批量写入（用于迁移旧数据），多个 worker 同时启动时只有一个会写入"""
+
+    @abstractmethod
+    def version(self, namespace: str) -> int:
+        """命名空间的当前版本号"""
+
+    def close(self):
+        """释放连接等资源"""
+
+
+def _add_fields(value: Optional[dict], fields: Dict[str, float]) -> dict:
+    """把 fields 的数值累加到 value 上"""
+    result = dict(value or {})
+    for name, delta in fields.items():
+        result[name] = result.get(name, 0) + delta
+    return result
+
+
+# 定义内存存储，供单进程运行和测试使用
+class MemoryBackend(StateBackend):
+    """进程内的存储，不能在 worker 之间共享，也不会持久化"""
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, Any]] = {}  # 命名空间 -> {键: 值}
+        self._versions: Dict[str, int] = {}  # 命名空间 -> 版本号
+        self._written: Dict[str, Dict[str, int]] = {}  # 命名空间 -> {键: 最后写入时的版本号}
+        self._lock = threading.RLock()
+
+    def _bump(self, namespace: str, *keys: str) -> int:
+        self._versions[namespace] = self._versions.get(namespace, 0) + 1
+        written = self._written.setdefault(namespace, {})
+        for key in keys:
+            written[key] = self._versions[namespace]
+        return self._versions[namespace]
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            return copy.deepcopy(self._data.get(namespace, {}).get(key))
+
+    def items(self, namespace: str) -> Dict[str, Any]:
+        with self._lock:
+            return copy.deepcopy(self._data.get(namespace, {}))
+
+    def changes(self, namespace: str, since: int) -> Tuple[Dict[str, Any], List[str], int]:
+        with self._lock:
+            data = self._data.get(namespace, {})
+            written = self._written.get(namespace, {})
+            changed = {key: copy.deepcopy(data[key]) for key in data if written.get(key, 0) > since}
+            return changed, list(data), self._versions.get(namespace, 0)
+
+    def put(self, namespace: str, key: str, value: Any) -> int:
+        with self._lock:
+            self._data.setdefault(namespace, {})[key] = copy.deepcopy(value)
+            return self._bump(namespace, key)
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Any]) -> Tuple[Any, int]:
+        with self._lock:
+            value = fn(copy.deepcopy(self._data.get(namespace, {}).get(key)))
+            if value is None:
+                return None, self._versions.get(namespace, 0)
+            self._data.setdefault(namespace, {})[key] = copy.deepcopy(value)
+            return value, self._bump(namespace, key)
+
+    def increment(self, namespace: str, deltas: Dict[str, Dict[str, float]]) -> int:
+        with self._lock:
+            data = self._data.setdefault(namespace, {})
+            for key, fields in deltas.items():
+                data[key] = _add_fields(data.get(key), fields)
+            return self._bump(namespace, *deltas)
+
+    def delete(self, namespace: str, key: str) -> Tuple[bool, int]:
+        with self._lock:
+            if self._data.get(namespace, {}).pop(key, None) is None:
+                return False, self._versions.get(namespace, 0)
+            self._written.get(namespace, {}).pop(key, None)
+            return True, self._bump(namespace)
+
+    def delete_matching(self, namespace: str, predicate: Callable[[str], bool]) -> Tuple[int, int]:
+        with self._lock:
+            data = self._data.get(namespace, {})
+            keys = [key for key in data if predicate(key)]
+            if not keys:
+                return 0, self._versions.get(namespace, 0)
+            written = self._written.get(namespace, {})
+            for key in keys:
+                del data[key]
+                written.pop(key, None)
+            return len(keys), self._bump(namespace)
+
+    def clear(self, namespace: str) -> int:
+        with self._lock:
+            self._data.pop(namespace, None)
+            self._written.pop(namespace, None)
+            return self._bump(namespace)
+
+    def import_if_empty(self, namespace: str, values: Dict[str, Any]) -> bool:
+        with self._lock:
+            if self._data.get(namespace):
+                return False
+            self._data[namespace] = copy.deepcopy(values)
+            self._bump(namespace, *values)
+            return True
+
+    def version(self, namespace: str) -> int:
+        with self._lock:
+            return self._versions.get(namespace, 0)
+
+
+# 定义 SQLite 存储，默认的共享状态存储
+class SQLiteBackend(StateBackend):
+    """基于 SQLite 的共享存储
+
+    使用 WAL 模式，读写互不阻塞；写入使用 BEGIN IMMEDIATE 事务，多个 worker 的写入按顺序执行，
+    锁等待最长 timeout 秒。每个线程使用独立的连接。每行记录最后写入时命名空间的版本号，用于增量读取。
+    """
+
+    def __init__(self, path: str = "baiyu_state.db", timeout: float = 30.0):
+        self.path = path  # 数据库文件路径
+        self.timeout = timeout  # 等待写锁的最长时间（秒）
+        self._local = threading.local()  # 每个线程的连接
+        self._connections = []  # 所有连接，关闭时使用
+        self._connections_lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS state ("
+                       "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                       "version INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (namespace, key))")
+            # 旧版数据库没有 version 列，已有的行视为版本 0
+            if "version" not in [row[1] for row in db.execute("PRAGMA table_info(state)")]:
+                db.execute("ALTER TABLE state ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            db.execute("CREATE TABLE IF NOT EXISTS versions ("
+                       "namespace TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # isolation_level=None：由代码显式控制事务
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            with self._connections_lock:
+                self._connections.append(db)
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """写事务：开始时即获取写锁，避免读后升级写锁时死锁"""
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    @staticmethod
+    def _bump(db: sqlite3.Connection, namespace: str) -> int:
+        db.execute("INSERT INTO versions (namespace, version) VALUES (?, 1) "
+                   "ON CONFLICT(namespace) DO UPDATE SET version = version + 1", (namespace,))
+        return db.execute("SELECT version FROM versions WHERE namespace = ?", (namespace,)).fetchone()[0]
+
+    @staticmethod
+    def _version(db: sqlite3.Connection, namespace: str) -> int:
+        row = db.execute("SELECT version FROM versions WHERE namespace = ?", (namespace,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        row = self._connect().execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def items(self, namespace: str) -> Dict[str, Any]:
+        rows = self._connect().execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def changes(self, namespace: str, since: int) -> Tuple[Dict[str, Any], List[str], int]:
+        db = self._connect()
+        # 先读版本号：之后写入的行会在下次增量读取时再次返回，不会遗漏
+        version = self._version(db, namespace)
+        rows = db.execute("SELECT key, CASE WHEN version > ? THEN value END FROM state WHERE namespace = ?",
+                          (since, namespace)).fetchall()
+        changed = {key: json.loads(value) for key, value in rows if value is not None}
+        return changed, [key for key, _ in rows], version
+
+    def put(self, namespace: str, key: str, value: Any) -> int:
+        data = json.dumps(value, ensure_ascii=False)
+        with self._transaction() as db:
+            version = self._bump(db, namespace)
+            db.execute("INSERT OR REPLACE INTO state (namespace, key, value, version) VALUES (?, ?, ?, ?)",
+                       (namespace, key, data, version))
+            return version
+
+    def update(self, namespace: str, key: str, fn: Callable[[Any], Any]) -> Tuple[Any, int]:
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            value = fn(json.loads(row[0]) if row else None)
+            if value is None:
+                return None, self._version(db, namespace)
+            version = self._bump(db, namespace)
+            db.execute("INSERT OR REPLACE INTO state (namespace, key, value, version) VALUES (?, ?, ?, ?)",
+                       (namespace, key, json.dumps(value, ensure_ascii=False), version))
+            return value, version
+
+    def increment(self, namespace: str, deltas: Dict[str, Dict[str, float]]) -> int:
+        with self._transaction() as db:
+            version = self._bump(db, namespace)
+            for key, fields in deltas.items():
+                row = db.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+                value = _add_fields(json.loads(row[0]) if row else None, fields)
+                db.execute("INSERT OR REPLACE INTO state (namespace, key, value, version) VALUES (?, ?, ?, ?)",
+                           (namespace, key, json.dumps(value, ensure_ascii=False), version))
+            return version
+
+    def delete(self, namespace: str, key: str) -> Tuple[bool, int]:
+        with self._transaction() as db:
+            if db.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key)).rowcount == 0:
+                return False, self._version(db, namespace)
+            return True, self._bump(db, namespace)
+
+    def delete_matching(self, namespace: str, predicate: Callable[[str], bool]) -> Tuple[int, int]:
+        with self._transaction() as db:
+            rows = db.execute("SELECT key FROM state WHERE namespace = ?", (namespace,)).fetchall()
+            keys = [(namespace, key) for key, in rows if predicate(key)]
+            if not keys:
+                return 0, self._version(db, namespace)
+            db.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", keys)
+            return len(keys), self._bump(db, namespace)
+
+    def clear(self, namespace: str) -> int:
+        with self._transaction() as db:
+            db.execute("DELETE FROM state WHERE namespace = ?", (namespace,))
+            return self._bump(db, namespace)
+
+    def import_if_empty(self, namespace: str, values: Dict[str, Any]) -> bool:
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM state WHERE namespace = ? LIMIT 1", (namespace,)).fetchone():
+                return False
+            version = self._bump(db, namespace)
+            db.executemany("INSERT INTO state (namespace, key, value, version) VALUES (?, ?, ?, ?)",
+                           [(namespace, k, json.dumps(v, ensure_ascii=False), version) for k, v in values.items()])
+            return True
+
+    def version(self, namespace: str) -> int:
+        return self._version(self._connect(), namespace)
+
+    def close(self):
+        with self._connections_lock:
+            for db in self._connections:
+                try:
+                    db.close()
+                except Exception:
+                    pass
+            self._connections = []
+        self._local = threading.local()
+
+
+def create_backend(kind: str = "sqlite", path: str = "baiyu_state.db") -> StateBackend:
+    """根据名称创建存储：sqlite（默认，可多 worker 共享）或 memory（单进程、测试用）"""
+    kind = (kind or "sqlite").lower()
+    if kind == "sqlite":
+        return SQLiteBackend(path)
+    if kind == "memory":
+        return MemoryBackend()
+    raise ValueError(f"不支持的状态存储类型: {kind}")
+
+
+def migrate_json_file(backend: StateBackend, namespace: str, path: str, convert: Callable[[Any], Dict[str, Any]]) -> bool:
+    """把旧版 JSON 数据文件导入空的命名空间，原文件保留不动"""
+    if not path or not os.path.exists(path):
+        return False
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            values = convert(json.load(f))
+    except Exception as e:
+        logger.error(f"读取旧数据文件失败，跳过迁移: {path}: {str(e)}")
+        return False
+    if not values:
+        return False
+    if backend.import_if_empty(namespace, values):
+        logger.info(f"已将 {path} 迁移到共享状态存储（{namespace}，{len(values)} 条）")
+        return True
+    return False
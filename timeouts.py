@@ -0,0 +1,308 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于超时控制
+import asyncio
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 time 模块，用于单调时钟
+import time
+# 从 contextlib 导入上下文管理器工具
+from contextlib import asynccontextmanager, contextmanager
+# 从 contextvars 导入 ContextVar，用于把调用范围传到适配器发出的上游请求
+from contextvars import ContextVar
+# 从 typing 模块导入类型提示
+from typing import Optional, Tuple
+
+# 导入 aiohttp 库，上游请求的超时参数沿用 aiohttp.ClientTimeout
+import aiohttp
+
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 分项超时（秒）：建立连接、等待响应头、流式响应两段数据之间、整个请求
+TIMEOUT_FIELDS = ("connect", "first_byte", "idle", "total")
+
+
+# 请求超过截止时间时抛出的异常，是 asyncio.TimeoutError 的子类，原有的超时处理仍然适用
+class DeadlineExceeded(asyncio.TimeoutError):
+    """请求的时间预算已用完"""
+
+
+# 定义 Deadline 类，表示一个请求的截止时间
+class Deadline:
+    """请求的截止时间（单调时钟）
+
+    在收到请求时创建，经 MCP 传到适配器发出的每个上游请求：排队、上游调用都只能使用剩余的预算。
+    """
+
+    def __init__(self, budget: float):
+        if budget <= 0:
+            raise ValueError("请求时间预算必须大于0")
+        self.budget = budget  # 时间预算（秒）
+        self.expires = time.monotonic() + budget  # 截止时刻
+
+    @classmethod
+    def parse(cls, value) -> Optional["Deadline"]:
+        """从请求字段或请求头（秒数）创建，未指定时返回 None，格式错误时抛出 ValueError"""
+        if value is None or value == "":
+            return None
+        try:
+            budget = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"无效的请求时间预算: {value}")
+        return cls(budget)
+
+    def remaining(self) -> float:
+        """剩余预算（秒），已过期时为 0"""
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+    def cap(self, timeout: Optional[float]) -> float:
+        """把超时限制在剩余预算以内"""
+        remaining = self.remaining()
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def exceeded(self, stage: str) -> DeadlineExceeded:
+        metrics.incr("deadline_exceeded", stage=stage)
+        return DeadlineExceeded(f"请求超过截止时间（预算 {self.budget:g} 秒，{stage}）")
+
+    def check(self, stage: str):
+        """已过期时抛出 DeadlineExceeded"""
+        if self.expired:
+            raise self.exceeded(stage)
+
+
+# 定义 TimeoutPolicy 类，表示上游请求的分项超时
+class TimeoutPolicy:
+    """上游请求的分项超时，None 表示不单独限制
+
+    connect 限制建立连接，first_byte 限制发出请求到收到响应头，
+    idle 限制流式响应中两段数据之间的间隔，total 限制整个请求（含读取响应体）。
+    """
+
+    def __init__(self, connect: Optional[float] = 10.0, first_byte: Optional[float] = None,
+                 idle: Optional[float] = 60.0, total: Optional[float] = 600.0):
+        self.connect = connect
+        self.first_byte = first_byte
+        self.idle = idle
+        self.total = total
+
+    def override(self, config: Optional[dict], model: Optional[str] = None) -> "TimeoutPolicy":
+        """按提供商配置覆盖，返回新的策略，配置无效时抛出 ValueError
+
+        配置格式: {"connect": 5, "idle": 30, "models": {"deepseek-reasoner": {"first_byte": 300}}}，
+        models 中的模型名先精确匹配，再按最长前缀匹配。
+        """
+        if not config:
+            return self
+        if not isinstance(config, dict):
+            raise ValueError("timeouts 配置必须是对象")
+        fields = self._validate({k: v for k, v in config.items() if k != "models"})
+        models = config.get("models") or {}
+        if not isinstance(models, dict):
+            raise ValueError("timeouts.models 配置必须是对象")
+        for name, overrides in models.items():
+            if not isinstance(overrides, dict):
+                raise ValueError(f"模型 {name} 的 timeouts 配置必须是对象")
+            self._validate(overrides)
+        if model:
+            matched = model if model in models else max((name for name in models if model.startswith(name)),
+                                                        key=len, default=None)
+            if matched is not None:
+                fields.update(models[matched])
+        values = self.to_dict()
+        values.update(fields)
+        return TimeoutPolicy(**values)
+
+    @staticmethod
+    def _validate(fields: dict) -> dict:
+        for name, value in fields.items():
+            if name not in TIMEOUT_FIELDS:
+                raise ValueError(f"未知的超时项: {name}，可选 {', '.join(TIMEOUT_FIELDS)}")
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+                raise ValueError(f"超时项 {name} 必须是正数或 null")
+        return dict(fields)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in TIMEOUT_FIELDS}
+
+
+# 当前调用范围：(超时策略, 截止时间)，由 MCP 在调用适配器时设置
+_scope: ContextVar[Optional[Tuple[TimeoutPolicy, Optional[Deadline]]]] = ContextVar("upstream_call_scope", default=None)
+
+
+@contextmanager
+def call_scope(policy: TimeoutPolicy, deadline: Optional[Deadline] = None):
+    """在范围内由适配器发出的上游请求使用 policy 的分项超时和 deadline 的剩余预算
+
+    范围内的异常发生时截止时间已过，则转换为 DeadlineExceeded（原异常作为 __cause__）。
+    """
+    token = _scope.set((policy, deadline))
+    try:
+        yield
+    except Exception as e:
+        if deadline is not None and deadline.expired and not isinstance(e, DeadlineExceeded):
+            raise deadline.exceeded("上游调用") from e
+        raise
+    finally:
+        try:
+            _scope.reset(token)
+        except ValueError:
+            # 流式生成器在其他上下文中被关闭（例如由事件循环回收），范围已随原上下文失效
+            pass
+
+
+@asynccontextmanager
+async def timed_session(session_cm):
+    """包装传输层会话：在调用范围内时按策略设置每个请求的超时，否则原样使用"""
+    async with session_cm as session:
+        scope = _scope.get()
+        yield session if scope is None else _TimedSession(session, *scope)
+
+
+class _TimedSession:
+    """与 aiohttp.ClientSession 接口相同的会话，请求的 timeout 参数由超时策略和截止时间决定"""
+
+    def __init__(self, session, policy: TimeoutPolicy, deadline: Optional[Deadline]):
+        self.session = session
+        self.policy = policy
+        self.deadline = deadline
+
+    def request(self, method: str, url, **kwargs):
+        return _TimedRequest(self, method, url, kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+class _TimedRequest:
+    """发出请求并在 first_byte 内等待响应头，之后流式读取受 idle 限制"""
+
+    def __init__(self, owner: _TimedSession, method: str, url, kwargs: dict):
+        self.owner = owner
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.cm = None
+
+    def _timeouts(self) -> Tuple[aiohttp.ClientTimeout, Optional[float]]:
+        """返回 (传给会话的 ClientTimeout, 等待响应头的时限)"""
+        policy, deadline = self.owner.policy, self.owner.deadline
+        total = policy.total
+        if deadline is not None:
+            deadline.check("发出请求前")
+            total = deadline.cap(total)
+        first_byte = policy.first_byte if total is None or policy.first_byte is None else min(policy.first_byte, total)
+        return aiohttp.ClientTimeout(total=total, sock_connect=policy.connect), first_byte
+
+    def _expired(self, stage: str) -> bool:
+        deadline = self.owner.deadline
+        if deadline is not None and deadline.expired:
+            return True
+        metrics.incr("upstream_timeouts", stage=stage)
+        return False
+
+    async def __aenter__(self):
+        timeout, first_byte = self._timeouts()
+        self.cm = self.owner.session.request(self.method, self.url, **dict(self.kwargs, timeout=timeout))
+        try:
+            response = await asyncio.wait_for(self.cm.__aenter__(), first_byte)
+        except asyncio.TimeoutError as e:
+            if self._expired("connect" if isinstance(e, aiohttp.ServerTimeoutError) else "first_byte"):
+                raise self.owner.deadline.exceeded("等待响应") from e
+            if isinstance(e, aiohttp.ServerTimeoutError):
+                raise
+            raise asyncio.TimeoutError(f"{first_byte:g} 秒内未收到上游响应") from e
+        if self.owner.policy.idle is not None:
+            response.content = _IdleStream(response.content, self.owner.policy.idle, self)
+        return response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self.cm.__aexit__(exc_type, exc, tb)
+
+
+class _IdleStream:
+    """响应体流的包装：逐行、逐块读取时两段数据之间不超过 idle 秒，一次读完整个响应体时不受限制"""
+
+    def __init__(self, stream, idle: float, request: _TimedRequest):
+        self.stream = stream
+        self.idle = idle
+        self.request = request
+
+    async def _wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.idle)
+        except asyncio.TimeoutError as e:
+            if self.request._expired("idle"):
+                raise self.request.owner.deadline.exceeded("读取响应") from e
+            raise asyncio.TimeoutError(f"上游 {self.idle:g} 秒内没有新数据") from e
+
+    async def _iterate(self, iterable):
+        iterator = iterable.__aiter__()
+        while True:
+            try:
+                item = await self._wait(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+            yield item
+
+    def __aiter__(self):
+        return self._iterate(self.stream)
+
+    def iter_any(self):
+        return self._iterate(self.stream.iter_any())
+
+    def iter_chunked(self, n: int):
+        return self._iterate(self.stream.iter_chunked(n))
+
+    def iter_chunks(self):
+        return self._iterate(self.stream.iter_chunks())
+
+    async def readline(self) -> bytes:
+        return await self._wait(self.stream.readline())
+
+    async def readany(self) -> bytes:
+        return await self._wait(self.stream.readany())
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
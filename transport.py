@@ -0,0 +1,376 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于超时控制
+import asyncio
+# 导入 json 模块，用于解析响应体
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 从 abc 模块导入 ABC 和 abstractmethod，用于定义传输层接口
+from abc import ABC, abstractmethod
+# 从 contextlib 导入 asynccontextmanager，用于定义会话上下文
+from contextlib import asynccontextmanager
+# 从 typing 模块导入类型提示
+from typing import Optional
+
+# 导入 aiohttp 模块，默认的 HTTP/1.1 传输
+import aiohttp
+# 从 multidict 导入不区分大小写的字典，用于构造与 aiohttp 相同的错误信息
+from multidict import CIMultiDict, CIMultiDictProxy
+# 导入 yarl 模块，用于构造请求URL
+from yarl import URL
+
+# httpx 和 h2 为可选依赖，未安装时不能使用 HTTP/2 传输
+try:
+    import httpx
+    HTTPX_AVAILABLE = True
+except ImportError:
+    httpx = None
+    HTTPX_AVAILABLE = False
+try:
+    import h2  # noqa: F401
+    H2_AVAILABLE = True
+except ImportError:
+    H2_AVAILABLE = False
+
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 可选的传输类型：http1 为 aiohttp（默认），http2 为 httpx（TLS 上通过 ALPN 协商），
+# h2c 为明文 HTTP/2（直接以 HTTP/2 连接，用于本地网关或模拟服务）
+TRANSPORT_KINDS = ("http1", "http2", "h2c")
+
+
+# 定义传输层接口
+class Transport(ABC):
+    """适配器的上游 HTTP 传输
+
+    session() 返回 async with 使用的会话，提供适配器用到的 aiohttp.ClientSession 接口
+    （get/head/post/put/patch/delete，参数 json/data/headers/params/timeout，响应的 status/headers/
+    text/json/read/content/raise_for_status），超时抛出 asyncio.TimeoutError，
+    连接和读取错误抛出 aiohttp.ClientError 的子类，适配器代码与传输类型无关。
+    会话在适配器内复用连接池，aclose 时关闭。
+    """
+
+    kind = "http1"
+
+    @abstractmethod
+    def session(self):
+        """返回会话的异步上下文管理器"""
+
+    @abstractmethod
+    async def aclose(self):
+        """关闭连接池"""
+
+
+# 定义 aiohttp 传输，连接池在同一适配器的请求间复用（HTTP/1.1 keep-alive）
+class AiohttpTransport(Transport):
+    kind = "http1"
+
+    def __init__(self, limit: int = 100, keepalive_timeout: float = 30.0):
+        self.limit = limit  # 同时打开的最大连接数
+        self.keepalive_timeout = keepalive_timeout  # 空闲连接保留时间（秒）
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop = None
+
+    @asynccontextmanager
+    async def session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            # 会话绑定事件循环，换了事件循环（如测试中）时重新创建
+            connector = aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._loop = loop
+        yield self._session
+
+    async def aclose(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# 定义 httpx 传输，同一主机的并发请求复用一个 HTTP/2 连接
+class HttpxTransport(Transport):
+    def __init__(self, http2: bool = True, prior_knowledge: bool = False, max_connections: int = 100,
+                 keepalive_expiry: float = 30.0):
+        if not HTTPX_AVAILABLE or (http2 and not H2_AVAILABLE):
+            raise RuntimeError("HTTP/2 传输需要安装 httpx 和 h2（pip install httpx[http2]）")
+        self.kind = "h2c" if prior_knowledge else ("http2" if http2 else "http1")
+        self.http2 = http2
+        self.prior_knowledge = prior_knowledge  # 明文连接直接使用 HTTP/2，不经过升级协商
+        self.max_connections = max_connections
+        self.keepalive_expiry = keepalive_expiry
+        self._client = None
+        self._loop = None
+
+    @asynccontextmanager
+    async def session(self):
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._loop is not loop:
+            limits = httpx.Limits(max_connections=self.max_connections, keepalive_expiry=self.keepalive_expiry)
+            self._client = httpx.AsyncClient(http2=self.http2, http1=not self.prior_knowledge, limits=limits,
+                                             timeout=None, follow_redirects=True)
+            self._loop = loop
+        yield _HttpxSession(self._client)
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+
+def create_transport(kind: Optional[str] = None) -> Transport:
+    """按类型创建传输；HTTP/2 依赖未安装时记录警告并使用 HTTP/1.1"""
+    kind = (kind or "http1").lower()
+    if kind not in TRANSPORT_KINDS:
+        raise ValueError(f"未知的传输类型: {kind}，可选 {', '.join(TRANSPORT_KINDS)}")
+    if kind == "http1":
+        return AiohttpTransport()
+    if not HTTPX_AVAILABLE or not H2_AVAILABLE:
+        logger.warning(f"未安装 httpx 或 h2，{kind} 传输不可用，改用 HTTP/1.1")
+        return AiohttpTransport()
+    return HttpxTransport(http2=True, prior_knowledge=kind == "h2c")
+
+
+# ---------- httpx 到 aiohttp 接口的适配 ----------
+
+class _Deadline:
+    """aiohttp.ClientTimeout 的 total 限制整个请求（含读取响应体），其余字段映射到 httpx 的分项超时"""
+
+    def __init__(self, timeout):
+        loop = asyncio.get_running_loop()
+        total = getattr(timeout, "total", None)
+        self.loop = loop
+        self.expires = loop.time() + total if total else None
+        connect = getattr(timeout, "connect", None) or getattr(timeout, "sock_connect", None) or total
+        read = getattr(timeout, "sock_read", None) or total
+        self.httpx_timeout = httpx.Timeout(connect=connect, read=read, write=total, pool=connect)
+
+    async def run(self, coro):
+        if self.expires is None:
+            return await coro
+        remaining = self.expires - self.loop.time()
+        if remaining <= 0:
+            coro.close()
+            raise asyncio.TimeoutError()
+        return await asyncio.wait_for(coro, remaining)
+
+
+async def _call(deadline: _Deadline, coro, payload: bool = False):
+    """执行 httpx 操作，把异常转换为 aiohttp 调用方预期的类型"""
+    try:
+        return await deadline.run(coro)
+    except httpx.ConnectTimeout as e:
+        # 与 aiohttp 的连接超时相同，ServerTimeoutError 也是 asyncio.TimeoutError
+        raise aiohttp.ServerTimeoutError(str(e)) from e
+    except httpx.TimeoutException as e:
+        raise asyncio.TimeoutError(str(e)) from e
+    except (httpx.RemoteProtocolError, httpx.ReadError) as e:
+        if payload:
+            raise aiohttp.ClientPayloadError(str(e)) from e
+        raise aiohttp.ClientConnectionError(str(e)) from e
+    except httpx.HTTPError as e:
+        raise aiohttp.ClientConnectionError(str(e)) from e
+
+
+class _BufferWriter:
+    """收集 aiohttp 表单编码输出的写入器"""
+
+    def __init__(self):
+        self.chunks = []
+
+    async def write(self, data: bytes):
+        self.chunks.append(bytes(data))
+
+    async def write_eof(self, chunk: bytes = b""):
+        if chunk:
+            self.chunks.append(bytes(chunk))
+
+
+class _HttpxSession:
+    """提供 aiohttp.ClientSession 请求方法的 httpx 会话"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method: str, url, **kwargs):
+        return _HttpxRequest(self.client, method, str(url), kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+class _HttpxRequest:
+    def __init__(self, client, method: str, url: str, kwargs: dict):
+        self.client = client
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.response: Optional[_HttpxResponse] = None
+
+    async def _build(self, deadline: _Deadline):
+        kwargs = self.kwargs
+        headers = dict(kwargs.get("headers") or {})
+        content = None
+        data = kwargs.get("data")
+        if isinstance(data, aiohttp.FormData):
+            # multipart 表单按 aiohttp 的编码方式生成，保证两种传输发送的内容相同
+            payload = data()
+            writer = _BufferWriter()
+            await payload.write(writer)
+            content = b"".join(writer.chunks)
+            headers["Content-Type"] = payload.content_type
+        elif isinstance(data, (bytes, bytearray, str)):
+            content = data
+        elif data is not None:
+            return self.client.build_request(self.method, self.url, data=data, headers=headers,
+                                             params=kwargs.get("params"), timeout=deadline.httpx_timeout)
+        return self.client.build_request(self.method, self.url, json=kwargs.get("json"), content=content,
+                                         headers=headers, params=kwargs.get("params"),
+                                         timeout=deadline.httpx_timeout)
+
+    async def __aenter__(self) -> "_HttpxResponse":
+        deadline = _Deadline(self.kwargs.get("timeout"))
+        request = await self._build(deadline)
+        raw = await _call(deadline, self.client.send(request, stream=True))
+        metrics.incr("upstream_http_responses", version=raw.http_version)
+        self.response = _HttpxResponse(raw, deadline)
+        return self.response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.response is not None:
+            await self.response.release()
+
+
+class _LineStream:
+    """响应体流，提供 aiohttp StreamReader 的按行迭代和读取方法"""
+
+    def __init__(self, response: "_HttpxResponse"):
+        self.response = response
+
+    async def _chunks(self):
+        iterator = self.response.raw.aiter_bytes()
+        while True:
+            try:
+                chunk = await _call(self.response.deadline, iterator.__anext__(), payload=True)
+            except StopAsyncIteration:
+                return
+            if chunk:
+                yield chunk
+
+    async def __aiter__(self):
+        buffer = b""
+        async for chunk in self._chunks():
+            buffer += chunk
+            while True:
+                index = buffer.find(b"\n")
+                if index < 0:
+                    break
+                line, buffer = buffer[:index + 1], buffer[index + 1:]
+                yield line
+        if buffer:
+            yield buffer
+
+    def iter_any(self):
+        return self._chunks()
+
+    async def iter_chunked(self, size: int):
+        buffer = b""
+        async for chunk in self._chunks():
+            buffer += chunk
+            while len(buffer) >= size:
+                yield buffer[:size]
+                buffer = buffer[size:]
+        if buffer:
+            yield buffer
+
+    async def read(self, n: int = -1) -> bytes:
+        return await self.response.read()
+
+
+class _HttpxResponse:
+    """提供 aiohttp.ClientResponse 常用接口的 httpx 响应"""
+
+    def __init__(self, raw, deadline: _Deadline):
+        self.raw = raw
+        self.deadline = deadline
+        self.status = raw.status_code
+        self.reason = raw.reason_phrase
+        self.headers = CIMultiDictProxy(CIMultiDict(raw.headers.multi_items()))
+        self.url = URL(str(raw.url))
+        self.method = raw.request.method
+        self.version = raw.http_version
+        self.content = _LineStream(self)
+        self._body: Optional[bytes] = None
+
+    @property
+    def request_info(self) -> aiohttp.RequestInfo:
+        headers = CIMultiDictProxy(CIMultiDict(self.raw.request.headers.multi_items()))
+        return aiohttp.RequestInfo(self.url, self.method, headers, self.url)
+
+    async def read(self) -> bytes:
+        if self._body is None:
+            self._body = await _call(self.deadline, self.raw.aread(), payload=True)
+        return self._body
+
+    async def text(self, encoding: Optional[str] = None, errors: str = "strict") -> str:
+        body = await self.read()
+        return body.decode(encoding or self.raw.charset_encoding or "utf-8", errors)
+
+    async def json(self, content_type: Optional[str] = "application/json", loads=None, encoding=None):
+        body = await self.read()
+        if content_type and content_type not in self.headers.get("Content-Type", "").lower():
+            raise aiohttp.ContentTypeError(self.request_info, (), status=self.status,
+                                           message=f"Attempt to decode JSON with unexpected mimetype: "
+                                                   f"{self.headers.get('Content-Type', '')}",
+                                           headers=self.headers)
+        text = body.decode(encoding or self.raw.charset_encoding or "utf-8").strip()
+        if not text:
+            return None
+        return (loads or json.loads)(text)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(self.request_info, (), status=self.status, message=self.reason,
+                                              headers=self.headers)
+
+    async def release(self):
+        await self.raw.aclose()
+
+    def close(self):
+        asyncio.ensure_future(self.raw.aclose())
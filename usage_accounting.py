@@ -0,0 +1,176 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于定期写入和在线程中执行存储操作
+import asyncio
+# 导入 json 模块，用于编码统计键
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 time 模块，用于计算时间桶
+import time
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional, Tuple
+
+# 导入模型能力索引和费用计算
+from capabilities import CapabilityRegistry, estimate_cost
+# 导入运行指标记录模块
+from metrics import metrics
+# 导入共享状态存储
+from state_backend import MemoryBackend, StateBackend
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 用量统计在共享状态存储中的命名空间
+USAGE_NAMESPACE = "usage"
+# 统计键的维度（按顺序）
+USAGE_DIMENSIONS = ("bucket", "provider", "model", "consumer", "conversation", "currency")
+# 每个统计键累加的计数
+USAGE_COUNTERS = ("requests", "estimated_requests", "prompt_tokens", "completion_tokens", "total_tokens",
+                  "cache_read_tokens", "cache_write_tokens", "cost")
+
+
+# 定义 UsageAccountant 类，按时间桶汇总 token 用量和费用
+class UsageAccountant:
+    """token 用量和费用统计
+
+    record 只把一条记录追加到内存列表，不做任何 I/O；后台任务每 flush_interval 秒
+    按 (时间桶, 提供商, 模型, 调用方, 会话, 币种) 合并后在一个事务中累加到共享存储，
+    多个 worker 的计数互相累加。超过 retention_buckets 个时间桶的旧数据定期删除。
+    """
+
+    def __init__(self, capabilities: CapabilityRegistry, state: Optional[StateBackend] = None,
+                 bucket_seconds: int = 3600, flush_interval: float = 5.0, retention_buckets: int = 24 * 90):
+        self.capabilities = capabilities  # 模型能力索引，提供价格
+        self.state = state or MemoryBackend()  # 统计数据所在的存储
+        self.bucket_seconds = bucket_seconds  # 时间桶长度（秒）
+        self.flush_interval = flush_interval  # 写入存储的间隔（秒）
+        self.retention_buckets = retention_buckets  # 保留的时间桶数，0 表示不删除
+        self._pending: List[tuple] = []  # 尚未写入存储的记录
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._pruned_bucket = 0  # 上次清理时的时间桶
+
+    def record(self, provider: str, model: str, usage: Optional[dict], consumer: Optional[str] = None,
+               conversation: Optional[str] = None, estimated: bool = False):
+        """记录一次请求的用量，estimated 表示 token 数为估算值（上游未返回用量）"""
+        usage = usage or {}
+        self._pending.append((time.time(), provider or "", model or "", consumer or "", conversation or "",
+                              int(usage.get("prompt_tokens") or 0), int(usage.get("completion_tokens") or 0),
+                              int(usage.get("cache_read_tokens") or 0), int(usage.get("cache_write_tokens") or 0),
+                              estimated))
+
+    def _bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.bucket_seconds) * self.bucket_seconds
+
+    def _aggregate(self, records: List[tuple]) -> Dict[str, Dict[str, float]]:
+        """按统计键合并记录"""
+        deltas: Dict[str, Dict[str, float]] = {}
+        for (timestamp, provider, model, consumer, conversation, prompt, completion,
+             cache_read, cache_write, estimated) in records:
+            caps = self.capabilities.lookup(provider, model)
+            key = json.dumps([self._bucket(timestamp), provider, model, consumer, conversation, caps.currency],
+                             ensure_ascii=False)
+            row = deltas.setdefault(key, dict.fromkeys(USAGE_COUNTERS, 0))
+            row["requests"] += 1
+            row["estimated_requests"] += 1 if estimated else 0
+            row["prompt_tokens"] += prompt
+            row["completion_tokens"] += completion
+            row["total_tokens"] += prompt + completion
+            row["cache_read_tokens"] += cache_read
+            row["cache_write_tokens"] += cache_write
+            row["cost"] += estimate_cost(caps, prompt, completion, cache_read, cache_write)
+        return deltas
+
+    async def flush(self):
+        """把内存中的记录写入存储"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            records, self._pending = self._pending, []
+            if not records:
+                return
+            deltas = self._aggregate(records)
+            try:
+                await asyncio.to_thread(self.state.increment, USAGE_NAMESPACE, deltas)
+            except Exception as e:
+                # 写入失败时放回列表，下次重试
+                self._pending = records + self._pending
+                logger.error(f"写入用量统计失败: {str(e)}")
+                return
+            metrics.incr("usage_flushes")
+            metrics.incr("usage_records_flushed", len(records))
+            await self._maybe_prune()
+
+    async def _maybe_prune(self):
+        """每个时间桶最多清理一次过期数据"""
+        current = self._bucket(time.time())
+        if not self.retention_buckets or current == self._pruned_bucket:
+            return
+        self._pruned_bucket = current
+        cutoff = current - self.retention_buckets * self.bucket_seconds
+        try:
+            await asyncio.to_thread(self._prune, cutoff)
+        except Exception as e:
+            logger.error(f"清理过期用量统计失败: {str(e)}")
+
+    def _prune(self, cutoff: int):
+        # 键的第一项为时间桶，只解析键，在一个事务中删除
+        deleted, _ = self.state.delete_matching(USAGE_NAMESPACE, lambda key: json.loads(key)[0] < cutoff)
+        if deleted:
+            logger.info(f"已清理 {deleted} 条过期用量统计")
+
+    async def run(self):
+        """后台任务：定期写入存储"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def query(self, group_by: Tuple[str, ...] = ("provider", "model"), since: Optional[float] = None,
+              until: Optional[float] = None, **filters) -> List[dict]:
+        """按 group_by 维度汇总存储中的统计，filters 按维度精确过滤（如 provider="openai"）"""
+        for name in tuple(group_by) + tuple(filters):
+            if name not in USAGE_DIMENSIONS:
+                raise ValueError(f"未知的统计维度: {name}")
+        groups: Dict[tuple, dict] = {}
+        for key, counters in self.state.items(USAGE_NAMESPACE).items():
+            dims = dict(zip(USAGE_DIMENSIONS, json.loads(key)))
+            if since is not None and dims["bucket"] + self.bucket_seconds <= since:
+                continue
+            if until is not None and dims["bucket"] >= until:
+                continue
+            if any(value is not None and dims[name] != value for name, value in filters.items()):
+                continue
+            # 不同币种的费用不能相加，始终按币种分组
+            group = tuple(dims[name] for name in group_by) + (dims["currency"],)
+            row = groups.get(group)
+            if row is None:
+                row = {name: dims[name] for name in group_by}
+                row["currency"] = dims["currency"]
+                row.update(dict.fromkeys(USAGE_COUNTERS, 0))
+                groups[group] = row
+            for name in USAGE_COUNTERS:
+                row[name] += counters.get(name, 0)
+        rows = list(groups.values())
+        for row in rows:
+            row["cost"] = round(row["cost"], 6)
+        return sorted(rows, key=lambda r: [str(r.get(name, "")) for name in group_by])
+
+    def pending(self) -> int:
+        """尚未写入存储的记录数"""
+        return len(self._pending)
@@ -0,0 +1,257 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于管理 ffmpeg 子进程
+import asyncio
+# 导入 hashlib 模块，用于计算视频内容哈希
+import hashlib
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 os 模块，用于文件路径处理
+import os
+# 导入 shutil 模块，用于查找 ffmpeg 和清理临时目录
+import shutil
+# 导入 uuid 模块，用于生成临时目录名
+import uuid
+# 从 typing 模块导入类型提示
+from typing import Dict, List, Optional
+
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 视频文件扩展名
+VIDEO_EXTENSIONS = {'.mp4', '.mov', '.avi', '.webm'}
+
+
+def _hash_file(path: str) -> str:
+    """计算文件的 SHA-256（同步，在线程池中调用）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# 上传过程中的增量抽帧会话
+class _ExtractionStream:
+    """把上传的数据边写边送入 ffmpeg 的标准输入"""
+
+    def __init__(self, process: asyncio.subprocess.Process, tmp_dir: str):
+        self.process = process  # ffmpeg 子进程
+        self.tmp_dir = tmp_dir  # 候选帧输出目录
+        self.hasher = hashlib.sha256()  # 视频内容哈希，随上传增量计算
+        self.failed = False  # ffmpeg 提前退出（例如 moov 在文件末尾的 mp4 无法从管道解析）
+
+    async def feed(self, chunk: bytes):
+        """送入一块上传数据"""
+        self.hasher.update(chunk)
+        if self.failed:
+            return
+        try:
+            self.process.stdin.write(chunk)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            self.failed = True
+
+    async def close(self) -> bool:
+        """结束输入并等待 ffmpeg 退出，返回是否成功"""
+        try:
+            self.process.stdin.close()
+        except Exception:
+            pass
+        _, stderr = await self.process.communicate()
+        if self.process.returncode != 0:
+            self.failed = True
+            logger.debug(f"增量抽帧失败，将在上传完成后改用文件抽帧: {stderr.decode(errors='ignore')[-300:]}")
+        return not self.failed
+
+    def abort(self):
+        """上传失败时终止 ffmpeg"""
+        if self.process.returncode is None:
+            self.process.kill()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+# 定义 KeyframeExtractor 类，从视频中抽取代表性关键帧
+class KeyframeExtractor:
+    """基于场景切换的视频关键帧抽取
+
+    上传时把数据同时送入 ffmpeg，边上传边抽帧；管道输入无法解析时（例如 moov 在末尾的 mp4），
+    上传完成后改为从文件抽帧。关键帧按视频内容哈希保存在 frames_dir 下，重复上传和重启后都可复用。
+    """
+
+    def __init__(self, frames_dir: str, max_frames: int = 6, scene_threshold: float = 0.3,
+                 workers: int = 2, ffmpeg: Optional[str] = None, max_width: int = 1280):
+        self.frames_dir = frames_dir  # 关键帧缓存目录
+        self.max_frames = max_frames  # 每个视频保留的关键帧数
+        self.scene_threshold = scene_threshold  # 场景切换阈值（0~1，越小越敏感）
+        self.workers = workers  # 同时运行的 ffmpeg 进程数上限
+        self.ffmpeg = ffmpeg or shutil.which("ffmpeg")  # ffmpeg 可执行文件
+        self.max_width = max_width  # 关键帧最大宽度
+        self._active = 0  # 运行中的 ffmpeg 进程数
+        self._slots = asyncio.Semaphore(workers)  # 文件抽帧的并发限制
+        self._digests: Dict[str, str] = {}  # 视频路径 -> 内容哈希
+        self._tasks: Dict[str, asyncio.Task] = {}  # 视频路径 -> 进行中的抽帧任务
+        os.makedirs(frames_dir, exist_ok=True)
+        if not self.ffmpeg:
+            logger.warning("未找到 ffmpeg，视频关键帧抽取不可用")
+
+    @property
+    def available(self) -> bool:
+        return bool(self.ffmpeg)
+
+    def _command(self, source: str, out_dir: str) -> List[str]:
+        """场景切换抽帧命令：首帧加上所有场景切换帧，候选帧数量有上限"""
+        vf = (f"select='eq(n\\,0)+gt(scene\\,{self.scene_threshold})',"
+              f"scale='min({self.max_width}\\,iw)':-2")
+        # 从文件抽帧时不读取标准输入
+        stdin_flags = [] if source == "pipe:0" else ["-nostdin"]
+        return [
+            self.ffmpeg, "-hide_banner", "-loglevel", "error", *stdin_flags,
+            "-i", source, "-vf", vf, "-vsync", "vfr",
+            "-frames:v", str(self.max_frames * 8), "-q:v", "3",
+            os.path.join(out_dir, "cand_%04d.jpg"),
+        ]
+
+    def _frame_dir(self, digest: str) -> str:
+        return os.path.join(self.frames_dir, digest)
+
+    @staticmethod
+    def _list_frames(directory: str) -> List[str]:
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".jpg")]
+
+    def _select(self, tmp_dir: str, digest: str) -> List[str]:
+        """从候选帧中均匀选出 max_frames 帧，移动到按哈希命名的缓存目录"""
+        candidates = self._list_frames(tmp_dir)
+        if not candidates:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return []
+        if len(candidates) > self.max_frames:
+            step = (len(candidates) - 1) / max(1, self.max_frames - 1)
+            candidates = [candidates[round(i * step)] for i in range(self.max_frames)]
+        final_dir = self._frame_dir(digest)
+        if os.path.isdir(final_dir):
+            # 相同内容的视频已抽过帧
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return self._list_frames(final_dir)
+        keep = set(candidates)
+        for path in self._list_frames(tmp_dir):
+            if path not in keep:
+                os.remove(path)
+        os.replace(tmp_dir, final_dir)
+        return self._list_frames(final_dir)
+
+    def _tmp_dir(self) -> str:
+        path = os.path.join(self.frames_dir, f".tmp-{uuid.uuid4().hex}")
+        os.makedirs(path)
+        return path
+
+    async def start_stream(self) -> Optional[_ExtractionStream]:
+        """开始一次边上传边抽帧，ffmpeg 不可用或进程数已满时返回 None（改为上传完成后抽帧）"""
+        if not self.available or self._active >= self.workers:
+            return None
+        tmp_dir = self._tmp_dir()
+        process = await asyncio.create_subprocess_exec(
+            *self._command("pipe:0", tmp_dir),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self._active += 1
+        return _ExtractionStream(process, tmp_dir)
+
+    async def _extract_file(self, path: str, digest: str) -> List[str]:
+        """从完整的视频文件抽帧"""
+        async with self._slots:
+            tmp_dir = self._tmp_dir()
+            process = await asyncio.create_subprocess_exec(
+                *self._command(path, tmp_dir),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            _, stderr = await process.communicate()
+            if process.returncode != 0:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise Exception(f"视频抽帧失败: {stderr.decode(errors='ignore')[-300:]}")
+            frames = await asyncio.to_thread(self._select, tmp_dir, digest)
+        metrics.incr("video_keyframes_extracted", mode="file")
+        return frames
+
+    async def _finish(self, path: str, stream: Optional[_ExtractionStream]) -> List[str]:
+        """完成抽帧：优先使用上传时的增量结果，失败时从文件重新抽帧"""
+        if stream is not None:
+            try:
+                ok = await stream.close()
+            finally:
+                self._active -= 1
+            digest = stream.hasher.hexdigest()
+            self._digests[path] = digest
+            if ok:
+                frames = await asyncio.to_thread(self._select, stream.tmp_dir, digest)
+                if frames:
+                    metrics.incr("video_keyframes_extracted", mode="stream")
+                    return frames
+            shutil.rmtree(stream.tmp_dir, ignore_errors=True)
+        else:
+            digest = await asyncio.to_thread(_hash_file, path)
+            self._digests[path] = digest
+        cached = self._list_frames(self._frame_dir(digest))
+        if cached:
+            metrics.incr("video_keyframe_cache_hits")
+            return cached
+        return await self._extract_file(path, digest)
+
+    def abort(self, stream: _ExtractionStream):
+        """上传失败时放弃增量抽帧"""
+        stream.abort()
+        self._active -= 1
+
+    def schedule(self, path: str, stream: Optional[_ExtractionStream] = None):
+        """上传完成后在后台完成抽帧"""
+        if not self.available:
+            return
+        task = asyncio.ensure_future(self._finish(path, stream))
+        self._tasks[path] = task
+
+        def _done(t: asyncio.Task):
+            if self._tasks.get(path) is t:
+                del self._tasks[path]
+            if not t.cancelled() and t.exception() is not None:
+                logger.error(f"视频关键帧抽取失败: {path}: {str(t.exception())}")
+
+        task.add_done_callback(_done)
+
+    async def frames_for(self, path: str) -> List[str]:
+        """获取视频的关键帧路径，抽帧仍在进行时等待其完成"""
+        if not self.available:
+            return []
+        task = self._tasks.get(path)
+        if task is not None:
+            return await asyncio.shield(task)
+        digest = self._digests.get(path)
+        if digest:
+            frames = self._list_frames(self._frame_dir(digest))
+            if frames:
+                return frames
+        # 重启后首次访问，或上传时未抽帧
+        return await self._finish(path, None)
@@ -0,0 +1,106 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于并发预热各提供商
+import asyncio
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 time 模块，用于计时
+import time
+# 从 typing 模块导入类型提示
+from typing import Dict, Optional
+
+# 导入运行指标记录模块
+from metrics import metrics
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+# 探测请求的内容
+PROBE_MESSAGES = [{"role": "user", "content": "ping"}]
+
+
+# 定义 ProviderWarmer 类，在服务启动时预热已配置的提供商
+class ProviderWarmer:
+    """启动预热
+
+    为每个已配置的提供商建立连接并放入连接池、获取鉴权令牌（百度）或生成 JWT（智谱），
+    probe=True 时再以 max_tokens=1 发一次聊天请求，确认密钥和模型可用。
+    预热结束（无论各提供商是否成功）后 ready 为 True；单个提供商失败只记录在状态中，
+    避免某个提供商故障时所有 worker 都无法就绪。
+    """
+
+    def __init__(self, mcp, probe: bool = False, timeout: float = 10.0, enabled: bool = True):
+        self.mcp = mcp  # MCP 实例
+        self.probe = probe  # 是否发送探测请求
+        self.timeout = timeout  # 单个提供商预热的最长时间（秒）
+        self.enabled = enabled  # 关闭时直接视为就绪
+        self.ready = not enabled  # 预热是否已结束
+        self.providers: Dict[str, dict] = {}  # 提供商名称 -> 预热结果
+        self.started_at: Optional[float] = None
+        self.elapsed: Optional[float] = None  # 整个预热过程的耗时（秒）
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """在后台开始预热（在 FastAPI lifespan 中、配置加载后调用）"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """并发预热当前路由快照中的所有提供商"""
+        self.started_at = time.monotonic()
+        try:
+            with self.mcp.pin_routes() as routes:
+                names = list(routes.providers)
+                await asyncio.gather(*(self._warm(name, routes.providers[name]) for name in names))
+        finally:
+            self.elapsed = time.monotonic() - self.started_at
+            self.ready = True
+        warm = sum(1 for result in self.providers.values() if result["status"] == "warm")
+        logger.info(f"启动预热完成: {warm}/{len(names)} 个提供商，耗时 {self.elapsed:.2f} 秒")
+
+    async def _warm(self, name: str, adapter):
+        """预热单个提供商，失败时记录错误"""
+        started = time.monotonic()
+        self.providers[name] = {"status": "warming"}
+        try:
+            await asyncio.wait_for(adapter.warm_up(), self.timeout)
+            result = {"status": "warm", "connect_seconds": round(time.monotonic() - started, 3)}
+            if self.probe:
+                probe_started = time.monotonic()
+                await asyncio.wait_for(self.mcp.complete(PROBE_MESSAGES, name, max_tokens=1, consumer="warmup"),
+                                       self.timeout)
+                result["probe_seconds"] = round(time.monotonic() - probe_started, 3)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"提供商 {name} 预热失败: {str(e) or type(e).__name__}")
+            result = {"status": "failed", "error": str(e) or type(e).__name__}
+        self.providers[name] = result
+        metrics.incr("warmup", provider=name, status=result["status"])
+
+    def status(self) -> dict:
+        return {"ready": self.ready, "enabled": self.enabled, "probe": self.probe,
+                "elapsed": round(self.elapsed, 3) if self.elapsed is not None else None,
+                "providers": dict(self.providers)}
+
+    async def close(self):
+        """取消未完成的预热"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
@@ -0,0 +1,267 @@
+# This file is part of BaiyuAISpace.
+# Copyright (C) 2025 白Bai_YU雨
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+
+
+# 导入 asyncio 模块，用于并发处理多路会话
+import asyncio
+# 导入 json 模块，用于解析客户端帧
+import json
+# 导入 logging 模块，用于日志记录
+import logging
+# 导入 uuid 模块，用于生成请求ID
+import uuid
+# 从 typing 模块导入类型提示
+from typing import Dict, Optional
+
+# 从 fastapi 导入 WebSocket 相关类型
+from fastapi import WebSocket, WebSocketDisconnect
+
+# 导入准入控制模块
+from admission import AdmissionRejected, PRIORITY_CLASSES, DEFAULT_PRIORITY
+# 导入运行指标记录模块
+from metrics import metrics
+# 导入请求截止时间
+from timeouts import Deadline, DeadlineExceeded
+
+# 获取一个 logger 实例，用于记录日志
+logger = logging.getLogger(__name__)
+
+
+def _check_fields(frame: dict) -> Optional[str]:
+    """校验客户端帧中的字段类型，返回错误说明，字段有效时返回 None"""
+    for name in ("request_id", "history_id"):
+        if frame.get(name) is not None and not isinstance(frame[name], str):
+            return f"{name} 必须是字符串"
+    for name in ("seq", "window"):
+        value = frame.get(name)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+            return f"{name} 必须是非负整数"
+    return None
+
+
+# 单路会话流的状态
+class _Stream:
+    def __init__(self, stream_id: str, request_id: str, window: Optional[int]):
+        self.stream_id = stream_id  # 会话流ID（history_id 或 request_id）
+        self.request_id = request_id  # 当前请求ID
+        self.window = window  # 流控窗口：未确认的增量帧上限，None 表示不做流控
+        self.seq = 0  # 已发送的增量帧序号
+        self.acked = 0  # 客户端已确认的序号
+        self.credit = asyncio.Event()  # 窗口有余量时置位
+        self.credit.set()
+        self.task: Optional[asyncio.Task] = None  # 执行上游请求的任务
+
+    def ack(self, seq: int):
+        """处理客户端确认"""
+        if seq > self.acked:
+            self.acked = seq
+        if self.window is None or self.seq - self.acked < self.window:
+            self.credit.set()
+
+    async def wait_credit(self):
+        """流控：未确认帧达到窗口上限时等待客户端确认"""
+        if self.window is not None and self.seq - self.acked >= self.window:
+            self.credit.clear()
+            await self.credit.wait()
+
+
+# 定义 ChatSocketSession 类，在一条 WebSocket 连接上复用多路聊天会话
+class ChatSocketSession:
+    """/ws/chat 的连接会话
+
+    客户端帧（JSON）：
+      {"type": "chat", "request_id", "history_id", "messages", "model", "file_urls", "priority", "window", "timeout"}
+      {"type": "cancel", "request_id" 或 "history_id"}
+      {"type": "ack", "request_id", "seq"}
+      {"type": "ping"}
+    服务端帧（JSON）：
+      accepted / delta(seq, content) / done(content) / error(status, detail, retry_after) / cancelled(reason) / pong
+    同一 history_id 上的新请求会取消仍在进行的旧请求（reason=superseded）。
+    """
+
+    def __init__(self, websocket: WebSocket, mcp, chat_history, consumer: Optional[str] = None,
+                 max_streams: int = 8, compactor=None):
+        self.websocket = websocket  # WebSocket 连接
+        self.mcp = mcp  # MCP 实例，用于路由请求
+        self.chat_history = chat_history  # 聊天历史记录管理实例
+        self.consumer = consumer  # 调用方标识，用于准入配额
+        self.max_streams = max_streams  # 单个连接上的最大并发会话数
+        self.compactor = compactor  # 长对话摘要，None 表示不压缩
+        self.streams: Dict[str, _Stream] = {}  # 进行中的会话流，键为 stream_id
+        self._send_lock = asyncio.Lock()  # 保证帧按完整消息发送
+
+    async def send(self, frame: dict):
+        """发送一帧"""
+        async with self._send_lock:
+            await self.websocket.send_json(frame)
+
+    def _find_stream(self, frame: dict) -> Optional[_Stream]:
+        """按 history_id 或 request_id 查找会话流"""
+        key = frame.get("history_id") or frame.get("request_id")
+        if key in self.streams:
+            return self.streams[key]
+        for stream in self.streams.values():
+            if stream.request_id == frame.get("request_id"):
+                return stream
+        return None
+
+    async def run(self):
+        """接收并分发客户端帧，直到连接关闭"""
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+                # 二进制等非文本帧不中断连接，回复错误帧
+                if not isinstance(message.get("text"), str):
+                    await self.send({"type": "error", "status": 400, "detail": "只支持文本帧"})
+                    continue
+                try:
+                    frame = json.loads(message["text"])
+                except json.JSONDecodeError:
+                    await self.send({"type": "error", "status": 400, "detail": "帧不是有效的JSON"})
+                    continue
+                frame_type = frame.get("type") if isinstance(frame, dict) else None
+                invalid = _check_fields(frame) if frame_type else None
+                if invalid:
+                    error = {"type": "error", "status": 400, "detail": invalid}
+                    if isinstance(frame.get("request_id"), str):
+                        error["request_id"] = frame["request_id"]
+                    await self.send(error)
+                elif frame_type == "chat":
+                    await self._start_chat(frame)
+                elif frame_type == "cancel":
+                    stream = self._find_stream(frame)
+                    if stream:
+                        self._cancel_stream(stream)
+                        await self.send({"type": "cancelled", "request_id": stream.request_id, "reason": "client"})
+                elif frame_type == "ack":
+                    stream = self._find_stream(frame)
+                    if stream:
+                        stream.ack(frame.get("seq") or 0)
+                elif frame_type == "ping":
+                    await self.send({"type": "pong"})
+                else:
+                    await self.send({"type": "error", "status": 400, "detail": f"未知的帧类型: {frame_type}"})
+        except WebSocketDisconnect:
+            pass
+        finally:
+            # 连接断开，取消所有仍在进行的上游请求
+            for stream in list(self.streams.values()):
+                metrics.incr("chat_requests_cancelled", reason="websocket_closed", provider=self.mcp.current_provider or "")
+                self._cancel_stream(stream)
+
+    def _cancel_stream(self, stream: _Stream):
+        """取消会话流的上游任务"""
+        if stream.task and not stream.task.done():
+            stream.task.cancel()
+        if self.streams.get(stream.stream_id) is stream:
+            del self.streams[stream.stream_id]
+
+    async def _start_chat(self, frame: dict):
+        """启动一路聊天请求"""
+        request_id = frame.get("request_id") or str(uuid.uuid4())
+        history_id = frame.get("history_id")
+        messages = frame.get("messages")
+        priority = frame.get("priority") or DEFAULT_PRIORITY
+        if not isinstance(messages, list) or not messages:
+            await self.send({"type": "error", "request_id": request_id, "status": 400, "detail": "消息列表为空或格式不正确"})
+            return
+        if priority not in PRIORITY_CLASSES:
+            await self.send({"type": "error", "request_id": request_id, "status": 400, "detail": f"未知的优先级类别: {priority}"})
+            return
+        # timeout 为本次请求的时间预算（秒），从收到请求帧开始计算
+        try:
+            deadline = Deadline.parse(frame.get("timeout"))
+        except ValueError as e:
+            await self.send({"type": "error", "request_id": request_id, "status": 400, "detail": str(e)})
+            return
+
+        stream_id = history_id or request_id
+        previous = self.streams.get(stream_id)
+        if previous:
+            # 同一会话上的新请求取代旧请求
+            self._cancel_stream(previous)
+            metrics.incr("chat_requests_cancelled", reason="superseded", provider=self.mcp.current_provider or "")
+            await self.send({"type": "cancelled", "request_id": previous.request_id, "reason": "superseded"})
+        elif len(self.streams) >= self.max_streams:
+            await self.send({"type": "error", "request_id": request_id, "status": 429,
+                             "detail": f"单个连接最多同时进行 {self.max_streams} 路会话"})
+            return
+
+        stream = _Stream(stream_id, request_id, frame.get("window") or None)
+        self.streams[stream_id] = stream
+        stream.task = asyncio.ensure_future(self._run_chat(stream, frame, history_id, messages, priority,
+                                                         deadline))
+        await self.send({"type": "accepted", "request_id": request_id, "history_id": history_id})
+
+    async def _run_chat(self, stream: _Stream, frame: dict, history_id: Optional[str], messages: list, priority: str,
+                        deadline: Optional[Deadline] = None):
+        """执行上游流式请求，并把增量文本作为帧推送给客户端"""
+        request_id = stream.request_id
+        try:
+            # 只保存最后一条用户消息，避免重复
+            if history_id:
+                for msg in reversed(messages):
+                    if isinstance(msg, dict) and msg.get('role') == 'user':
+                        # 写入共享存储可能等待其他 worker 的写锁，放到线程中执行，不阻塞其他会话
+                        await asyncio.to_thread(self.chat_history.add_message, history_id, msg)
+                        break
+
+            if self.compactor is not None:
+                messages = self.compactor.assemble(history_id, messages)
+
+            file_urls = frame.get("file_urls") if isinstance(frame.get("file_urls"), list) else None
+            parts = []
+            async for chunk in self.mcp.stream_request(messages, frame.get("model", "default"),
+                                                       file_urls=file_urls, priority=priority,
+                                                       consumer=self.consumer, conversation=history_id,
+                                                       deadline=deadline):
+                await stream.wait_credit()
+                stream.seq += 1
+                parts.append(chunk)
+                await self.send({"type": "delta", "request_id": request_id, "seq": stream.seq, "content": chunk})
+
+            content = "".join(parts)
+            if history_id:
+                await asyncio.to_thread(self.chat_history.add_message, history_id,
+                                        {"role": "assistant", "content": content})
+                if self.compactor is not None:
+                    self.compactor.schedule(history_id)
+            await self.send({"type": "done", "request_id": request_id, "history_id": history_id, "content": content})
+        except asyncio.CancelledError:
+            raise
+        except AdmissionRejected as e:
+            await self._send_error(request_id, e.status_code, e.reason, retry_after=e.retry_after)
+        except DeadlineExceeded as e:
+            await self._send_error(request_id, 504, str(e))
+        except Exception as e:
+            logger.error(f"WebSocket聊天请求失败: {str(e)}")
+            await self._send_error(request_id, 500, f"聊天请求处理失败: {str(e)}")
+        finally:
+            if self.streams.get(stream.stream_id) is stream:
+                del self.streams[stream.stream_id]
+
+    async def _send_error(self, request_id: str, status: int, detail: str, retry_after: Optional[int] = None):
+        """发送错误帧，连接已断开时忽略"""
+        frame = {"type": "error", "request_id": request_id, "status": status, "detail": detail}
+        if retry_after is not None:
+            frame["retry_after"] = retry_after
+        try:
+            await self.send(frame)
+        except Exception:
+            pass